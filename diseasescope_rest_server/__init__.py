@@ -13,6 +13,7 @@ import json
 import shutil
 import time
 import copy
+import math
 import flask
 
 from flask import Flask, jsonify, request
@@ -21,6 +22,10 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 from diseasescope_rest_server import dao
+from diseasescope_rest_server import profiling
+from diseasescope_rest_server import tracing
+from diseasescope_rest_server import estimate
+from diseasescope_rest_server import archive
 
 desc = """DiseaseScope REST Server
 
@@ -48,20 +53,34 @@ JOB_PATH_KEY = 'JOB_PATH'
 WAIT_COUNT_KEY = 'WAIT_COUNT'
 SLEEP_TIME_KEY = 'SLEEP_TIME'
 DEFAULT_RATE_LIMIT_KEY = 'DEFAULT_RATE_LIMIT'
+# number of tasks all task runners process at once, used to
+# estimate when submitted tasks start
+RUNNER_SLOTS_KEY = 'RUNNER_SLOTS'
+# layout of task directories, with SHARD_DEPTH of 0 tasks are stored
+# under <state>/<remote ip>/<uuid>, otherwise under SHARD_DEPTH
+# directories named after SHARD_WIDTH character slices of the uuid,
+# ie <state>/<uuid[0:2]>/<uuid[2:4]>/<uuid>. Task runners must be
+# started with the same layout
+SHARD_DEPTH_KEY = 'SHARD_DEPTH'
+SHARD_WIDTH_KEY = 'SHARD_WIDTH'
 
 app.config[JOB_PATH_KEY] = '/tmp'
 app.config[WAIT_COUNT_KEY] = 60
 app.config[SLEEP_TIME_KEY] = 10
 app.config[DEFAULT_RATE_LIMIT_KEY] = '360 per hour'
+app.config[RUNNER_SLOTS_KEY] = 1
+app.config[SHARD_DEPTH_KEY] = 0
+app.config[SHARD_WIDTH_KEY] = dao.DEFAULT_SHARD_WIDTH
 
 app.config.from_envvar(DISEASESCOPE_REST_SETTINGS_ENV, silent=True)
 app.logger.info('Job Path dir: ' + app.config[JOB_PATH_KEY])
 SERVICE_NS = 'diseasescope'
 
 LOCATION = 'Location'
+RETRY_AFTER = 'Retry-After'
 
 ERROR_PARAM = 'error'
-REMOTEIP_PARAM = 'remoteip'
+REMOTEIP_PARAM = dao.REMOTEIP_PARAM
 
 
 api = Api(app, version=str(__version__),
@@ -131,6 +150,17 @@ def get_delete_request_dir():
     """
     return os.path.join(app.config[JOB_PATH_KEY], dao.DELETE_REQUESTS)
 
+
+def get_task_layout():
+    """
+    Gets layout of task directories set by SHARD_DEPTH and
+    SHARD_WIDTH in configuration
+    :return: :py:class:`~dao.TaskLayout`
+    """
+    return dao.TaskLayout(shard_depth=app.config[SHARD_DEPTH_KEY],
+                          shard_width=app.config[SHARD_WIDTH_KEY])
+
+
 def milliseconds_since_epoch(curtime):
     """
 
@@ -144,7 +174,8 @@ def create_task(params):
     """
     Creates a task by consuming data from request_obj passed in
     and persisting that information to the filesystem under
-    JOB_PATH/SUBMIT_DIR/<IP ADDRESS>/UUID with various parameters
+    JOB_PATH/SUBMIT_DIR/<IP ADDRESS>/UUID, or the sharded path
+    given by :py:func:`get_task_layout`, with various parameters
     stored in TASK_JSON file and if the 'network' file is set
     that data is dumped to NETWORK_DATA file within the directory
     :param request_obj:
@@ -156,8 +187,10 @@ def create_task(params):
     params['progress'] = 0
     params['wallTime'] = 0
     params['submitTime'] = milliseconds_since_epoch(datetime.utcnow())
-    taskpath = os.path.join(get_submit_dir(), str(params[REMOTEIP_PARAM]),
-                            str(params['uuid']))
+    taskpath = get_task_layout().get_taskdir(app.config[JOB_PATH_KEY],
+                                             dao.SUBMITTED_STATUS,
+                                             str(params['uuid']),
+                                             ipaddr=params[REMOTEIP_PARAM])
     try:
         original_umask = os.umask(0)
         os.makedirs(taskpath, mode=0o775)
@@ -220,18 +253,58 @@ def get_task(uuidstr, iphintlist=None, basedir=None):
 
     # Todo: Add logic to leverage iphintlist
     # Todo: Add a retry if not found with small delay in case of dir is moving
-    for entry in os.listdir(basedir):
-        ip_path = os.path.join(basedir, entry)
-        if not os.path.isdir(ip_path):
-            continue
-        for subentry in os.listdir(ip_path):
-            if uuidstr != subentry:
-                continue
-            taskpath = os.path.join(ip_path, subentry)
+    return get_task_layout().find_taskdir(basedir, uuidstr)
+
+
+def find_task(uuidstr):
+    """
+    Looks for task in submitted, processing and done directories
+    :param uuidstr: uuid string for task
+    :return: tuple (state of task, full path to task) or
+             (None, None) if not found
+    """
+    for status, basedir in [(dao.SUBMITTED_STATUS, get_submit_dir()),
+                            (dao.PROCESSING_STATUS, get_processing_dir()),
+                            (dao.DONE_STATUS, get_done_dir())]:
+        taskpath = get_task(uuidstr, basedir=basedir)
+        if taskpath is not None:
+            return status, taskpath
+    return None, None
+
 
-            if os.path.isdir(taskpath):
-                return taskpath
-    return None
+# QueueEstimator of each job path, kept so its index of
+# queued tasks is reused across requests
+_estimators = {}
+
+
+def get_queue_estimator():
+    """
+    Gets QueueEstimator of tasks under job path
+    :return: :py:class:`~estimate.QueueEstimator`
+    """
+    key = (app.config[JOB_PATH_KEY], app.config[RUNNER_SLOTS_KEY],
+           app.config[SHARD_DEPTH_KEY], app.config[SHARD_WIDTH_KEY])
+    if key not in _estimators:
+        _estimators[key] = estimate.QueueEstimator(
+            app.config[JOB_PATH_KEY], slots=app.config[RUNNER_SLOTS_KEY],
+            layout=get_task_layout())
+    return _estimators[key]
+
+
+# TaskArchive of each job path, kept so its index of
+# archived tasks is reused across requests
+_archives = {}
+
+
+def get_task_archive():
+    """
+    Gets archive of old done tasks under job path
+    :return: :py:class:`~archive.TaskArchive`
+    """
+    key = app.config[JOB_PATH_KEY]
+    if key not in _archives:
+        _archives[key] = archive.TaskArchive(archive.get_archive_dir(key))
+    return _archives[key]
 
 
 ERROR_RESP = api.model('ErrorResponseSchema', {
@@ -291,6 +364,10 @@ class RunDiseaseScope(Resource):
     """
     POST_HEADERS = copy.deepcopy(RATE_LIMIT_HEADERS)
     POST_HEADERS['Location'] = 'URL containing resource/result generated by this request'
+    POST_HEADERS[tracing.TRACE_ID_HEADER] = 'Id of trace of task, taken ' \
+                                            'from traceparent or ' \
+                                            'X-Trace-Id header of ' \
+                                            'request if set'
 
     taskres_obj = api.model('Task', {
         'id': fields.String(description='id of task',
@@ -316,6 +393,11 @@ class RunDiseaseScope(Resource):
         dao.HIVIEWURL_PARAM: fields.String('http://hiview-test.ucsd.edu',
                                        description='HiView server to use',
                                        example='http://hiview-test.ucsd.edu'),
+        dao.PROFILE_PARAM: fields.Boolean(
+            description='If true, pipeline stages are profiled and '
+                        'profiles can be downloaded from <id>/profile/' +
+                        profiling.PROFILE_SUMMARY_FILE,
+            example=False),
     })
 
     @api.doc('Runs DiseaseScope')
@@ -355,12 +437,15 @@ class RunDiseaseScope(Resource):
                 return marshal(er, ERROR_RESP), 400
 
             thereq['remoteip'] = request.remote_addr
+            trace_id = tracing.get_trace_id_from_headers(request.headers)
+            thereq[dao.TRACE_ID_KEY] = trace_id
             res = create_task(thereq)
 
             task = TaskResponse()
             task.id = res
             return (marshal(task, RunDiseaseScope.taskres_obj), 202,
-                    {LOCATION: SERVICE_NS + '/' + res})
+                    {LOCATION: SERVICE_NS + '/' + res,
+                     tracing.TRACE_ID_HEADER: trace_id})
         except OSError as ea:
             app.logger.exception('Error creating task due to OSError ' +
                                  str(ea))
@@ -407,30 +492,69 @@ class GetQueryResult(Resource):
                                    example=341),
         'submitTime': fields.Integer(description='Submit time in milliseconds since epoch',
                                      example=1560806575),
+        'queueWaitTime': fields.Integer(description='Time in milliseconds '
+                                                    'query waited before '
+                                                    'processing started',
+                                        example=1200),
+        'stages': fields.Raw(
+            description='Map of pipeline stage name to timing of stage '
+                        'with startTime (milliseconds since epoch), '
+                        'duration and queueWait (milliseconds), '
+                        'inputSize and outputSize (number of genes, '
+                        'edges) and cached (true if output came from '
+                        'cache)',
+            example={'get_disease_genes': {
+                'startTime': 1560806576,
+                'duration': 2500,
+                'queueWait': 0,
+                'inputSize': {},
+                'outputSize': {'disease_genes': 120},
+                'cached': False}}),
         'status': fields.String(description='One of the following <' +
                                             ' | '.join(dao.STATUS_LIST) + '>',
-                                example=dao.DONE_STATUS)
+                                example=dao.DONE_STATUS),
+        estimate.QUEUE_POSITION_KEY: fields.Integer(
+            description='Position of submitted task in queue, 1 is next '
+                        'to run and 0 means task is processing',
+            example=3),
+        estimate.ESTIMATED_START_TIME_KEY: fields.Integer(
+            description='Estimated start time of task in milliseconds '
+                        'since epoch, null if unknown',
+            example=1560806675000),
+        estimate.ESTIMATED_FINISH_TIME_KEY: fields.Integer(
+            description='Estimated finish time of task in milliseconds '
+                        'since epoch, null if unknown',
+            example=1560807275000),
+        estimate.POLL_INTERVAL_KEY: fields.Integer(
+            description='Suggested time in milliseconds to wait before '
+                        'polling again, also set in seconds in the '
+                        'Retry-After header',
+            example=30000)
     })
 
-    @api.response(200, 'Successful response from server', completeresultobj)
+    @api.response(200, 'Successful response from server', completeresultobj,
+                  headers={RETRY_AFTER: 'Suggested time in seconds to wait '
+                                        'before polling again, set if task '
+                                        'is submitted or processing'})
     @api.response(410, 'Task not found')
     @api.response(429, 'Too many requests', TOO_MANY_REQUESTS)
     @api.response(500, 'Internal server error', ERROR_RESP)
     def get(self, id):
         """
         Gets the status and results of a DiseaseScope task
+
+        For submitted and processing tasks the queue position, estimated
+        start and finish time and a suggested poll interval are included.
+        Estimates are based on recent stage durations and are approximate.
+        Results of old tasks moved to the archive are still returned
         """
         cleanid = id.strip()
 
-        taskpath = get_task(cleanid, basedir=get_submit_dir())
-
-        if taskpath is None:
-            taskpath = get_task(cleanid, basedir=get_processing_dir())
-
-        if taskpath is None:
-            taskpath = get_task(cleanid, basedir=get_done_dir())
-
+        status, taskpath = find_task(cleanid)
         if taskpath is None:
+            data = get_task_archive().get_task(cleanid)
+            if data is not None:
+                return jsonify(data)
             resp = flask.make_response()
             resp.status_code = 410
             return resp
@@ -451,7 +575,37 @@ class GetQueryResult(Resource):
         with open(result, 'r') as f:
             data = json.load(f)
 
-        return jsonify(data)
+        if dao.STATUS_RESULT_KEY not in data:
+            # tasks in error state are stored with done tasks
+            # and have no result
+            if status == dao.DONE_STATUS and 'result' not in data:
+                status = dao.ERROR_STATUS
+            data[dao.STATUS_RESULT_KEY] = status
+        headers = {}
+        if data[dao.STATUS_RESULT_KEY] in [dao.SUBMITTED_STATUS,
+                                           dao.PROCESSING_STATUS]:
+            self._add_estimate(cleanid, data)
+            if estimate.POLL_INTERVAL_KEY in data:
+                headers[RETRY_AFTER] = str(int(math.ceil(
+                    data[estimate.POLL_INTERVAL_KEY] / 1000.0)))
+        resp = jsonify(data)
+        resp.headers.extend(headers)
+        return resp
+
+    def _add_estimate(self, uuidstr, data):
+        """
+        Adds queue position, estimated start and finish time and
+        poll interval of task to **data**, logging any error
+        :param uuidstr: id of task
+        :param data: status of task
+        :return: None
+        """
+        try:
+            data.update(get_queue_estimator().get_estimate(
+                uuidstr, data[dao.STATUS_RESULT_KEY], taskdict=data))
+        except Exception:
+            app.logger.exception('Caught exception estimating start and '
+                                 'finish of task ' + uuidstr)
 
     def _get_task_parameters(self, taskpath):
         """
@@ -504,6 +658,9 @@ class GetQueryResult(Resource):
             with open(os.path.join(req_dir, cleanid), 'w') as f:
                 f.write(request.remote_addr)
                 f.flush()
+            # archived tasks have no task directory for the task
+            # runner to delete, so they are deleted from archive here
+            get_task_archive().delete(cleanid)
             resp.status_code = 200
             return resp
         except Exception as e:
@@ -513,6 +670,34 @@ class GetQueryResult(Resource):
             return marshal(er, ERROR_RESP), 500
 
 
+@ns.route('/<string:id>/profile/<string:name>', strict_slashes=False)
+class GetTaskProfile(Resource):
+    """
+    Profiles of pipeline stages of task
+    """
+    @api.response(200, 'Profile file')
+    @api.response(404, 'Task or profile not found')
+    @api.response(429, 'Too many requests', TOO_MANY_REQUESTS)
+    def get(self, id, name):
+        """
+        Gets profile of a task submitted with profile set to true
+
+        **name** is profile.json for wall time, CPU time, peak memory
+        and slowest functions of each stage or profile.<stage>.pstats
+        for the cProfile output of a stage
+        """
+        resp = flask.make_response()
+        resp.status_code = 404
+        if not profiling.is_profile_file(name):
+            return resp
+        status, taskpath = find_task(id.strip())
+        if (taskpath is None or
+                not os.path.isfile(os.path.join(taskpath, name))):
+            return resp
+        return flask.send_from_directory(taskpath, name,
+                                         as_attachment=True)
+
+
 class ServerStatus(object):
     """Represents status of server
     """
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+"""Archive of old done tasks packed into daily segment files"""
+import os
+import json
+import time
+import zlib
+import fcntl
+import logging
+import threading
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server.dao import FileBasedTask
+from diseasescope_rest_server.dao import TaskLayout
+
+logger = logging.getLogger(__name__)
+
+
+# directory under base directory of tasks holding archive
+ARCHIVE_DIR = 'archive'
+
+# segment files hold zlib compressed result of each archived task
+# one after another, index files hold one line per task of form
+# <uuid> <offset> <length> locating its result in the segment
+# of the same day
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+# file locked by archiver so only one appends to archive at a time
+LOCK_FILE = 'archive.lock'
+
+# file listing ids of archived tasks that were deleted, one per line.
+# Each id is appended with a single write by whoever handles the
+# delete request, so no lock is needed
+DELETED_FILE = 'deleted.log'
+
+# number of seconds in a day
+DAY_SECONDS = 86400
+
+
+def get_archive_dir(taskdir):
+    """
+    Gets directory of archive
+    :param taskdir: base directory of tasks
+    :return: path
+    """
+    return os.path.join(taskdir, ARCHIVE_DIR)
+
+
+def get_day(timestamp):
+    """
+    Gets name of segment of tasks finished at **timestamp**
+    :param timestamp: time in seconds since epoch
+    :return: UTC date as str of form YYYYMMDD
+    """
+    return time.strftime('%Y%m%d', time.gmtime(timestamp))
+
+
+class TaskArchive(object):
+    """
+    Results of done tasks packed into one segment file per day
+    with an index of where in the segment each result is. The
+    index of all segments is kept in memory and new index lines
+    are read when a task is not found, so a result is read
+    with a single seek and read of its segment. Deleted tasks
+    are listed in :py:const:`DELETED_FILE` and no longer returned,
+    their results stay in the segment
+    """
+    def __init__(self, archivedir):
+        """
+        Constructor
+        :param archivedir: directory of archive
+        """
+        self._archivedir = archivedir
+        self._index = {}
+        self._sizes = {}
+        self._deleted = set()
+        self._deleted_size = 0
+        self._lock = threading.Lock()
+
+    def get_archive_dir(self):
+        """
+        Gets directory of archive
+        :return:
+        """
+        return self._archivedir
+
+    def refresh(self):
+        """
+        Reads lines appended to index files since last refresh
+        :return: number of index lines read
+        """
+        try:
+            with os.scandir(self._archivedir) as it:
+                entries = [e for e in it if e.name.endswith(INDEX_SUFFIX)]
+        except OSError:
+            return 0
+        count = 0
+        with self._lock:
+            for entry in entries:
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    continue
+                if size == self._sizes.get(entry.name, 0):
+                    continue
+                count += self._read_index(entry.name, entry.path)
+        return count
+
+    def _read_index(self, name, path):
+        """
+        Reads complete lines of index file past the part read
+        by an earlier call. Malformed lines, such as one left
+        by an interrupted append, are skipped
+        :param name: name of index file
+        :param path: path to index file
+        :return: number of lines read
+        """
+        day = name[0:-len(INDEX_SUFFIX)]
+        start = self._sizes.get(name, 0)
+        try:
+            with open(path, 'rb') as f:
+                if f.seek(0, os.SEEK_END) < start:
+                    start = 0
+                f.seek(start)
+                data = f.read()
+        except OSError as e:
+            logger.error('Unable to read ' + path + ' : ' + str(e))
+            return 0
+        end = data.rfind(b'\n') + 1
+        count = 0
+        for line in data[0:end].decode('utf-8', 'replace').splitlines():
+            parts = line.split(' ')
+            if len(parts) != 3:
+                continue
+            try:
+                self._index[parts[0]] = (day, int(parts[1]), int(parts[2]))
+            except ValueError:
+                continue
+            count += 1
+        self._sizes[name] = start + end
+        return count
+
+    def _is_deleted(self, uuidstr):
+        """
+        Checks if archived task was deleted, first reading ids
+        appended to :py:const:`DELETED_FILE` since last check
+        :param uuidstr: id of task
+        :return: True if deleted otherwise False
+        """
+        path = os.path.join(self._archivedir, DELETED_FILE)
+        with self._lock:
+            try:
+                with open(path, 'rb') as f:
+                    if f.seek(0, os.SEEK_END) > self._deleted_size:
+                        f.seek(self._deleted_size)
+                        data = f.read()
+                        end = data.rfind(b'\n') + 1
+                        self._deleted.update(
+                            data[0:end].decode('utf-8',
+                                               'replace').split())
+                        self._deleted_size += end
+            except OSError:
+                pass
+            return uuidstr in self._deleted
+
+    def get_location(self, uuidstr):
+        """
+        Gets where result of task is in archive
+        :param uuidstr: id of task
+        :return: tuple (day, offset, length) or None if task
+                 is not archived or was deleted
+        """
+        loc = self._index.get(uuidstr)
+        if loc is None and self.refresh() > 0:
+            loc = self._index.get(uuidstr)
+        if loc is not None and self._is_deleted(uuidstr):
+            return None
+        return loc
+
+    def has_task(self, uuidstr):
+        """
+        Checks if task is archived
+        :param uuidstr: id of task
+        :return: True if archived and not deleted otherwise False
+        """
+        return self.get_location(uuidstr) is not None
+
+    def delete(self, uuidstr):
+        """
+        Deletes archived task by appending its id to
+        :py:const:`DELETED_FILE`, so it is no longer returned
+        by this or any other :py:class:`TaskArchive`
+        :param uuidstr: id of task
+        :return: True if task was archived otherwise False
+        """
+        if not self.has_task(uuidstr):
+            return False
+        path = os.path.join(self._archivedir, DELETED_FILE)
+        # leading newline ends any line left by an interrupted write
+        with open(path, 'ab') as f:
+            f.write(('\n' + uuidstr + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self._deleted.add(uuidstr)
+        logger.info('Deleted archived task ' + uuidstr)
+        return True
+
+    def get_task(self, uuidstr):
+        """
+        Gets result of archived task
+        :param uuidstr: id of task
+        :return: result as dict or None if task is not archived
+                 or its result cannot be read
+        """
+        loc = self.get_location(uuidstr)
+        if loc is None:
+            return None
+        day, offset, length = loc
+        segment = os.path.join(self._archivedir, day + SEGMENT_SUFFIX)
+        try:
+            with open(segment, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+            if len(data) != length:
+                raise ValueError('segment ends at ' +
+                                 str(offset + len(data)))
+            return json.loads(zlib.decompress(data).decode('utf-8'))
+        except (OSError, ValueError, zlib.error) as e:
+            logger.error('Unable to read task ' + uuidstr + ' from ' +
+                         segment + ' : ' + str(e))
+            return None
+
+    def append(self, day, records):
+        """
+        Appends results to segment of **day** and then their
+        locations to its index, syncing each to disk, so a task
+        is in the index only once its result is stored
+        :param day: day of segment as returned by :py:func:`get_day`
+        :param records: list of tuples (uuid, result as dict)
+        :return: None
+        """
+        if len(records) == 0:
+            return
+        os.makedirs(self._archivedir, mode=0o775, exist_ok=True)
+        lines = []
+        segment = os.path.join(self._archivedir, day + SEGMENT_SUFFIX)
+        with open(segment, 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            for uuidstr, data in records:
+                blob = zlib.compress(json.dumps(data).encode('utf-8'))
+                f.write(blob)
+                lines.append(uuidstr + ' ' + str(offset) + ' ' +
+                             str(len(blob)) + '\n')
+                offset += len(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        index = os.path.join(self._archivedir, day + INDEX_SUFFIX)
+        with open(index, 'ab+') as f:
+            # end line left by an interrupted append
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    lines.insert(0, '\n')
+            f.write(''.join(lines).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class TaskArchiver(object):
+    """
+    Moves done tasks older than **min_age** into a
+    :py:class:`TaskArchive` and removes their directories, leaving
+    a few large files in place of many small ones. Only the result
+    returned by the REST service is kept, profiles and other files
+    of a task are removed with it. Tasks with a pending delete
+    request are left for the task runner to delete
+    """
+    def __init__(self, taskdir, min_age=30 * DAY_SECONDS, layout=None,
+                 batch_size=100, archive=None):
+        """
+        Constructor
+        :param taskdir: base directory of tasks
+        :param min_age: time in seconds since task was done before
+                        it is archived
+        :param layout: TaskLayout of task directories, if None
+                       tasks are stored under address they were
+                       submitted from
+        :param batch_size: number of tasks appended to archive
+                           before their directories are removed
+        :param archive: TaskArchive to add tasks to, if None archive
+                        under **taskdir** is used
+        """
+        self._taskdir = taskdir
+        self._min_age = min_age
+        if layout is None:
+            layout = TaskLayout()
+        self._layout = layout
+        self._batch_size = batch_size
+        if archive is None:
+            archive = TaskArchive(get_archive_dir(taskdir))
+        self._archive = archive
+
+    def _get_done_time(self, taskdir):
+        """
+        Gets time task was done from modification time of its
+        result and task json files
+        :param taskdir: task directory
+        :return: time in seconds since epoch or None if task
+                 has no task json
+        """
+        try:
+            done_time = os.stat(os.path.join(taskdir,
+                                             dao.TASK_JSON)).st_mtime
+        except OSError:
+            return None
+        try:
+            return max(done_time, os.stat(os.path.join(
+                taskdir, dao.RESULT)).st_mtime)
+        except OSError:
+            return done_time
+
+    def get_archivable_taskdirs(self):
+        """
+        Gets done tasks old enough to archive
+        :return: list of tuples (day, uuid, task directory) sorted
+                 by day
+        """
+        tasks = []
+        cutoff = time.time() - self._min_age
+        deletedir = os.path.join(self._taskdir, dao.DELETE_REQUESTS)
+        statedir = os.path.join(self._taskdir, dao.DONE_STATUS)
+        for entry in self._layout.iter_taskdirs(statedir):
+            done_time = self._get_done_time(entry.path)
+            if done_time is None or done_time > cutoff:
+                continue
+            if os.path.isfile(os.path.join(deletedir, entry.name)):
+                continue
+            tasks.append((get_day(done_time), entry.name, entry.path))
+        tasks.sort()
+        return tasks
+
+    def _get_result(self, taskdir):
+        """
+        Gets result of task with status set as the REST
+        service would return it
+        :param taskdir: task directory
+        :return: dict
+        """
+        result = os.path.join(taskdir, dao.RESULT)
+        if not os.path.isfile(result):
+            result = os.path.join(taskdir, dao.TASK_JSON)
+        with open(result, 'r') as f:
+            data = json.load(f)
+        if dao.STATUS_RESULT_KEY not in data:
+            # tasks in error state are stored with done tasks
+            # and have no result
+            if 'result' in data:
+                data[dao.STATUS_RESULT_KEY] = dao.DONE_STATUS
+            else:
+                data[dao.STATUS_RESULT_KEY] = dao.ERROR_STATUS
+        return data
+
+    def _archive_batch(self, day, batch, counts):
+        """
+        Appends batch of tasks to archive and removes their
+        directories. Tasks already in archive, from a run where
+        removal failed, are only removed. Tasks with a delete
+        request are skipped, or deleted from the archive if the
+        request arrived while they were appended
+        :param day: day of segment
+        :param batch: list of tuples (uuid, task directory)
+        :param counts: dict of counts to update
+        """
+        records = []
+        archived = []
+        deletedir = os.path.join(self._taskdir, dao.DELETE_REQUESTS)
+        for uuidstr, taskdir in batch:
+            # delete request may have arrived since tasks were listed
+            if os.path.isfile(os.path.join(deletedir, uuidstr)):
+                continue
+            if not self._archive.has_task(uuidstr):
+                try:
+                    records.append((uuidstr, self._get_result(taskdir)))
+                except (OSError, ValueError) as e:
+                    logger.error('Unable to read result of ' + taskdir +
+                                 ' : ' + str(e))
+                    counts['failed'] += 1
+                    continue
+            archived.append((uuidstr, taskdir))
+        self._archive.append(day, records)
+        for uuidstr, taskdir in archived:
+            # delete request that arrived before the task was appended
+            # found nothing to delete in the archive
+            if os.path.isfile(os.path.join(deletedir, uuidstr)):
+                self._archive.delete(uuidstr)
+            emsg = FileBasedTask(taskdir, None).delete_task_files()
+            if emsg is not None:
+                logger.error('Unable to remove archived task ' +
+                             taskdir + ' : ' + emsg)
+                counts['failed'] += 1
+                continue
+            counts['archived'] += 1
+
+    def archive_tasks(self, time_budget=None):
+        """
+        Archives done tasks older than **min_age**. Returns without
+        archiving if another archiver is running
+        :param time_budget: maximum time in seconds to spend archiving,
+                            remaining tasks are archived by the next
+                            call. None means no limit
+        :return: dict with number of tasks 'archived' and 'failed'
+        """
+        start_time = time.time()
+        counts = {'archived': 0, 'failed': 0}
+        archivedir = self._archive.get_archive_dir()
+        os.makedirs(archivedir, mode=0o775, exist_ok=True)
+        with open(os.path.join(archivedir, LOCK_FILE), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                logger.info('Another archiver is running')
+                return counts
+            try:
+                self._archive.refresh()
+                tasks = self.get_archivable_taskdirs()
+                pos = 0
+                while pos < len(tasks):
+                    if (time_budget is not None and
+                            time.time() - start_time > time_budget):
+                        break
+                    day = tasks[pos][0]
+                    batch = []
+                    while (pos < len(tasks) and tasks[pos][0] == day and
+                           len(batch) < self._batch_size):
+                        batch.append(tasks[pos][1:])
+                        pos += 1
+                    self._archive_batch(day, batch, counts)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return counts
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""Disk backed cache of DiseaseScope pipeline stage outputs"""
+import os
+import time
+import gzip
+import json
+import fcntl
+import pickle
+import threading
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_SUFFIX = '.pkl.gz'
+LOCK_FILE = '.lock'
+
+# default time in seconds entries stay valid
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# default maximum time in seconds between scans of cache directory
+# that pick up entries written by other processes
+DEFAULT_SCAN_INTERVAL = 60
+
+
+def get_reference_version(files):
+    """
+    Gets a version string for the reference data files passed in
+    by hashing their contents. Files that are None or do not
+    exist are skipped
+    :param files: list of file paths
+    :return: sha256 hex digest as string
+    """
+    sha = hashlib.sha256()
+    for fp in files:
+        if fp is None or not os.path.isfile(fp):
+            continue
+        with open(fp, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+class StageCache(object):
+    """
+    Size bounded least recently used cache of pipeline stage
+    outputs stored as compressed pickles under a directory. The
+    directory can be shared by any number of runner processes.
+    Entries are written atomically and eviction is serialized
+    with a lock file.
+
+    Last access time of an entry is tracked with the access time
+    of its file, set explicitly on every hit, and the time the entry
+    was written with its modification time.
+
+    Size of cache is kept as a running total, measured by each scan
+    of the directory and increased by every put, so the directory is
+    only scanned once the total exceeds the maximum size or every
+    **scan_interval** seconds to pick up writes of other processes.
+    """
+    def __init__(self, cachedir, max_size=1024 * 1024 * 1024,
+                 ttls=None, default_ttl=DEFAULT_TTL,
+                 version='', scan_interval=DEFAULT_SCAN_INTERVAL):
+        """
+        Constructor
+        :param cachedir: directory to store cache entries
+        :param max_size: maximum size of cache in bytes
+        :param ttls: dict of stage name => time in seconds
+                     entries for that stage are valid
+        :param default_ttl: time in seconds entries are valid
+                            for stages not in **ttls**
+        :param version: version of reference data, included
+                        in every key
+        :param scan_interval: maximum time in seconds between scans
+                              of cache directory done on put
+        """
+        self._cachedir = cachedir
+        self._max_size = max_size
+        if ttls is None:
+            self._ttls = {}
+        else:
+            self._ttls = ttls
+        self._default_ttl = default_ttl
+        self._version = version
+        self._hits = 0
+        self._misses = 0
+        self._scan_interval = scan_interval
+        self._size = None
+        self._scan_time = 0
+        self._size_lock = threading.Lock()
+        if not os.path.isdir(self._cachedir):
+            os.makedirs(self._cachedir, mode=0o775)
+
+    def get_key(self, stagename, inputs):
+        """
+        Gets cache key for stage with **inputs**
+        :param stagename: name of stage
+        :param inputs: json serializable inputs of stage
+        :return: key as string
+        """
+        data = json.dumps({'stage': stagename,
+                           'inputs': inputs,
+                           'version': self._version},
+                          sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _get_entry_path(self, key):
+        """
+        Gets path to entry with key
+        :param key:
+        :return:
+        """
+        return os.path.join(self._cachedir, key[0:2], key + CACHE_SUFFIX)
+
+    def _get_ttl(self, stagename):
+        """
+        Gets time to live for entries of stage
+        :param stagename:
+        :return:
+        """
+        return self._ttls.get(stagename, self._default_ttl)
+
+    def get(self, stagename, key):
+        """
+        Gets output of stage from cache
+        :param stagename: name of stage
+        :param key: key from :py:meth:`get_key`
+        :return: cached output or None if not in cache or expired
+        """
+        entry = self._get_entry_path(key)
+        try:
+            st = os.stat(entry)
+        except OSError:
+            self._misses += 1
+            return None
+
+        now = time.time()
+        if now - st.st_mtime > self._get_ttl(stagename):
+            logger.debug('Cache entry for ' + stagename + ' expired')
+            self._remove_entry(entry)
+            self._misses += 1
+            return None
+        try:
+            with gzip.open(entry, 'rb') as f:
+                val = pickle.load(f)
+            os.utime(entry, (now, st.st_mtime))
+        except Exception as e:
+            logger.error('Unable to load cache entry ' + entry +
+                         ' : ' + str(e))
+            self._remove_entry(entry)
+            self._misses += 1
+            return None
+        self._hits += 1
+        return val
+
+    def put(self, stagename, key, val):
+        """
+        Adds output of stage to cache, evicting least recently
+        used entries if running total size of cache exceeds its
+        maximum size
+        :param stagename: name of stage
+        :param key: key from :py:meth:`get_key`
+        :param val: output to cache, must be picklable
+        :return: True if added otherwise False
+        """
+        entry = self._get_entry_path(key)
+        tmpentry = (entry + '.' + str(os.getpid()) + '.' +
+                    str(threading.get_ident()) + '.tmp')
+        try:
+            entrydir = os.path.dirname(entry)
+            if not os.path.isdir(entrydir):
+                os.makedirs(entrydir, mode=0o775, exist_ok=True)
+            with gzip.open(tmpentry, 'wb') as f:
+                pickle.dump(val, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmpentry)
+            os.replace(tmpentry, entry)
+        except Exception as e:
+            logger.warning('Unable to cache output of stage ' +
+                           stagename + ' : ' + str(e))
+            self._remove_entry(tmpentry)
+            return False
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+            scan = (self._size is None or self._size > self._max_size or
+                    time.time() - self._scan_time > self._scan_interval)
+        if scan is True:
+            self.evict()
+        return True
+
+    def get_size(self):
+        """
+        Gets running total size of cache
+        :return: size in bytes or None if cache was not scanned yet
+        """
+        with self._size_lock:
+            return self._size
+
+    def evict(self):
+        """
+        Scans cache directory, updating running total size of
+        cache, and removes least recently used entries until cache
+        is no larger then its maximum size
+        :return: number of entries removed
+        """
+        with open(os.path.join(self._cachedir, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = []
+                total = 0
+                for subdir in os.scandir(self._cachedir):
+                    if not subdir.is_dir():
+                        continue
+                    for entry in os.scandir(subdir.path):
+                        if not entry.name.endswith(CACHE_SUFFIX):
+                            continue
+                        st = entry.stat()
+                        entries.append((st.st_atime, st.st_size,
+                                        entry.path))
+                        total += st.st_size
+                removed = 0
+                if total > self._max_size:
+                    entries.sort()
+                    for atime, size, path in entries:
+                        if total <= self._max_size:
+                            break
+                        self._remove_entry(path)
+                        total -= size
+                        removed += 1
+                    logger.debug('Evicted ' + str(removed) +
+                                 ' entries from cache')
+                with self._size_lock:
+                    self._size = total
+                    self._scan_time = time.time()
+                return removed
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _remove_entry(self, path):
+        """
+        Removes cache entry ignoring errors
+        :param path:
+        :return:
+        """
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def get_hits(self):
+        """
+        Gets number of cache hits
+        :return:
+        """
+        return self._hits
+
+    def get_misses(self):
+        """
+        Gets number of cache misses
+        :return:
+        """
+        return self._misses
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""Runs CLIXO locally to infer hierarchical model of a network"""
+import os
+import time
+import logging
+import threading
+import subprocess
+
+from diseasescope_rest_server.edgetable import EdgeTable
+
+logger = logging.getLogger(__name__)
+
+
+CLIXO_API_METHOD = 'clixo-api'
+CLIXO_LOCAL_METHOD = 'clixo-local'
+INFER_METHODS = [CLIXO_API_METHOD, CLIXO_LOCAL_METHOD]
+
+# files written under task directory
+EDGE_TABLE_FILE = 'clixo_input.tsv'
+EDGE_TABLE_CHECKSUM_SUFFIX = '.md5'
+CLIXO_OUTPUT_FILE = 'clixo_output.tsv'
+CLIXO_ERROR_FILE = 'clixo_error.txt'
+
+# defaults matching those of the REST service
+DEFAULT_NDEX_SERVER = 'test.ndexbio.org'
+DEFAULT_NDEX_USER = 'diseasescope_anon'
+DEFAULT_NDEX_NAME = 'DiseaseScopeOntology'
+DEFAULT_HIVIEW_URL = 'http://hiview-test.ucsd.edu'
+
+# value of edge type column in CLIXO output for
+# edges from a term to a gene
+GENE_EDGE_TYPE = 'gene'
+
+# time in seconds between checks for cancellation while waiting
+# for CLIXO
+DEFAULT_POLL_INTERVAL = 0.5
+
+
+class ClixoError(Exception):
+    """
+    Raised when CLIXO fails
+    """
+    pass
+
+
+class ClixoPool(object):
+    """
+    Runs CLIXO as local subprocesses. At most **max_instances** run
+    at once, further runs wait for one to finish. Each run is given
+    its own set of **cores_per_run** CPUs, not shared with other
+    runs, so concurrent runs do not slow each other down. A run
+    whose task is cancelled is killed, see :py:meth:`run`
+    """
+    def __init__(self, clixo_cmd='clixo', max_instances=2,
+                 cores_per_run=1, timeout=None, cpus=None,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        """
+        Constructor
+        :param clixo_cmd: path to CLIXO binary
+        :param max_instances: maximum number of CLIXO processes
+                              run at once
+        :param cores_per_run: number of CPUs given to each run
+        :param timeout: time in seconds after which a CLIXO process
+                        is killed, None means no limit
+        :param cpus: list of CPU ids runs can use, if None all
+                     CPUs available to this process are used
+        :param poll_interval: time in seconds between checks for
+                              cancellation of a run
+        """
+        self._clixo_cmd = clixo_cmd
+        self._max_instances = max_instances
+        self._cores_per_run = max(cores_per_run, 1)
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+        if cpus is None:
+            if hasattr(os, 'sched_getaffinity'):
+                cpus = sorted(os.sched_getaffinity(0))
+            else:
+                cpus = list(range(os.cpu_count() or 1))
+        self._free_cpus = list(cpus)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_instances)
+
+    def get_max_instances(self):
+        """
+        Gets maximum number of CLIXO processes run at once
+        :return:
+        """
+        return self._max_instances
+
+    def get_command(self, edgefile, alpha, beta):
+        """
+        Gets command to run CLIXO on **edgefile**
+        :param edgefile: tab delimited file of gene, gene, score
+        :param alpha: CLIXO alpha parameter
+        :param beta: CLIXO beta parameter
+        :return: list of str
+        """
+        return [self._clixo_cmd, '-i', edgefile, '-a', str(alpha),
+                '-b', str(beta)]
+
+    def _allocate_cpus(self):
+        """
+        Takes CPUs for a run from free CPUs
+        :return: list of CPU ids, empty if none are free
+        """
+        with self._lock:
+            cpus = self._free_cpus[0:self._cores_per_run]
+            self._free_cpus = self._free_cpus[len(cpus):]
+            return cpus
+
+    def _release_cpus(self, cpus):
+        """
+        Returns CPUs of a run to free CPUs
+        """
+        with self._lock:
+            self._free_cpus.extend(cpus)
+
+    def run(self, edgefile, outputfile, alpha, beta, cancel_check=None):
+        """
+        Runs CLIXO writing the hierarchy it outputs to **outputfile**.
+        Standard error is written to a file next to **outputfile**.
+        While waiting for a free run or for CLIXO to finish
+        **cancel_check** is called every **poll_interval** seconds,
+        if it raises CLIXO is killed and the exception is raised
+        :param edgefile: tab delimited file of gene, gene, score
+        :param outputfile: file to write CLIXO output to
+        :param alpha: CLIXO alpha parameter
+        :param beta: CLIXO beta parameter
+        :param cancel_check: function taking no arguments that raises
+                             if the run should stop, None to never stop
+        :raises ClixoError: if CLIXO fails or times out
+        :return: None
+        """
+        cmd = self.get_command(edgefile, alpha, beta)
+        errfile = os.path.join(os.path.dirname(outputfile),
+                               CLIXO_ERROR_FILE)
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = str(self._cores_per_run)
+        while not self._slots.acquire(timeout=self._poll_interval):
+            if cancel_check is not None:
+                cancel_check()
+        try:
+            cpus = self._allocate_cpus()
+            try:
+                logger.info('Running ' + ' '.join(cmd) + ' on CPUs ' +
+                            str(cpus))
+                with open(outputfile, 'w') as out, open(errfile, 'w') as err:
+                    try:
+                        proc = subprocess.Popen(cmd, stdout=out, stderr=err,
+                                                env=env)
+                    except OSError as e:
+                        raise ClixoError('Unable to run ' +
+                                         self._clixo_cmd + ' : ' + str(e))
+                    if len(cpus) > 0 and hasattr(os, 'sched_setaffinity'):
+                        try:
+                            os.sched_setaffinity(proc.pid, cpus)
+                        except OSError as e:
+                            logger.warning('Unable to set CPU affinity of '
+                                           'CLIXO : ' + str(e))
+                    returncode = self._wait(proc, cancel_check)
+            finally:
+                self._release_cpus(cpus)
+        finally:
+            self._slots.release()
+        if returncode != 0:
+            with open(errfile, 'r') as f:
+                errmsg = f.read()[-1000:].strip()
+            raise ClixoError('CLIXO exited with code ' + str(returncode) +
+                             ' : ' + errmsg)
+
+    def _wait(self, proc, cancel_check):
+        """
+        Waits for CLIXO process to exit. The process is killed if it
+        runs longer than timeout or **cancel_check** raises
+        :param proc: CLIXO process
+        :param cancel_check: function that raises if run should stop
+                             or None
+        :raises ClixoError: if CLIXO runs longer than timeout
+        :return: exit code of process
+        """
+        deadline = None
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+        try:
+            while True:
+                wait = self._poll_interval
+                if deadline is not None:
+                    wait = max(min(wait, deadline - time.time()), 0)
+                try:
+                    return proc.wait(timeout=wait)
+                except subprocess.TimeoutExpired:
+                    pass
+                if deadline is not None and time.time() >= deadline:
+                    raise ClixoError('CLIXO did not finish within ' +
+                                     str(self._timeout) + ' seconds')
+                if cancel_check is not None:
+                    cancel_check()
+        except BaseException:
+            if proc.poll() is None:
+                logger.info('Killing CLIXO process ' + str(proc.pid))
+                proc.kill()
+                proc.wait()
+            raise
+
+
+def write_edge_table(network, columns, edge_attr, path):
+    """
+    Writes edge table as tab delimited file of
+    gene, gene, score with no header as CLIXO expects
+    :param network: edge table as :py:class:`pandas.DataFrame`
+                    or :py:class:`~edgetable.EdgeTable`
+    :param columns: names of the two gene columns
+    :param edge_attr: name of score column
+    :param path: file to write
+    :return: None
+    """
+    if isinstance(network, EdgeTable):
+        network.write_tsv(path, edge_attr)
+        return
+    network[list(columns) + [edge_attr]].to_csv(path, sep='\t',
+                                                header=False,
+                                                index=False)
+
+
+def write_edge_table_if_changed(network, columns, edge_attr, path):
+    """
+    Writes edge table as :py:func:`write_edge_table` does unless
+    **path** already holds the same :py:class:`~edgetable.EdgeTable`,
+    such as when a task is retried, in which case **path** is left
+    as is. The file is written to a temporary file then renamed so
+    an interrupted write is never reused
+    :param network: edge table as :py:class:`pandas.DataFrame`
+                    or :py:class:`~edgetable.EdgeTable`
+    :param columns: names of the two gene columns
+    :param edge_attr: name of score column
+    :param path: file to write
+    :return: True if file was written otherwise False
+    """
+    checksumfile = path + EDGE_TABLE_CHECKSUM_SUFFIX
+    checksum = None
+    if isinstance(network, EdgeTable):
+        checksum = network.get_checksum() + ' ' + edge_attr
+        if os.path.isfile(path) and os.path.isfile(checksumfile):
+            with open(checksumfile, 'r') as f:
+                if f.read() == checksum:
+                    logger.debug('Reusing edge table ' + path)
+                    return False
+    if os.path.isfile(checksumfile):
+        os.unlink(checksumfile)
+    write_edge_table(network, columns, edge_attr, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    if checksum is not None:
+        with open(checksumfile, 'w') as f:
+            f.write(checksum)
+    return True
+
+
+def read_clixo_output(path):
+    """
+    Reads hierarchy output by CLIXO
+    :param path: CLIXO output file
+    :return: list of [parent, child, edge type] lists
+    """
+    edges = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            cols = line.split('\t')
+            if len(cols) < 3:
+                continue
+            edges.append(cols[0:3])
+    return edges
+
+
+def get_hiview_url(hiviewurl, ndexurl, ndexserver):
+    """
+    Gets HiView url to view network in NDEx
+    :param hiviewurl: HiView server url
+    :param ndexurl: url of network in NDEx
+    :param ndexserver: NDEx server network is on
+    :return: str
+    """
+    uuid = ndexurl.rstrip('/').split('/')[-1]
+    server = ndexserver
+    if not server.startswith('http'):
+        server = 'http://' + server
+    return (hiviewurl.rstrip('/') + '/' + uuid + '?type=test&server=' +
+            server)
+
+
+def upload_hierarchy(edges, task):
+    """
+    Stores hierarchy in NDEx using the NDEx server and credentials
+    of **task**
+    :param edges: hierarchy from :py:func:`read_clixo_output`
+    :param task: task being processed
+    :return: tuple (HiView url, NDEx url)
+    """
+    import pandas as pd
+    from ddot import Ontology
+
+    table = pd.DataFrame(edges, columns=['Parent', 'Child', 'EdgeType'])
+    ont = Ontology.from_table(table, parent='Parent', child='Child',
+                              is_mapping=lambda x: (x['EdgeType'] ==
+                                                    GENE_EDGE_TYPE))
+    ndexserver = task.get_ndexserver() or DEFAULT_NDEX_SERVER
+    ndexurl = ont.to_ndex(ndex_server=ndexserver,
+                          ndex_user=task.get_ndexuser() or DEFAULT_NDEX_USER,
+                          ndex_pass=task.get_ndexpass() or DEFAULT_NDEX_USER,
+                          name=task.get_ndexname() or DEFAULT_NDEX_NAME,
+                          layout='bubble-collect')
+    if isinstance(ndexurl, tuple):
+        ndexurl = ndexurl[0]
+    return (get_hiview_url(task.get_hiviewurl() or DEFAULT_HIVIEW_URL,
+                           ndexurl, ndexserver), ndexurl)
@@ -2,10 +2,12 @@
 
 """Data Access Objects for diseasescope REST server"""
 import os
+import time
 import logging
 import shutil
 import json
-import glob
+import weakref
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +16,35 @@ TASK_JSON = 'task.json'
 TMP_RESULT = 'result.tmp'
 RESULT = 'result.json'
 
+# directory under task where output of completed
+# pipeline stages is stored
+CHECKPOINT_DIR = 'checkpoints'
+
+# file under task listing, one per line, files and directories
+# created in task directory
+TASK_MANIFEST = 'manifest.txt'
+
+# file under task holding lease of runner processing the task
+LEASE_FILE = 'lease.json'
+
+# serializes appends to task manifests
+_manifest_lock = threading.Lock()
+
+# defaults of sharded layout of task directories, where tasks are
+# stored under <state>/<uuid[0:2]>/<uuid[2:4]>/<uuid>
+DEFAULT_SHARD_DEPTH = 2
+DEFAULT_SHARD_WIDTH = 2
+
+# deepest sharded layout recognized when parsing task paths
+MAX_SHARD_DEPTH = 8
+
+# when task json writes are flushed to disk, never, on every
+# write or once per write interval of CoalescingTaskWriter
+FSYNC_NONE = 'none'
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_POLICIES = [FSYNC_NONE, FSYNC_ALWAYS, FSYNC_INTERVAL]
+
 STATUS_RESULT_KEY = 'status'
 NOTFOUND_STATUS = 'notfound'
 UNKNOWN_STATUS = 'unknown'
@@ -44,8 +75,340 @@ NDEXPASS_PARAM = 'ndexpass'
 NDEXNAME_PARAM = 'ndexname'
 HIVIEWURL_PARAM = 'hiviewurl'
 
+# keys in task json set by task runner
+PROGRESS_KEY = 'progress'
+STAGES_KEY = 'stages'
+QUEUE_WAIT_TIME_KEY = 'queueWaitTime'
+
+# key in task json holding id of trace spans of task are recorded in
+TRACE_ID_KEY = 'traceId'
+
 DOID_PARAM = 'doid'
 TISSUE_PARAM = 'tissue'
+# address task was submitted from
+REMOTEIP_PARAM = 'remoteip'
+# if true the pipeline stages of task are profiled
+PROFILE_PARAM = 'profile'
+
+
+def _is_tmpfile(name):
+    """
+    Checks if **name** is a temporary file written while replacing
+    one of :py:const:`FileBasedTask.TASK_FILES`, such as those
+    written by :py:meth:`FileBasedTask.write_task_json`
+    :param name: file name
+    :return: True if it is otherwise False
+    """
+    if not name.endswith('.tmp'):
+        return False
+    for taskfile in FileBasedTask.TASK_FILES:
+        if name.startswith(taskfile + '.'):
+            return True
+    return False
+
+
+def fsync_directory(path):
+    """
+    Flushes directory entries of **path** to disk so renames
+    in it survive a crash
+    :param path: directory
+    :return: None
+    """
+    dirfd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+def record_task_files(taskdir, names):
+    """
+    Adds files or directories, directly under **taskdir**, to
+    manifest of task so :py:meth:`FileBasedTask.delete_task_files`
+    removes them
+    :param taskdir: task directory
+    :param names: list of names of files or directories
+    :return: None
+    """
+    if names is None or len(names) == 0:
+        return
+    for name in names:
+        if os.sep in name or name in ['', '.', '..']:
+            raise ValueError(str(name) + ' is not directly under task '
+                                         'directory')
+    with _manifest_lock:
+        with open(os.path.join(taskdir, TASK_MANIFEST), 'a') as f:
+            f.write(''.join([n + '\n' for n in names]))
+
+
+def get_task_files(taskdir):
+    """
+    Gets files and directories listed in manifest of task
+    :param taskdir: task directory
+    :return: set of names, empty if task has no manifest
+    """
+    mfile = os.path.join(taskdir, TASK_MANIFEST)
+    if not os.path.isfile(mfile):
+        return set()
+    with open(mfile, 'r') as f:
+        return set([line.rstrip('\n') for line in f
+                    if len(line.rstrip('\n')) > 0])
+
+
+def _remove_tree_fd(dirfd):
+    """
+    Removes everything in directory open as **dirfd**. Entry types
+    come from the directory listing and removal is relative to the
+    open directory so no entry is stat'ed or looked up by full path
+    :param dirfd: file descriptor of open directory
+    :return: None
+    """
+    with os.scandir(dirfd) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subfd = os.open(entry.name,
+                            os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+                            dir_fd=dirfd)
+            try:
+                _remove_tree_fd(subfd)
+            finally:
+                os.close(subfd)
+            os.rmdir(entry.name, dir_fd=dirfd)
+        else:
+            os.unlink(entry.name, dir_fd=dirfd)
+
+
+def remove_tree(path):
+    """
+    Removes directory **path** and everything in it. Symbolic links
+    are removed, never followed
+    :param path: directory to remove
+    :return: None
+    """
+    if (os.scandir not in os.supports_fd or
+            os.unlink not in os.supports_dir_fd):
+        shutil.rmtree(path)
+        return
+    dirfd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    try:
+        _remove_tree_fd(dirfd)
+    finally:
+        os.close(dirfd)
+    os.rmdir(path)
+
+
+def _split_taskdir(taskdir):
+    """
+    Splits task directory path into base directory, state, directories
+    between state directory and task directory and uuid of task. There
+    is one such directory, named after the address task was submitted
+    from, unless path is in a sharded layout where there is one for
+    each slice of the uuid
+    :param taskdir: path to task directory
+    :return: tuple (basedir, state, list of directories, uuid) where
+             state is None if path is too short
+    """
+    taskuuid = os.path.basename(taskdir)
+    names = []
+    cur = os.path.dirname(taskdir)
+    for i in range(MAX_SHARD_DEPTH):
+        name = os.path.basename(cur)
+        if name == '':
+            break
+        names.insert(0, name)
+        cur = os.path.dirname(cur)
+    depth = 1
+    for d in range(len(names), 0, -1):
+        shards = names[len(names) - d:]
+        width = len(shards[0])
+        if (all(len(shard) == width for shard in shards) and
+                width * d < len(taskuuid) and
+                ''.join(shards) == taskuuid[0:width * d]):
+            depth = d
+            break
+    reldirs = []
+    cur = os.path.dirname(taskdir)
+    for i in range(depth):
+        reldirs.insert(0, os.path.basename(cur))
+        cur = os.path.dirname(cur)
+    state = os.path.basename(cur)
+    if state == '':
+        state = None
+    return os.path.dirname(cur), state, reldirs, taskuuid
+
+
+class TaskLayout(object):
+    """
+    Builds and finds paths of task directories under the state
+    directories of the task tree. With a **shard_depth** of 0 tasks
+    are stored under <state>/<remote ip>/<uuid>, otherwise under
+    <state>/<uuid[0:w]>/<uuid[w:2w]>/.../<uuid> with **shard_depth**
+    directories of **shard_width** characters, which keeps
+    directories small when most tasks come from one address.
+    Tasks are found and listed in either layout, so a tree can be
+    migrated to another layout while in use. Directories directly
+    under a state directory whose name is **shard_width** characters
+    with no '.' or ':' are taken to be shards, all others to be
+    named after an address
+    """
+    def __init__(self, shard_depth=0, shard_width=DEFAULT_SHARD_WIDTH):
+        """
+        Constructor
+        :param shard_depth: number of shard directories, 0 to store
+                            tasks under directory named after the
+                            address they were submitted from
+        :param shard_width: number of characters of uuid in name of
+                            each shard directory
+        :raises ValueError: if **shard_depth** or **shard_width** is
+                            out of range
+        """
+        if shard_depth < 0 or shard_depth > MAX_SHARD_DEPTH:
+            raise ValueError('shard_depth must be in range 0-' +
+                             str(MAX_SHARD_DEPTH))
+        if shard_width < 1:
+            raise ValueError('shard_width must be 1 or larger')
+        self._shard_depth = shard_depth
+        self._shard_width = shard_width
+
+    def is_sharded(self):
+        """
+        Checks if new task directories are sharded by uuid
+        :return: True if sharded, False if stored under address
+        """
+        return self._shard_depth > 0
+
+    def get_shard_dirs(self, uuidstr, depth=None):
+        """
+        Gets names of shard directories of task
+        :param uuidstr: uuid of task
+        :param depth: number of shard directories, None for
+                      **shard_depth**
+        :return: list of names
+        """
+        if depth is None:
+            depth = self._shard_depth
+        width = self._shard_width
+        return [uuidstr[i * width:(i + 1) * width] for i in range(depth)]
+
+    def get_taskdir(self, basedir, state, uuidstr, ipaddr=None):
+        """
+        Gets path of directory of task in this layout
+        :param basedir: base directory of tasks
+        :param state: state of task, such as :py:const:`SUBMITTED_STATUS`
+        :param uuidstr: uuid of task
+        :param ipaddr: address task was submitted from, only used if
+                       layout is not sharded
+        :raises ValueError: if **uuidstr** is too short to be sharded
+        :return: path
+        """
+        if self.is_sharded() is False:
+            return os.path.join(basedir, state, str(ipaddr), uuidstr)
+        if len(uuidstr) <= self._shard_depth * self._shard_width:
+            raise ValueError('Task id ' + uuidstr + ' too short to shard')
+        return os.path.join(basedir, state,
+                            *(self.get_shard_dirs(uuidstr) + [uuidstr]))
+
+    def _is_shard_dir(self, name):
+        """
+        Checks if **name** of directory under state directory
+        is that of a shard
+        """
+        return (len(name) == self._shard_width and '.' not in name and
+                ':' not in name)
+
+    def _list_dirs(self, path):
+        """
+        Gets directories directly under **path**
+        :return: list of os.DirEntry, empty if **path** cannot be read
+        """
+        try:
+            with os.scandir(path) as it:
+                return [e for e in it if e.is_dir(follow_symlinks=False)]
+        except OSError:
+            return []
+
+    def find_taskdirs(self, statedir, uuids):
+        """
+        Finds directories of tasks under **statedir** listing
+        only **statedir**. Directories named after addresses are
+        checked before shards, so a task moved from the former to
+        the latter by a migration is not missed
+        :param statedir: state directory, such as <basedir>/submitted
+        :param uuids: ids of tasks
+        :return: dict of task id => task directory of tasks found
+        """
+        found = {}
+        remaining = [u for u in uuids if u not in ['', '.', '..'] and
+                     os.sep not in u]
+        if len(remaining) == 0:
+            return found
+        entries = self._list_dirs(statedir)
+        for entry in entries:
+            if self._is_shard_dir(entry.name):
+                continue
+            for uuidstr in list(remaining):
+                path = os.path.join(entry.path, uuidstr)
+                if os.path.isdir(path):
+                    found[uuidstr] = path
+                    remaining.remove(uuidstr)
+            if len(remaining) == 0:
+                return found
+        shards = set([e.name for e in entries if self._is_shard_dir(e.name)])
+        for uuidstr in remaining:
+            if uuidstr[0:self._shard_width] not in shards:
+                continue
+            for depth in range(1, MAX_SHARD_DEPTH + 1):
+                if len(uuidstr) <= depth * self._shard_width:
+                    break
+                path = os.path.join(statedir,
+                                    *self.get_shard_dirs(uuidstr,
+                                                         depth=depth))
+                if not os.path.isdir(path):
+                    break
+                if os.path.isdir(os.path.join(path, uuidstr)):
+                    found[uuidstr] = os.path.join(path, uuidstr)
+                    break
+        return found
+
+    def find_taskdir(self, statedir, uuidstr):
+        """
+        Finds directory of task under **statedir**
+        :param statedir: state directory, such as <basedir>/submitted
+        :param uuidstr: id of task
+        :return: path to task directory or None if not found
+        """
+        return self.find_taskdirs(statedir, [uuidstr]).get(uuidstr)
+
+    def iter_taskdirs(self, statedir):
+        """
+        Lists directories of all tasks under **statedir**
+        :param statedir: state directory, such as <basedir>/submitted
+        :return: generator of os.DirEntry of task directories
+        """
+        for entry in self._list_dirs(statedir):
+            if self._is_shard_dir(entry.name):
+                for taskentry in self._iter_shard(entry.path, entry.name):
+                    yield taskentry
+                continue
+            for taskentry in self._list_dirs(entry.path):
+                yield taskentry
+
+    def _iter_shard(self, path, prefix):
+        """
+        Lists directories of tasks under shard directory, names of
+        tasks start with **prefix**, those of deeper shards do not
+        :param path: shard directory
+        :param prefix: start of uuid of tasks under **path**
+        :return: generator of os.DirEntry of task directories
+        """
+        for entry in self._list_dirs(path):
+            if len(entry.name) > len(prefix) and entry.name.startswith(prefix):
+                yield entry
+            elif len(entry.name) == self._shard_width:
+                for taskentry in self._iter_shard(entry.path,
+                                                  prefix + entry.name):
+                    yield taskentry
 
 
 class FileBasedTask(object):
@@ -56,11 +419,41 @@ class FileBasedTask(object):
     STATE = 'state'
     IPADDR = 'ipaddr'
     UUID = 'uuid'
-    TASK_FILES = [TASK_JSON]
+    TASK_FILES = [TASK_JSON, RESULT, TMP_RESULT, TASK_MANIFEST, LEASE_FILE]
+    TASK_DIRS = [CHECKPOINT_DIR]
 
-    def __init__(self, taskdir, taskdict):
+    def __init__(self, taskdir, taskdict, layout=None):
+        """
+        Constructor
+        :param taskdir: directory of task
+        :param taskdict: task json as dict
+        :param layout: TaskLayout task is put in when moved to
+                       another state, None to keep task in the
+                       layout it is in
+        """
         self._taskdir = taskdir
         self._taskdict = taskdict
+        self._layout = layout
+        self._scratchdir = None
+        self._writer = None
+        self._lock = threading.RLock()
+
+    def set_writer(self, writer):
+        """
+        Sets writer :py:meth:`save_task` hands task json to, so
+        frequent saves are coalesced
+        :param writer: CoalescingTaskWriter or None to write task
+                       json on every call to :py:meth:`save_task`
+        :return:
+        """
+        self._writer = writer
+
+    def get_lock(self):
+        """
+        Gets lock held while task json is written or task is moved
+        :return: :py:class:`threading.RLock`
+        """
+        return self._lock
 
     def delete_task_files(self):
         """
@@ -76,15 +469,40 @@ class FileBasedTask(object):
                     ' is not a directory')
 
         # this is a paranoid removal since we only are tossing
-        # the directory in question and files listed in TASK_FILES
+        # the directory in question, files listed in TASK_FILES,
+        # directories listed in TASK_DIRS and anything listed in
+        # the manifest of the task. The manifest is removed last
+        # so an interrupted removal can be redone
         try:
-            for entry in os.listdir(self._taskdir):
-                if entry not in FileBasedTask.TASK_FILES:
-                    logger.error(entry + ' not in files created by task')
-                    continue
-                fp = os.path.join(self._taskdir, entry)
-                if os.path.isfile(fp):
-                    os.unlink(fp)
+            known = get_task_files(self._taskdir)
+            known.update(FileBasedTask.TASK_FILES)
+            known.update(FileBasedTask.TASK_DIRS)
+            dirfd = None
+            if os.unlink in os.supports_dir_fd:
+                dirfd = os.open(self._taskdir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                with os.scandir(self._taskdir) as it:
+                    entries = [e for e in it if e.name != TASK_MANIFEST]
+                unknown = False
+                for entry in entries:
+                    if (entry.name not in known and
+                            not _is_tmpfile(entry.name)):
+                        logger.error(entry.name +
+                                     ' not in files created by task')
+                        unknown = True
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        remove_tree(entry.path)
+                    elif dirfd is not None:
+                        os.unlink(entry.name, dir_fd=dirfd)
+                    else:
+                        os.unlink(entry.path)
+            finally:
+                if dirfd is not None:
+                    os.close(dirfd)
+            mfile = os.path.join(self._taskdir, TASK_MANIFEST)
+            if unknown is False and os.path.isfile(mfile):
+                os.unlink(mfile)
             os.rmdir(self._taskdir)
             return None
         except Exception as e:
@@ -107,11 +525,38 @@ class FileBasedTask(object):
         if not os.path.isdir(self._taskdir):
             return str(self._taskdir) + ' is not a directory'
 
-        tjsonfile = os.path.join(self._taskdir, TASK_JSON)
-        logger.debug('Writing task data to: ' + tjsonfile)
-        with open(tjsonfile, 'w') as f:
-            json.dump(self._taskdict, f)
+        if self._writer is not None:
+            self._writer.save(self)
+            return None
+        return self.write_task_json(json.dumps(self._taskdict))
 
+    def write_task_json(self, data, fsync=False):
+        """
+        Writes **data** to task json file via a temporary file that is
+        renamed over it, so readers never see a partially written file
+        :param data: task json as str
+        :param fsync: if True, data is flushed to disk before rename
+        :return: None for success otherwise string containing error message
+        """
+        with self._lock:
+            if self._taskdir is None or not os.path.isdir(self._taskdir):
+                return str(self._taskdir) + ' is not a directory'
+            tjsonfile = os.path.join(self._taskdir, TASK_JSON)
+            tmpfile = (tjsonfile + '.' + str(os.getpid()) + '.' +
+                       str(threading.get_ident()) + '.tmp')
+            logger.debug('Writing task data to: ' + tjsonfile)
+            try:
+                with open(tmpfile, 'w') as f:
+                    f.write(data)
+                    if fsync is True:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmpfile, tjsonfile)
+                if fsync is True:
+                    fsync_directory(self._taskdir)
+            finally:
+                if os.path.isfile(tmpfile):
+                    os.unlink(tmpfile)
         return None
 
     def move_task(self, new_state,
@@ -121,6 +566,18 @@ class FileBasedTask(object):
         :param new_state: new state
         :return: None
         """
+        with self._lock:
+            if self._writer is not None:
+                self._writer.flush(self)
+            return self._move_task(new_state, error_message=error_message)
+
+    def _move_task(self, new_state, error_message=None):
+        """
+        Changes state of task to new_state, called with lock
+        of task held
+        :param new_state: new state
+        :return: None
+        """
         taskattrib = self._get_uuid_ip_state_basedir_from_path()
         if taskattrib is None or taskattrib[FileBasedTask.BASEDIR] is None:
             return 'Unable to extract state basedir from task path'
@@ -144,11 +601,21 @@ class FileBasedTask(object):
                         emsg)
             self._taskdict['message'] = emsg
             self.save_task()
+            if self._writer is not None:
+                self._writer.flush(self)
         logger.debug('Changing task: ' + str(taskattrib[FileBasedTask.UUID]) +
                      ' to state ' + new_state)
-        ptaskdir = os.path.join(taskattrib[FileBasedTask.BASEDIR], new_state,
-                                taskattrib[FileBasedTask.IPADDR],
-                                taskattrib[FileBasedTask.UUID])
+        if self._layout is not None:
+            ptaskdir = self._layout.get_taskdir(
+                taskattrib[FileBasedTask.BASEDIR], new_state,
+                taskattrib[FileBasedTask.UUID],
+                ipaddr=taskattrib[FileBasedTask.IPADDR])
+        else:
+            basedir, state, reldirs, taskuuid = _split_taskdir(self._taskdir)
+            ptaskdir = os.path.join(basedir, new_state,
+                                    *(reldirs + [taskuuid]))
+        # parent is created so move is a rename not a copy
+        os.makedirs(os.path.dirname(ptaskdir), mode=0o775, exist_ok=True)
         shutil.move(self._taskdir, ptaskdir)
         self._taskdir = ptaskdir
 
@@ -157,7 +624,8 @@ class FileBasedTask(object):
     def _get_uuid_ip_state_basedir_from_path(self):
         """
         Parses taskdir path into main parts and returns
-        result as dict
+        result as dict. If task is in a sharded layout, ip address
+        comes from :py:const:`REMOTEIP_PARAM` in task json
         :return: {'basedir': basedir,
                   'state': state
                   'ipaddr': ip address,
@@ -169,16 +637,17 @@ class FileBasedTask(object):
                     FileBasedTask.STATE: None,
                     FileBasedTask.IPADDR: None,
                     FileBasedTask.UUID: None}
-        taskuuid = os.path.basename(self._taskdir)
-        ipdir = os.path.dirname(self._taskdir)
-        ipaddr = os.path.basename(ipdir)
+        basedir, state, reldirs, taskuuid = _split_taskdir(self._taskdir)
+        shardprefix = ''.join(reldirs)
+        if (len(shardprefix) == 0 or
+                shardprefix != taskuuid[0:len(shardprefix)]):
+            ipaddr = reldirs[0]
+        elif isinstance(self._taskdict, dict):
+            ipaddr = self._taskdict.get(REMOTEIP_PARAM)
+        else:
+            ipaddr = None
         if ipaddr == '':
             ipaddr = None
-        statedir = os.path.dirname(ipdir)
-        state = os.path.basename(statedir)
-        if state == '':
-            state = None
-        basedir = os.path.dirname(statedir)
         return {FileBasedTask.BASEDIR: basedir,
                 FileBasedTask.STATE: state,
                 FileBasedTask.IPADDR: ipaddr,
@@ -229,6 +698,23 @@ class FileBasedTask(object):
         """
         return self._taskdir
 
+    def set_scratchdir(self, scratchdir):
+        """
+        Sets directory where temporary files of task are written
+        :param scratchdir: directory or None to use task directory
+        :return:
+        """
+        self._scratchdir = scratchdir
+
+    def get_scratchdir(self):
+        """
+        Gets directory where temporary files of task are written
+        :return: scratch directory if set otherwise task directory
+        """
+        if self._scratchdir is None:
+            return self._taskdir
+        return self._scratchdir
+
     def set_taskdict(self, taskdict):
         """
         Sets task dictionary
@@ -316,8 +802,18 @@ class FileBasedSubmittedTaskFactory(object):
     """
     Reads file system to get tasks
     """
-    def __init__(self, taskdir):
+    def __init__(self, taskdir, layout=None):
+        """
+        Constructor
+        :param taskdir: base directory of tasks
+        :param layout: TaskLayout of task directories, if None
+                       tasks are stored under address they were
+                       submitted from
+        """
         self._taskdir = taskdir
+        if layout is None:
+            layout = TaskLayout()
+        self._layout = layout
         self._submitdir = None
         if self._taskdir is not None:
             self._submitdir = os.path.join(self._taskdir,
@@ -337,25 +833,21 @@ class FileBasedSubmittedTaskFactory(object):
                          ' does not exist or is not a directory')
             return None
         logger.debug('Examining ' + self._submitdir + ' for new tasks')
-        for entry in os.listdir(self._submitdir):
-            fp = os.path.join(self._submitdir, entry)
-            if not os.path.isdir(fp):
-                continue
-            for subentry in os.listdir(fp):
-                subfp = os.path.join(fp, subentry)
-                if os.path.isdir(subfp):
-                    tjson = os.path.join(subfp, TASK_JSON)
-                    if os.path.isfile(tjson):
-                        try:
-                            with open(tjson, 'r') as f:
-                                jsondata = json.load(f)
-                            return FileBasedTask(subfp, jsondata)
-                        except Exception as e:
-                            if subfp not in self._problemlist:
-                                logger.info('Skipping task: ' + subfp +
-                                            ' due to error reading json' +
-                                            ' file: ' + str(e))
-                                self._problemlist.append(subfp)
+        for entry in self._layout.iter_taskdirs(self._submitdir):
+            subfp = entry.path
+            tjson = os.path.join(subfp, TASK_JSON)
+            if os.path.isfile(tjson):
+                try:
+                    with open(tjson, 'r') as f:
+                        jsondata = json.load(f)
+                    return FileBasedTask(subfp, jsondata,
+                                         layout=self._layout)
+                except Exception as e:
+                    if subfp not in self._problemlist:
+                        logger.info('Skipping task: ' + subfp +
+                                    ' due to error reading json' +
+                                    ' file: ' + str(e))
+                        self._problemlist.append(subfp)
         return None
 
     def get_size_of_problem_list(self):
@@ -377,12 +869,18 @@ class DeletedFileBasedTaskFactory(object):
     """
     Reads filesystem for tasks that should be deleted
     """
-    def __init__(self, taskdir):
+    def __init__(self, taskdir, layout=None):
         """
         Constructor
         :param taskdir:
+        :param layout: TaskLayout of task directories, if None
+                       tasks are stored under address they were
+                       submitted from
         """
         self._taskdir = taskdir
+        if layout is None:
+            layout = TaskLayout()
+        self._layout = layout
         self._delete_req_dir = None
         self._searchdirs = []
         if self._taskdir is not None:
@@ -397,57 +895,498 @@ class DeletedFileBasedTaskFactory(object):
         else:
             logger.error('Taskdir is None')
 
-    def get_next_task(self):
+    def get_delete_request_ids(self):
         """
-        Gets next task that should be deleted
-        :return:
+        Reads all pending delete request token files in a single
+        pass of the delete requests directory
+        :return: list of task ids that have delete requests
         """
         if self._delete_req_dir is None:
             logger.error('Delete request dir is None')
-            return None
+            return []
         if not os.path.isdir(self._delete_req_dir):
             logger.error(self._delete_req_dir + ' is not a directory')
-            return None
-        logger.debug('Examining ' + self._delete_req_dir +
-                     ' for delete task requests')
-        for entry in os.listdir(self._delete_req_dir):
-            fp = os.path.join(self._delete_req_dir, entry)
-            if not os.path.isfile(fp):
-                continue
-            task = self._get_task_with_id(entry)
+            return []
+        taskids = []
+        for entry in os.scandir(self._delete_req_dir):
+            if entry.is_file():
+                taskids.append(entry.name)
+        return taskids
+
+    def has_delete_request(self, taskid):
+        """
+        Checks if there is a delete request for task with id
+        :param taskid: id of task
+        :return: True if delete request exists otherwise False
+        """
+        if self._delete_req_dir is None or taskid is None:
+            return False
+        return os.path.isfile(os.path.join(self._delete_req_dir, taskid))
 
-            logger.info('Removing delete request file: ' + fp)
+    def remove_delete_request(self, taskid):
+        """
+        Removes delete request token file for task with id
+        :param taskid: id of task
+        :return: None
+        """
+        fp = os.path.join(self._delete_req_dir, taskid)
+        logger.info('Removing delete request file: ' + fp)
+        try:
             os.unlink(fp)
-            if task is None:
-                logger.info('Task ' + entry + ' not found')
+        except OSError:
+            logger.debug('Delete request file already removed: ' + fp)
+
+    def get_next_tasks(self, max_tasks=None):
+        """
+        Gets all tasks that should be deleted. All pending delete
+        request tokens are read at once and resolved against a single
+        scan of the task tree. Requests for tasks that no longer exist
+        are removed. Task json is not parsed since it is not needed
+        to delete a task.
+
+        NOTE: Caller is responsible for invoking
+              :py:meth:`remove_delete_request` once a task
+              returned by this method has been deleted
+
+        :param max_tasks: If set, only up to this many tasks are returned
+        :return: list of FileBasedTask objects to delete
+        """
+        taskids = self.get_delete_request_ids()
+        if len(taskids) == 0:
+            return []
+        logger.debug('Found ' + str(len(taskids)) +
+                     ' delete task requests')
+        if max_tasks is not None:
+            taskids = taskids[:max_tasks]
+
+        found = self._get_taskdirs_with_ids(taskids)
+        tasks = []
+        for taskid in taskids:
+            if taskid not in found:
+                logger.info('Task ' + taskid + ' not found')
+                self.remove_delete_request(taskid)
                 continue
-            return task
-        return None
+            tasks.append(FileBasedTask(found[taskid], {},
+                                       layout=self._layout))
+        return tasks
 
-    def _get_task_with_id(self, taskid):
+    def _get_taskdirs_with_ids(self, taskids):
         """
-        Uses glob to look for task with id under taskdir
-        :return: FileBasedTask object or None if not found
+        Looks for directories of tasks with ids in **taskids**
+        listing each state directory once. Search stops as soon
+        as all tasks are found
+        :param taskids: list of task ids
+        :return: dict of task id => task directory
         """
+        remaining = list(taskids)
+        found = {}
         for search_dir in self._searchdirs:
-            for entry in glob.glob(os.path.join(search_dir, '*', taskid)):
-                if not os.path.isdir(entry):
-                    logger.error('Found match (' + entry +
-                                 '), but its not a directory')
+            if not os.path.isdir(search_dir):
+                continue
+            found.update(self._layout.find_taskdirs(search_dir, remaining))
+            remaining = [t for t in remaining if t not in found]
+            if len(remaining) == 0:
+                return found
+        return found
+
+
+class OrphanedTaskSweeper(object):
+    """
+    Removes orphaned task directories, those under the submitted,
+    processing or done directories that have no task json file,
+    such as directories left by an interrupted delete or a
+    task that was never fully created
+    """
+    STATES = [SUBMITTED_STATUS, PROCESSING_STATUS, DONE_STATUS]
+
+    def __init__(self, taskdir, min_age=86400, layout=None):
+        """
+        Constructor
+        :param taskdir: base directory of tasks
+        :param min_age: time in seconds since last modification
+                        before a directory without task json file
+                        is removed
+        :param layout: TaskLayout of task directories, if None
+                       tasks are stored under address they were
+                       submitted from
+        """
+        self._taskdir = taskdir
+        self._min_age = min_age
+        if layout is None:
+            layout = TaskLayout()
+        self._layout = layout
+
+    def get_orphaned_taskdirs(self):
+        """
+        Gets orphaned task directories
+        :return: list of paths
+        """
+        orphans = []
+        cutoff = time.time() - self._min_age
+        for state in OrphanedTaskSweeper.STATES:
+            statedir = os.path.join(self._taskdir, state)
+            if not os.path.isdir(statedir):
+                continue
+            for entry in self._layout.iter_taskdirs(statedir):
+                if os.path.exists(os.path.join(entry.path, TASK_JSON)):
                     continue
-                tjson = os.path.join(entry, TASK_JSON)
-                if os.path.isfile(tjson):
-                    try:
-                        with open(tjson, 'r') as f:
-                            jsondata = json.load(f)
-                        return FileBasedTask(entry, jsondata)
-                    except Exception as e:
-                            logger.exception('Unable to parse json for task ' +
-                                             entry + ' going to skip json: ' +
-                                             str(e))
-                            return FileBasedTask(entry, {})
-                else:
-                    logger.error('No json for task ' + entry +
-                                 ' going to skip json')
-                    return FileBasedTask(entry, {})
-        return None
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                        continue
+                except OSError:
+                    continue
+                orphans.append(entry.path)
+        return orphans
+
+    def sweep(self, time_budget=None):
+        """
+        Removes orphaned task directories
+        :param time_budget: maximum time in seconds to spend removing
+                            directories, remaining ones are removed
+                            by the next call. None means no limit
+        :return: number of directories removed
+        """
+        start_time = time.time()
+        removed = 0
+        for path in self.get_orphaned_taskdirs():
+            if (time_budget is not None and
+                    time.time() - start_time > time_budget):
+                break
+            try:
+                logger.info('Removing orphaned task directory ' + path)
+                remove_tree(path)
+                removed += 1
+            except Exception:
+                logger.exception('Caught exception removing orphaned task '
+                                 'directory ' + path)
+        return removed
+
+
+class TaskLayoutMigrator(object):
+    """
+    Moves task directories into **layout** while the REST service
+    and task runners keep running. Each task is moved with a single
+    rename, so it is always found in the old or new location, and
+    tasks claimed or deleted while being moved are skipped. Tasks
+    in processing are held by runners so they are not moved by
+    default, runners put them in their configured layout once done.
+    Address of tasks moved into a sharded layout is kept in
+    :py:const:`REMOTEIP_PARAM` of their task json, which the REST
+    service sets when a task is created
+    """
+    STATES = [SUBMITTED_STATUS, DONE_STATUS]
+
+    def __init__(self, taskdir, layout, states=None):
+        """
+        Constructor
+        :param taskdir: base directory of tasks
+        :param layout: TaskLayout to move tasks into
+        :param states: states whose tasks are moved, if None
+                       :py:const:`TaskLayoutMigrator.STATES` is used
+        """
+        self._taskdir = taskdir
+        self._layout = layout
+        if states is None:
+            states = TaskLayoutMigrator.STATES
+        self._states = states
+
+    def _get_ipaddress(self, taskdir):
+        """
+        Gets address task was submitted from
+        :param taskdir: task directory
+        :return: address as str or None if not known
+        """
+        taskdict = None
+        try:
+            with open(os.path.join(taskdir, TASK_JSON), 'r') as f:
+                taskdict = json.load(f)
+        except (OSError, ValueError):
+            pass
+        return FileBasedTask(taskdir, taskdict).get_ipaddress()
+
+    def _remove_empty_dirs(self, path, statedir):
+        """
+        Removes **path** and its parents up to **statedir**
+        while they are empty
+        """
+        while path != statedir and path.startswith(statedir + os.sep):
+            try:
+                os.rmdir(path)
+            except OSError:
+                return
+            path = os.path.dirname(path)
+
+    def migrate(self, dry_run=False, time_budget=None, pause=0):
+        """
+        Moves task directories into **layout**
+        :param dry_run: if True only log the moves
+        :param time_budget: maximum time in seconds to spend moving
+                            tasks, remaining ones are moved by the
+                            next call. None means no limit
+        :param pause: time in seconds to sleep after each move to
+                      limit load on the file system
+        :return: dict with number of tasks 'moved', 'skipped'
+                 because another process moved or deleted them
+                 first and 'failed'
+        """
+        start_time = time.time()
+        counts = {'moved': 0, 'skipped': 0, 'failed': 0}
+        for state in self._states:
+            statedir = os.path.join(self._taskdir, state)
+            for entry in self._layout.iter_taskdirs(statedir):
+                if (time_budget is not None and
+                        time.time() - start_time > time_budget):
+                    return counts
+                ipaddr = None
+                if self._layout.is_sharded() is False:
+                    ipaddr = self._get_ipaddress(entry.path)
+                    if ipaddr is None:
+                        logger.error('Unable to move ' + entry.path +
+                                     ' : address of submitter unknown')
+                        counts['failed'] += 1
+                        continue
+                try:
+                    dest = self._layout.get_taskdir(self._taskdir, state,
+                                                    entry.name,
+                                                    ipaddr=ipaddr)
+                except ValueError as e:
+                    logger.error('Unable to move ' + entry.path + ' : ' +
+                                 str(e))
+                    counts['failed'] += 1
+                    continue
+                if dest == entry.path:
+                    continue
+                logger.info('Moving ' + entry.path + ' to ' + dest)
+                if dry_run is True:
+                    counts['moved'] += 1
+                    continue
+                if os.path.exists(dest):
+                    logger.error('Unable to move ' + entry.path + ' : ' +
+                                 dest + ' exists')
+                    counts['failed'] += 1
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(dest), mode=0o775,
+                                exist_ok=True)
+                    os.rename(entry.path, dest)
+                except FileNotFoundError:
+                    logger.info('Skipping ' + entry.path + ' moved or '
+                                'deleted by another process')
+                    counts['skipped'] += 1
+                    continue
+                except OSError as e:
+                    logger.error('Unable to move ' + entry.path + ' : ' +
+                                 str(e))
+                    counts['failed'] += 1
+                    continue
+                counts['moved'] += 1
+                self._remove_empty_dirs(os.path.dirname(entry.path),
+                                        statedir)
+                if pause > 0:
+                    time.sleep(pause)
+        return counts
+
+
+class CoalescingTaskWriter(object):
+    """
+    Writes task json files from a background thread at most once per
+    **interval** seconds per task. Saves in between replace the
+    pending data, so frequent progress updates cost one write per
+    interval and the latest data is always written. Task json is
+    serialized when saved so later changes to the task dictionary do
+    not race with the write
+    """
+    def __init__(self, interval=1.0, fsync=FSYNC_NONE):
+        """
+        Constructor
+        :param interval: minimum time in seconds between writes of
+                         task json of a task
+        :param fsync: :py:const:`FSYNC_NONE` to never flush writes to
+                      disk, :py:const:`FSYNC_ALWAYS` to flush every
+                      write or :py:const:`FSYNC_INTERVAL` to flush all
+                      files written once per interval
+        :raises ValueError: if **fsync** is not a known policy
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: ' + str(fsync))
+        self._interval = interval
+        self._fsync = fsync
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._last_write = weakref.WeakKeyDictionary()
+        self._seq = 0
+        self._written_seq = weakref.WeakKeyDictionary()
+        self._unsynced = set()
+        self._write_count = 0
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """
+        Starts background thread
+        :return: None
+        """
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._write_loop,
+                                            name='task-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Writes all pending task json and stops background thread
+        :return: None
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        with self._cond:
+            self._thread = None
+        self._write_pending(force=True)
+
+    def get_write_count(self):
+        """
+        Gets number of task json files written
+        :return: int
+        """
+        with self._cond:
+            return self._write_count
+
+    def get_pending_count(self):
+        """
+        Gets number of tasks whose task json is waiting to be written
+        :return: int
+        """
+        with self._cond:
+            return len(self._pending)
+
+    def save(self, task):
+        """
+        Queues task json of **task** to be written. If background
+        thread is not running task json is written now
+        :param task: FileBasedTask
+        :return: None
+        """
+        data = json.dumps(task.get_taskdict())
+        with self._cond:
+            self._seq += 1
+            self._pending[task] = (self._seq, data)
+            self._cond.notify_all()
+        if self._thread is None:
+            self._write_pending(force=True)
+
+    def flush(self, task):
+        """
+        Writes pending task json of **task** now
+        :param task: FileBasedTask
+        :return: None
+        """
+        with self._cond:
+            entry = self._pending.pop(task, None)
+        if entry is not None:
+            self._write(task, entry[0], entry[1])
+        self._fsync_unsynced()
+
+    def _get_due_tasks(self, force=False):
+        """
+        Removes and returns pending tasks whose last write was at
+        least interval ago, called with condition held
+        :param force: if True all pending tasks are returned
+        :return: tuple (list of (task, seq, data), seconds until
+                 next pending task is due or None)
+        """
+        now = time.time()
+        due = []
+        wait = None
+        for task, (seq, data) in list(self._pending.items()):
+            remaining = (self._last_write.get(task, 0) + self._interval -
+                         now)
+            if force is True or remaining <= 0:
+                due.append((task, seq, data))
+                del self._pending[task]
+            elif wait is None or remaining < wait:
+                wait = remaining
+        return due, wait
+
+    def _write(self, task, seq, data):
+        """
+        Writes task json unless newer data was already written
+        :return: None
+        """
+        with task.get_lock():
+            with self._cond:
+                if self._written_seq.get(task, 0) >= seq:
+                    return
+                self._written_seq[task] = seq
+                self._last_write[task] = time.time()
+            try:
+                res = task.write_task_json(
+                    data, fsync=self._fsync == FSYNC_ALWAYS)
+            except Exception as e:
+                res = str(e)
+            if res is not None:
+                logger.warning('Unable to write task json of ' +
+                               str(task.get_taskdir()) + ' : ' + res)
+                return
+            with self._cond:
+                self._write_count += 1
+                if self._fsync == FSYNC_INTERVAL:
+                    self._unsynced.add(task.get_taskdir())
+
+    def _fsync_unsynced(self):
+        """
+        Flushes task json files written since last call to disk if
+        fsync policy is :py:const:`FSYNC_INTERVAL`
+        :return: None
+        """
+        with self._cond:
+            taskdirs = self._unsynced
+            self._unsynced = set()
+        for taskdir in taskdirs:
+            try:
+                tjsonfile = os.path.join(taskdir, TASK_JSON)
+                fd = os.open(tjsonfile, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                fsync_directory(taskdir)
+            except OSError as e:
+                logger.debug('Unable to fsync ' + taskdir + ' : ' + str(e))
+
+    def _write_pending(self, force=False):
+        """
+        Writes task json of pending tasks that are due
+        :param force: if True all pending tasks are written
+        :return: seconds until next pending task is due or None
+        """
+        with self._cond:
+            due, wait = self._get_due_tasks(force=force)
+        for task, seq, data in due:
+            self._write(task, seq, data)
+        self._fsync_unsynced()
+        return wait
+
+    def _write_loop(self):
+        """
+        Writes pending task json until stopped
+        :return: None
+        """
+        while True:
+            with self._cond:
+                if self._stopped is True:
+                    return
+                if len(self._pending) == 0:
+                    self._cond.wait()
+                    continue
+            wait = self._write_pending()
+            if wait is not None:
+                with self._cond:
+                    if self._stopped is False:
+                        self._cond.wait(timeout=wait)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+
+import sys
+import argparse
+import logging
+
+import diseasescope_rest_server
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import archive
+from diseasescope_rest_server.dao import TaskLayout
+from diseasescope_rest_server.archive import TaskArchiver
+
+
+logger = logging.getLogger('diseasescopearchivetasks')
+
+LOG_FORMAT = "%(asctime)-15s %(levelname)s %(relativeCreated)dms " \
+             "%(filename)s::%(funcName)s():%(lineno)d %(message)s"
+
+
+def _parse_arguments(desc, args):
+    """Parses command line arguments"""
+    help_fm = argparse.RawDescriptionHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('taskdir', help='Base directory of tasks')
+    parser.add_argument('--days', type=float, default=30.0,
+                        help='Number of days since task was done before '
+                             'it is archived')
+    parser.add_argument('--batch_size', type=int, default=100,
+                        help='Number of tasks appended to archive before '
+                             'their directories are removed')
+    parser.add_argument('--shard_width', type=int,
+                        default=dao.DEFAULT_SHARD_WIDTH,
+                        help='Number of characters of task id in name '
+                             'of each shard directory, must match task '
+                             'runner')
+    parser.add_argument('--time_budget', type=float,
+                        help='Maximum time in seconds to spend archiving '
+                             'tasks, if unset all old tasks are archived')
+    parser.add_argument('--verbose', '-v', action='count', default=0,
+                        help='Increases verbosity of logger to standard '
+                             'error for log messages in this module and '
+                             'in diseasescope_rest_server. Messages are '
+                             'output at these python logging levels '
+                             '-v = ERROR, -vv = WARNING, -vvv = INFO, '
+                             '-vvvv = DEBUG, -vvvvv = NOTSET')
+    parser.add_argument('--version', action='version',
+                        version=('%(prog)s ' +
+                                 diseasescope_rest_server.__version__))
+    return parser.parse_args(args)
+
+
+def _setup_logging(args):
+    """
+    Sets up logging based on parsed command line arguments.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    level = (50 - (10 * args.verbose))
+    logging.basicConfig(format=LOG_FORMAT, level=level)
+
+
+def run(theargs):
+    """
+    Archives old done tasks under taskdir set in **theargs**
+    :param theargs: parsed command line arguments
+    :return: 0 if all tasks were archived, 1 if any failed
+    """
+    archiver = TaskArchiver(theargs.taskdir,
+                            min_age=theargs.days * archive.DAY_SECONDS,
+                            layout=TaskLayout(
+                                shard_width=theargs.shard_width),
+                            batch_size=theargs.batch_size)
+    counts = archiver.archive_tasks(time_budget=theargs.time_budget)
+    sys.stdout.write('archived ' + str(counts['archived']) + ' failed ' +
+                     str(counts['failed']) + '\n')
+    if counts['failed'] > 0:
+        return 1
+    return 0
+
+
+def main(args):
+    """Main entry point"""
+    desc = """Archives done tasks of DiseaseScope REST Server older than
+    --days days. Results of tasks are packed into one compressed
+    segment file per day, with an index of where each result is,
+    under the archive directory of taskdir and the task directories
+    are removed. The REST service keeps returning results of archived
+    tasks. Meant to be run periodically, such as from cron, while the
+    REST service and task runners are up.
+
+    """
+    theargs = _parse_arguments(desc, args[1:])
+    theargs.program = args[0]
+    theargs.version = diseasescope_rest_server.__version__
+    _setup_logging(theargs)
+    try:
+        return run(theargs)
+    except Exception:
+        logger.exception('Caught exception archiving tasks')
+        return 2
+    finally:
+        logging.shutdown()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+import threading
+
+import diseasescope_rest_server
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import httpsession
+from diseasescope_rest_server import pipeline
+from diseasescope_rest_server import fakeservices
+from diseasescope_rest_server.fakeservices import FakeServices
+from diseasescope_rest_server.fakeservices import FakeServiceSettings
+from diseasescope_rest_server.fakeservices import FakeDiseaseScope
+from diseasescope_rest_server.dao import FileBasedSubmittedTaskFactory
+from diseasescope_rest_server.dao import DeletedFileBasedTaskFactory
+from diseasescope_rest_server import diseasescope_taskrunner
+
+
+logger = logging.getLogger('diseasescopebenchmark')
+
+LOG_FORMAT = "%(asctime)-15s %(levelname)s %(relativeCreated)dms " \
+             "%(filename)s::%(funcName)s():%(lineno)d %(message)s"
+
+# default latency in seconds of each fake service
+DEFAULT_LATENCIES = {fakeservices.BIOTHINGS_SERVICE: 0.05,
+                     fakeservices.BIGGIM_SERVICE: 0.2,
+                     fakeservices.MYGENE_SERVICE: 0.05,
+                     fakeservices.CLIXO_SERVICE: 0.5,
+                     fakeservices.NDEX_SERVICE: 0.1,
+                     fakeservices.HIVIEW_SERVICE: 0.0}
+
+
+def _parse_arguments(desc, args):
+    """Parses command line arguments"""
+    help_fm = argparse.RawDescriptionHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('--workdir',
+                        help='Directory to store tasks in, if unset a '
+                             'temporary directory is created and removed '
+                             'when done')
+    parser.add_argument('--jobs', type=int, default=20,
+                        help='Number of jobs to submit')
+    parser.add_argument('--latency', default='',
+                        help='Comma delimited list of <service>=<seconds> '
+                             'setting latency of fake services (' +
+                             ', '.join(fakeservices.SERVICES) + ')')
+    parser.add_argument('--payload_size', type=int, default=200,
+                        help='Number of items returned by each fake '
+                             'service')
+    parser.add_argument('--error_rate', type=float, default=0.0,
+                        help='Fraction, 0 to 1, of requests to fake '
+                             'services that fail with a 503')
+    parser.add_argument('--max_tasks', type=int, default=4,
+                        help='Maximum number of tasks runner processes '
+                             'at once')
+    parser.add_argument('--io_threads', type=int, default=8,
+                        help='Number of threads running I/O bound stages')
+    parser.add_argument('--cpu_threads', type=int,
+                        help='Number of threads running CPU bound stages, '
+                             'if unset number of CPUs is used')
+    parser.add_argument('--poll_interval', type=float, default=0.1,
+                        help='Time in seconds between polls of query '
+                             'result')
+    parser.add_argument('--timeout', type=float, default=3600.0,
+                        help='Time in seconds to wait for all jobs')
+    parser.add_argument('--seed', type=int,
+                        help='Seed for random errors of fake services')
+    parser.add_argument('--json', default=False, action='store_true',
+                        help='If set, report is written as json')
+    parser.add_argument('--verbose', '-v', action='count', default=0,
+                        help='Increases verbosity of logger to standard '
+                             'error for log messages in this module and '
+                             'in diseasescope_rest_server. Messages are '
+                             'output at these python logging levels '
+                             '-v = ERROR, -vv = WARNING, -vvv = INFO, '
+                             '-vvvv = DEBUG, -vvvvv = NOTSET')
+    parser.add_argument('--version', action='version',
+                        version=('%(prog)s ' +
+                                 diseasescope_rest_server.__version__))
+    return parser.parse_args(args)
+
+
+def _setup_logging(args):
+    """
+    Sets up logging based on parsed command line arguments.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    level = (50 - (10 * args.verbose))
+    logging.basicConfig(format=LOG_FORMAT, level=level)
+
+
+def get_percentile(values, percentile):
+    """
+    Gets percentile of values using nearest rank method
+    :param values: list of numbers
+    :param percentile: percentile in range 0-100
+    :return: value at percentile or None if **values** is empty
+    """
+    if values is None or len(values) == 0:
+        return None
+    svals = sorted(values)
+    rank = int(math.ceil(percentile / 100.0 * len(svals))) - 1
+    return svals[max(0, min(rank, len(svals) - 1))]
+
+
+class BenchmarkResult(object):
+    """
+    Collects time to result and stage timings of benchmark jobs
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._times = []
+        self._failed = 0
+        self._stages = {}
+        self._elapsed = None
+
+    def add_job(self, time_to_result, data):
+        """
+        Adds finished job
+        :param time_to_result: time in seconds from submit to result
+        :param data: json returned by query result endpoint
+        :return: None
+        """
+        self._times.append(time_to_result)
+        if data.get(dao.STATUS_RESULT_KEY) != dao.DONE_STATUS:
+            self._failed += 1
+        stages = data.get(dao.STAGES_KEY)
+        if not isinstance(stages, dict):
+            return
+        for name, entry in stages.items():
+            duration = entry.get(pipeline.STAGE_DURATION_KEY)
+            if duration is None:
+                continue
+            self._stages[name] = self._stages.get(name, 0) + duration
+
+    def set_elapsed(self, elapsed):
+        """
+        Sets time in seconds benchmark took
+        :param elapsed:
+        :return:
+        """
+        self._elapsed = elapsed
+
+    def get_report(self, jobs):
+        """
+        Gets report of benchmark
+        :param jobs: number of jobs submitted
+        :return: dict
+        """
+        jobs_per_hour = None
+        if self._elapsed:
+            jobs_per_hour = len(self._times) * 3600.0 / self._elapsed
+        total = sum(self._stages.values())
+        stages = {}
+        for name, duration in self._stages.items():
+            stages[name] = {'duration': duration,
+                            'fraction': duration / total if total else 0.0}
+        return {'jobs': jobs,
+                'completed': len(self._times) - self._failed,
+                'failed': self._failed,
+                'unfinished': jobs - len(self._times),
+                'elapsed': self._elapsed,
+                'jobsPerHour': jobs_per_hour,
+                'timeToResultP50': get_percentile(self._times, 50),
+                'timeToResultP99': get_percentile(self._times, 99),
+                'stages': stages}
+
+
+def format_report(report):
+    """
+    Formats report as human readable text
+    :param report: dict from :py:meth:`BenchmarkResult.get_report`
+    :return: str
+    """
+    lines = []
+    for key in ['jobs', 'completed', 'failed', 'unfinished', 'elapsed',
+                'jobsPerHour', 'timeToResultP50', 'timeToResultP99']:
+        val = report[key]
+        if isinstance(val, float):
+            val = '%.3f' % val
+        lines.append('%-16s %s' % (key, val))
+    lines.append('Stage split (total milliseconds, fraction):')
+    for name in sorted(report['stages'].keys()):
+        entry = report['stages'][name]
+        lines.append('  %-28s %10d %6.1f%%' % (name, entry['duration'],
+                                               entry['fraction'] * 100.0))
+    return '\n'.join(lines)
+
+
+def run_benchmark(workdir, jobs, services, poll_interval=0.1,
+                  timeout=3600, session=None, max_tasks=1,
+                  stagepools=None):
+    """
+    Submits **jobs** queries to the REST service, runs them with a
+    task runner whose DiseaseScope objects call **services** and
+    polls the REST service until every job finishes
+    :param workdir: directory to store tasks in
+    :param jobs: number of jobs to run
+    :param services: started FakeServices
+    :param poll_interval: time in seconds between polls of each job
+    :param timeout: time in seconds to wait for all jobs
+    :param session: PooledSession DiseaseScope objects call services
+                    with, if None :py:mod:`requests` is used
+    :param max_tasks: maximum number of tasks runner processes at once
+    :param stagepools: StagePools runner runs stages on
+    :return: BenchmarkResult
+    """
+    app = diseasescope_rest_server.app
+    app.config[diseasescope_rest_server.JOB_PATH_KEY] = workdir
+    diseasescope_rest_server.limiter.enabled = False
+    client = app.test_client()
+
+    runner = diseasescope_taskrunner.Diseasescopetaskrunner(
+        wait_time=poll_interval,
+        taskfactory=FileBasedSubmittedTaskFactory(workdir),
+        deletetaskfactory=DeletedFileBasedTaskFactory(workdir),
+        httpsession=session,
+        stagepools=stagepools,
+        max_tasks=max_tasks,
+        scope_factory=lambda task: FakeDiseaseScope(
+            task.get_taskdict()[dao.DOID_PARAM], services,
+            session=session))
+    stop = threading.Event()
+    runner_thread = threading.Thread(target=runner.run_tasks,
+                                     kwargs={'keep_looping':
+                                             lambda: not stop.is_set()},
+                                     name='benchmark-runner')
+    runner_thread.daemon = True
+
+    result = BenchmarkResult()
+    pending = {}
+    start_time = time.time()
+    runner_thread.start()
+    try:
+        for i in range(jobs):
+            rv = client.post(diseasescope_rest_server.SERVICE_NS,
+                             json={dao.DOID_PARAM: 1000 + i})
+            if rv.status_code != 202:
+                raise Exception('Unable to submit job: ' +
+                                rv.data.decode('utf-8'))
+            pending[json.loads(rv.data)['id']] = time.time()
+
+        while len(pending) > 0 and time.time() - start_time < timeout:
+            time.sleep(poll_interval)
+            for taskid in list(pending.keys()):
+                rv = client.get(diseasescope_rest_server.SERVICE_NS +
+                                '/' + taskid)
+                if rv.status_code != 200:
+                    continue
+                data = json.loads(rv.data)
+                if data.get(dao.STATUS_RESULT_KEY) not in [dao.DONE_STATUS,
+                                                           dao.ERROR_STATUS]:
+                    continue
+                result.add_job(time.time() - pending[taskid], data)
+                del pending[taskid]
+    finally:
+        result.set_elapsed(time.time() - start_time)
+        stop.set()
+        runner_thread.join(timeout=60)
+    return result
+
+
+def run(theargs):
+    """
+    Runs benchmark
+    :param theargs: parsed command line arguments
+    :return: 0 upon success otherwise 1
+    """
+    latencies = dict(DEFAULT_LATENCIES)
+    latencies.update(pipeline.parse_stage_times(theargs.latency))
+    settings = {}
+    for service in fakeservices.SERVICES:
+        settings[service] = FakeServiceSettings(
+            latency=latencies.get(service, 0.0),
+            payload_size=theargs.payload_size,
+            error_rate=theargs.error_rate)
+    services = FakeServices(settings=settings, seed=theargs.seed)
+
+    if theargs.workdir is None:
+        workdir = tempfile.mkdtemp(prefix='diseasescope_benchmark')
+    else:
+        workdir = os.path.abspath(theargs.workdir)
+    stagepools = pipeline.StagePools(io_workers=theargs.io_threads,
+                                     cpu_workers=theargs.cpu_threads)
+    services.start()
+    try:
+        result = run_benchmark(workdir, theargs.jobs, services,
+                               poll_interval=theargs.poll_interval,
+                               timeout=theargs.timeout,
+                               session=httpsession.PooledSession(
+                                   backoff_factor=0.05),
+                               max_tasks=theargs.max_tasks,
+                               stagepools=stagepools)
+    finally:
+        services.stop()
+        stagepools.shutdown(wait=False)
+        if theargs.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = result.get_report(theargs.jobs)
+    report['requests'] = {s: services.get_request_count(s)
+                          for s in fakeservices.SERVICES}
+    if theargs.json is True:
+        sys.stdout.write(json.dumps(report, indent=2) + '\n')
+    else:
+        sys.stdout.write(format_report(report) + '\n')
+    if report['unfinished'] > 0:
+        return 1
+    return 0
+
+
+def main(args):
+    """Main entry point"""
+    desc = """Runs an offline end to end benchmark of DiseaseScope REST
+    Server and task runner. Jobs are submitted to the REST service,
+    run by a task runner whose external service calls go to local
+    fake services and polled until done. Reports jobs per hour,
+    p50 and p99 time to result and how time splits across pipeline
+    stages.
+
+    """
+    theargs = _parse_arguments(desc, args[1:])
+    theargs.program = args[0]
+    theargs.version = diseasescope_rest_server.__version__
+    _setup_logging(theargs)
+    try:
+        return run(theargs)
+    except Exception:
+        logger.exception('Caught exception running benchmark')
+        return 2
+    finally:
+        logging.shutdown()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
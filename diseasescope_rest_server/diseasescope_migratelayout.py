@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+
+import sys
+import argparse
+import logging
+
+import diseasescope_rest_server
+from diseasescope_rest_server import dao
+from diseasescope_rest_server.dao import TaskLayout
+from diseasescope_rest_server.dao import TaskLayoutMigrator
+
+
+logger = logging.getLogger('diseasescopemigratelayout')
+
+LOG_FORMAT = "%(asctime)-15s %(levelname)s %(relativeCreated)dms " \
+             "%(filename)s::%(funcName)s():%(lineno)d %(message)s"
+
+
+def _parse_arguments(desc, args):
+    """Parses command line arguments"""
+    help_fm = argparse.RawDescriptionHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('taskdir', help='Base directory of tasks')
+    parser.add_argument('--shard_depth', type=int,
+                        default=dao.DEFAULT_SHARD_DEPTH,
+                        help='Number of shard directories, taken from '
+                             'start of task id, to move tasks under. '
+                             'Set to 0 to move tasks back under '
+                             'directories named after address of '
+                             'submitter')
+    parser.add_argument('--shard_width', type=int,
+                        default=dao.DEFAULT_SHARD_WIDTH,
+                        help='Number of characters of task id in name '
+                             'of each shard directory')
+    parser.add_argument('--states',
+                        default=','.join(TaskLayoutMigrator.STATES),
+                        help='Comma delimited list of states whose tasks '
+                             'are moved. Tasks in ' +
+                             dao.PROCESSING_STATUS + ' are held by task '
+                             'runners which move them into their '
+                             'configured layout when done')
+    parser.add_argument('--time_budget', type=float,
+                        help='Maximum time in seconds to spend moving '
+                             'tasks, if unset all tasks are moved')
+    parser.add_argument('--pause', type=float, default=0.0,
+                        help='Time in seconds to wait after each move '
+                             'to limit load on file system')
+    parser.add_argument('--dry_run', default=False, action='store_true',
+                        help='If set, moves are logged but not done')
+    parser.add_argument('--verbose', '-v', action='count', default=0,
+                        help='Increases verbosity of logger to standard '
+                             'error for log messages in this module and '
+                             'in diseasescope_rest_server. Messages are '
+                             'output at these python logging levels '
+                             '-v = ERROR, -vv = WARNING, -vvv = INFO, '
+                             '-vvvv = DEBUG, -vvvvv = NOTSET')
+    parser.add_argument('--version', action='version',
+                        version=('%(prog)s ' +
+                                 diseasescope_rest_server.__version__))
+    return parser.parse_args(args)
+
+
+def _setup_logging(args):
+    """
+    Sets up logging based on parsed command line arguments.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    level = (50 - (10 * args.verbose))
+    logging.basicConfig(format=LOG_FORMAT, level=level)
+
+
+def run(theargs):
+    """
+    Moves tasks into layout set by **theargs**
+    :param theargs: parsed command line arguments
+    :return: 0 if all tasks were moved, 1 if any failed
+    """
+    layout = TaskLayout(shard_depth=theargs.shard_depth,
+                        shard_width=theargs.shard_width)
+    states = [s.strip() for s in theargs.states.split(',')
+              if len(s.strip()) > 0]
+    migrator = TaskLayoutMigrator(theargs.taskdir, layout, states=states)
+    counts = migrator.migrate(dry_run=theargs.dry_run,
+                              time_budget=theargs.time_budget,
+                              pause=theargs.pause)
+    sys.stdout.write('moved ' + str(counts['moved']) + ' skipped ' +
+                     str(counts['skipped']) + ' failed ' +
+                     str(counts['failed']) + '\n')
+    if counts['failed'] > 0:
+        return 1
+    return 0
+
+
+def main(args):
+    """Main entry point"""
+    desc = """Moves tasks of DiseaseScope REST Server into a new
+    directory layout, such as from directories named after address
+    of submitter to directories sharded on task id. Can be run while
+    REST service and task runners are up, each task is moved with a
+    single rename. Once done set SHARD_DEPTH and SHARD_WIDTH of REST
+    service and --shard_depth and --shard_width of task runners to
+    match.
+
+    """
+    theargs = _parse_arguments(desc, args[1:])
+    theargs.program = args[0]
+    theargs.version = diseasescope_rest_server.__version__
+    _setup_logging(theargs)
+    try:
+        return run(theargs)
+    except Exception:
+        logger.exception('Caught exception moving tasks')
+        return 2
+    finally:
+        logging.shutdown()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -4,15 +4,37 @@
 import os
 import sys
 import argparse
+import functools
 import logging
 import logging.config
 import time
+import signal
+import threading
+import subprocess
 from datetime import datetime
 import daemon
 import diseasescope_rest_server
 from diseasescope_rest_server import dao
+from diseasescope_rest_server import cache
+from diseasescope_rest_server import httpsession
+from diseasescope_rest_server import clixo
+from diseasescope_rest_server import metrics
+from diseasescope_rest_server import tracing
+from diseasescope_rest_server import refdata
+from diseasescope_rest_server.scratch import ScratchSpace
+from diseasescope_rest_server.lease import TaskLeaseManager
+from diseasescope_rest_server.profiling import ProfilePolicy
+from diseasescope_rest_server.estimate import StageDurationModel
+from diseasescope_rest_server import estimate
+from diseasescope_rest_server.profiling import TaskProfiler
+from diseasescope_rest_server import profiling
 from diseasescope_rest_server.dao import FileBasedSubmittedTaskFactory
 from diseasescope_rest_server.dao import DeletedFileBasedTaskFactory
+from diseasescope_rest_server.dao import OrphanedTaskSweeper
+from diseasescope_rest_server.dao import CoalescingTaskWriter
+from diseasescope_rest_server.pipeline import DiseaseScopePipeline
+from diseasescope_rest_server.pipeline import TaskMonitor
+from diseasescope_rest_server import pipeline
 from diseasescope.diseasescope import DiseaseScope
 
 
@@ -22,6 +44,13 @@ logger = logging.getLogger('diseasescopetaskrunner')
 LOG_FORMAT = "%(asctime)-15s %(levelname)s %(relativeCreated)dms " \
              "%(filename)s::%(funcName)s():%(lineno)d %(message)s"
 
+# returned by watchdog when task was cancelled by a delete request
+CANCEL_DELETED = 'deleted'
+
+# returned by watchdog when task was cancelled because the drain
+# deadline of the runner passed and it was put back in submitted queue
+CANCEL_REQUEUED = 'requeued'
+
 
 def _parse_arguments(desc, args):
     """Parses command line arguments"""
@@ -38,12 +67,224 @@ def _parse_arguments(desc, args):
     parser.add_argument('--disabledelete', action='store_true',
                         help='If set, task runner will NOT monitor '
                              'delete requests')
+    parser.add_argument('--delete_time_budget', type=float, default=10.0,
+                        help='Maximum time in seconds to spend deleting '
+                             'tasks each time the runner looks for '
+                             'new tasks. Any remaining delete requests '
+                             'are handled in the next cycle')
+    parser.add_argument('--cancel_poll_interval', type=float, default=5.0,
+                        help='Time in seconds between checks for a delete '
+                             'request of the task currently running')
+    parser.add_argument('--task_timeout', type=float,
+                        help='If set, tasks running longer then this '
+                             'many seconds are stopped and moved to error')
+    parser.add_argument('--stage_timeouts', default='',
+                        help='Comma delimited list of <stage>=<seconds> '
+                             'setting maximum time a pipeline stage can '
+                             'run (ie infer_hierarchical_model=7200). '
+                             'Tasks with a stage exceeding its timeout '
+                             'are stopped and moved to error')
+    parser.add_argument('--default_stage_timeout', type=float,
+                        help='If set, maximum time in seconds any stage '
+                             'not listed in --stage_timeouts can run')
+    parser.add_argument('--watchdog_interval', type=float, default=1.0,
+                        help='Time in seconds between checks of running '
+                             'task for timeouts')
+    parser.add_argument('--drain_timeout', type=float, default=600.0,
+                        help='Time in seconds tasks in flight can run '
+                             'after SIGTERM or SIGHUP before they are '
+                             'stopped and put back in the submitted queue '
+                             'to resume from their checkpoints. No new '
+                             'tasks are claimed once either signal is '
+                             'received. SIGHUP also starts a replacement '
+                             'runner, with configuration reloaded, that '
+                             'claims tasks while this one drains')
     parser.add_argument('--nodaemon', default=False, action='store_true',
                         help='If set program will NOT run in daemon mode')
     parser.add_argument('--doidmappingfile', required=True,
                         help='DOID mapping file')
     parser.add_argument('--genesetfile', required=True,
                         help='Gene set file')
+    parser.add_argument('--cachedir',
+                        help='If set, output of pipeline stages that only '
+                             'depend on disease id and reference data, '
+                             'such as disease genes, tissues and the '
+                             'BigGIM network, are cached in this directory '
+                             'and shared by all runners using it')
+    parser.add_argument('--cachemaxsize', type=int, default=1024,
+                        help='Maximum size of cache in megabytes. Least '
+                             'recently used entries are removed once '
+                             'exceeded')
+    parser.add_argument('--cachettl', default='',
+                        help='Comma delimited list of <stage>=<seconds> '
+                             'setting how long cached output of a stage '
+                             'is valid (ie get_network=86400)')
+    parser.add_argument('--cachedefaultttl', type=int,
+                        default=cache.DEFAULT_TTL,
+                        help='Time in seconds cached output of a stage '
+                             'not listed in --cachettl is valid')
+    parser.add_argument('--max_tasks', type=int, default=1,
+                        help='Maximum number of tasks processed at once')
+    parser.add_argument('--io_threads', type=int, default=8,
+                        help='Number of threads running I/O bound pipeline '
+                             'stages, such as calls to biothings, BigGIM, '
+                             'CLIXO API, NDEx and HiView, shared by all '
+                             'tasks in flight')
+    parser.add_argument('--cpu_threads', type=int,
+                        help='Number of threads running CPU bound pipeline '
+                             'stages, such as edge table conversion, '
+                             'shared by all tasks in flight. If unset, '
+                             'number of CPUs is used')
+    parser.add_argument('--stage_queue_size', type=int, default=16,
+                        help='Maximum number of stages waiting for a '
+                             'thread of the I/O or CPU pool before tasks '
+                             'wait to submit more')
+    parser.add_argument('--max_abandoned_stages', type=int,
+                        default=pipeline.DEFAULT_MAX_ABANDONED,
+                        help='Maximum number of stages abandoned by tasks '
+                             'that timed out or were deleted, but still '
+                             'running because they never returned, in the '
+                             'I/O or CPU pool. Each holds a thread and a '
+                             'copy of the task data. Once reached, the '
+                             'pool refuses new stages, tasks that need it '
+                             'are put back in the submitted queue and the '
+                             'runner drains and starts a replacement, as '
+                             'on SIGHUP')
+    parser.add_argument('--infer_method', default=clixo.CLIXO_API_METHOD,
+                        choices=clixo.INFER_METHODS,
+                        help='How hierarchical model is inferred. ' +
+                             clixo.CLIXO_API_METHOD + ' sends network to '
+                             'the CLIXO API, ' + clixo.CLIXO_LOCAL_METHOD +
+                             ' runs CLIXO set by --clixo_cmd locally')
+    parser.add_argument('--clixo_cmd', default='clixo',
+                        help='Path to CLIXO binary used by ' +
+                             clixo.CLIXO_LOCAL_METHOD)
+    parser.add_argument('--clixo_max_instances', type=int, default=2,
+                        help='Maximum number of local CLIXO processes '
+                             'run at once')
+    parser.add_argument('--clixo_cores', type=int, default=1,
+                        help='Number of CPUs given to each local CLIXO '
+                             'process')
+    parser.add_argument('--clixo_timeout', type=float,
+                        help='If set, local CLIXO processes running '
+                             'longer then this many seconds are killed. '
+                             'CLIXO is also killed when its task is '
+                             'cancelled, such as by a stage or task '
+                             'timeout or a delete request')
+    parser.add_argument('--scratchdir',
+                        help='If set, temporary files of tasks, such as '
+                             'CLIXO input and output, are written to a '
+                             'directory per task under this directory '
+                             'instead of the task directory. Should be on '
+                             'node local storage such as SSD or tmpfs. '
+                             'Only files kept as task output are copied '
+                             'to the task directory')
+    parser.add_argument('--task_write_interval', type=float, default=1.0,
+                        help='Minimum time in seconds between writes of '
+                             'task json of a task. Updates in between, such '
+                             'as task progress and stage timing, are '
+                             'coalesced into one write')
+    parser.add_argument('--fsync', default=dao.FSYNC_NONE,
+                        choices=dao.FSYNC_POLICIES,
+                        help='When writes of task json are flushed to '
+                             'disk, ' + dao.FSYNC_NONE + ' leaves it to the '
+                             'operating system, ' + dao.FSYNC_ALWAYS +
+                             ' flushes every write and ' +
+                             dao.FSYNC_INTERVAL + ' flushes all writes '
+                             'once per --task_write_interval')
+    parser.add_argument('--lease_time', type=float, default=300.0,
+                        help='Time in seconds a runner\'s lease on a task '
+                             'it processes is valid without a heartbeat. '
+                             'Heartbeats are written every third of this')
+    parser.add_argument('--recovery_interval', type=float, default=60.0,
+                        help='Time in seconds between checks for tasks in '
+                             'processing whose lease expired, such as '
+                             'those of a runner that died')
+    parser.add_argument('--max_recoveries', type=int, default=3,
+                        help='Number of times a task whose lease expired '
+                             'is put back in the queue before it is moved '
+                             'to error')
+    parser.add_argument('--sweep_interval', type=float, default=3600.0,
+                        help='Time in seconds between removals of orphaned '
+                             'task directories, those without a task json '
+                             'file. 0 or less disables removal')
+    parser.add_argument('--orphan_age', type=float, default=86400.0,
+                        help='Time in seconds since last change before a '
+                             'task directory without a task json file is '
+                             'removed as orphaned')
+    parser.add_argument('--shard_depth', type=int, default=0,
+                        help='Number of directories, named after slices '
+                             'of the task id, tasks are put under when '
+                             'they change state, ie 2 for '
+                             '<state>/<id[0:2]>/<id[2:4]>/<id>. 0 puts '
+                             'tasks under <state>/<remote ip>/<id>. '
+                             'Should match SHARD_DEPTH of REST service. '
+                             'Tasks are found in either layout')
+    parser.add_argument('--shard_width', type=int,
+                        default=dao.DEFAULT_SHARD_WIDTH,
+                        help='Number of characters of task id in name '
+                             'of each shard directory')
+    parser.add_argument('--http_retries', type=int, default=5,
+                        help='Number of times requests to external '
+                             'services are retried on connection errors '
+                             'and 5xx responses')
+    parser.add_argument('--http_backoff', type=float, default=0.5,
+                        help='Base time in seconds of exponential '
+                             'backoff, with jitter, between retries')
+    parser.add_argument('--http_timeout', type=float, default=600.0,
+                        help='Time in seconds to wait for a response from '
+                             'an external service')
+    parser.add_argument('--http_pool_size', type=int, default=10,
+                        help='Maximum keep-alive connections per host')
+    parser.add_argument('--circuit_failures', type=int, default=5,
+                        help='Consecutive failed requests to a host after '
+                             'which requests to it are rejected')
+    parser.add_argument('--circuit_reset', type=float, default=60.0,
+                        help='Time in seconds requests to a failing host '
+                             'are rejected before one is tried again')
+    parser.add_argument('--metrics_port', type=int,
+                        help='If set, metrics are served in Prometheus '
+                             'text format at http://<metrics_address>:'
+                             '<metrics_port>' + metrics.METRICS_PATH +
+                             '. While the port is in use, such as by the '
+                             'runner a SIGHUP replaces until it exits, '
+                             'binding is retried')
+    parser.add_argument('--metrics_address', default='127.0.0.1',
+                        help='Address metrics are served on')
+    parser.add_argument('--metrics_file',
+                        help='If set, metrics are written in Prometheus '
+                             'text format to this file, for the textfile '
+                             'collector of the node exporter, every '
+                             '--metrics_interval seconds')
+    parser.add_argument('--metrics_interval', type=float, default=15.0,
+                        help='Time in seconds between writes of '
+                             '--metrics_file')
+    parser.add_argument('--profile', action='store_true',
+                        help='If set, every pipeline stage of every task '
+                             'is profiled with cProfile and tracemalloc. '
+                             'Profiles are written to the task directory '
+                             'as ' + profiling.PROFILE_SUMMARY_FILE +
+                             ' and ' + profiling.PROFILE_FILE_PREFIX +
+                             '<stage>' + profiling.PROFILE_FILE_SUFFIX +
+                             '. Tasks submitted with ' +
+                             dao.PROFILE_PARAM + ' set to true are '
+                             'profiled regardless')
+    parser.add_argument('--profile_rate', type=float, default=0.0,
+                        help='Fraction, from 0 to 1, of tasks to profile '
+                             'when --profile is not set')
+    parser.add_argument('--trace_file',
+                        help='If set, spans of tasks, covering queue wait, '
+                             'claim, each pipeline stage and each call to '
+                             'an external service, are appended to this '
+                             'file in zipkin v2 json format, one span '
+                             'per line')
+    parser.add_argument('--trace_collector',
+                        help='If set, spans of tasks are posted to this '
+                             'zipkin compatible collector url (ie '
+                             'http://localhost:9411/api/v2/spans)')
+    parser.add_argument('--trace_service',
+                        default=tracing.DEFAULT_SERVICE_NAME,
+                        help='Service name set on spans')
     parser.add_argument('--logconfig', help='Logging configuration file')
     parser.add_argument('--version', action='version',
                         version=('%(prog)s ' + diseasescope_rest_server.__version__))
@@ -58,46 +299,210 @@ class Diseasescopetaskrunner(object):
                  taskfactory=None,
                  deletetaskfactory=None,
                  doidfile=None,
-                 genesetfile=None):
+                 genesetfile=None,
+                 delete_time_budget=None,
+                 stagecache=None,
+                 cancel_poll_interval=5,
+                 task_timeout=None,
+                 stage_timeouts=None,
+                 default_stage_timeout=None,
+                 watchdog_interval=1,
+                 httpsession=None,
+                 scope_factory=None,
+                 stagepools=None,
+                 max_tasks=1,
+                 stages=None,
+                 scratchspace=None,
+                 sweeper=None,
+                 sweep_interval=3600,
+                 taskwriter=None,
+                 leasemanager=None,
+                 recovery_interval=60,
+                 replacement_factory=None,
+                 metrics=None,
+                 profilepolicy=None,
+                 tracer=None,
+                 durationmodel=None,
+                 referencedata=None):
+        """
+        Constructor
+        :param httpsession: PooledSession that requests made by
+                            :py:class:`DiseaseScope` are sent through,
+                            if None they are made by :py:mod:`requests`
+        :param scope_factory: function that takes a task and returns
+                              the DiseaseScope object to run the pipeline
+                              on, if None :py:class:`DiseaseScope` is used
+        :param stagepools: StagePools shared by all tasks in flight,
+                           if None each task uses its own pools
+        :param max_tasks: maximum number of tasks processed at once
+        :param stages: list of PipelineStage objects to run, if None
+                       :py:func:`pipeline.get_diseasescope_stages`
+                       is used
+        :param scratchspace: ScratchSpace where temporary files of
+                             tasks are written, if None they are
+                             written to the task directory
+        :param sweeper: OrphanedTaskSweeper run every
+                        **sweep_interval** seconds, None to not
+                        remove orphaned task directories
+        :param sweep_interval: time in seconds between sweeps
+        :param taskwriter: CoalescingTaskWriter that writes task json
+                           of tasks being processed, if None task json
+                           is written on every save
+        :param leasemanager: TaskLeaseManager used to hold leases on
+                             tasks being processed and to recover tasks
+                             whose lease expired, None to not use leases
+        :param recovery_interval: time in seconds between checks for
+                                  tasks whose lease expired
+        :param replacement_factory: function taking no arguments that
+                                    starts a replacement runner, called
+                                    when a drain with replacement is
+                                    requested
+        :param metrics: MetricsRegistry where claim latency, queue wait
+                        and outcome of tasks are recorded, None to not
+                        record metrics
+        :param profilepolicy: ProfilePolicy deciding which tasks have
+                              their stages profiled, None to profile
+                              no tasks
+        :param tracer: Tracer recording spans of each task in the
+                       trace whose id is in the task json, None to
+                       not record spans
+        :param durationmodel: StageDurationModel the stage durations
+                              of tasks done are added to, used by the
+                              REST service to estimate when tasks
+                              start and finish. None to not record
+                              durations
+        :param referencedata: ReferenceData holding **doidfile** and
+                              **genesetfile**, that
+                              :py:class:`DiseaseScope` reads them from
+                              so they are read and parsed once for all
+                              tasks. If None every task reads them
+        """
         self._taskfactory = taskfactory
         self._wait_time = wait_time
         self._deletetaskfactory = deletetaskfactory
+        self._delete_time_budget = delete_time_budget
         self._doidfile = doidfile
         self._geneset_file = genesetfile
+        self._cancel_poll_interval = cancel_poll_interval
+        self._task_timeout = task_timeout
+        if stage_timeouts is None:
+            self._stage_timeouts = {}
+        else:
+            self._stage_timeouts = stage_timeouts
+        self._default_stage_timeout = default_stage_timeout
+        self._watchdog_interval = watchdog_interval
+        self._stall_time = 0.0
+        self._stats_lock = threading.Lock()
+        self._max_tasks = max(max_tasks, 1)
+        self._active_tasks = {}
+        self._httpsession = httpsession
+        self._timed_out_tasks = 0
+        self._scratchspace = scratchspace
+        self._sweeper = sweeper
+        self._sweep_interval = sweep_interval
+        self._last_sweep = None
+        self._taskwriter = taskwriter
+        self._leasemanager = leasemanager
+        self._recovery_interval = recovery_interval
+        self._last_recovery = None
+        self._replacement_factory = replacement_factory
+        self._draining = False
+        self._drain_deadline = None
+        self._replace = False
+        self._requeue_in_flight = False
+        self._metrics = metrics
+        self._stagepools = stagepools
+        self._profilepolicy = profilepolicy
+        self._tracer = tracer
+        self._referencedata = referencedata
+        self._route_diseasescope = scope_factory is None
+        if scope_factory is None:
+            scope_factory = self._create_diseasescope
+        self._pipeline = DiseaseScopePipeline(scope_factory,
+                                              cache=stagecache,
+                                              pools=stagepools,
+                                              stages=stages,
+                                              metrics=metrics)
+        self._durationmodel = durationmodel
+        if durationmodel is not None:
+            durationmodel.set_stages(self._pipeline.get_stages())
+
+    def _create_diseasescope(self, task):
+        """
+        Creates DiseaseScope object for task
+        :param task: task to process
+        :return: DiseaseScope object
+        """
+        taskdict = task.get_taskdict()
+        return DiseaseScope(taskdict['doid'], convert_doid=True,
+                            doid_mapping_file=self._doidfile,
+                            geneset_file=self._geneset_file)
 
     def _process_task(self, task, delete_temp_files=True):
         """
-        Processes a task
+        Processes a task. The pipeline is run in a separate thread
+        watched by this one, which enforces stage and task timeouts
+        and cancels the task if a delete request for it arrives
         :param taskdir:
         :return:
         """
         logger.info('Task dir: ' + task.get_taskdir())
-        task.move_task(dao.PROCESSING_STATUS)
+        if task.get_state() != dao.PROCESSING_STATUS:
+            task.move_task(dao.PROCESSING_STATUS)
         taskdict = task.get_taskdict()
-        scope = (
-            DiseaseScope(taskdict['doid'], convert_doid=True,
-                         doid_mapping_file=self._doidfile,
-                         geneset_file=self._geneset_file)
-                .get_disease_genes(method="biothings")
-                .get_disease_tissues(n=10)
-                .expand_gene_set(method='biggim')
-                .get_network(method="biggim")
-                .convert_edge_table_names(
-                ["Gene1", "Gene2"],
-                'entrezgene',
-                "symbol",
-                keep=False
-            )
-                .infer_hierarchical_model(
-                edge_attr="mean",
-                method='clixo-api',
-                temp_path=task.get_taskdir(),
-                method_kwargs={
-                    'alpha': 0.01,
-                    'beta': 0.5,
-                }
-            )
-        )
+        if isinstance(taskdict, dict) and 'submitTime' in taskdict:
+            curtime = diseasescope_rest_server.milliseconds_since_epoch(
+                datetime.utcnow())
+            taskdict[dao.QUEUE_WAIT_TIME_KEY] = (curtime -
+                                                 taskdict['submitTime'])
+            if self._metrics is not None:
+                self._metrics.observe(metrics.QUEUE_WAIT_SECONDS,
+                                      taskdict[dao.QUEUE_WAIT_TIME_KEY] /
+                                      1000.0)
+
+        monitor = TaskMonitor()
+        result = {}
+        profiler = self._create_profiler(task)
+        worker = threading.Thread(target=self._run_pipeline,
+                                  args=(task, monitor, result, profiler,
+                                        tracing.get_current_span()),
+                                  name='pipeline-' + str(task.get_task_uuid()))
+        worker.daemon = True
+        worker.start()
+        reason = self._watch_pipeline(task, monitor, worker)
+        if profiler is not None:
+            profiler.stop()
+            if reason is None:
+                self._save_profile(task, profiler)
+        if reason == CANCEL_DELETED:
+            logger.info('Deleting cancelled task: ' + task.get_taskdir())
+            self._delete_cancelled_task(task)
+            self._record_outcome('deleted')
+            return
+        if reason == CANCEL_REQUEUED:
+            logger.info('Requeueing task stopped by drain: ' +
+                        task.get_taskdir())
+            task.move_task(dao.SUBMITTED_STATUS)
+            self._record_outcome('requeued')
+            return
+        if reason is not None:
+            # the pipeline thread stops once it sees the cancel and
+            # stages still running are abandoned, freeing their place
+            # in the stage pools, and write nothing further to the task
+            logger.error('Task timed out: ' + reason)
+            task.move_task(dao.ERROR_STATUS, error_message=reason)
+            self._record_outcome('timeout')
+            return
+        if isinstance(result.get('error'), pipeline.StagePoolExhaustedError):
+            logger.warning('Requeueing task refused by stage pools: ' +
+                           str(result['error']))
+            task.move_task(dao.SUBMITTED_STATUS)
+            self._record_outcome('requeued')
+            return
+        if 'error' in result:
+            raise result['error']
+
+        scope = result['scope']
         logger.info('Task finished')
         # ADD PROCESSING LOGIC HERE
         emsg = None
@@ -105,14 +510,15 @@ class Diseasescopetaskrunner(object):
         taskdict['progress'] = 100
         taskdict['result'] = {
             "hiviewurl": scope.hiview_url,
-            "ndexurl": ""}
+            "ndexurl": getattr(scope, 'ndex_url', None) or ""}
 
         if emsg is not None:
             logger.error('Task had error: ' + emsg)
         else:
             logger.info('Task processing completed')
 
-        curtime = diseasescope_rest_server.milliseconds_since_epoch(datetime.utcnow())
+        curtime = diseasescope_rest_server.milliseconds_since_epoch(
+            datetime.utcnow())
         taskdict['wallTime'] = curtime - taskdict['submitTime']
         task.save_task()
         if emsg is not None:
@@ -121,60 +527,591 @@ class Diseasescopetaskrunner(object):
             status = dao.DONE_STATUS
         task.move_task(status,
                        error_message=emsg)
+        self._record_outcome(status)
+        if status == dao.DONE_STATUS:
+            self._record_durations(task)
         return
 
+    def _record_durations(self, task):
+        """
+        Adds stage durations of task to duration model, logging
+        any error
+        :param task: task done
+        :return: None
+        """
+        if self._durationmodel is None:
+            return
+        try:
+            self._durationmodel.record_task(task.get_taskdict())
+        except Exception:
+            logger.exception('Caught exception recording stage durations '
+                             'of task ' + str(task.get_task_uuid()))
+
+    def _record_outcome(self, outcome):
+        """
+        Counts task processed with **outcome** in metrics and
+        tags span of task with it
+        :param outcome: outcome of task, such as done or timeout
+        :return: None
+        """
+        if self._metrics is not None:
+            self._metrics.inc(metrics.TASKS_TOTAL,
+                              labels={'outcome': outcome})
+        span = tracing.get_current_span()
+        if span is not None:
+            span.set_tag('outcome', outcome)
+
+    def collect_metrics(self, registry):
+        """
+        Sets gauges of tasks in flight, timed out tasks and stage
+        pool usage in **registry**. Meant to be added as a collector
+        of the MetricsRegistry
+        :param registry: MetricsRegistry
+        :return: None
+        """
+        registry.set(metrics.TASKS_IN_FLIGHT, len(self._active_tasks))
+        registry.set(metrics.TASK_SLOTS, self._max_tasks)
+        with self._stats_lock:
+            registry.set(metrics.STAGE_STALL_SECONDS, self._stall_time)
+            registry.set(metrics.TIMED_OUT_TASKS, self._timed_out_tasks)
+        if self._stagepools is None:
+            return
+        for kind in pipeline.STAGE_KINDS:
+            labels = {'kind': kind}
+            registry.set(metrics.STAGE_POOL_WORKERS,
+                         self._stagepools.get_workers(kind), labels=labels)
+            registry.set(metrics.STAGE_POOL_PENDING,
+                         self._stagepools.get_pending(kind), labels=labels)
+            registry.set(metrics.STAGE_POOL_ABANDONED,
+                         self._stagepools.get_abandoned(kind),
+                         labels=labels)
+
+    def _run_pipeline(self, task, monitor, result, profiler=None,
+                      span=None):
+        """
+        Runs pipeline on task storing the DiseaseScope object under
+        'scope' key of **result** or any exception raised under 'error'
+        :param task: task to process
+        :param monitor: TaskMonitor for pipeline
+        :param result: dict to store result in
+        :param profiler: TaskProfiler to profile stages with or None
+        :param span: Span of task stages are recorded under or None
+        :return: None
+        """
+        kwargs = {'monitor': monitor}
+        if profiler is not None:
+            kwargs['profiler'] = profiler
+        try:
+            with tracing.use_span(span):
+                result['scope'] = self._pipeline.run(task, **kwargs)
+        except Exception as e:
+            result['error'] = e
+
+    def _create_profiler(self, task):
+        """
+        Creates profiler writing to the task directory if
+        task should be profiled
+        :param task: task to process
+        :return: started TaskProfiler or None if task is not profiled
+        """
+        if (self._profilepolicy is None or
+                self._profilepolicy.should_profile(task) is False):
+            return None
+        taskdir = task.get_taskdir()
+        logger.info('Profiling task ' + taskdir)
+        names = [profiling.PROFILE_SUMMARY_FILE]
+        for stage in self._pipeline.get_stages():
+            names.append(profiling.get_profile_file(stage.get_name()))
+        dao.record_task_files(taskdir, names)
+        profiler = TaskProfiler(taskdir)
+        profiler.start()
+        return profiler
+
+    def _save_profile(self, task, profiler):
+        """
+        Writes summary of profile of task, logging any error
+        :param task: task processed
+        :param profiler: TaskProfiler of task
+        :return: None
+        """
+        try:
+            profiler.save()
+        except Exception:
+            logger.exception('Caught exception saving profile of task ' +
+                             task.get_taskdir())
+
+    def _watch_pipeline(self, task, monitor, worker):
+        """
+        Waits for pipeline thread **worker** to finish, cancelling the
+        pipeline if it exceeds the stage or task timeout or a delete
+        request for the task arrives
+        :param task: task being processed
+        :param monitor: TaskMonitor for pipeline
+        :param worker: thread running pipeline
+        :return: None if pipeline finished, :py:const:`CANCEL_DELETED` if
+                 task was deleted, :py:const:`CANCEL_REQUEUED` if drain
+                 deadline passed or message describing timeout
+        """
+        taskid = task.get_task_uuid()
+        last_delete_check = time.time()
+        last_heartbeat = last_delete_check
+        while True:
+            worker.join(self._watchdog_interval)
+            if not worker.is_alive():
+                return None
+            if self._requeue_in_flight is True:
+                monitor.cancel('Task runner shutting down')
+                return CANCEL_REQUEUED
+            now = time.time()
+            if (self._leasemanager is not None and
+                    now - last_heartbeat >=
+                    self._leasemanager.get_lease_time() / 3.0):
+                last_heartbeat = now
+                self._leasemanager.heartbeat(task)
+            if (self._deletetaskfactory is not None and
+                    now - last_delete_check >= self._cancel_poll_interval):
+                last_delete_check = now
+                try:
+                    if self._deletetaskfactory.has_delete_request(taskid):
+                        logger.info('Delete request found for running '
+                                    'task ' + str(taskid))
+                        monitor.cancel('Task deleted')
+                        return CANCEL_DELETED
+                except Exception:
+                    logger.exception('Caught exception checking for '
+                                     'delete request')
+
+            reason = None
+            stagename, stage_start = monitor.get_current_stage()
+            running = monitor.get_running_stages()
+            for name in sorted(running.keys()):
+                timeout = self._stage_timeouts.get(name,
+                                                   self._default_stage_timeout)
+                if timeout is not None and now - running[name] > timeout:
+                    stagename, stage_start = name, running[name]
+                    reason = ('Stage ' + name + ' exceeded timeout of ' +
+                              str(timeout) + ' seconds')
+                    break
+            if (reason is None and self._task_timeout is not None and
+                    now - monitor.get_start_time() > self._task_timeout):
+                reason = ('Task exceeded timeout of ' +
+                          str(self._task_timeout) + ' seconds')
+                if stagename is not None:
+                    reason += ' in stage ' + stagename
+            if reason is not None:
+                monitor.cancel(reason)
+                with self._stats_lock:
+                    if stage_start is not None:
+                        self._stall_time += now - stage_start
+                    self._timed_out_tasks += 1
+                return reason
+
+    def get_stall_time(self):
+        """
+        Gets total time in seconds spent in stages that timed out
+        :return:
+        """
+        return self._stall_time
+
+    def get_timed_out_task_count(self):
+        """
+        Gets number of tasks that timed out
+        :return:
+        """
+        return self._timed_out_tasks
+
+    def _delete_cancelled_task(self, task):
+        """
+        Deletes task cancelled by delete request and removes
+        the request
+        :param task: cancelled task
+        :return: None
+        """
+        res = task.delete_task_files()
+        if res is not None:
+            logger.error('Error deleting task: ' + res)
+        if self._deletetaskfactory is not None:
+            self._deletetaskfactory.remove_delete_request(task.get_task_uuid())
+
+    def request_drain(self, timeout=None, replace=False):
+        """
+        Makes :py:meth:`run_tasks` stop claiming tasks and return once
+        tasks in flight finish. Tasks still running **timeout** seconds
+        after this call are stopped and put back in the submitted queue
+        where they resume from their stage checkpoints. Only sets flags
+        so it can be called from a signal handler
+        :param timeout: time in seconds tasks in flight can keep
+                        running, None to wait for them to finish
+        :param replace: if True, replacement runner is started with
+                        **replacement_factory** passed to constructor
+                        before tasks in flight are waited on
+        :return: None
+        """
+        if timeout is not None:
+            self._drain_deadline = time.time() + timeout
+        if replace is True:
+            self._replace = True
+        self._draining = True
+
+    def is_draining(self):
+        """
+        Checks if runner was asked to drain
+        :return: True if draining otherwise False
+        """
+        return self._draining
+
     def run_tasks(self, keep_looping=lambda: True):
         """
         Main entry point, this function loops looking for
-        tasks to run.
+        tasks to run until **keep_looping** returns False or
+        :py:meth:`request_drain` is called
         :param keep_looping: Function that should return True to
                              denote this method should keep waiting
                              for new Tasks or False to exit
         :return:
         """
-        while keep_looping():
+        if self._httpsession is not None and self._route_diseasescope:
+            httpsession.route_module_requests(
+                sys.modules[DiseaseScope.__module__], self._httpsession)
+        if self._referencedata is not None and self._route_diseasescope:
+            self._referencedata.load()
+            refdata.route_module_reference_data(
+                sys.modules[DiseaseScope.__module__], self._referencedata)
+        if self._scratchspace is not None:
+            self._scratchspace.remove_stale()
+        if self._taskwriter is not None:
+            self._taskwriter.start()
+
+        while self._draining is False and keep_looping():
 
-            while self._remove_deleted_task() is True:
-                pass
+            self._remove_deleted_tasks()
+            self._recover_expired_tasks()
+            self._sweep_orphaned_tasks()
+            self._reap_finished_tasks()
+
+            if (self._stagepools is not None and
+                    self._stagepools.is_exhausted()):
+                # threads of abandoned stages are only freed when
+                # this process exits
+                logger.error('Stage pools hold too many abandoned '
+                             'stages, draining and starting replacement '
+                             'runner')
+                self.request_drain(replace=True)
+                break
+
+            if len(self._active_tasks) >= self._max_tasks:
+                time.sleep(self._watchdog_interval)
+                continue
 
             task = self._taskfactory.get_next_task()
             if task is None:
-                time.sleep(self._wait_time)
+                self._sleep_unless_draining(self._wait_time)
                 continue
 
             logger.info('Found a task: ' + str(task.get_taskdir()))
+            claim_start = time.time()
             try:
-                self._process_task(task)
+                if self._leasemanager is not None:
+                    # lease is written before the move so the task
+                    # is never in processing without one
+                    self._leasemanager.heartbeat(task)
+                # moved here so task is not picked up again
+                task.move_task(dao.PROCESSING_STATUS)
             except Exception as e:
+                if not os.path.isdir(task.get_taskdir()):
+                    # claimed by another runner, such as a replacement
+                    # started while this one drains
+                    logger.info('Task ' + str(task.get_task_uuid()) +
+                                ' claimed by another runner: ' + str(e))
+                    continue
                 emsg = ('Caught exception processing task: ' +
                         task.get_taskdir() + ' : ' + str(e))
                 logger.exception('Skipping task cause - ' + emsg)
                 task.move_task(dao.ERROR_STATUS,
                                error_message=emsg)
+                continue
+            if self._leasemanager is not None:
+                # another runner claiming the task at the same time
+                # may have overwritten the lease before the move
+                self._leasemanager.heartbeat(task)
+            if self._metrics is not None:
+                self._metrics.observe(metrics.CLAIM_SECONDS,
+                                      time.time() - claim_start)
+            span = self._start_task_span(task, claim_start)
+            worker = threading.Thread(target=self._run_task,
+                                      args=(task, span),
+                                      name='task-' +
+                                           str(task.get_task_uuid()))
+            self._active_tasks[task.get_task_uuid()] = worker
+            worker.start()
+
+        if self._draining is True:
+            self._start_replacement()
+            logger.info('Draining ' + str(len(self._active_tasks)) +
+                        ' tasks in flight')
+        self._wait_for_tasks_in_flight()
+        if self._scratchspace is not None:
+            self._scratchspace.remove_all()
+        if self._taskwriter is not None:
+            self._taskwriter.stop()
+
+    def _sleep_unless_draining(self, seconds):
+        """
+        Sleeps **seconds** seconds, in steps of watchdog interval, so
+        a drain requested meanwhile is acted on promptly
+        :param seconds: time to sleep in seconds
+        :return: None
+        """
+        end = time.time() + seconds
+        while self._draining is False:
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, max(self._watchdog_interval, 0.01)))
+
+    def _start_replacement(self):
+        """
+        Starts replacement runner if one was requested and
+        **replacement_factory** was passed to constructor
+        :return: None
+        """
+        if self._replace is False or self._replacement_factory is None:
+            return
+        self._replace = False
+        try:
+            self._replacement_factory()
+        except Exception:
+            logger.exception('Caught exception starting replacement '
+                             'runner')
+
+    def _wait_for_tasks_in_flight(self):
+        """
+        Waits for tasks in flight to finish. Once drain deadline
+        passes the watchdog of each task stops it and puts it back
+        in the submitted queue
+        :return: None
+        """
+        while self._reap_finished_tasks() > 0:
+            if (self._requeue_in_flight is False and
+                    self._drain_deadline is not None and
+                    time.time() >= self._drain_deadline):
+                logger.warning('Drain deadline passed, requeueing ' +
+                               str(len(self._active_tasks)) +
+                               ' tasks in flight')
+                self._requeue_in_flight = True
+            time.sleep(max(self._watchdog_interval, 0.01))
+
+    def _start_task_span(self, task, claim_start):
+        """
+        Starts span of task in trace whose id is in the task json,
+        adding a new trace id to the task json if it has none. Span
+        starts at submit time of task and has child spans of the
+        time task waited in the queue and the time to claim it
+        :param task: task claimed
+        :param claim_start: time in seconds since epoch claim started
+        :return: Span or None if tracing is disabled
+        """
+        if self._tracer is None:
+            return None
+        taskdict = task.get_taskdict()
+        if not isinstance(taskdict, dict):
+            return None
+        trace_id = taskdict.get(dao.TRACE_ID_KEY)
+        if trace_id is None:
+            trace_id = tracing.new_trace_id()
+            taskdict[dao.TRACE_ID_KEY] = trace_id
+        start = claim_start
+        if 'submitTime' in taskdict:
+            start = min(taskdict['submitTime'] / 1000.0, claim_start)
+        span = self._tracer.start_span('task', trace_id, start=start,
+                                       tags={'taskid':
+                                             task.get_task_uuid(),
+                                             'doid': task.get_diseaseid()})
+        span.start_child('queue_wait', start=start).finish(end=claim_start)
+        span.start_child('claim', start=claim_start).finish()
+        return span
+
+    def _run_task(self, task, span=None):
+        """
+        Processes task moving it to error if processing fails.
+        Run in its own thread so several tasks can be in flight
+        :param task: task to process
+        :param span: Span of task from :py:meth:`_start_task_span`
+                     or None
+        :return: None
+        """
+        if self._taskwriter is not None:
+            task.set_writer(self._taskwriter)
+        if self._scratchspace is not None:
+            task.set_scratchdir(self._scratchspace.create(
+                task.get_task_uuid()))
+        try:
+            with tracing.use_span(span):
+                self._process_task(task)
+        except Exception as e:
+            emsg = ('Caught exception processing task: ' +
+                    task.get_taskdir() + ' : ' + str(e))
+            logger.exception('Skipping task cause - ' + emsg)
+            task.move_task(dao.ERROR_STATUS,
+                           error_message=emsg)
+            with tracing.use_span(span):
+                self._record_outcome(dao.ERROR_STATUS)
+        finally:
+            if self._scratchspace is not None:
+                self._release_scratchdir(task)
+            if self._leasemanager is not None:
+                self._leasemanager.release(task)
+            if span is not None:
+                span.finish()
+
+    def _release_scratchdir(self, task):
+        """
+        Copies artifacts declared by pipeline stages from scratch
+        directory of task to the task directory, unless the task was
+        deleted, and removes the scratch directory
+        :param task: task processed
+        :return: None
+        """
+        taskid = task.get_task_uuid()
+        try:
+            taskdir = task.get_taskdir()
+            if os.path.isdir(taskdir):
+                # recorded before copying so a crash never
+                # leaves files missing from the manifest
+                artifacts = self._pipeline.get_artifacts()
+                dao.record_task_files(taskdir, artifacts)
+                self._scratchspace.copy_artifacts(taskid, taskdir, artifacts)
+        finally:
+            self._scratchspace.remove(taskid)
+            task.set_scratchdir(None)
+
+    def _reap_finished_tasks(self):
+        """
+        Removes finished tasks from tasks in flight
+        :return: number of tasks still in flight
+        """
+        for taskid, worker in list(self._active_tasks.items()):
+            if not worker.is_alive():
+                del self._active_tasks[taskid]
+        return len(self._active_tasks)
 
-    def _remove_deleted_task(self):
+    def _remove_deleted_tasks(self):
         """
-        Looks for delete task request and handles it
-        :return: False if none found otherwise True
+        Gets all pending delete task requests in one pass and
+        deletes those tasks, stopping once the delete time budget
+        has been exceeded so real work keeps flowing. Requests that
+        are not handled remain for the next call
+        :return: number of tasks deleted
         """
         if self._deletetaskfactory is None:
-            return False
+            return 0
 
+        start_time = time.time()
         try:
-            task = self._deletetaskfactory.get_next_task()
-            if task is None:
-                return False
-            if task.get_taskdir() is not None:
+            tasks = self._deletetaskfactory.get_next_tasks()
+        except Exception:
+            logger.exception('Caught exception looking for delete task '
+                             'requests')
+            return 0
+
+        deleted = 0
+        for task in tasks:
+            if task.get_task_uuid() in self._active_tasks:
+                # running tasks are cancelled by their watchdog
+                continue
+            if (self._delete_time_budget is not None and
+                    time.time() - start_time > self._delete_time_budget):
+                logger.info('Delete time budget exceeded, ' +
+                            str(len(tasks) - deleted) +
+                            ' delete requests will be handled later')
+                break
+            try:
                 logger.info('Deleting task: ' + task.get_taskdir())
                 res = task.delete_task_files()
                 if res is not None:
                     logger.error('Error deleting task: ' + res)
-                return True
-            return True
+            except Exception:
+                logger.exception('Caught exception deleting task: ' +
+                                 str(task.get_taskdir()))
+            self._deletetaskfactory.remove_delete_request(task.get_task_uuid())
+            deleted += 1
+        return deleted
+
+    def _recover_expired_tasks(self):
+        """
+        Requeues, or moves to error, tasks in processing whose lease
+        expired if recovery interval has elapsed since the last check
+        :return: tuple (number requeued, number moved to error)
+        """
+        if self._leasemanager is None:
+            return 0, 0
+        curtime = time.time()
+        if (self._last_recovery is not None and
+                curtime - self._last_recovery < self._recovery_interval):
+            return 0, 0
+        self._last_recovery = curtime
+        try:
+            return self._leasemanager.recover_expired_tasks(
+                exclude=set(self._active_tasks.keys()))
         except Exception:
-            logger.exception('Caught exception looking for delete task '
-                             'requests')
-            return False
+            logger.exception('Caught exception recovering tasks')
+            return 0, 0
+
+    def _sweep_orphaned_tasks(self):
+        """
+        Removes orphaned task directories if sweep interval has
+        elapsed since the last sweep
+        :return: number of directories removed
+        """
+        if self._sweeper is None:
+            return 0
+        curtime = time.time()
+        if (self._last_sweep is not None and
+                curtime - self._last_sweep < self._sweep_interval):
+            return 0
+        self._last_sweep = curtime
+        try:
+            return self._sweeper.sweep(time_budget=self._delete_time_budget)
+        except Exception:
+            logger.exception('Caught exception removing orphaned tasks')
+            return 0
+
+
+def spawn_replacement(argv, cwd=None):
+    """
+    Starts new task runner process with command line arguments
+    **argv**. The new process parses its arguments and reads its
+    configuration and reference files again
+    :param argv: list of arguments, first being path to program
+    :param cwd: working directory relative paths in **argv** are
+                relative to, if None the current one is used
+    :return: :py:class:`subprocess.Popen` of new process
+    """
+    cmd = [sys.executable] + list(argv)
+    logger.info('Starting replacement task runner: ' + ' '.join(cmd))
+    return subprocess.Popen(cmd, cwd=cwd, close_fds=True,
+                            start_new_session=True)
+
+
+def install_signal_handlers(runner, drain_timeout):
+    """
+    Makes SIGTERM drain **runner** and SIGHUP drain **runner** after
+    starting a replacement runner
+    :param runner: Diseasescopetaskrunner
+    :param drain_timeout: time in seconds tasks in flight can run
+                          after either signal
+    :return: dict of signal => previous handler
+    """
+    def _drain(signum, frame):
+        logger.info('Received signal ' + str(signum) +
+                    ', no longer claiming tasks')
+        runner.request_drain(timeout=drain_timeout,
+                             replace=signum == signal.SIGHUP)
+
+    previous = {}
+    for signum in [signal.SIGTERM, signal.SIGHUP]:
+        previous[signum] = signal.signal(signum, _drain)
+    return previous
 
 
 def run(theargs, keep_looping=lambda: True):
@@ -189,19 +1126,141 @@ def run(theargs, keep_looping=lambda: True):
         ab_tdir = os.path.abspath(theargs.taskdir)
         logger.debug('Task directory set to: ' + ab_tdir)
 
-        tfac = FileBasedSubmittedTaskFactory(ab_tdir)
+        layout = dao.TaskLayout(shard_depth=theargs.shard_depth,
+                                shard_width=theargs.shard_width)
+        tfac = FileBasedSubmittedTaskFactory(ab_tdir, layout=layout)
         if theargs.disabledelete is True:
             logger.info('Deletion of tasks disabled')
             dfac = None
         else:
-            dfac = DeletedFileBasedTaskFactory(ab_tdir)
-        runner = Diseasescopetaskrunner(taskfactory=tfac,
-                                wait_time=theargs.wait_time,
-                                deletetaskfactory=dfac,
-                                doidfile=theargs.doidmappingfile,
-                                genesetfile=theargs.genesetfile)
-
-        runner.run_tasks(keep_looping=keep_looping)
+            dfac = DeletedFileBasedTaskFactory(ab_tdir, layout=layout)
+        stagecache = None
+        if theargs.cachedir is not None:
+            version = cache.get_reference_version([theargs.doidmappingfile,
+                                                   theargs.genesetfile])
+            logger.debug('Caching stage output in ' + theargs.cachedir +
+                         ' with reference data version ' + version)
+            stagecache = cache.StageCache(os.path.abspath(theargs.cachedir),
+                                          max_size=theargs.cachemaxsize *
+                                          1024 * 1024,
+                                          ttls=pipeline.parse_stage_times(
+                                              theargs.cachettl),
+                                          default_ttl=theargs.cachedefaultttl,
+                                          version=version)
+        tracer = None
+        if theargs.trace_collector is not None:
+            exporter = tracing.ZipkinSpanExporter(theargs.trace_collector)
+            exporter.start()
+            tracer = tracing.Tracer(exporter,
+                                    service_name=theargs.trace_service)
+        elif theargs.trace_file is not None:
+            tracer = tracing.Tracer(tracing.FileSpanExporter(
+                os.path.abspath(theargs.trace_file)),
+                service_name=theargs.trace_service)
+        registry = None
+        if (theargs.metrics_port is not None or
+                theargs.metrics_file is not None):
+            registry = metrics.MetricsRegistry()
+            registry.add_collector(metrics.TaskQueueCollector(ab_tdir,
+                                                              layout=layout))
+        session = httpsession.PooledSession(
+            retries=theargs.http_retries,
+            backoff_factor=theargs.http_backoff,
+            pool_size=theargs.http_pool_size,
+            timeout=(10, theargs.http_timeout),
+            failure_threshold=theargs.circuit_failures,
+            reset_timeout=theargs.circuit_reset,
+            metrics=registry)
+        clixopool = None
+        if theargs.infer_method == clixo.CLIXO_LOCAL_METHOD:
+            clixopool = clixo.ClixoPool(
+                clixo_cmd=theargs.clixo_cmd,
+                max_instances=theargs.clixo_max_instances,
+                cores_per_run=theargs.clixo_cores,
+                timeout=theargs.clixo_timeout)
+        stages = pipeline.get_diseasescope_stages(
+            infer_method=theargs.infer_method, clixopool=clixopool)
+        scratchspace = None
+        if theargs.scratchdir is not None:
+            scratchspace = ScratchSpace(theargs.scratchdir)
+        taskwriter = CoalescingTaskWriter(
+            interval=theargs.task_write_interval, fsync=theargs.fsync)
+        leasemanager = TaskLeaseManager(ab_tdir,
+                                        lease_time=theargs.lease_time,
+                                        max_retries=theargs.max_recoveries,
+                                        layout=layout)
+        sweeper = None
+        if theargs.sweep_interval > 0:
+            sweeper = OrphanedTaskSweeper(ab_tdir,
+                                          min_age=theargs.orphan_age,
+                                          layout=layout)
+        # reference files are parsed once for all tasks
+        referencedata = refdata.ReferenceData([theargs.doidmappingfile,
+                                               theargs.genesetfile])
+        referencedata.load()
+        runner = Diseasescopetaskrunner(
+            taskfactory=tfac,
+            wait_time=theargs.wait_time,
+            deletetaskfactory=dfac,
+            doidfile=theargs.doidmappingfile,
+            genesetfile=theargs.genesetfile,
+            delete_time_budget=theargs.delete_time_budget,
+            stagecache=stagecache,
+            cancel_poll_interval=theargs.cancel_poll_interval,
+            task_timeout=theargs.task_timeout,
+            stage_timeouts=pipeline.parse_stage_times(
+                theargs.stage_timeouts),
+            default_stage_timeout=theargs.default_stage_timeout,
+            watchdog_interval=theargs.watchdog_interval,
+            httpsession=session,
+            stagepools=pipeline.StagePools(
+                io_workers=theargs.io_threads,
+                cpu_workers=theargs.cpu_threads,
+                queue_size=theargs.stage_queue_size,
+                max_abandoned=theargs.max_abandoned_stages),
+            max_tasks=theargs.max_tasks,
+            stages=stages,
+            scratchspace=scratchspace,
+            sweeper=sweeper,
+            sweep_interval=theargs.sweep_interval,
+            taskwriter=taskwriter,
+            leasemanager=leasemanager,
+            recovery_interval=theargs.recovery_interval,
+            replacement_factory=functools.partial(
+                spawn_replacement, theargs.argv, cwd=theargs.cwd),
+            metrics=registry,
+            profilepolicy=ProfilePolicy(
+                enabled=theargs.profile,
+                sample_rate=theargs.profile_rate),
+            tracer=tracer,
+            durationmodel=StageDurationModel(
+                os.path.join(ab_tdir,
+                             estimate.STAGE_MODEL_FILE)),
+            referencedata=referencedata)
+
+        exporters = []
+        if registry is not None:
+            registry.add_collector(runner.collect_metrics)
+            if theargs.metrics_port is not None:
+                exporters.append(metrics.MetricsServer(
+                    registry, theargs.metrics_port,
+                    address=theargs.metrics_address))
+            if theargs.metrics_file is not None:
+                exporters.append(metrics.TextfileExporter(
+                    registry, os.path.abspath(theargs.metrics_file),
+                    interval=theargs.metrics_interval))
+        for exporter in exporters:
+            exporter.start()
+        previous = install_signal_handlers(runner, theargs.drain_timeout)
+        try:
+            runner.run_tasks(keep_looping=keep_looping)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            for exporter in exporters:
+                exporter.stop()
+            if tracer is not None:
+                tracer.shutdown()
     except Exception:
         logger.exception("Error caught exception")
         return 2
@@ -217,9 +1276,16 @@ def main(args, keep_looping=lambda: True):
     theargs = _parse_arguments(desc, args[1:])
     theargs.program = args[0]
     theargs.version = diseasescope_rest_server.__version__
+    # daemon changes working directory to / so replacement runner
+    # is started in this one, where relative paths in its arguments,
+    # such as taskdir and --logconfig, resolve as they did here
+    theargs.argv = [os.path.abspath(args[0])] + args[1:]
+    theargs.cwd = os.getcwd()
 
     if theargs.nodaemon is False:
-        with daemon.DaemonContext():
+        # SIGTERM and SIGHUP are handled by run()
+        with daemon.DaemonContext(signal_map={signal.SIGTERM: None,
+                                              signal.SIGHUP: None}):
             return run(theargs, keep_looping)
     else:
         return run(theargs, keep_looping)
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+"""Compact integer coded edge table for large networks"""
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+NODE_ID_DTYPE = np.int32
+WEIGHT_DTYPE = np.float32
+
+# files in directory written by EdgeTable.save()
+SOURCES_FILE = 'sources.npy'
+TARGETS_FILE = 'targets.npy'
+SYMBOLS_FILE = 'symbols.json.gz'
+METADATA_FILE = 'metadata.json'
+ATTRIBUTE_FILE_PREFIX = 'attribute_'
+
+COLUMNS_KEY = 'columns'
+ATTRIBUTES_KEY = 'attributes'
+NUMEDGES_KEY = 'numedges'
+
+
+class EdgeTable(object):
+    """
+    Edge table storing each edge as a pair of int32 node ids, that
+    index an array of node symbols, plus float32 attributes. Node
+    names are stored once per node instead of once per edge, which
+    for dense tissue networks uses several times less memory than a
+    string keyed :py:class:`pandas.DataFrame`. Renaming nodes is a
+    lookup per node, not per edge, and a
+    :py:class:`pandas.DataFrame` is built only by
+    :py:meth:`to_dataframe`
+    """
+    def __init__(self, sources, targets, symbols, attributes=None,
+                 columns=('Gene1', 'Gene2')):
+        """
+        Constructor
+        :param sources: node ids of source of each edge
+        :param targets: node ids of target of each edge
+        :param symbols: node symbol of each node id
+        :param attributes: dict of attribute name => value of each
+                           edge, such as edge weights
+        :param columns: names of source and target columns used
+                        by :py:meth:`to_dataframe`
+        """
+        self._sources = np.asarray(sources, dtype=NODE_ID_DTYPE)
+        self._targets = np.asarray(targets, dtype=NODE_ID_DTYPE)
+        self._symbols = np.asarray(symbols, dtype=object)
+        self._attributes = {}
+        if attributes is not None:
+            for name, vals in attributes.items():
+                self._attributes[name] = np.asarray(vals,
+                                                    dtype=WEIGHT_DTYPE)
+        self._columns = tuple(columns)
+
+    @staticmethod
+    def from_dataframe(df, columns=('Gene1', 'Gene2')):
+        """
+        Creates EdgeTable from edge table. Numeric columns other then
+        **columns** are kept as float32 attributes, other columns
+        are dropped
+        :param df: edge table as :py:class:`pandas.DataFrame`
+        :param columns: names of source and target columns
+        :return: EdgeTable
+        """
+        # pandas dtypes such as StringDtype are not numpy dtypes
+        # so they are checked with pandas.api.types
+        from pandas.api import types
+        numedges = len(df)
+        nodes = np.concatenate([df[columns[0]].to_numpy(dtype=object),
+                                df[columns[1]].to_numpy(dtype=object)
+                                ]).astype(str)
+        symbols, ids = np.unique(nodes, return_inverse=True)
+        attributes = {}
+        for name in df.columns:
+            if name in columns:
+                continue
+            dtype = df[name].dtype
+            if (types.is_numeric_dtype(dtype) and
+                    not types.is_bool_dtype(dtype)):
+                attributes[name] = df[name].to_numpy(dtype=WEIGHT_DTYPE,
+                                                     na_value=np.nan)
+        return EdgeTable(ids[0:numedges], ids[numedges:],
+                         symbols.astype(object), attributes=attributes,
+                         columns=columns)
+
+    def __len__(self):
+        """
+        Gets number of edges
+        :return:
+        """
+        return len(self._sources)
+
+    def get_columns(self):
+        """
+        Gets names of source and target columns
+        :return: tuple
+        """
+        return self._columns
+
+    def get_sources(self):
+        """
+        Gets node ids of source of each edge
+        :return: int32 array
+        """
+        return self._sources
+
+    def get_targets(self):
+        """
+        Gets node ids of target of each edge
+        :return: int32 array
+        """
+        return self._targets
+
+    def get_symbols(self):
+        """
+        Gets symbol of each node id
+        :return: object array of str
+        """
+        return self._symbols
+
+    def get_attribute_names(self):
+        """
+        Gets names of edge attributes
+        :return: list of str
+        """
+        return sorted(self._attributes.keys())
+
+    def get_attribute(self, name):
+        """
+        Gets value of attribute for each edge
+        :param name: name of attribute
+        :return: float32 array
+        """
+        return self._attributes[name]
+
+    def get_number_of_nodes(self):
+        """
+        Gets number of nodes
+        :return: int
+        """
+        return len(self._symbols)
+
+    def get_nbytes(self):
+        """
+        Gets approximate memory used by edge table in bytes
+        :return: int
+        """
+        total = self._sources.nbytes + self._targets.nbytes
+        total += sum([a.nbytes for a in self._attributes.values()])
+        total += sum([len(s) + 49 for s in self._symbols])
+        return total
+
+    def rename_nodes(self, newsymbols):
+        """
+        Creates EdgeTable with nodes renamed. Edges with a node whose
+        new symbol is None are dropped and nodes renamed to the same
+        symbol are merged
+        :param newsymbols: sequence with new symbol, or None, for
+                           each node id
+        :return: EdgeTable
+        """
+        newsymbols = np.asarray(newsymbols, dtype=object)
+        if len(newsymbols) != len(self._symbols):
+            raise ValueError('Expected ' + str(len(self._symbols)) +
+                             ' symbols, got ' + str(len(newsymbols)))
+        keepnode = np.array([s is not None for s in newsymbols],
+                            dtype=bool)
+        keptsymbols, keptids = np.unique(newsymbols[keepnode].astype(str),
+                                         return_inverse=True)
+        remap = np.full(len(newsymbols), -1, dtype=NODE_ID_DTYPE)
+        remap[keepnode] = keptids
+        keepedge = keepnode[self._sources] & keepnode[self._targets]
+        attributes = {}
+        for name, vals in self._attributes.items():
+            attributes[name] = vals[keepedge]
+        return EdgeTable(remap[self._sources][keepedge],
+                         remap[self._targets][keepedge],
+                         keptsymbols.astype(object),
+                         attributes=attributes, columns=self._columns)
+
+    def get_node_dataframe(self):
+        """
+        Gets table with one row per node, indexed by node id, where
+        both source and target columns hold the symbol of the node.
+        Passing this table to a function that renames the nodes of an
+        edge table renames every node with one lookup per node
+        :return: :py:class:`pandas.DataFrame`
+        """
+        import pandas as pd
+        return pd.DataFrame({self._columns[0]: self._symbols,
+                             self._columns[1]: self._symbols})
+
+    def get_symbols_from_node_dataframe(self, df):
+        """
+        Gets new symbol of each node from table created by
+        :py:meth:`get_node_dataframe` whose nodes were renamed.
+        Rows that were removed denote nodes that could not be renamed
+        :param df: renamed table from :py:meth:`get_node_dataframe`
+        :return: object array with new symbol, or None, of each node
+                 or None if **df** is not a renamed node table
+        """
+        try:
+            ids = np.asarray(df.index.values)
+            if len(ids) > 0 and (ids.min() < 0 or
+                                 ids.max() >= len(self._symbols)):
+                return None
+            first = df[self._columns[0]].values
+            if not np.array_equal(first, df[self._columns[1]].values):
+                return None
+        except Exception:
+            return None
+        newsymbols = np.full(len(self._symbols), None, dtype=object)
+        newsymbols[ids.astype(np.int64)] = first
+        return newsymbols
+
+    def to_dataframe(self):
+        """
+        Builds string keyed edge table
+        :return: :py:class:`pandas.DataFrame`
+        """
+        import pandas as pd
+        data = {self._columns[0]: self._symbols[self._sources],
+                self._columns[1]: self._symbols[self._targets]}
+        for name in self.get_attribute_names():
+            data[name] = self._attributes[name]
+        return pd.DataFrame(data)
+
+    def write_tsv(self, path, attribute):
+        """
+        Writes tab delimited file of source, target, **attribute**
+        with no header
+        :param path: file to write
+        :param attribute: name of attribute to write as third column
+        :return: None
+        """
+        srcs = self._symbols[self._sources]
+        tgts = self._symbols[self._targets]
+        vals = self._attributes[attribute]
+        with open(path, 'w') as f:
+            for i in range(len(srcs)):
+                f.write(srcs[i] + '\t' + tgts[i] + '\t' +
+                        str(vals[i]) + '\n')
+
+    def get_checksum(self):
+        """
+        Gets checksum of edges, symbols and attributes
+        :return: hex digest as str
+        """
+        md5 = hashlib.md5()
+        md5.update(json.dumps([list(self._columns),
+                               self.get_attribute_names()]).encode('utf-8'))
+        md5.update(np.ascontiguousarray(self._sources).tobytes())
+        md5.update(np.ascontiguousarray(self._targets).tobytes())
+        for name in self.get_attribute_names():
+            md5.update(np.ascontiguousarray(self._attributes[name]).tobytes())
+        md5.update('\n'.join(self._symbols).encode('utf-8'))
+        return md5.hexdigest()
+
+    def save(self, path):
+        """
+        Saves edge table to directory **path**, replacing any existing
+        one. Node ids and attributes are stored one column per
+        uncompressed ``.npy`` file so :py:meth:`load` can memory map
+        them and symbols are stored once, gzip compressed
+        :param path: directory to write
+        :return: None
+        """
+        tmppath = path + '.tmp'
+        if os.path.isdir(tmppath):
+            shutil.rmtree(tmppath)
+        os.mkdir(tmppath, 0o775)
+        np.save(os.path.join(tmppath, SOURCES_FILE), self._sources)
+        np.save(os.path.join(tmppath, TARGETS_FILE), self._targets)
+        attributes = {}
+        for index, name in enumerate(self.get_attribute_names()):
+            afile = ATTRIBUTE_FILE_PREFIX + str(index) + '.npy'
+            np.save(os.path.join(tmppath, afile), self._attributes[name])
+            attributes[name] = afile
+        with gzip.open(os.path.join(tmppath, SYMBOLS_FILE), 'wt') as f:
+            json.dump(list(self._symbols), f)
+        with open(os.path.join(tmppath, METADATA_FILE), 'w') as f:
+            json.dump({COLUMNS_KEY: list(self._columns),
+                       ATTRIBUTES_KEY: attributes,
+                       NUMEDGES_KEY: len(self)}, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmppath, path)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+        Loads edge table written by :py:meth:`save`
+        :param path: directory written by :py:meth:`save`
+        :param mmap: if True, node ids and attributes are memory
+                     mapped read only instead of read into memory
+        :raises ValueError: if edge table in **path** is incomplete
+        :return: EdgeTable
+        """
+        mode = 'r' if mmap is True else None
+        with open(os.path.join(path, METADATA_FILE), 'r') as f:
+            metadata = json.load(f)
+        with gzip.open(os.path.join(path, SYMBOLS_FILE), 'rt') as f:
+            symbols = json.load(f)
+        sources = np.load(os.path.join(path, SOURCES_FILE), mmap_mode=mode)
+        targets = np.load(os.path.join(path, TARGETS_FILE), mmap_mode=mode)
+        attributes = {}
+        for name, afile in metadata[ATTRIBUTES_KEY].items():
+            attributes[name] = np.load(os.path.join(path, afile),
+                                       mmap_mode=mode)
+        for vals in [sources, targets] + list(attributes.values()):
+            if len(vals) != metadata[NUMEDGES_KEY]:
+                raise ValueError('Edge table ' + path + ' expected ' +
+                                 str(metadata[NUMEDGES_KEY]) +
+                                 ' edges, found ' + str(len(vals)))
+        return EdgeTable(sources, targets, symbols, attributes=attributes,
+                         columns=metadata[COLUMNS_KEY])
+
+
+def get_size_of_directory(path):
+    """
+    Gets total size in bytes of files directly under **path**
+    :param path: directory
+    :return: int
+    """
+    total = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file():
+                total += entry.stat().st_size
+    return total
@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+
+"""Estimates of when submitted and processing tasks start and finish"""
+import os
+import json
+import time
+import heapq
+import logging
+import threading
+
+from diseasescope_rest_server import dao
+
+logger = logging.getLogger(__name__)
+
+
+# file under task directory where task runners keep the rolling
+# model of stage durations read by the REST service
+STAGE_MODEL_FILE = 'stage_durations.json'
+
+# keys added to status of submitted and processing tasks,
+# times are in milliseconds
+QUEUE_POSITION_KEY = 'queuePosition'
+ESTIMATED_START_TIME_KEY = 'estimatedStartTime'
+ESTIMATED_FINISH_TIME_KEY = 'estimatedFinishTime'
+POLL_INTERVAL_KEY = 'pollInterval'
+
+# keys of entry for each stage in model file
+MODEL_REQUIRES_KEY = 'requires'
+MODEL_ALL_KEY = 'all'
+MODEL_SIZES_KEY = 'sizes'
+MODEL_MEAN_KEY = 'mean'
+MODEL_COUNT_KEY = 'count'
+
+# attribute whose size, as recorded in outputSize of stages,
+# is the gene set size durations are grouped by
+GENE_SET_ATTR = 'disease_genes'
+
+# upper bounds of gene set sizes durations are grouped by
+DEFAULT_SIZE_BUCKETS = (50, 100, 250, 500, 1000, 2500)
+
+
+def get_gene_set_size(taskdict):
+    """
+    Gets size of gene set of task, which is known once the
+    stages finding disease genes have run
+    :param taskdict: task json as dict
+    :return: largest size of :py:const:`GENE_SET_ATTR` output by a
+             stage of task or None if no stage output it
+    """
+    if not isinstance(taskdict, dict):
+        return None
+    stages = taskdict.get(dao.STAGES_KEY)
+    if not isinstance(stages, dict):
+        return None
+    size = None
+    for entry in stages.values():
+        try:
+            val = entry['outputSize'][GENE_SET_ATTR]
+        except (KeyError, TypeError):
+            continue
+        if size is None or val > size:
+            size = val
+    return size
+
+
+def _get_size_bucket(size, buckets):
+    """
+    Gets name of bucket **size** falls in
+    :param size: gene set size
+    :param buckets: sorted upper bounds of buckets
+    :return: upper bound of bucket as str or '+Inf'
+    """
+    for bound in buckets:
+        if size <= bound:
+            return str(bound)
+    return '+Inf'
+
+
+class StageDurationModel(object):
+    """
+    Rolling model of the duration of each pipeline stage, overall
+    and grouped by gene set size, persisted to **path** so task
+    runners can update it and the REST service can read it. Each
+    mean is a plain average of the first 1/**alpha** durations and
+    an exponentially weighted one after that, so it follows changes
+    in the speed of upstream services. When several runners update
+    the model at once an update can be lost, which only slows
+    how fast the model follows
+    """
+    def __init__(self, path=None, alpha=0.2,
+                 buckets=DEFAULT_SIZE_BUCKETS, min_samples=3):
+        """
+        Constructor
+        :param path: file model is stored in, None to keep it
+                     in memory only
+        :param alpha: weight of newest duration in mean
+        :param buckets: upper bounds of gene set sizes durations
+                        are grouped by
+        :param min_samples: number of durations a gene set size group
+                            needs before its mean is used instead of
+                            the mean of all durations of the stage
+        """
+        self._path = path
+        self._alpha = alpha
+        self._buckets = sorted(buckets)
+        self._min_samples = min_samples
+        self._stages = {}
+        self._requires = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Loads model from **path** if file changed since last load
+        :return: True if model was loaded otherwise False
+        """
+        if self._path is None:
+            return False
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except OSError:
+            return False
+        with self._lock:
+            if mtime == self._mtime:
+                return False
+            try:
+                with open(self._path, 'r') as f:
+                    stages = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning('Unable to load stage duration model ' +
+                               self._path + ' : ' + str(e))
+                return False
+            if not isinstance(stages, dict):
+                return False
+            self._stages = stages
+            self._mtime = mtime
+            return True
+
+    def save(self):
+        """
+        Writes model to **path**
+        :return: None
+        """
+        if self._path is None:
+            return
+        tmpfile = self._path + '.' + str(os.getpid()) + '.tmp'
+        with self._lock:
+            with open(tmpfile, 'w') as f:
+                json.dump(self._stages, f, indent=2, sort_keys=True)
+            os.replace(tmpfile, self._path)
+            self._mtime = os.stat(self._path).st_mtime
+
+    def set_stages(self, stages):
+        """
+        Records the stages each stage requires, so remaining time is
+        estimated along the longest chain of dependent stages instead
+        of the sum of all stages
+        :param stages: list of PipelineStage objects
+        :return: None
+        """
+        with self._lock:
+            for stage in stages:
+                self._requires[stage.get_name()] = list(stage.get_requires())
+            self._apply_requires()
+
+    def _apply_requires(self):
+        """
+        Sets stages required by each stage given to
+        :py:meth:`set_stages` in model
+        """
+        for stagename, requires in self._requires.items():
+            entry = self._stages.setdefault(stagename, {})
+            entry[MODEL_REQUIRES_KEY] = requires
+
+    def _update_mean(self, entry, duration):
+        """
+        Adds **duration** to mean in **entry**
+        """
+        count = entry.get(MODEL_COUNT_KEY, 0)
+        mean = entry.get(MODEL_MEAN_KEY, 0.0)
+        weight = max(self._alpha, 1.0 / (count + 1))
+        entry[MODEL_MEAN_KEY] = mean + weight * (duration - mean)
+        entry[MODEL_COUNT_KEY] = count + 1
+
+    def record_task(self, taskdict):
+        """
+        Adds durations of stages of finished task to model, loading
+        latest model from **path** first and saving it after. Stages
+        whose output came from the stage cache are skipped
+        :param taskdict: task json as dict
+        :return: None
+        """
+        if not isinstance(taskdict, dict):
+            return
+        stages = taskdict.get(dao.STAGES_KEY)
+        if not isinstance(stages, dict):
+            return
+        self.load()
+        size = get_gene_set_size(taskdict)
+        with self._lock:
+            self._apply_requires()
+            for stagename, timing in stages.items():
+                if not isinstance(timing, dict):
+                    continue
+                duration = timing.get('duration')
+                # output of cached stages was read from stage cache
+                # in about no time, which says nothing about a run
+                if duration is None or timing.get('cached') is True:
+                    continue
+                entry = self._stages.setdefault(stagename, {})
+                self._update_mean(entry.setdefault(MODEL_ALL_KEY, {}),
+                                  duration)
+                if size is None:
+                    continue
+                bucket = _get_size_bucket(size, self._buckets)
+                sizes = entry.setdefault(MODEL_SIZES_KEY, {})
+                self._update_mean(sizes.setdefault(bucket, {}), duration)
+        self.save()
+
+    def get_stage_names(self):
+        """
+        Gets names of stages in model
+        :return: sorted list of stage names
+        """
+        with self._lock:
+            return sorted(self._stages.keys())
+
+    def get_stage_duration(self, stagename, size=None):
+        """
+        Gets expected duration of stage
+        :param stagename: name of stage
+        :param size: gene set size of task or None if not known
+        :return: duration in milliseconds or None if stage has
+                 no recorded durations
+        """
+        with self._lock:
+            entry = self._stages.get(stagename)
+            if entry is None:
+                return None
+            if size is not None:
+                bucket = entry.get(MODEL_SIZES_KEY, {}).get(
+                    _get_size_bucket(size, self._buckets))
+                if (bucket is not None and
+                        bucket.get(MODEL_COUNT_KEY, 0) >= self._min_samples):
+                    return bucket[MODEL_MEAN_KEY]
+            allentry = entry.get(MODEL_ALL_KEY)
+            if allentry is None:
+                return None
+            return allentry[MODEL_MEAN_KEY]
+
+    def get_remaining_time(self, taskdict, now=None):
+        """
+        Estimates time until task finishes. Stages that finished take
+        no more time, running stages take their expected duration
+        less the time they have run and stages not yet started begin
+        once the stages they require end
+        :param taskdict: task json as dict, submitted tasks have
+                         no stages recorded yet
+        :param now: current time in milliseconds since epoch, None
+                    for current time
+        :return: time in milliseconds or None if model has no
+                 duration for a stage still to run
+        """
+        if now is None:
+            now = int(time.time() * 1000)
+        stages = None
+        if isinstance(taskdict, dict):
+            stages = taskdict.get(dao.STAGES_KEY)
+        if not isinstance(stages, dict):
+            stages = {}
+        size = get_gene_set_size(taskdict)
+        with self._lock:
+            requires = {name: entry.get(MODEL_REQUIRES_KEY)
+                        for name, entry in self._stages.items()}
+        if len(requires) == 0:
+            return None
+        if all(r is None for r in requires.values()):
+            # stages not known, assume they run one after another
+            names = sorted(requires.keys())
+            requires = {name: names[0:i] for i, name in enumerate(names)}
+
+        ends = {}
+        for stagename in self._get_topological_order(requires):
+            timing = stages.get(stagename)
+            if isinstance(timing, dict) and 'duration' in timing:
+                ends[stagename] = 0
+                continue
+            expected = self.get_stage_duration(stagename, size=size)
+            if expected is None:
+                return None
+            if isinstance(timing, dict) and 'startTime' in timing:
+                ends[stagename] = max(expected -
+                                      (now - timing['startTime']), 0)
+                continue
+            begin = max([0] + [ends.get(r, 0)
+                               for r in requires[stagename] or []])
+            ends[stagename] = begin + expected
+        return int(max(ends.values()))
+
+    def _get_topological_order(self, requires):
+        """
+        Orders stages so each comes after the stages it requires,
+        required stages missing from the model are ignored
+        :param requires: dict of stage name => list of required stages
+        :return: list of stage names
+        """
+        order = []
+        visited = set()
+
+        def visit(name):
+            if name in visited or name not in requires:
+                return
+            visited.add(name)
+            for req in requires[name] or []:
+                visit(req)
+            order.append(name)
+
+        for stagename in sorted(requires.keys()):
+            visit(stagename)
+        return order
+
+
+class TaskQueueIndex(object):
+    """
+    Index of submitted and processing tasks ordered by submit time.
+    Task directories are rescanned at most once every **ttl**
+    seconds and only task json files that changed since the last
+    scan are read again
+    """
+    def __init__(self, taskdir, ttl=5, layout=None):
+        """
+        Constructor
+        :param taskdir: base directory of tasks
+        :param ttl: time in seconds index is used before rescanning
+        :param layout: TaskLayout of task directories, if None tasks
+                       are stored under address they were submitted
+                       from
+        """
+        self._taskdir = taskdir
+        self._ttl = ttl
+        if layout is None:
+            layout = dao.TaskLayout()
+        self._layout = layout
+        self._last_scan = None
+        self._entries = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def _read_task(self, tjson, seen):
+        """
+        Reads task json reusing the copy read by the last
+        scan if file did not change
+        :param tjson: path to task json
+        :param seen: set path of task json is added to
+        :return: task json as dict or None if it could not be read
+        """
+        try:
+            mtime = os.stat(tjson).st_mtime
+        except OSError:
+            return None
+        seen.add(tjson)
+        entry = self._entries.get(tjson)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        try:
+            with open(tjson, 'r') as f:
+                taskdict = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(taskdict, dict):
+            return None
+        self._entries[tjson] = (mtime, taskdict)
+        return taskdict
+
+    def _scan(self, state, seen):
+        """
+        Gets tasks in **state**
+        :param state: state of tasks
+        :param seen: set paths of task json files read are added to
+        :return: list of tuples (uuid, task json as dict) ordered
+                 by submit time
+        """
+        tasks = []
+        statedir = os.path.join(self._taskdir, state)
+        for entry in self._layout.iter_taskdirs(statedir):
+            taskdict = self._read_task(os.path.join(entry.path,
+                                                    dao.TASK_JSON), seen)
+            if taskdict is None:
+                continue
+            tasks.append((entry.name, taskdict))
+        tasks.sort(key=lambda t: (t[1].get('submitTime', 0), t[0]))
+        return tasks
+
+    def refresh(self, force=False):
+        """
+        Rescans task directories if **ttl** seconds have passed
+        since last scan
+        :param force: if True rescan regardless of time of last scan
+        :return: True if task directories were rescanned
+        """
+        with self._lock:
+            now = time.time()
+            if (force is False and self._last_scan is not None and
+                    now - self._last_scan < self._ttl):
+                return False
+            seen = set()
+            tasks = {state: self._scan(state, seen)
+                     for state in [dao.SUBMITTED_STATUS,
+                                   dao.PROCESSING_STATUS]}
+            # drop copies of tasks that left the queue
+            self._entries = {path: entry
+                             for path, entry in self._entries.items()
+                             if path in seen}
+            self._tasks = tasks
+            self._last_scan = now
+            return True
+
+    def get_tasks(self, state):
+        """
+        Gets tasks in **state** as of last scan
+        :param state: :py:const:`~dao.SUBMITTED_STATUS` or
+                      :py:const:`~dao.PROCESSING_STATUS`
+        :return: list of tuples (uuid, task json as dict) ordered
+                 by submit time
+        """
+        with self._lock:
+            return list(self._tasks.get(state, []))
+
+
+class QueueEstimator(object):
+    """
+    Estimates queue position, start and finish time of submitted and
+    processing tasks, and how often a client should poll for status,
+    from a :py:class:`TaskQueueIndex` and a
+    :py:class:`StageDurationModel`. Tasks in processing occupy the
+    runner slots and submitted tasks are assumed to start, in order
+    of submit time, as slots free up. Runners claim tasks in directory
+    order so queue position is approximate
+    """
+    def __init__(self, taskdir, index=None, model=None, slots=1,
+                 min_poll=5, max_poll=300, default_poll=30,
+                 poll_fraction=0.25, layout=None):
+        """
+        Constructor
+        :param taskdir: base directory of tasks
+        :param index: TaskQueueIndex, if None one is created
+        :param model: StageDurationModel, if None one stored in
+                      :py:const:`STAGE_MODEL_FILE` under **taskdir**
+                      is used
+        :param slots: number of tasks processed at once by all
+                      runners, the number of tasks in processing
+                      is used if it is larger
+        :param min_poll: minimum poll interval in seconds
+        :param max_poll: maximum poll interval in seconds
+        :param default_poll: poll interval in seconds when start or
+                             finish cannot be estimated
+        :param poll_fraction: fraction of time until expected start,
+                              or finish if task is processing,
+                              suggested as poll interval
+        :param layout: TaskLayout of task directories used if
+                       **index** is None
+        """
+        if index is None:
+            index = TaskQueueIndex(taskdir, layout=layout)
+        self._index = index
+        if model is None:
+            model = StageDurationModel(os.path.join(taskdir,
+                                                    STAGE_MODEL_FILE))
+        self._model = model
+        self._slots = max(slots, 1)
+        self._min_poll = min_poll
+        self._max_poll = max_poll
+        self._default_poll = default_poll
+        self._poll_fraction = poll_fraction
+
+    def _get_poll_interval(self, event_time, now):
+        """
+        Gets poll interval
+        :param event_time: expected time in milliseconds since epoch
+                           of next change of task or None if unknown
+        :param now: current time in milliseconds since epoch
+        :return: poll interval in milliseconds
+        """
+        if event_time is None:
+            return self._default_poll * 1000
+        interval = (event_time - now) * self._poll_fraction
+        return int(min(max(interval, self._min_poll * 1000),
+                       self._max_poll * 1000))
+
+    def _get_slot_free_times(self, processing, now):
+        """
+        Gets times runner slots become free
+        :param processing: list of tuples (uuid, task json) in processing
+        :param now: current time in milliseconds since epoch
+        :return: heap of times in milliseconds since epoch or None if
+                 finish of a task in processing cannot be estimated
+        """
+        free = []
+        for taskid, taskdict in processing:
+            remaining = self._model.get_remaining_time(taskdict, now=now)
+            if remaining is None:
+                return None
+            free.append(now + remaining)
+        free.extend([now] * max(self._slots - len(free), 0))
+        heapq.heapify(free)
+        return free
+
+    def get_estimate(self, uuidstr, state, taskdict=None, now=None):
+        """
+        Estimates queue position, start and finish time of task
+        :param uuidstr: id of task
+        :param state: :py:const:`~dao.SUBMITTED_STATUS` or
+                      :py:const:`~dao.PROCESSING_STATUS`
+        :param taskdict: task json of task, used if task is not yet
+                         in the index
+        :param now: current time in milliseconds since epoch, None
+                    for current time
+        :return: dict with :py:const:`QUEUE_POSITION_KEY`,
+                 :py:const:`ESTIMATED_START_TIME_KEY`,
+                 :py:const:`ESTIMATED_FINISH_TIME_KEY`, set to None
+                 if they cannot be estimated, and
+                 :py:const:`POLL_INTERVAL_KEY`
+        """
+        if now is None:
+            now = int(time.time() * 1000)
+        self._index.refresh()
+        self._model.load()
+        processing = self._index.get_tasks(dao.PROCESSING_STATUS)
+        res = {QUEUE_POSITION_KEY: 0,
+               ESTIMATED_START_TIME_KEY: None,
+               ESTIMATED_FINISH_TIME_KEY: None}
+        if state == dao.PROCESSING_STATUS:
+            current = dict(processing).get(uuidstr, taskdict)
+            starts = [t['startTime'] for t in
+                      (current or {}).get(dao.STAGES_KEY, {}).values()
+                      if isinstance(t, dict) and 'startTime' in t]
+            res[ESTIMATED_START_TIME_KEY] = min(starts) if starts else now
+            remaining = self._model.get_remaining_time(current, now=now)
+            if remaining is not None:
+                res[ESTIMATED_FINISH_TIME_KEY] = now + remaining
+            res[POLL_INTERVAL_KEY] = self._get_poll_interval(
+                res[ESTIMATED_FINISH_TIME_KEY], now)
+            return res
+
+        submitted = self._index.get_tasks(dao.SUBMITTED_STATUS)
+        ids = [taskid for taskid, tdict in submitted]
+        if uuidstr in ids:
+            position = ids.index(uuidstr)
+        else:
+            position = len(submitted)
+            submitted.append((uuidstr, taskdict))
+        res[QUEUE_POSITION_KEY] = position + 1
+        free = self._get_slot_free_times(processing, now)
+        if free is not None:
+            for taskid, tdict in submitted[0:position + 1]:
+                start = heapq.heappop(free)
+                duration = self._model.get_remaining_time(tdict, now=now)
+                if duration is None:
+                    if taskid == uuidstr:
+                        res[ESTIMATED_START_TIME_KEY] = start
+                    break
+                if taskid == uuidstr:
+                    res[ESTIMATED_START_TIME_KEY] = start
+                    res[ESTIMATED_FINISH_TIME_KEY] = start + duration
+                heapq.heappush(free, start + duration)
+        res[POLL_INTERVAL_KEY] = self._get_poll_interval(
+            res[ESTIMATED_START_TIME_KEY], now)
+        return res
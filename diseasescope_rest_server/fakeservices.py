@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""Local stand-ins for the external services DiseaseScope calls"""
+import json
+import time
+import random
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+BIOTHINGS_SERVICE = 'biothings'
+BIGGIM_SERVICE = 'biggim'
+MYGENE_SERVICE = 'mygene'
+CLIXO_SERVICE = 'clixo'
+NDEX_SERVICE = 'ndex'
+HIVIEW_SERVICE = 'hiview'
+
+SERVICES = [BIOTHINGS_SERVICE, BIGGIM_SERVICE, MYGENE_SERVICE,
+            CLIXO_SERVICE, NDEX_SERVICE, HIVIEW_SERVICE]
+
+# key in json returned by every fake service
+ITEMS_KEY = 'items'
+
+
+class FakeServiceSettings(object):
+    """
+    Behavior of a fake service
+    """
+    def __init__(self, latency=0.0, payload_size=100, error_rate=0.0):
+        """
+        Constructor
+        :param latency: time in seconds service takes to respond
+        :param payload_size: number of items returned by service
+        :param error_rate: fraction, 0 to 1, of requests that
+                           fail with 503 status code
+        """
+        self.latency = latency
+        self.payload_size = payload_size
+        self.error_rate = error_rate
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each connection in its own thread
+    """
+    daemon_threads = True
+
+
+class _FakeServiceHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to fake services. First part of path
+    is the name of service
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            self.rfile.read(length)
+        service = self.path.strip('/').split('/')[0]
+        status, body = self.server.fakeservices.handle_request(service)
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class FakeServices(object):
+    """
+    Local HTTP server standing in for biothings, BigGIM, mygene,
+    the CLIXO API, NDEx and HiView with configurable latency,
+    payload size and error rate per service. Every service
+    responds with json of the form {"items": [0, 1, ...]}
+    """
+    def __init__(self, settings=None, host='127.0.0.1', port=0,
+                 seed=None):
+        """
+        Constructor
+        :param settings: dict of service name => FakeServiceSettings,
+                         services not in dict use default settings
+        :param host: host to listen on
+        :param port: port to listen on, 0 picks a free port
+        :param seed: seed for random errors
+        """
+        if settings is None:
+            self._settings = {}
+        else:
+            self._settings = settings
+        self._host = host
+        self._port = port
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._server = None
+        self._thread = None
+
+    def get_settings(self, service):
+        """
+        Gets settings of service
+        :param service: name of service
+        :return: FakeServiceSettings
+        """
+        if service not in self._settings:
+            self._settings[service] = FakeServiceSettings()
+        return self._settings[service]
+
+    def start(self):
+        """
+        Starts server in background thread
+        :return: None
+        """
+        self._server = _ThreadingHTTPServer((self._host, self._port),
+                                            _FakeServiceHandler)
+        self._server.fakeservices = self
+        self._port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='fakeservices')
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info('Fake services listening on ' + self.get_url())
+
+    def stop(self):
+        """
+        Stops server
+        :return: None
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+    def get_url(self, service=None):
+        """
+        Gets url of server or of **service**
+        :param service: name of service
+        :return: url as str
+        """
+        url = 'http://' + self._host + ':' + str(self._port)
+        if service is None:
+            return url
+        return url + '/' + service
+
+    def get_request_count(self, service):
+        """
+        Gets number of requests made to service
+        :param service: name of service
+        :return: int
+        """
+        with self._lock:
+            return self._counts.get(service, 0)
+
+    def handle_request(self, service):
+        """
+        Handles request to service, sleeping for latency of service
+        :param service: name of service
+        :return: tuple (status code, json serializable body)
+        """
+        settings = self.get_settings(service)
+        with self._lock:
+            self._counts[service] = self._counts.get(service, 0) + 1
+            fail = self._random.random() < settings.error_rate
+        if settings.latency > 0:
+            time.sleep(settings.latency)
+        if fail:
+            return 503, {'message': 'Service unavailable'}
+        return 200, {ITEMS_KEY: list(range(settings.payload_size))}
+
+
+class FakeDiseaseScope(object):
+    """
+    Stand in for :py:class:`diseasescope.diseasescope.DiseaseScope`
+    with the same methods and attributes whose every step calls
+    the corresponding fake service, through **session**
+    """
+    def __init__(self, doid, fakeservices, session=None):
+        """
+        Constructor
+        :param doid: disease id
+        :param fakeservices: FakeServices to call
+        :param session: session to call services with, if None
+                        :py:mod:`requests` is used
+        """
+        self.doid = doid
+        self.disease_genes = None
+        self.tissues = None
+        self.network = None
+        self.hiview_url = None
+        self._services = fakeservices
+        self._session = session
+
+    def _call(self, service, path, payload=None):
+        """
+        Calls service, raising exception on error
+        :return: items returned by service
+        """
+        url = self._services.get_url(service) + '/' + path
+        session = self._session
+        if session is None:
+            session = requests
+        if payload is None:
+            resp = session.get(url)
+        else:
+            resp = session.post(url, json=payload)
+        resp.raise_for_status()
+        return resp.json()[ITEMS_KEY]
+
+    def get_disease_genes(self, method='biothings'):
+        items = self._call(BIOTHINGS_SERVICE, 'disease/' + str(self.doid))
+        self.disease_genes = [str(i) for i in items]
+        return self
+
+    def get_disease_tissues(self, n=10):
+        items = self._call(BIOTHINGS_SERVICE, 'tissues/' + str(self.doid))
+        self.tissues = ['tissue' + str(i) for i in items[0:n]]
+        return self
+
+    def expand_gene_set(self, method='biggim'):
+        items = self._call(BIGGIM_SERVICE, 'expand',
+                           payload={'genes': self.disease_genes})
+        genes = set(self.disease_genes)
+        self.disease_genes = self.disease_genes + [str(i + len(genes))
+                                                   for i in items]
+        return self
+
+    def get_network(self, method='biggim'):
+        import pandas as pd
+        items = self._call(BIGGIM_SERVICE, 'network',
+                           payload={'genes': self.disease_genes,
+                                    'tissues': self.tissues})
+        genes = self.disease_genes
+        self.network = pd.DataFrame({
+            'Gene1': [genes[i % len(genes)] for i in items],
+            'Gene2': [genes[(i + 1) % len(genes)] for i in items],
+            'mean': [float(i % 100) / 100.0 for i in items]})
+        return self
+
+    def convert_edge_table_names(self, columns, scope, field, keep=False):
+        genes = set()
+        for c in columns:
+            genes.update(self.network[c])
+        self._call(MYGENE_SERVICE, 'query', payload={'q': sorted(genes),
+                                                     'scopes': scope,
+                                                     'fields': field})
+        for c in columns:
+            self.network[c] = 'SYM' + self.network[c].astype(str)
+        return self
+
+    def infer_hierarchical_model(self, edge_attr='mean', method='clixo-api',
+                                 temp_path=None, method_kwargs=None):
+        self._call(CLIXO_SERVICE, 'submit',
+                   payload={'edges': len(self.network),
+                            'params': method_kwargs})
+        self._call(CLIXO_SERVICE, 'result')
+        items = self._call(NDEX_SERVICE, 'network', payload={})
+        self.hiview_url = (self._services.get_url(HIVIEW_SERVICE) + '/' +
+                           str(len(items)))
+        return self
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+
+"""Shared pooled and retrying HTTP session for external service calls"""
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from diseasescope_rest_server import metrics
+from diseasescope_rest_server import tracing
+
+logger = logging.getLogger(__name__)
+
+
+# status codes from external services that are retried
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+# http methods that are retried on read errors and error status
+# codes. POST is left out since submitting a CLIXO job or uploading
+# to NDEx creates a resource, so it is only retried on connect
+# errors when the request was never sent
+RETRY_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE',
+                           'OPTIONS'])
+
+# default (connect, read) timeout in seconds
+DEFAULT_TIMEOUT = (10, 600)
+
+# names of functions of requests module that
+# :py:class:`SessionRequests` sends through its session
+REQUESTS_FUNCTIONS = ['request', 'get', 'options', 'head', 'post',
+                      'put', 'patch', 'delete']
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised when a request is made to a host whose circuit is open
+    """
+    pass
+
+
+class JitterRetry(Retry):
+    """
+    Retry using exponential backoff with full jitter, so
+    workers hitting the same failing service spread out
+    their retries
+    """
+    def get_backoff_time(self):
+        """
+        Gets random time between 0 and the exponential backoff time
+        :return: time in seconds
+        """
+        backoff = super(JitterRetry, self).get_backoff_time()
+        if backoff <= 0:
+            return 0
+        return random.uniform(0, backoff)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failures of requests to a host. Once
+    **failure_threshold** failures occur in a row the circuit opens
+    and requests are rejected until **reset_timeout** seconds pass,
+    after which one trial request is let through. Success of the
+    trial closes the circuit, failure opens it again
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        """
+        Constructor
+        :param failure_threshold: consecutive failures that open circuit
+        :param reset_timeout: time in seconds circuit stays open
+        """
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_time = None
+        self._trial_running = False
+
+    def get_state(self):
+        """
+        Gets state of circuit
+        :return: :py:const:`CLOSED`, :py:const:`OPEN` or
+                 :py:const:`HALF_OPEN`
+        """
+        with self._lock:
+            if self._opened_time is None:
+                return CircuitBreaker.CLOSED
+            if time.time() - self._opened_time >= self._reset_timeout:
+                return CircuitBreaker.HALF_OPEN
+            return CircuitBreaker.OPEN
+
+    def allow_request(self):
+        """
+        Checks whether a request can be made
+        :return: True if request can be made otherwise False
+        """
+        with self._lock:
+            if self._opened_time is None:
+                return True
+            if time.time() - self._opened_time < self._reset_timeout:
+                return False
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        """
+        Records successful request, closing circuit
+        :return: None
+        """
+        with self._lock:
+            self._failures = 0
+            self._opened_time = None
+            self._trial_running = False
+
+    def record_failure(self):
+        """
+        Records failed request, opening circuit if threshold is
+        reached or trial request failed
+        :return: None
+        """
+        with self._lock:
+            self._failures += 1
+            if (self._trial_running or
+                    self._failures >= self._failure_threshold):
+                self._opened_time = time.time()
+            self._trial_running = False
+
+
+class PooledSession(requests.Session):
+    """
+    :py:class:`requests.Session` keeping a pool of keep-alive
+    connections per host, retrying transient failures with
+    :py:class:`JitterRetry` and guarding every host with its
+    own :py:class:`CircuitBreaker`. Safe to share across threads
+    """
+    def __init__(self, retries=5, backoff_factor=0.5,
+                 pool_size=10, timeout=DEFAULT_TIMEOUT,
+                 failure_threshold=5, reset_timeout=60, metrics=None):
+        """
+        Constructor
+        :param retries: maximum number of retries of a request
+        :param backoff_factor: base in seconds of exponential backoff
+        :param pool_size: maximum connections kept per host
+        :param timeout: default timeout in seconds as float or
+                        (connect, read) tuple for requests made
+                        without a timeout
+        :param failure_threshold: consecutive failed requests to a
+                                  host that open its circuit
+        :param reset_timeout: time in seconds circuit of host stays
+                              open
+        :param metrics: MetricsRegistry where latency and failures of
+                        requests are recorded per host, None to not
+                        record them
+        """
+        super(PooledSession, self).__init__()
+        self._timeout = timeout
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+        self._requests = 0
+        self._failures = 0
+        self._counts_lock = threading.Lock()
+        self._metrics = metrics
+        retry = _create_retry(retries, backoff_factor)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def get_circuit_breaker(self, url):
+        """
+        Gets circuit breaker of host in **url**, creating it
+        if needed
+        :param url: url of request
+        :return: :py:class:`CircuitBreaker`
+        """
+        host = urlparse(url).netloc
+        with self._breakers_lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    failure_threshold=self._failure_threshold,
+                    reset_timeout=self._reset_timeout)
+                self._breakers[host] = breaker
+            return breaker
+
+    def get_circuit_states(self):
+        """
+        Gets state of circuit of every host contacted
+        :return: dict of host => state
+        """
+        with self._breakers_lock:
+            breakers = dict(self._breakers)
+        return {host: b.get_state() for host, b in breakers.items()}
+
+    def get_request_count(self):
+        """
+        Gets number of requests made
+        :return:
+        """
+        return self._requests
+
+    def get_failure_count(self):
+        """
+        Gets number of requests that failed after retries
+        :return:
+        """
+        return self._failures
+
+    def request(self, method, url, **kwargs):
+        """
+        Makes request, applying default timeout and rejecting
+        request if circuit of host is open. If a span is active
+        in this thread the request is recorded as a child span and
+        its trace context is passed on in the traceparent header
+        :raises CircuitOpenError: if circuit of host is open
+        """
+        breaker = self.get_circuit_breaker(url)
+        host = urlparse(url).netloc
+        if not breaker.allow_request():
+            self._record_metrics(host, None)
+            raise CircuitOpenError('Circuit open for ' + str(host) +
+                                   ' rejecting request')
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._timeout
+        span = self._start_span(method, url, host, kwargs)
+        with self._counts_lock:
+            self._requests += 1
+        start = time.time()
+        try:
+            resp = super(PooledSession, self).request(method, url, **kwargs)
+        except Exception as e:
+            self._count_failure()
+            breaker.record_failure()
+            self._record_metrics(host, start)
+            if span is not None:
+                span.set_tag('error', str(e))
+                span.finish()
+            raise
+        if resp.status_code in RETRY_STATUS_CODES:
+            self._count_failure()
+            breaker.record_failure()
+            self._record_metrics(host, start)
+        else:
+            breaker.record_success()
+            self._record_metrics(host, start, failed=False)
+        if span is not None:
+            span.set_tag('http.status_code', resp.status_code)
+            span.finish()
+        return resp
+
+    def _count_failure(self):
+        """
+        Adds one to number of failed requests
+        :return: None
+        """
+        with self._counts_lock:
+            self._failures += 1
+
+    def _start_span(self, method, url, host, kwargs):
+        """
+        Starts span of request as child of span active in this thread
+        and adds traceparent header of span to **kwargs**
+        :param method: http method
+        :param url: url of request
+        :param host: host of request
+        :param kwargs: keyword arguments of request
+        :return: Span or None if no span is active
+        """
+        parent = tracing.get_current_span()
+        if parent is None:
+            return None
+        span = parent.start_child(method.upper() + ' ' + host,
+                                  kind=tracing.CLIENT_KIND,
+                                  tags={'http.method': method.upper(),
+                                        'http.url': url})
+        headers = dict(kwargs.get('headers') or {})
+        headers[tracing.TRACEPARENT_HEADER] = span.get_traceparent()
+        kwargs['headers'] = headers
+        return span
+
+    def _record_metrics(self, host, start, failed=True):
+        """
+        Records latency and failure of request in metrics
+        :param host: host of request
+        :param start: start time of request or None if request
+                      was not made
+        :param failed: True if request failed
+        :return: None
+        """
+        if self._metrics is None:
+            return
+        labels = {'target': host}
+        if start is not None:
+            self._metrics.observe(metrics.HTTP_SECONDS,
+                                  time.time() - start, labels=labels)
+        if failed is True:
+            self._metrics.inc(metrics.HTTP_ERRORS_TOTAL, labels=labels)
+
+
+def _create_retry(retries, backoff_factor):
+    """
+    Creates retry policy, handling rename of method_whitelist to
+    allowed_methods in newer urllib3
+    :return: :py:class:`JitterRetry`
+    """
+    kwargs = {'total': retries,
+              'connect': retries,
+              'read': retries,
+              'status': retries,
+              'backoff_factor': backoff_factor,
+              'status_forcelist': RETRY_STATUS_CODES,
+              'raise_on_status': False}
+    try:
+        return JitterRetry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        return JitterRetry(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+class SessionRequests(object):
+    """
+    Stand in for :py:mod:`requests` module whose request functions,
+    such as get() and post(), are sent through a session. All other
+    attributes, such as exceptions, are those of :py:mod:`requests`
+    """
+    def __init__(self, session):
+        """
+        Constructor
+        :param session: session to send requests through
+        """
+        self._session = session
+
+    def get_session(self):
+        """
+        Gets session requests are sent through
+        :return:
+        """
+        return self._session
+
+    def __getattr__(self, name):
+        if name in REQUESTS_FUNCTIONS:
+            return getattr(self._session, name)
+        return getattr(requests, name)
+
+
+def route_module_requests(module, session):
+    """
+    Sends requests **module** makes through its global reference
+    to :py:mod:`requests`, such as requests.get(), through
+    **session**. Only that reference is replaced so other users of
+    :py:mod:`requests` are unaffected. Meant for libraries, such as
+    DiseaseScope, that do not take a session
+    :param module: module to route requests of
+    :param session: session to use
+    :return: True if requests of module are routed, False if module
+             does not use :py:mod:`requests`
+    """
+    current = getattr(module, 'requests', None)
+    if current is not requests and not isinstance(current,
+                                                  SessionRequests):
+        logger.debug(str(module.__name__) + ' does not use requests')
+        return False
+    module.requests = SessionRequests(session)
+    logger.debug('Routing requests of ' + str(module.__name__) +
+                 ' through shared session')
+    return True
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""Leases held by task runners on the tasks they process"""
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server.dao import FileBasedTask
+
+logger = logging.getLogger(__name__)
+
+
+LEASE_FILE = dao.LEASE_FILE
+
+LEASE_OWNER_KEY = 'owner'
+LEASE_HEARTBEAT_KEY = 'heartbeat'
+LEASE_EXPIRES_KEY = 'expires'
+
+# key in task json counting the times task was requeued
+# after the runner processing it stopped renewing its lease
+RECOVERY_ATTEMPTS_KEY = 'recoveryAttempts'
+
+
+def get_owner_id():
+    """
+    Gets id unique to this process to identify owner of leases
+    :return: str of form <hostname>:<pid>:<random hex>
+    """
+    return (socket.gethostname() + ':' + str(os.getpid()) + ':' +
+            uuid.uuid4().hex[0:8])
+
+
+def read_lease(taskdir):
+    """
+    Reads lease of task
+    :param taskdir: task directory
+    :return: dict or None if task has no readable lease
+    """
+    lfile = os.path.join(taskdir, LEASE_FILE)
+    try:
+        with open(lfile, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class TaskLeaseManager(object):
+    """
+    Writes leases into the directories of tasks a runner processes
+    and renews them with a heartbeat. Tasks in processing whose
+    lease expired, because their runner died or the host rebooted,
+    are put back in the submitted queue, where they resume from
+    their stage checkpoints, or moved to error once they were
+    recovered **max_retries** times
+    """
+    def __init__(self, taskdir, owner=None, lease_time=300,
+                 max_retries=3, layout=None):
+        """
+        Constructor
+        :param taskdir: base directory of tasks
+        :param owner: id of this runner, if None
+                      :py:func:`get_owner_id` is used
+        :param lease_time: time in seconds a lease is valid after
+                           its last heartbeat
+        :param max_retries: maximum number of times a task is
+                            requeued after its lease expired
+        :param layout: TaskLayout of task directories, if None
+                       tasks are stored under address they were
+                       submitted from
+        """
+        self._taskdir = taskdir
+        if layout is None:
+            layout = dao.TaskLayout()
+        self._layout = layout
+        if owner is None:
+            owner = get_owner_id()
+        self._owner = owner
+        self._lease_time = lease_time
+        self._max_retries = max_retries
+
+    def get_owner(self):
+        """
+        Gets id of owner of leases written by this object
+        :return: str
+        """
+        return self._owner
+
+    def get_lease_time(self):
+        """
+        Gets time in seconds a lease is valid after its last heartbeat
+        :return:
+        """
+        return self._lease_time
+
+    def heartbeat(self, task):
+        """
+        Writes, or renews, lease of this runner on **task**
+        :param task: task being processed
+        :return: None
+        """
+        now = time.time()
+        lease = {LEASE_OWNER_KEY: self._owner,
+                 LEASE_HEARTBEAT_KEY: now,
+                 LEASE_EXPIRES_KEY: now + self._lease_time}
+        taskdir = task.get_taskdir()
+        if taskdir is None or not os.path.isdir(taskdir):
+            return
+        lfile = os.path.join(taskdir, LEASE_FILE)
+        tmpfile = lfile + '.' + self._owner.replace(':', '_') + '.tmp'
+        try:
+            with open(tmpfile, 'w') as f:
+                json.dump(lease, f)
+            os.replace(tmpfile, lfile)
+        except OSError as e:
+            logger.warning('Unable to write lease ' + lfile + ' : ' + str(e))
+            if os.path.isfile(tmpfile):
+                os.unlink(tmpfile)
+
+    def release(self, task):
+        """
+        Removes lease of this runner from **task**
+        :param task: task no longer processed
+        :return: None
+        """
+        taskdir = task.get_taskdir()
+        if taskdir is None:
+            return
+        lease = read_lease(taskdir)
+        if lease is None or lease.get(LEASE_OWNER_KEY) != self._owner:
+            return
+        try:
+            os.unlink(os.path.join(taskdir, LEASE_FILE))
+        except OSError:
+            pass
+
+    def is_expired(self, taskdir, now=None):
+        """
+        Checks if lease of task expired. Tasks without a lease, such
+        as those claimed by a runner without leases, expire
+        **lease_time** seconds after their task json was last written
+        :param taskdir: task directory
+        :param now: current time in seconds since epoch, None for
+                    current time
+        :return: True if expired otherwise False
+        """
+        if now is None:
+            now = time.time()
+        lease = read_lease(taskdir)
+        if lease is not None:
+            return lease.get(LEASE_EXPIRES_KEY, 0) < now
+        try:
+            mtime = os.stat(os.path.join(taskdir,
+                                         dao.TASK_JSON)).st_mtime
+        except OSError:
+            return False
+        return mtime + self._lease_time < now
+
+    def get_expired_tasks(self, exclude=None):
+        """
+        Gets tasks in processing whose lease expired
+        :param exclude: ids of tasks to skip, such as those in flight
+        :return: list of FileBasedTask objects
+        """
+        if exclude is None:
+            exclude = set()
+        procdir = os.path.join(self._taskdir, dao.PROCESSING_STATUS)
+        if not os.path.isdir(procdir):
+            return []
+        now = time.time()
+        expired = []
+        for entry in self._layout.iter_taskdirs(procdir):
+            if entry.name in exclude:
+                continue
+            if not self.is_expired(entry.path, now=now):
+                continue
+            try:
+                with open(os.path.join(entry.path,
+                                       dao.TASK_JSON), 'r') as f:
+                    taskdict = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.debug('Skipping ' + entry.path + ' : ' + str(e))
+                continue
+            expired.append(FileBasedTask(entry.path, taskdict,
+                                         layout=self._layout))
+        return expired
+
+    def recover_expired_tasks(self, exclude=None):
+        """
+        Puts tasks whose lease expired back in the submitted queue,
+        or moves them to error if they were already recovered
+        **max_retries** times
+        :param exclude: ids of tasks to skip, such as those in flight
+        :return: tuple (number requeued, number moved to error)
+        """
+        requeued = 0
+        failed = 0
+        for task in self.get_expired_tasks(exclude=exclude):
+            taskdict = task.get_taskdict()
+            attempts = taskdict.get(RECOVERY_ATTEMPTS_KEY, 0)
+            try:
+                if attempts >= self._max_retries:
+                    emsg = ('Task abandoned after runner processing it '
+                            'stopped ' + str(attempts + 1) + ' times')
+                    logger.error(emsg + ' : ' + task.get_taskdir())
+                    self._remove_lease(task)
+                    task.move_task(dao.ERROR_STATUS, error_message=emsg)
+                    failed += 1
+                    continue
+                logger.info('Lease of task ' + task.get_taskdir() +
+                            ' expired, requeueing it')
+                taskdict[RECOVERY_ATTEMPTS_KEY] = attempts + 1
+                task.save_task()
+                self._remove_lease(task)
+                task.move_task(dao.SUBMITTED_STATUS)
+                requeued += 1
+            except Exception:
+                # another runner may have recovered the task first
+                logger.exception('Caught exception recovering task ' +
+                                 str(task.get_taskdir()))
+        return requeued, failed
+
+    def _remove_lease(self, task):
+        """
+        Removes lease of task regardless of owner
+        :param task: task
+        :return: None
+        """
+        try:
+            os.unlink(os.path.join(task.get_taskdir(), LEASE_FILE))
+        except OSError:
+            pass
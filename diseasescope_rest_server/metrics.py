@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+
+"""Metrics of the task runner in Prometheus text format"""
+import os
+import errno
+import socket
+import logging
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer
+from http.server import BaseHTTPRequestHandler
+
+from diseasescope_rest_server import dao
+
+logger = logging.getLogger(__name__)
+
+
+# upper bounds in seconds of histogram buckets, pipeline stages
+# range from under a second to hours for CLIXO
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0,
+                   300.0, 900.0, 1800.0, 3600.0, 7200.0)
+
+HOST_LABEL = 'host'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRICS_PATH = '/metrics'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+QUEUE_DEPTH = 'diseasescope_queue_depth'
+TASKS_IN_FLIGHT = 'diseasescope_tasks_in_flight'
+TASK_SLOTS = 'diseasescope_task_slots'
+TASKS_TOTAL = 'diseasescope_tasks_total'
+CLAIM_SECONDS = 'diseasescope_task_claim_seconds'
+QUEUE_WAIT_SECONDS = 'diseasescope_task_queue_wait_seconds'
+STAGE_SECONDS = 'diseasescope_stage_duration_seconds'
+STAGE_CACHE_TOTAL = 'diseasescope_stage_cache_requests_total'
+STAGE_POOL_WORKERS = 'diseasescope_stage_pool_workers'
+STAGE_POOL_PENDING = 'diseasescope_stage_pool_pending'
+STAGE_POOL_ABANDONED = 'diseasescope_stage_pool_abandoned'
+STAGE_STALL_SECONDS = 'diseasescope_stage_stall_seconds'
+TIMED_OUT_TASKS = 'diseasescope_timed_out_tasks'
+HTTP_SECONDS = 'diseasescope_http_request_seconds'
+HTTP_ERRORS_TOTAL = 'diseasescope_http_errors_total'
+
+METRIC_HELP = {
+    QUEUE_DEPTH: 'Number of tasks in each state',
+    TASKS_IN_FLIGHT: 'Number of tasks being processed',
+    TASK_SLOTS: 'Maximum number of tasks processed at once',
+    TASKS_TOTAL: 'Number of tasks processed by outcome',
+    CLAIM_SECONDS: 'Time to claim a task found in the submitted queue',
+    QUEUE_WAIT_SECONDS: 'Time from submit of task to its pickup',
+    STAGE_SECONDS: 'Time to run pipeline stage',
+    STAGE_CACHE_TOTAL: 'Lookups of stage output in stage cache by result',
+    STAGE_POOL_WORKERS: 'Number of threads of stage pool',
+    STAGE_POOL_PENDING: 'Number of stages running or waiting in pool',
+    STAGE_POOL_ABANDONED: 'Number of stages abandoned by timed out or '
+                          'deleted tasks that are still running',
+    STAGE_STALL_SECONDS: 'Total time spent in stages of tasks that '
+                         'timed out',
+    TIMED_OUT_TASKS: 'Number of tasks stopped by stage or task timeout',
+    HTTP_SECONDS: 'Time of requests to external services by host',
+    HTTP_ERRORS_TOTAL: 'Requests to external services that failed by host'
+}
+
+
+def _escape(val):
+    """
+    Escapes label value for text format
+    :param val: label value
+    :return: escaped str
+    """
+    return (str(val).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(labelkey, extra=None):
+    """
+    Formats labels as {name="value",...}
+    :param labelkey: tuple of (name, value) pairs
+    :param extra: (name, value) pair appended after **labelkey**
+    :return: str, empty if there are no labels
+    """
+    pairs = list(labelkey)
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join([n + '="' + _escape(v) + '"'
+                           for n, v in pairs]) + '}'
+
+
+def _format_value(val):
+    """
+    Formats sample value
+    :param val: number
+    :return: str
+    """
+    if val == float('inf'):
+        return '+Inf'
+    return repr(float(val))
+
+
+def count_tasks(taskdir, state, layout=None):
+    """
+    Counts tasks in **state** under **taskdir**
+    :param taskdir: base directory of tasks
+    :param state: state directory, such as
+                  :py:const:`~diseasescope_rest_server.dao.SUBMITTED_STATUS`
+    :param layout: TaskLayout of task directories, if None tasks
+                   are stored under address they were submitted from
+    :return: int
+    """
+    if layout is None:
+        layout = dao.TaskLayout()
+    total = 0
+    for entry in layout.iter_taskdirs(os.path.join(taskdir, state)):
+        total += 1
+    return total
+
+
+class MetricsRegistry(object):
+    """
+    Thread safe store of counters, gauges and histograms rendered in
+    the Prometheus text format. Every sample is labeled with the host
+    of the runner so several hosts can be compared. Functions added
+    with :py:meth:`add_collector` are called before each render to
+    update gauges that are cheaper to read on demand, such as queue
+    depth
+    """
+    def __init__(self, labels=None, buckets=DEFAULT_BUCKETS):
+        """
+        Constructor
+        :param labels: dict of labels added to every sample, if None
+                       host label set to name of this host is used
+        :param buckets: upper bounds of histogram buckets in
+                        increasing order
+        """
+        if labels is None:
+            labels = {HOST_LABEL: socket.gethostname()}
+        self._labels = dict(labels)
+        self._buckets = tuple(buckets)
+        self._types = {}
+        self._values = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_key(self, name, mtype, labels):
+        """
+        Gets key of sample, registering type of metric
+        :raises ValueError: if **name** was used for another type
+        :return: tuple (name, label pairs)
+        """
+        curtype = self._types.setdefault(name, mtype)
+        if curtype != mtype:
+            raise ValueError('Metric ' + name + ' is a ' + curtype +
+                             ' not a ' + mtype)
+        merged = dict(self._labels)
+        if labels is not None:
+            merged.update(labels)
+        return name, tuple(sorted(merged.items()))
+
+    def inc(self, name, value=1, labels=None):
+        """
+        Increments counter
+        :param name: name of counter
+        :param value: amount to add
+        :param labels: dict of labels of sample
+        :return: None
+        """
+        with self._lock:
+            key = self._get_key(name, COUNTER, labels)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        """
+        Sets gauge
+        :param name: name of gauge
+        :param value: value
+        :param labels: dict of labels of sample
+        :return: None
+        """
+        with self._lock:
+            key = self._get_key(name, GAUGE, labels)
+            self._values[key] = value
+
+    def observe(self, name, value, labels=None):
+        """
+        Adds observation to histogram
+        :param name: name of histogram
+        :param value: observed value, in seconds for durations
+        :param labels: dict of labels of sample
+        :return: None
+        """
+        with self._lock:
+            key = self._get_key(name, HISTOGRAM, labels)
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = [[0] * len(self._buckets), 0.0, 0]
+                self._histograms[key] = hist
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    def get_value(self, name, labels=None):
+        """
+        Gets value of counter or gauge, or number of observations
+        of histogram
+        :param name: name of metric
+        :param labels: dict of labels of sample
+        :return: value or None if sample does not exist
+        """
+        with self._lock:
+            mtype = self._types.get(name)
+            if mtype is None:
+                return None
+            key = self._get_key(name, mtype, labels)
+            if mtype == HISTOGRAM:
+                hist = self._histograms.get(key)
+                return None if hist is None else hist[2]
+            return self._values.get(key)
+
+    def add_collector(self, func):
+        """
+        Adds function called with this registry before each render
+        :param func: function taking a MetricsRegistry
+        :return: None
+        """
+        self._collectors.append(func)
+
+    def collect(self):
+        """
+        Calls functions added by :py:meth:`add_collector`, logging
+        any exception raised
+        :return: None
+        """
+        for func in self._collectors:
+            try:
+                func(self)
+            except Exception:
+                logger.exception('Caught exception collecting metrics')
+
+    def render(self):
+        """
+        Collects and renders all metrics
+        :return: metrics in Prometheus text format as str
+        """
+        self.collect()
+        lines = []
+        with self._lock:
+            for name in sorted(self._types.keys()):
+                mtype = self._types[name]
+                if name in METRIC_HELP:
+                    lines.append('# HELP ' + name + ' ' + METRIC_HELP[name])
+                lines.append('# TYPE ' + name + ' ' + mtype)
+                if mtype == HISTOGRAM:
+                    self._render_histogram(name, lines)
+                    continue
+                for key in sorted(k for k in self._values if k[0] == name):
+                    lines.append(name + _format_labels(key[1]) + ' ' +
+                                 _format_value(self._values[key]))
+        return '\n'.join(lines) + '\n'
+
+    def _render_histogram(self, name, lines):
+        """
+        Appends bucket, sum and count samples of histogram to
+        **lines**, called with lock held
+        :return: None
+        """
+        for key in sorted(k for k in self._histograms if k[0] == name):
+            counts, total, count = self._histograms[key]
+            cumulative = 0
+            for bound, bcount in zip(self._buckets, counts):
+                cumulative += bcount
+                lines.append(name + '_bucket' +
+                             _format_labels(key[1], ('le',
+                                                     _format_value(bound))) +
+                             ' ' + str(cumulative))
+            lines.append(name + '_bucket' +
+                         _format_labels(key[1], ('le', '+Inf')) +
+                         ' ' + str(count))
+            lines.append(name + '_sum' + _format_labels(key[1]) + ' ' +
+                         _format_value(total))
+            lines.append(name + '_count' + _format_labels(key[1]) + ' ' +
+                         str(count))
+
+
+class TaskQueueCollector(object):
+    """
+    Collector setting :py:const:`QUEUE_DEPTH` gauge to number of
+    submitted and processing tasks and pending delete requests.
+    Done tasks are not counted since that directory grows without
+    bound and listing it on every scrape would be slow
+    """
+    STATES = [dao.SUBMITTED_STATUS, dao.PROCESSING_STATUS,
+              dao.DELETE_REQUESTS]
+
+    def __init__(self, taskdir, layout=None):
+        """
+        Constructor
+        :param taskdir: base directory of tasks
+        :param layout: TaskLayout of task directories, if None tasks
+                       are stored under address they were submitted
+                       from
+        """
+        self._taskdir = taskdir
+        self._layout = layout
+
+    def __call__(self, registry):
+        """
+        Updates queue depth of each state in **registry**
+        :param registry: MetricsRegistry
+        :return: None
+        """
+        for state in TaskQueueCollector.STATES:
+            if state == dao.DELETE_REQUESTS:
+                depth = self._count_delete_requests()
+            else:
+                depth = count_tasks(self._taskdir, state,
+                                    layout=self._layout)
+            registry.set(QUEUE_DEPTH, depth, labels={'state': state})
+
+    def _count_delete_requests(self):
+        """
+        Counts pending delete requests
+        :return: int
+        """
+        try:
+            with os.scandir(os.path.join(self._taskdir,
+                                         dao.DELETE_REQUESTS)) as it:
+                return len([e for e in it if e.is_file()])
+        except OSError:
+            return 0
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves metrics of registry of server at :py:const:`METRICS_PATH`
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request: ' + (format % args))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each request in its own thread
+    """
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """
+    HTTP server, run in a daemon thread, serving metrics of a
+    :py:class:`MetricsRegistry` at :py:const:`METRICS_PATH`. Bound
+    to localhost by default. If the port is in use, such as by the
+    runner this one replaces while it drains, binding is retried in
+    the background until the port is free
+    """
+    def __init__(self, registry, port, address='127.0.0.1',
+                 retry_interval=1.0):
+        """
+        Constructor
+        :param registry: MetricsRegistry to serve
+        :param port: port to listen on, 0 picks a free port
+        :param address: address to listen on
+        :param retry_interval: time in seconds between attempts to
+                               bind to port while it is in use
+        """
+        self._registry = registry
+        self._port = port
+        self._address = address
+        self._retry_interval = retry_interval
+        self._server = None
+        self._thread = None
+        self._bind_thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts serving metrics. If port is in use, binding is retried
+        every **retry_interval** seconds in a background thread until
+        it succeeds or :py:meth:`stop` is called
+        :raises OSError: if binding fails for a reason other than
+                         port in use
+        :return: None
+        """
+        self._stop.clear()
+        try:
+            self._bind()
+            return
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+        logger.error(self._address + ':' + str(self._port) +
+                     ' in use, retrying every ' +
+                     str(self._retry_interval) + ' seconds')
+        self._bind_thread = threading.Thread(target=self._retry_bind,
+                                             name='metrics-server-bind')
+        self._bind_thread.daemon = True
+        self._bind_thread.start()
+
+    def _bind(self):
+        """
+        Binds to port and starts serving metrics in a daemon thread,
+        unless :py:meth:`stop` was called
+        :raises OSError: if binding fails
+        :return: None
+        """
+        server = _ThreadingHTTPServer((self._address, self._port),
+                                      _MetricsHandler)
+        server.registry = self._registry
+        with self._lock:
+            if self._stop.is_set():
+                server.server_close()
+                return
+            self._server = server
+            self._thread = threading.Thread(target=server.serve_forever,
+                                            name='metrics-server')
+            self._thread.daemon = True
+            self._thread.start()
+        logger.info('Serving metrics on ' + self._address + ':' +
+                    str(self.get_port()))
+
+    def _retry_bind(self):
+        """
+        Retries binding to port until it succeeds or
+        :py:meth:`stop` is called
+        :return: None
+        """
+        while not self._stop.wait(self._retry_interval):
+            try:
+                self._bind()
+                return
+            except OSError as e:
+                logger.debug('Unable to bind metrics server: ' + str(e))
+
+    def get_port(self):
+        """
+        Gets port server listens on
+        :return: int or None if not serving
+        """
+        with self._lock:
+            if self._server is None:
+                return None
+            return self._server.server_address[1]
+
+    def stop(self):
+        """
+        Stops serving metrics and retrying to bind
+        :return: None
+        """
+        self._stop.set()
+        if self._bind_thread is not None:
+            self._bind_thread.join()
+            self._bind_thread = None
+        with self._lock:
+            server = self._server
+            self._server = None
+        if server is None:
+            return
+        server.shutdown()
+        server.server_close()
+        self._thread.join()
+
+
+class TextfileExporter(object):
+    """
+    Writes metrics of a :py:class:`MetricsRegistry` to a file every
+    **interval** seconds for the textfile collector of the
+    Prometheus node exporter. The file is replaced atomically
+    """
+    def __init__(self, registry, path, interval=15.0):
+        """
+        Constructor
+        :param registry: MetricsRegistry to write
+        :param path: file to write, should end in .prom
+        :param interval: time in seconds between writes
+        """
+        self._registry = registry
+        self._path = path
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        """
+        Writes metrics to file
+        :return: None
+        """
+        tmpfile = self._path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            with open(tmpfile, 'w') as f:
+                f.write(self._registry.render())
+            os.replace(tmpfile, self._path)
+        except OSError as e:
+            logger.error('Unable to write metrics to ' + self._path +
+                         ' : ' + str(e))
+
+    def _write_periodically(self):
+        """
+        Writes metrics every **interval** seconds until stopped
+        """
+        while not self._stop.wait(self._interval):
+            self.write()
+
+    def start(self):
+        """
+        Writes metrics and starts thread writing them periodically
+        :return: None
+        """
+        self.write()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._write_periodically,
+                                        name='metrics-textfile')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops thread and writes metrics one last time
+        :return: None
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.write()
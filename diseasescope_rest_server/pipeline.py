@@ -0,0 +1,1381 @@
+# -*- coding: utf-8 -*-
+
+"""DiseaseScope pipeline run by the task runner"""
+import os
+import copy
+import time
+import gzip
+import json
+import pickle
+import shutil
+import logging
+import functools
+import threading
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import wait
+
+import diseasescope_rest_server
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import clixo
+from diseasescope_rest_server import edgetable
+from diseasescope_rest_server import metrics
+from diseasescope_rest_server import tracing
+from diseasescope_rest_server.edgetable import EdgeTable
+
+logger = logging.getLogger(__name__)
+
+
+CHECKPOINT_MANIFEST = 'manifest.json'
+CHECKPOINT_SUFFIX = '.pkl.gz'
+CHECKPOINT_EDGETABLE_SUFFIX = '.edges'
+
+# keys in checkpoint manifest
+MANIFEST_STAGES_KEY = 'stages'
+MANIFEST_NAME_KEY = 'name'
+MANIFEST_FILE_KEY = 'file'
+MANIFEST_SIZE_KEY = 'size'
+MANIFEST_EDGETABLES_KEY = 'edgetables'
+
+# keys in entries of stages map in task json
+STAGE_START_TIME_KEY = 'startTime'
+STAGE_DURATION_KEY = 'duration'
+STAGE_QUEUE_WAIT_KEY = 'queueWait'
+STAGE_INPUT_SIZE_KEY = 'inputSize'
+STAGE_OUTPUT_SIZE_KEY = 'outputSize'
+STAGE_CACHED_KEY = 'cached'
+
+GET_DISEASE_GENES_STAGE = 'get_disease_genes'
+GET_DISEASE_TISSUES_STAGE = 'get_disease_tissues'
+EXPAND_GENE_SET_STAGE = 'expand_gene_set'
+GET_NETWORK_STAGE = 'get_network'
+CONVERT_EDGE_TABLE_NAMES_STAGE = 'convert_edge_table_names'
+INFER_HIERARCHICAL_MODEL_STAGE = 'infer_hierarchical_model'
+UPLOAD_HIERARCHY_STAGE = 'upload_hierarchy'
+
+# kinds of stages, each kind runs on its own pool
+IO_STAGE = 'io'
+CPU_STAGE = 'cpu'
+STAGE_KINDS = [IO_STAGE, CPU_STAGE]
+
+# time in seconds between checks for cancel while pipeline
+# waits for running stages
+CANCEL_POLL_INTERVAL = 0.5
+
+# maximum number of abandoned stages still running in a stage pool
+# before it refuses new stages
+DEFAULT_MAX_ABANDONED = 32
+
+# monitor and name of stage running in current thread
+_stage_context = threading.local()
+
+
+class PipelineStage(object):
+    """
+    Represents one step of the DiseaseScope pipeline
+    """
+    def __init__(self, name, func, outputs=None, requires=None,
+                 params=None, cacheable=False, kind=IO_STAGE,
+                 artifacts=None):
+        """
+        Constructor
+        :param name: name of stage
+        :param func: function that takes (scope, task, **params) and runs
+                     the stage on the DiseaseScope object **scope**
+        :param outputs: list of attribute names on DiseaseScope object
+                        the stage sets. These are always included in the
+                        output of the stage even if modified in place
+        :param requires: list of names of stages whose output this
+                         stage uses. Stages that require no other stage
+                         only depend on the disease id of the task
+        :param params: dict of parameters passed to **func**
+        :param cacheable: if True output of stage only depends on
+                          **params** and output of **requires** stages
+                          and can be shared across tasks
+        :param kind: :py:const:`IO_STAGE` if stage mostly waits on
+                     external services or :py:const:`CPU_STAGE` if
+                     it mostly computes
+        :param artifacts: list of names of files the stage writes to
+                          the scratch directory of the task that are
+                          kept once the task finishes
+        """
+        self._name = name
+        self._func = func
+        if outputs is None:
+            self._outputs = []
+        else:
+            self._outputs = outputs
+        if requires is None:
+            self._requires = []
+        else:
+            self._requires = requires
+        if params is None:
+            self._params = {}
+        else:
+            self._params = params
+        self._cacheable = cacheable
+        self._kind = kind
+        if artifacts is None:
+            self._artifacts = []
+        else:
+            self._artifacts = artifacts
+
+    def get_name(self):
+        """
+        Gets name of stage
+        :return:
+        """
+        return self._name
+
+    def get_outputs(self):
+        """
+        Gets attribute names stage sets on DiseaseScope object
+        :return:
+        """
+        return self._outputs
+
+    def get_requires(self):
+        """
+        Gets names of stages whose output this stage uses
+        :return:
+        """
+        return self._requires
+
+    def get_params(self):
+        """
+        Gets parameters passed to stage function
+        :return:
+        """
+        return self._params
+
+    def is_cacheable(self):
+        """
+        Denotes whether output of stage can be shared across tasks
+        :return:
+        """
+        return self._cacheable
+
+    def get_kind(self):
+        """
+        Gets kind of stage, :py:const:`IO_STAGE` or :py:const:`CPU_STAGE`
+        :return:
+        """
+        return self._kind
+
+    def get_artifacts(self):
+        """
+        Gets names of files stage writes to scratch directory
+        that are kept once the task finishes
+        :return:
+        """
+        return self._artifacts
+
+    def run(self, scope, task):
+        """
+        Runs stage on **scope** and returns the attributes of
+        **scope** that were added or changed by the stage
+        :param scope: DiseaseScope object
+        :param task: task being processed
+        :return: dict of attribute name => value
+        """
+        before = dict(scope.__dict__)
+        self._func(scope, task, **self._params)
+        delta = {}
+        for key, val in scope.__dict__.items():
+            if (key not in before or before[key] is not val or
+                    key in self._outputs):
+                delta[key] = val
+        return delta
+
+
+def _get_disease_genes(scope, task, method):
+    """
+    Runs get_disease_genes on **scope**
+    """
+    scope.get_disease_genes(method=method)
+
+
+def _get_disease_tissues(scope, task, n):
+    """
+    Runs get_disease_tissues on **scope**
+    """
+    scope.get_disease_tissues(n=n)
+
+
+def _expand_gene_set(scope, task, method):
+    """
+    Runs expand_gene_set on **scope**
+    """
+    scope.expand_gene_set(method=method)
+
+
+def _get_network(scope, task, method, columns):
+    """
+    Runs get_network on **scope** and replaces the network
+    with a compact :py:class:`~edgetable.EdgeTable`
+    """
+    scope.get_network(method=method)
+    try:
+        scope.network = EdgeTable.from_dataframe(scope.network,
+                                                 columns=columns)
+    except Exception as e:
+        logger.warning('Unable to convert network to EdgeTable, '
+                       'keeping it as is : ' + str(e))
+
+
+def _convert_edge_table_names(scope, task, columns, scope_name,
+                              field, keep):
+    """
+    Runs convert_edge_table_names on **scope**. If the network is
+    an :py:class:`~edgetable.EdgeTable` only a table with one row per
+    node is converted and the new names are applied to the edges
+    by node id
+    """
+    network = scope.network
+    if not isinstance(network, EdgeTable):
+        scope.convert_edge_table_names(columns, scope_name, field, keep=keep)
+        return
+    scope.network = network.get_node_dataframe()
+    try:
+        scope.convert_edge_table_names(columns, scope_name, field, keep=keep)
+        newsymbols = network.get_symbols_from_node_dataframe(scope.network)
+        if newsymbols is not None:
+            scope.network = network.rename_nodes(newsymbols)
+            return
+        logger.warning('Unexpected node table from '
+                       'convert_edge_table_names, converting full '
+                       'edge table')
+        scope.network = network.to_dataframe()
+        scope.convert_edge_table_names(columns, scope_name, field, keep=keep)
+        scope.network = EdgeTable.from_dataframe(scope.network,
+                                                 columns=columns)
+    except Exception:
+        scope.network = network
+        raise
+
+
+def _check_stage_cancelled():
+    """
+    Raises TaskCancelledError if pipeline of stage running in this
+    thread was cancelled. Called by stages before writing to the
+    task directory, since a stage abandoned by a task that timed
+    out or was deleted keeps running after the task directory
+    was moved or removed
+    :raises TaskCancelledError: if pipeline was cancelled
+    """
+    monitor = getattr(_stage_context, 'monitor', None)
+    if monitor is not None:
+        monitor.check_cancelled(_stage_context.stagename)
+
+
+def _record_temp_files(task, names):
+    """
+    Adds files written to scratch directory of task to the task
+    manifest if scratch directory is the task directory, so they
+    are removed when the task is deleted
+    :param task: task being processed
+    :param names: list of names of files
+    :raises TaskCancelledError: if pipeline was cancelled
+    :return: None
+    """
+    _check_stage_cancelled()
+    if task.get_scratchdir() != task.get_taskdir():
+        return
+    dao.record_task_files(task.get_taskdir(), sorted(names))
+
+
+def _infer_hierarchical_model(scope, task, edge_attr, method,
+                              method_kwargs):
+    """
+    Runs infer_hierarchical_model on **scope** using
+    scratch directory of task for temporary files. An
+    :py:class:`~edgetable.EdgeTable` network is passed to
+    DiseaseScope as a :py:class:`pandas.DataFrame` for the
+    duration of the call
+    """
+    network = scope.network
+    if isinstance(network, EdgeTable):
+        scope.network = network.to_dataframe()
+    before = set(os.listdir(task.get_scratchdir()))
+    try:
+        scope.infer_hierarchical_model(edge_attr=edge_attr,
+                                       method=method,
+                                       temp_path=task.get_scratchdir(),
+                                       method_kwargs=method_kwargs)
+    finally:
+        scope.network = network
+        _record_temp_files(task, set(os.listdir(task.get_scratchdir())) -
+                           before)
+
+
+def _infer_hierarchical_model_local(scope, task, edge_attr, columns,
+                                    method_kwargs, clixopool=None):
+    """
+    Runs CLIXO on the network of **scope** with **clixopool**, passing
+    the edge table and hierarchy through files in the scratch
+    directory of the task,
+    and sets hierarchy attribute of **scope** to the inferred hierarchy.
+    The text edge table CLIXO reads is reused if a retry left it behind
+    """
+    edgefile = os.path.join(task.get_scratchdir(), clixo.EDGE_TABLE_FILE)
+    outputfile = os.path.join(task.get_scratchdir(),
+                              clixo.CLIXO_OUTPUT_FILE)
+    _record_temp_files(task, [clixo.EDGE_TABLE_FILE,
+                              clixo.EDGE_TABLE_FILE + '.tmp',
+                              clixo.EDGE_TABLE_FILE +
+                              clixo.EDGE_TABLE_CHECKSUM_SUFFIX,
+                              clixo.CLIXO_OUTPUT_FILE,
+                              clixo.CLIXO_ERROR_FILE])
+    clixo.write_edge_table_if_changed(scope.network, columns, edge_attr,
+                                      edgefile)
+    # CLIXO is killed if the task is cancelled while it runs
+    clixopool.run(edgefile, outputfile, method_kwargs['alpha'],
+                  method_kwargs['beta'],
+                  cancel_check=_check_stage_cancelled)
+    scope.hierarchy = clixo.read_clixo_output(outputfile)
+
+
+def _upload_hierarchy(scope, task):
+    """
+    Stores hierarchy attribute of **scope** in NDEx and sets
+    hiview_url and ndex_url attributes of **scope**
+    """
+    scope.hiview_url, scope.ndex_url = clixo.upload_hierarchy(
+        scope.hierarchy, task)
+
+
+def get_diseasescope_stages(infer_method=clixo.CLIXO_API_METHOD,
+                            clixopool=None):
+    """
+    Gets the stages of the DiseaseScope pipeline in the order
+    they need to be run
+    :param infer_method: :py:const:`~clixo.CLIXO_API_METHOD` to
+                         infer hierarchy with the CLIXO API or
+                         :py:const:`~clixo.CLIXO_LOCAL_METHOD` to
+                         run CLIXO locally
+    :param clixopool: ClixoPool used to run CLIXO locally, if None
+                      and **infer_method** is local a ClixoPool with
+                      default settings is used
+    :raises ValueError: if **infer_method** is unknown
+    :return: list of PipelineStage objects
+    """
+    columns = ['Gene1', 'Gene2']
+    method_kwargs = {'alpha': 0.01,
+                     'beta': 0.5}
+    stages = [
+        PipelineStage(GET_DISEASE_GENES_STAGE, _get_disease_genes,
+                      outputs=['disease_genes'],
+                      params={'method': 'biothings'},
+                      cacheable=True),
+        PipelineStage(GET_DISEASE_TISSUES_STAGE, _get_disease_tissues,
+                      outputs=['tissues'],
+                      params={'n': 10},
+                      cacheable=True),
+        PipelineStage(EXPAND_GENE_SET_STAGE, _expand_gene_set,
+                      outputs=['disease_genes'],
+                      requires=[GET_DISEASE_GENES_STAGE],
+                      params={'method': 'biggim'},
+                      cacheable=True),
+        PipelineStage(GET_NETWORK_STAGE, _get_network,
+                      outputs=['network'],
+                      requires=[EXPAND_GENE_SET_STAGE,
+                                GET_DISEASE_TISSUES_STAGE],
+                      params={'method': 'biggim',
+                              'columns': columns},
+                      cacheable=True),
+        PipelineStage(CONVERT_EDGE_TABLE_NAMES_STAGE,
+                      _convert_edge_table_names,
+                      outputs=['network'],
+                      requires=[GET_NETWORK_STAGE],
+                      params={'columns': columns,
+                              'scope_name': 'entrezgene',
+                              'field': 'symbol',
+                              'keep': False},
+                      cacheable=True,
+                      kind=CPU_STAGE)
+    ]
+    if infer_method == clixo.CLIXO_API_METHOD:
+        # clixo-api runs CLIXO remotely so this stage
+        # mostly waits on the CLIXO service, NDEx and HiView
+        stages.append(PipelineStage(INFER_HIERARCHICAL_MODEL_STAGE,
+                                    _infer_hierarchical_model,
+                                    outputs=['hiview_url'],
+                                    requires=[CONVERT_EDGE_TABLE_NAMES_STAGE],
+                                    params={'edge_attr': 'mean',
+                                            'method': infer_method,
+                                            'method_kwargs': method_kwargs}))
+    elif infer_method == clixo.CLIXO_LOCAL_METHOD:
+        if clixopool is None:
+            clixopool = clixo.ClixoPool()
+        stages.append(PipelineStage(INFER_HIERARCHICAL_MODEL_STAGE,
+                                    functools.partial(
+                                        _infer_hierarchical_model_local,
+                                        clixopool=clixopool),
+                                    outputs=['hierarchy'],
+                                    requires=[CONVERT_EDGE_TABLE_NAMES_STAGE],
+                                    params={'edge_attr': 'mean',
+                                            'columns': columns,
+                                            'method_kwargs': method_kwargs},
+                                    kind=CPU_STAGE,
+                                    artifacts=[clixo.CLIXO_OUTPUT_FILE,
+                                               clixo.CLIXO_ERROR_FILE]))
+        stages.append(PipelineStage(UPLOAD_HIERARCHY_STAGE,
+                                    _upload_hierarchy,
+                                    outputs=['hiview_url', 'ndex_url'],
+                                    requires=[INFER_HIERARCHICAL_MODEL_STAGE]))
+    else:
+        raise ValueError('Unknown infer method: ' + str(infer_method))
+    return stages
+
+
+class StageCheckpointer(object):
+    """
+    Persists output of completed pipeline stages to
+    :py:const:`~diseasescope_rest_server.dao.CHECKPOINT_DIR` under
+    the task directory. Each stage output is stored as a compressed
+    pickle, except :py:class:`~edgetable.EdgeTable` values which are
+    saved in columnar form and memory mapped on restore. The
+    completed stages are listed, in order, in a json manifest
+    """
+    def __init__(self, taskdir):
+        """
+        Constructor
+        :param taskdir: task directory
+        """
+        self._checkpointdir = os.path.join(taskdir, dao.CHECKPOINT_DIR)
+        self._manifest = os.path.join(self._checkpointdir,
+                                      CHECKPOINT_MANIFEST)
+        self._disabled = False
+
+    def get_completed_stages(self):
+        """
+        Gets manifest entries of completed stages
+        :return: list of dicts, one per stage, in order completed
+        """
+        if not os.path.isfile(self._manifest):
+            return []
+        try:
+            with open(self._manifest, 'r') as f:
+                return json.load(f)[MANIFEST_STAGES_KEY]
+        except Exception as e:
+            logger.error('Unable to load checkpoint manifest ' +
+                         self._manifest + ' ignoring checkpoints : ' +
+                         str(e))
+            return []
+
+    def save(self, stagename, output):
+        """
+        Saves output of stage and adds stage to manifest. If output
+        cannot be saved, checkpointing is disabled for the rest of the
+        run so the manifest never lists a stage after a missing one
+        :param stagename: name of stage
+        :param output: dict of attribute name => value
+        :return: True if saved otherwise False
+        """
+        if self._disabled is True:
+            return False
+        try:
+            # mkdir so no directories are created if task
+            # directory was moved or removed
+            if not os.path.isdir(self._checkpointdir):
+                os.mkdir(self._checkpointdir, 0o775)
+            cfile = stagename + CHECKPOINT_SUFFIX
+            cpath = os.path.join(self._checkpointdir, cfile)
+            size = 0
+            tables = {}
+            pickled = {}
+            for key, val in output.items():
+                if not isinstance(val, EdgeTable):
+                    pickled[key] = val
+                    continue
+                tables[key] = stagename + '.' + key + \
+                    CHECKPOINT_EDGETABLE_SUFFIX
+                tpath = os.path.join(self._checkpointdir, tables[key])
+                val.save(tpath)
+                size += edgetable.get_size_of_directory(tpath)
+            with gzip.open(cpath + '.tmp', 'wb') as f:
+                pickle.dump(pickled, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cpath + '.tmp', cpath)
+            size += os.path.getsize(cpath)
+
+            stages = [s for s in self.get_completed_stages()
+                      if s[MANIFEST_NAME_KEY] != stagename]
+            stages.append({MANIFEST_NAME_KEY: stagename,
+                           MANIFEST_FILE_KEY: cfile,
+                           MANIFEST_EDGETABLES_KEY: tables,
+                           MANIFEST_SIZE_KEY: size})
+            with open(self._manifest + '.tmp', 'w') as f:
+                json.dump({MANIFEST_STAGES_KEY: stages}, f)
+            os.replace(self._manifest + '.tmp', self._manifest)
+            return True
+        except Exception as e:
+            logger.warning('Unable to checkpoint stage ' + stagename +
+                           ' disabling checkpoints for rest of run : ' +
+                           str(e))
+            self._disabled = True
+            return False
+
+    def restore(self, scope):
+        """
+        Applies output of all completed stages to **scope**
+        :param scope: DiseaseScope object
+        :return: list of names of stages restored
+        """
+        restored = []
+        for stage in self.get_completed_stages():
+            cpath = os.path.join(self._checkpointdir,
+                                 stage[MANIFEST_FILE_KEY])
+            try:
+                with gzip.open(cpath, 'rb') as f:
+                    output = pickle.load(f)
+                tables = stage.get(MANIFEST_EDGETABLES_KEY, {})
+                for key, tfile in tables.items():
+                    output[key] = EdgeTable.load(
+                        os.path.join(self._checkpointdir, tfile))
+            except Exception as e:
+                logger.error('Unable to load checkpoint ' + cpath +
+                             ' resuming from stage ' +
+                             stage[MANIFEST_NAME_KEY] + ' : ' + str(e))
+                break
+            scope.__dict__.update(output)
+            restored.append(stage[MANIFEST_NAME_KEY])
+        return restored
+
+    def clear(self):
+        """
+        Removes all checkpoints
+        :return: None
+        """
+        if os.path.isdir(self._checkpointdir):
+            shutil.rmtree(self._checkpointdir)
+
+
+class TaskCancelledError(Exception):
+    """
+    Raised when pipeline stops because task was cancelled
+    """
+    pass
+
+
+class StagePoolExhaustedError(RuntimeError):
+    """
+    Raised when a stage is submitted to a stage pool holding the
+    maximum number of abandoned stages
+    """
+    pass
+
+
+def parse_stage_times(timestr):
+    """
+    Parses comma delimited list of <stage>=<seconds>
+    :param timestr: string ie get_disease_genes=3600,get_network=60
+    :return: dict of stage name => time in seconds
+    :raises ValueError: if string is not in correct format
+    """
+    times = {}
+    if timestr is None or len(timestr.strip()) == 0:
+        return times
+    for entry in timestr.split(','):
+        if '=' not in entry:
+            raise ValueError('Invalid entry: ' + entry +
+                             ' expected <stage>=<seconds>')
+        stage, seconds = entry.split('=', 1)
+        times[stage.strip()] = float(seconds)
+    return times
+
+
+class TaskMonitor(object):
+    """
+    Shares state of a running pipeline with the thread watching
+    it. The watching thread can see which stages are running and
+    since when, and can cancel the pipeline
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self._cancel_reason = None
+        self._start_time = time.time()
+        self._running = {}
+
+    def get_start_time(self):
+        """
+        Gets time in seconds since epoch monitor was created
+        :return:
+        """
+        return self._start_time
+
+    def stage_started(self, stagename):
+        """
+        Denotes stage has started
+        :param stagename: name of stage
+        :return: None
+        """
+        with self._lock:
+            self._running[stagename] = time.time()
+
+    def stage_finished(self, stagename):
+        """
+        Denotes stage has finished
+        :param stagename: name of stage
+        :return: None
+        """
+        with self._lock:
+            self._running.pop(stagename, None)
+
+    def get_running_stages(self):
+        """
+        Gets stages currently running
+        :return: dict of stage name => start time in seconds since epoch
+        """
+        with self._lock:
+            return dict(self._running)
+
+    def get_current_stage(self):
+        """
+        Gets longest running stage
+        :return: tuple (stage name, start time in seconds since epoch)
+                 or (None, None) if no stage is running
+        """
+        with self._lock:
+            if len(self._running) == 0:
+                return None, None
+            stagename = min(self._running, key=self._running.get)
+            return stagename, self._running[stagename]
+
+    def cancel(self, reason):
+        """
+        Cancels pipeline, stopping it at the next safe point
+        :param reason: human readable reason for cancel
+        :return: None
+        """
+        with self._lock:
+            if self._cancel_reason is None:
+                self._cancel_reason = reason
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        """
+        Denotes if pipeline was cancelled
+        :return: True if cancelled
+        """
+        return self._cancel_event.is_set()
+
+    def get_cancel_reason(self):
+        """
+        Gets reason pipeline was cancelled
+        :return: str or None if not cancelled
+        """
+        return self._cancel_reason
+
+    def wait_for_cancel(self, timeout=None):
+        """
+        Waits for pipeline to be cancelled
+        :param timeout: time in seconds to wait
+        :return: True if cancelled
+        """
+        return self._cancel_event.wait(timeout)
+
+    def check_cancelled(self, stagename):
+        """
+        Raises TaskCancelledError if pipeline was cancelled
+        :param stagename: name of stage pipeline is at
+        :raises TaskCancelledError: if pipeline was cancelled
+        """
+        if self.is_cancelled():
+            raise TaskCancelledError('Task cancelled at stage ' +
+                                     stagename + ' : ' +
+                                     str(self._cancel_reason))
+
+
+def get_sizes(scope, attrs):
+    """
+    Gets sizes (number of genes, edges etc.) of attributes of **scope**
+    :param scope: DiseaseScope object
+    :param attrs: list of attribute names
+    :return: dict of attribute name => length, attributes that are
+             not set or have no length are omitted
+    """
+    sizes = {}
+    for attr in attrs:
+        try:
+            sizes[attr] = len(getattr(scope, attr))
+        except Exception:
+            continue
+    return sizes
+
+
+class PipelineProgress(object):
+    """
+    Records progress of pipeline and timing of each stage in the
+    **progress** and **stages** fields of the task json. Every
+    update is saved with the task, frequent saves are coalesced by
+    the writer set on the task, see
+    :py:class:`~diseasescope_rest_server.dao.CoalescingTaskWriter`.
+    Safe to call from the threads running stages
+    """
+    def __init__(self, task, numstages):
+        """
+        Constructor
+        :param task: task being processed
+        :param numstages: number of stages in pipeline
+        """
+        self._task = task
+        self._numstages = numstages
+        self._completed = 0
+        self._start_times = {}
+        self._lock = threading.RLock()
+
+    def _get_stages(self):
+        """
+        Gets stages map from task json, creating it if needed
+        :return: dict or None if task has no task json
+        """
+        taskdict = self._task.get_taskdict()
+        if not isinstance(taskdict, dict):
+            return None
+        if dao.STAGES_KEY not in taskdict:
+            taskdict[dao.STAGES_KEY] = {}
+        return taskdict[dao.STAGES_KEY]
+
+    def _update_progress(self):
+        """
+        Sets progress in task json to percent of stages completed,
+        100 is left for the task runner to set when done
+        """
+        taskdict = self._task.get_taskdict()
+        if not isinstance(taskdict, dict):
+            return
+        taskdict[dao.PROGRESS_KEY] = min(int(100.0 * self._completed /
+                                             max(self._numstages, 1)), 99)
+
+    def stage_restored(self, stagename):
+        """
+        Denotes stage was restored from checkpoint
+        :param stagename: name of stage
+        :return: None
+        """
+        with self._lock:
+            self._completed += 1
+            self._update_progress()
+
+    def stage_started(self, stagename, ready_time):
+        """
+        Records start of stage
+        :param stagename: name of stage
+        :param ready_time: time in seconds since epoch stage
+                           was ready to run
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            self._start_times[stagename] = now
+            stages = self._get_stages()
+            if stages is None:
+                return
+            stages[stagename] = {
+                STAGE_START_TIME_KEY:
+                    diseasescope_rest_server.milliseconds_since_epoch(
+                        datetime.utcnow()),
+                STAGE_QUEUE_WAIT_KEY: int((now - ready_time) * 1000)
+            }
+            self.save()
+
+    def stage_finished(self, stagename, inputsize, outputsize,
+                       cached=False):
+        """
+        Records end of stage
+        :param stagename: name of stage
+        :param inputsize: dict from :py:func:`get_sizes` of stage input
+        :param outputsize: dict from :py:func:`get_sizes` of stage output
+        :param cached: True if output came from cache
+        :return: None
+        """
+        with self._lock:
+            self._completed += 1
+            self._update_progress()
+            stages = self._get_stages()
+            if stages is None:
+                return
+            entry = stages.setdefault(stagename, {})
+            start = self._start_times.get(stagename, time.time())
+            entry[STAGE_DURATION_KEY] = int((time.time() - start) * 1000)
+            entry[STAGE_INPUT_SIZE_KEY] = inputsize
+            entry[STAGE_OUTPUT_SIZE_KEY] = outputsize
+            entry[STAGE_CACHED_KEY] = cached
+            self.save()
+
+    def save(self):
+        """
+        Saves task json
+        :return: None
+        """
+        with self._lock:
+            res = self._task.save_task()
+            if res is not None:
+                logger.error('Unable to save task progress: ' + str(res))
+
+
+class StagePools(object):
+    """
+    Separate pools for I/O bound and CPU bound stages, each sized on
+    its own. The number of stages waiting for a thread of a pool is
+    bounded, so submitting blocks once a pool falls behind. Shared by
+    all tasks a runner has in flight so different tasks can be in
+    different stages at once. Each stage gets its own thread, that
+    waits until fewer than the number of workers of its pool are
+    running, so a stage abandoned by a cancelled pipeline, see
+    :py:meth:`abandon`, gives its place in the pool to the next stage
+    even if it never returns. Each abandoned stage keeps its thread,
+    and a copy of the DiseaseScope object, until it returns, so once
+    a pool holds **max_abandoned** of them it refuses new stages, see
+    :py:meth:`is_exhausted`
+    """
+    def __init__(self, io_workers=8, cpu_workers=None, queue_size=16,
+                 max_abandoned=DEFAULT_MAX_ABANDONED):
+        """
+        Constructor
+        :param io_workers: number of threads running I/O bound stages
+        :param cpu_workers: number of threads running CPU bound stages,
+                            if None the number of CPUs is used
+        :param queue_size: maximum number of stages waiting for a
+                           thread of each pool
+        :param max_abandoned: maximum number of abandoned stages still
+                              running in each pool before it refuses
+                              new stages, None for no limit
+        """
+        if cpu_workers is None:
+            cpu_workers = os.cpu_count() or 1
+        self._workers = {IO_STAGE: io_workers,
+                         CPU_STAGE: cpu_workers}
+        self._running = {}
+        self._slots = {}
+        for kind in STAGE_KINDS:
+            self._running[kind] = threading.BoundedSemaphore(
+                self._workers[kind])
+            self._slots[kind] = threading.BoundedSemaphore(
+                self._workers[kind] + queue_size)
+        self._max_abandoned = max_abandoned
+        self._lock = threading.Lock()
+        self._pending = {kind: 0 for kind in STAGE_KINDS}
+        self._threads = {}
+        self._holding = {}
+        self._abandoned = {}
+        self._count = 0
+        self._shutdown = False
+
+    def get_workers(self, kind):
+        """
+        Gets number of threads of pool
+        :param kind: kind of stage
+        :return:
+        """
+        return self._workers[kind]
+
+    def get_pending(self, kind):
+        """
+        Gets number of stages running or waiting in pool
+        :param kind: kind of stage
+        :return:
+        """
+        with self._lock:
+            return self._pending[kind]
+
+    def get_abandoned(self, kind):
+        """
+        Gets number of abandoned stages still running
+        :param kind: kind of stage
+        :return:
+        """
+        with self._lock:
+            return len([k for k in self._abandoned.values() if k == kind])
+
+    def get_max_abandoned(self):
+        """
+        Gets maximum number of abandoned stages still running in a
+        pool before it refuses new stages
+        :return: int or None for no limit
+        """
+        return self._max_abandoned
+
+    def is_exhausted(self, kind=None):
+        """
+        Denotes if pool holds the maximum number of abandoned stages.
+        Such a pool refuses new stages until enough of them return,
+        which for stages hung on a service may be never, so a runner
+        should be replaced once this is True
+        :param kind: kind of stage, if None all pools are checked
+        :return: True if pool, or any pool if **kind** is None, is
+                 exhausted otherwise False
+        """
+        if self._max_abandoned is None:
+            return False
+        if kind is None:
+            kinds = STAGE_KINDS
+        else:
+            kinds = [kind]
+        for k in kinds:
+            if self.get_abandoned(k) >= self._max_abandoned:
+                return True
+        return False
+
+    def _stage_done(self, future):
+        """
+        Frees thread and slot of stage unless already freed
+        when stage was abandoned
+        :param future: future of stage
+        :return: True if freed, False if already freed
+        """
+        with self._lock:
+            kind = self._holding.pop(future, None)
+            if kind is None:
+                return False
+            self._pending[kind] -= 1
+        self._running[kind].release()
+        self._slots[kind].release()
+        return True
+
+    def _run(self, kind, future, func, args, kwargs):
+        """
+        Runs **func** once fewer than the number of workers of
+        pool are running, setting result of **future**
+        """
+        self._running[kind].acquire()
+        with self._lock:
+            self._holding[future] = kind
+        try:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        finally:
+            self._stage_done(future)
+            with self._lock:
+                self._threads.pop(future, None)
+                self._abandoned.pop(future, None)
+
+    def submit(self, kind, func, *args, **kwargs):
+        """
+        Submits **func** to pool of **kind**, waiting if the
+        pool queue is full
+        :param kind: :py:const:`IO_STAGE` or :py:const:`CPU_STAGE`
+        :param func: function to run
+        :raises RuntimeError: if pools were shut down
+        :raises StagePoolExhaustedError: if pool holds the maximum
+                                         number of abandoned stages
+        :return: :py:class:`concurrent.futures.Future`
+        """
+        if self._shutdown is True:
+            raise RuntimeError('Cannot submit stage after shutdown')
+        if self.is_exhausted(kind):
+            raise StagePoolExhaustedError(kind + ' pool has ' +
+                                          str(self.get_abandoned(kind)) +
+                                          ' abandoned stages still '
+                                          'running')
+        self._slots[kind].acquire()
+        future = Future()
+        with self._lock:
+            self._pending[kind] += 1
+            self._count += 1
+            thread = threading.Thread(target=self._run,
+                                      args=(kind, future, func, args,
+                                            kwargs),
+                                      name=kind + '-stage_' +
+                                      str(self._count))
+            thread.daemon = True
+            self._threads[future] = thread
+        try:
+            thread.start()
+        except Exception:
+            with self._lock:
+                self._pending[kind] -= 1
+                del self._threads[future]
+            self._slots[kind].release()
+            raise
+        return future
+
+    def abandon(self, future):
+        """
+        Gives up on stage of **future**. A stage still waiting for
+        a thread is cancelled. A running stage cannot be stopped, so
+        it is left running on its thread but its thread and queue
+        slot are freed for the next stage
+        :param future: future returned by :py:meth:`submit`
+        :return: None
+        """
+        if future.cancel():
+            return
+        with self._lock:
+            kind = self._holding.get(future)
+            if kind is None:
+                return
+            self._abandoned[future] = kind
+        if self._stage_done(future):
+            logger.info('Abandoned stage running on ' + kind + ' pool')
+            if self.is_exhausted(kind):
+                logger.error(kind + ' pool has ' +
+                             str(self.get_abandoned(kind)) +
+                             ' abandoned stages still running, refusing '
+                             'new stages')
+
+    def shutdown(self, wait=True):
+        """
+        Shuts down pools
+        :param wait: if True wait for running stages, other than
+                     abandoned ones, to finish
+        :return: None
+        """
+        self._shutdown = True
+        if wait is False:
+            return
+        with self._lock:
+            threads = [t for f, t in self._threads.items()
+                       if f not in self._abandoned]
+        for thread in threads:
+            thread.join()
+
+
+class StageDAG(object):
+    """
+    Directed acyclic graph of pipeline stages built from the
+    stages each stage requires
+    """
+    def __init__(self, stages):
+        """
+        Constructor
+        :param stages: list of PipelineStage objects
+        :raises ValueError: if a stage requires an unknown stage or
+                            stages require each other in a cycle
+        """
+        self._stages = stages
+        self._bynames = {}
+        for stage in stages:
+            self._bynames[stage.get_name()] = stage
+        for stage in stages:
+            for reqname in stage.get_requires():
+                if reqname not in self._bynames:
+                    raise ValueError('Stage ' + stage.get_name() +
+                                     ' requires unknown stage ' + reqname)
+        self._order = self._get_topological_order()
+
+    def _get_topological_order(self):
+        """
+        Gets stages ordered so every stage comes after the
+        stages it requires, keeping the order stages were given
+        in where possible
+        :raises ValueError: if stages require each other in a cycle
+        :return: list of PipelineStage objects
+        """
+        order = []
+        done = set()
+        remaining = list(self._stages)
+        while len(remaining) > 0:
+            ready = [s for s in remaining
+                     if set(s.get_requires()).issubset(done)]
+            if len(ready) == 0:
+                raise ValueError('Cycle found in stages: ' +
+                                 ', '.join([s.get_name()
+                                            for s in remaining]))
+            for stage in ready:
+                order.append(stage)
+                done.add(stage.get_name())
+                remaining.remove(stage)
+        return order
+
+    def get_stage(self, stagename):
+        """
+        Gets stage with name
+        :param stagename: name of stage
+        :return: PipelineStage or None if not found
+        """
+        return self._bynames.get(stagename)
+
+    def get_order(self):
+        """
+        Gets stages in topological order
+        :return: list of PipelineStage objects
+        """
+        return self._order
+
+    def get_ready_stages(self, done, started):
+        """
+        Gets stages whose required stages are all done
+        :param done: set of names of stages done
+        :param started: set of names of stages started or done
+        :return: list of PipelineStage objects in topological order
+        """
+        return [s for s in self._order
+                if s.get_name() not in started and
+                set(s.get_requires()).issubset(done)]
+
+
+class DiseaseScopePipeline(object):
+    """
+    Runs the DiseaseScope pipeline for a task as a
+    :py:class:`StageDAG`. Each stage runs on the
+    :py:class:`StagePools` pool for its kind as soon
+    as the stages it requires are done, so independent stages, such
+    as the tissue lookup, overlap. Stages run on a shallow copy of the
+    DiseaseScope object and their output is merged back once they
+    finish. Checkpointing, caching and timing of every stage is done
+    here: output of each stage is checkpointed so a retried or
+    recovered task resumes after the completed stages and if a
+    :py:class:`~diseasescope_rest_server.cache.StageCache` is set,
+    output of cacheable stages is shared across tasks
+    """
+    def __init__(self, scope_factory, stages=None, cache=None,
+                 max_workers=4, pools=None, metrics=None):
+        """
+        Constructor
+        :param scope_factory: function that takes a task and returns
+                              a new DiseaseScope object for it
+        :param stages: list of PipelineStage objects, if None
+                       :py:func:`get_diseasescope_stages` is used
+        :param cache: StageCache object or None for no caching
+        :param max_workers: maximum number of stages of a task
+                            run at once if **pools** is None
+        :param pools: StagePools shared with other pipelines, if None
+                      each run uses its own pools
+        :param metrics: MetricsRegistry where duration of stages and
+                        stage cache lookups are recorded, None to not
+                        record them
+        :raises ValueError: if stages do not form a valid DAG
+        """
+        self._scope_factory = scope_factory
+        if stages is None:
+            self._stages = get_diseasescope_stages()
+        else:
+            self._stages = stages
+        self._dag = StageDAG(self._stages)
+        self._cache = cache
+        self._max_workers = max_workers
+        self._pools = pools
+        self._metrics = metrics
+
+    def get_stages(self):
+        """
+        Gets stages of pipeline
+        :return:
+        """
+        return self._stages
+
+    def get_artifacts(self):
+        """
+        Gets names of files stages write to scratch directory
+        that are kept once the task finishes
+        :return: list of file names
+        """
+        artifacts = []
+        for stage in self._stages:
+            artifacts.extend(stage.get_artifacts())
+        return artifacts
+
+    def _get_cache_key(self, stage, task, keys):
+        """
+        Gets cache key for stage. Key is built from the stage
+        parameters and the keys of the stages it requires, or the
+        disease id of the task if it requires none
+        :param stage: PipelineStage
+        :param task: task being processed
+        :param keys: dict of stage name => cache key for stages
+                     already run
+        :return: key or None if stage is not cacheable
+        """
+        if self._cache is None or not stage.is_cacheable():
+            return None
+        inputs = {'params': stage.get_params()}
+        if len(stage.get_requires()) == 0:
+            inputs['doid'] = task.get_diseaseid()
+        else:
+            reqkeys = []
+            for reqname in stage.get_requires():
+                if keys.get(reqname) is None:
+                    return None
+                reqkeys.append(keys[reqname])
+            inputs['requires'] = reqkeys
+        return self._cache.get_key(stage.get_name(), inputs)
+
+    def _run_stage(self, stage, scope, task, key, monitor, progress,
+                   ready_time, profiler=None, parent_span=None):
+        """
+        Runs stage, or gets its output from the cache, in a
+        thread of the pool
+        :param stage: PipelineStage to run
+        :param scope: copy of DiseaseScope object to run stage on
+        :param task: task being processed
+        :param key: cache key of stage or None
+        :param monitor: TaskMonitor of pipeline
+        :param progress: PipelineProgress of pipeline
+        :param ready_time: time in seconds since epoch stage was
+                           ready to run
+        :param profiler: TaskProfiler the stage is run under, None
+                         to not profile it
+        :param parent_span: Span of task, the stage is recorded as a
+                            child span of it, None to not trace stage
+        :raises TaskCancelledError: if pipeline was cancelled
+        :return: tuple (output of stage, True if output was cached)
+        """
+        stagename = stage.get_name()
+        monitor.check_cancelled(stagename)
+        span = None
+        if parent_span is not None:
+            span = parent_span.start_child(
+                'stage ' + stagename,
+                tags={'stage': stagename,
+                      'queueWait': int((time.time() - ready_time) * 1000)})
+        monitor.stage_started(stagename)
+        try:
+            progress.stage_started(stagename, ready_time)
+            output = None
+            if key is not None:
+                output = self._cache.get(stagename, key)
+                self._record_cache_lookup(stagename, output is not None)
+            if output is not None:
+                logger.info('Using cached output for stage ' + stagename)
+                if span is not None:
+                    span.set_tag('cached', True)
+                return output, True
+            logger.info('Running stage ' + stagename)
+            start = time.time()
+            _stage_context.monitor = monitor
+            _stage_context.stagename = stagename
+            try:
+                with tracing.use_span(span):
+                    if profiler is None:
+                        output = stage.run(scope, task)
+                    else:
+                        output = profiler.profile(stagename, stage.run,
+                                                  scope, task)
+            finally:
+                _stage_context.monitor = None
+            if self._metrics is not None:
+                self._metrics.observe(metrics.STAGE_SECONDS,
+                                      time.time() - start,
+                                      labels={'stage': stagename})
+            if key is not None:
+                self._cache.put(stagename, key, output)
+            return output, False
+        except Exception as e:
+            if span is not None:
+                span.set_tag('error', str(e))
+            raise
+        finally:
+            monitor.stage_finished(stagename)
+            if span is not None:
+                span.finish()
+
+    def _record_cache_lookup(self, stagename, hit):
+        """
+        Records lookup of stage output in cache in metrics
+        :param stagename: name of stage
+        :param hit: True if output was in cache
+        :return: None
+        """
+        if self._metrics is None:
+            return
+        self._metrics.inc(metrics.STAGE_CACHE_TOTAL,
+                          labels={'stage': stagename,
+                                  'result': 'hit' if hit else 'miss'})
+
+    def run(self, task, monitor=None, profiler=None):
+        """
+        Runs pipeline on task. If **monitor** is cancelled the pipeline
+        stops, within :py:const:`CANCEL_POLL_INTERVAL` seconds, and
+        writes nothing more to the task directory. Stages already
+        running are abandoned, see :py:meth:`StagePools.abandon`, and
+        stop at their next write to the task directory. If a
+        span is active in the calling thread, see
+        :py:func:`~diseasescope_rest_server.tracing.use_span`, each stage
+        is recorded as a child span of it
+        :param task: task to process
+        :param monitor: TaskMonitor used to report the stages running
+                        and to cancel the pipeline
+        :param profiler: TaskProfiler every stage run is profiled
+                         with, None to not profile stages
+        :raises TaskCancelledError: if **monitor** was cancelled
+        :return: DiseaseScope object after all stages have run
+        """
+        if monitor is None:
+            monitor = TaskMonitor()
+        # stages run in pool threads so span of task active in
+        # this thread is passed to them
+        parent_span = tracing.get_current_span()
+        progress = PipelineProgress(task, len(self._stages))
+        start_time = time.time()
+        scope = self._scope_factory(task)
+        checkpointer = StageCheckpointer(task.get_taskdir())
+        completed = checkpointer.restore(scope)
+        if len(completed) > 0:
+            logger.info('Resuming task after stages: ' + ', '.join(completed))
+        keys = {}
+        for stage in self._dag.get_order():
+            keys[stage.get_name()] = self._get_cache_key(stage, task, keys)
+        done = set()
+        end_times = {}
+        for stagename in completed:
+            if self._dag.get_stage(stagename) is None:
+                continue
+            progress.stage_restored(stagename)
+            done.add(stagename)
+            end_times[stagename] = start_time
+        started = set(done)
+        running = {}
+        pools = self._pools
+        if pools is None:
+            pools = StagePools(io_workers=self._max_workers,
+                               cpu_workers=self._max_workers,
+                               queue_size=0)
+        try:
+            while len(done) < len(self._stages):
+                for stage in self._dag.get_ready_stages(done, started):
+                    stagename = stage.get_name()
+                    monitor.check_cancelled(stagename)
+                    ready_time = max([start_time] +
+                                     [end_times.get(r, start_time)
+                                      for r in stage.get_requires()])
+                    inputattrs = []
+                    for reqname in stage.get_requires():
+                        inputattrs.extend(self._dag.get_stage(
+                            reqname).get_outputs())
+                    future = pools.submit(stage.get_kind(), self._run_stage,
+                                          stage, copy.copy(scope), task,
+                                          keys[stagename], monitor,
+                                          progress, ready_time,
+                                          profiler=profiler,
+                                          parent_span=parent_span)
+                    running[future] = (stage, get_sizes(scope, inputattrs))
+                    started.add(stagename)
+
+                finished, notdone = wait(list(running.keys()),
+                                         timeout=CANCEL_POLL_INTERVAL,
+                                         return_when=FIRST_COMPLETED)
+                if len(finished) == 0:
+                    monitor.check_cancelled(', '.join(sorted(
+                        [r[0].get_name() for r in running.values()])))
+                for future in finished:
+                    stage, inputsize = running.pop(future)
+                    stagename = stage.get_name()
+                    output, cached = future.result()
+                    monitor.check_cancelled(stagename)
+                    scope.__dict__.update(output)
+                    end_times[stagename] = time.time()
+                    done.add(stagename)
+                    progress.stage_finished(stagename, inputsize,
+                                            get_sizes(scope,
+                                                      stage.get_outputs()),
+                                            cached=cached)
+                    checkpointer.save(stagename, output)
+        finally:
+            for future in running.keys():
+                pools.abandon(future)
+            if self._pools is None:
+                pools.shutdown(wait=False)
+        checkpointer.clear()
+        return scope
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""Opt-in profiling of the pipeline stages of a task"""
+import os
+import json
+import time
+import random
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+
+from diseasescope_rest_server import dao
+
+logger = logging.getLogger(__name__)
+
+
+# summary of profile of every stage written to task directory
+PROFILE_SUMMARY_FILE = 'profile.json'
+
+# profile of each stage is written to
+# <PROFILE_FILE_PREFIX><stage><PROFILE_FILE_SUFFIX> in task directory,
+# it can be loaded with pstats or viewed with snakeviz
+PROFILE_FILE_PREFIX = 'profile.'
+PROFILE_FILE_SUFFIX = '.pstats'
+
+# keys of entry for each stage in summary
+WALL_TIME_KEY = 'wallTime'
+CPU_TIME_KEY = 'cpuTime'
+PEAK_MEMORY_KEY = 'peakMemory'
+PROFILE_FILE_KEY = 'profileFile'
+TOP_FUNCTIONS_KEY = 'topFunctions'
+
+_tracing_lock = threading.Lock()
+_tracing_count = 0
+
+
+def get_profile_file(stagename):
+    """
+    Gets name of file profile of stage is written to
+    :param stagename: name of stage
+    :return: file name as str
+    """
+    return PROFILE_FILE_PREFIX + stagename + PROFILE_FILE_SUFFIX
+
+
+def is_profile_file(name):
+    """
+    Checks if **name** is a file written by :py:class:`TaskProfiler`
+    :param name: file name
+    :return: True if it is otherwise False
+    """
+    if name == PROFILE_SUMMARY_FILE:
+        return True
+    return (name.startswith(PROFILE_FILE_PREFIX) and
+            name.endswith(PROFILE_FILE_SUFFIX) and
+            os.path.basename(name) == name)
+
+
+def _start_tracing():
+    """
+    Starts tracing of memory allocations, if not already started
+    by another task being profiled
+    """
+    global _tracing_count
+    with _tracing_lock:
+        if _tracing_count == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing_count += 1
+
+
+def _stop_tracing():
+    """
+    Stops tracing of memory allocations once no task is profiled
+    """
+    global _tracing_count
+    with _tracing_lock:
+        _tracing_count = max(_tracing_count - 1, 0)
+        if _tracing_count == 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+class ProfilePolicy(object):
+    """
+    Decides which tasks are profiled: all tasks if **enabled**,
+    tasks submitted with the
+    :py:const:`~diseasescope_rest_server.dao.PROFILE_PARAM` parameter
+    set to true and a random **sample_rate** fraction of the others
+    """
+    def __init__(self, enabled=False, sample_rate=0.0,
+                 random_func=random.random):
+        """
+        Constructor
+        :param enabled: if True every task is profiled
+        :param sample_rate: fraction, from 0 to 1, of tasks to profile
+        :param random_func: function returning float in [0, 1) used
+                            to sample tasks
+        """
+        self._enabled = enabled
+        self._sample_rate = sample_rate
+        self._random_func = random_func
+
+    def should_profile(self, task):
+        """
+        Checks if task should be profiled
+        :param task: task to process
+        :return: True if task should be profiled otherwise False
+        """
+        if self._enabled is True:
+            return True
+        taskdict = task.get_taskdict()
+        if (isinstance(taskdict, dict) and
+                taskdict.get(dao.PROFILE_PARAM) is True):
+            return True
+        if self._sample_rate <= 0:
+            return False
+        return self._random_func() < self._sample_rate
+
+
+class TaskProfiler(object):
+    """
+    Profiles the pipeline stages of one task with :py:mod:`cProfile`
+    and records the peak memory allocated while each stage runs with
+    :py:mod:`tracemalloc`. Profile of each stage is written to
+    **outdir** once the stage finishes and :py:meth:`save` writes a
+    summary of all stages. cProfile only sees the thread running the
+    stage, but tracemalloc counts allocations of the whole process,
+    so peak memory of stages that overlap includes the others. Peak
+    memory is only reset per stage on Python 3.9 and later, before
+    that it is the peak since tracing started
+    """
+    def __init__(self, outdir, top=20):
+        """
+        Constructor
+        :param outdir: directory to write profiles to
+        :param top: number of functions with the highest cumulative
+                    time listed per stage in summary
+        """
+        self._outdir = outdir
+        self._top = top
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._tracing = False
+        self._stopped = False
+
+    def start(self):
+        """
+        Starts tracing of memory allocations
+        :return: None
+        """
+        if self._tracing is False:
+            _start_tracing()
+            self._tracing = True
+
+    def stop(self):
+        """
+        Stops tracing of memory allocations if no other task
+        is profiled. Profiles of stages that finish afterwards,
+        such as those abandoned when the task timed out, are
+        not written
+        :return: None
+        """
+        self._stopped = True
+        if self._tracing is True:
+            _stop_tracing()
+            self._tracing = False
+
+    def profile(self, stagename, func, *args, **kwargs):
+        """
+        Runs **func** profiling it as stage **stagename**. On Python
+        3.12 and later only one profiler can be active in a process,
+        so a stage starting while another is profiled, such as one
+        running alongside it or in another task, is run without
+        cProfile and only its times and memory are recorded
+        :param stagename: name of stage
+        :param func: function to run
+        :return: value returned by **func**
+        """
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError as e:
+            logger.info('Not profiling functions of stage ' + stagename +
+                        ' : ' + str(e))
+            prof = None
+        if tracemalloc.is_tracing():
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            start_mem = tracemalloc.get_traced_memory()[0]
+        else:
+            start_mem = None
+        start = time.time()
+        start_cpu = time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if prof is not None:
+                prof.disable()
+            entry = {WALL_TIME_KEY: int((time.time() - start) * 1000),
+                     CPU_TIME_KEY: int((time.thread_time() -
+                                        start_cpu) * 1000),
+                     PEAK_MEMORY_KEY: None}
+            if start_mem is not None and tracemalloc.is_tracing():
+                entry[PEAK_MEMORY_KEY] = max(
+                    tracemalloc.get_traced_memory()[1] - start_mem, 0)
+            self._save_stage(stagename, prof, entry)
+
+    def _save_stage(self, stagename, prof, entry):
+        """
+        Writes profile of stage and adds **entry** to summary
+        :param stagename: name of stage
+        :param prof: :py:class:`cProfile.Profile` of stage or None
+                     if stage was not profiled by cProfile
+        :param entry: dict of timing and memory of stage
+        :return: None
+        """
+        if self._stopped is True:
+            logger.info('Not saving profile of stage ' + stagename +
+                        ' that finished after profiling stopped')
+            return
+        if prof is None:
+            entry[PROFILE_FILE_KEY] = None
+            entry[TOP_FUNCTIONS_KEY] = []
+            with self._lock:
+                self._stages[stagename] = entry
+            return
+        pfile = get_profile_file(stagename)
+        try:
+            prof.dump_stats(os.path.join(self._outdir, pfile))
+            entry[PROFILE_FILE_KEY] = pfile
+        except OSError as e:
+            logger.error('Unable to write profile of stage ' + stagename +
+                         ' : ' + str(e))
+            entry[PROFILE_FILE_KEY] = None
+        entry[TOP_FUNCTIONS_KEY] = self._get_top_functions(prof)
+        with self._lock:
+            self._stages[stagename] = entry
+
+    def _get_top_functions(self, prof):
+        """
+        Gets functions with the highest cumulative time
+        :param prof: :py:class:`cProfile.Profile`
+        :return: list of dicts with function, calls, totalTime and
+                 cumulativeTime in milliseconds
+        """
+        stats = pstats.Stats(prof).stats
+        rows = sorted(stats.items(), key=lambda item: item[1][3],
+                      reverse=True)
+        top = []
+        for (filename, lineno, funcname), vals in rows[0:self._top]:
+            top.append({'function': (filename + ':' + str(lineno) +
+                                     '(' + funcname + ')'),
+                        'calls': vals[1],
+                        'totalTime': int(vals[2] * 1000),
+                        'cumulativeTime': int(vals[3] * 1000)})
+        return top
+
+    def get_stages(self):
+        """
+        Gets summary of profile of each stage profiled
+        :return: dict of stage name => dict
+        """
+        with self._lock:
+            return dict(self._stages)
+
+    def get_files(self):
+        """
+        Gets names of files written to **outdir**
+        :return: list of file names
+        """
+        with self._lock:
+            names = [e[PROFILE_FILE_KEY] for e in self._stages.values()
+                     if e[PROFILE_FILE_KEY] is not None]
+        return sorted(names) + [PROFILE_SUMMARY_FILE]
+
+    def save(self):
+        """
+        Writes summary of all stages profiled to
+        :py:const:`PROFILE_SUMMARY_FILE` in **outdir**
+        :return: None
+        """
+        summary = os.path.join(self._outdir, PROFILE_SUMMARY_FILE)
+        tmpfile = summary + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(self.get_stages(), f, indent=2, sort_keys=True)
+        os.replace(tmpfile, summary)
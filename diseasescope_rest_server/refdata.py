@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""Reference data (DOID mapping and gene sets) shared by all tasks"""
+import io
+import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PANDAS_READERS = ('read_csv', 'read_table')
+"""
+pandas functions whose result is memoized when reading a
+reference file
+"""
+
+
+class ReferenceData(object):
+    """
+    Contents of reference files, such as the DOID mapping and gene
+    set files, read once by the task runner and shared by all tasks
+    it processes. Tables parsed from a file by pandas are memoized
+    per set of reader arguments, so each table is parsed once and
+    every task gets a copy. A file is read again only if its size
+    or modification time changes
+    """
+    def __init__(self, files):
+        """
+        Constructor
+        :param files: list of paths to reference files, None entries
+                      are ignored
+        """
+        self._files = [os.path.abspath(f) for f in files if f is not None]
+        self._contents = {}
+        self._stats = {}
+        self._tables = {}
+        self._parse_count = 0
+        self._lock = threading.RLock()
+
+    def get_files(self):
+        """
+        Gets absolute paths of reference files
+        :return: list of str
+        """
+        return list(self._files)
+
+    def get_parse_count(self):
+        """
+        Gets number of times a reference file was parsed into a table
+        :return: int
+        """
+        with self._lock:
+            return self._parse_count
+
+    def is_reference_file(self, path):
+        """
+        Denotes if **path** is one of the reference files
+        :param path: path to check, objects other than str or bytes,
+                     such as open files, are never reference files
+        :return: True if it is, False otherwise
+        """
+        if isinstance(path, bytes):
+            path = path.decode()
+        if not isinstance(path, str):
+            return False
+        return os.path.abspath(path) in self._files
+
+    def load(self):
+        """
+        Reads all reference files that are new or changed since
+        last load
+        :raises OSError: if a reference file cannot be read
+        :return: None
+        """
+        for path in self._files:
+            self._get_contents(path)
+
+    def _get_contents(self, path):
+        """
+        Gets contents of reference file, reading it if it is new
+        or changed. Parsed tables of a changed file are dropped
+        :param path: absolute path to reference file
+        :return: contents of file as bytes
+        """
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime)
+        with self._lock:
+            if self._stats.get(path) == key:
+                return self._contents[path]
+            logger.info('Loading reference file: ' + path)
+            with open(path, 'rb') as f:
+                self._contents[path] = f.read()
+            self._stats[path] = key
+            for tablekey in list(self._tables.keys()):
+                if tablekey[0] == path:
+                    del self._tables[tablekey]
+            return self._contents[path]
+
+    def open(self, file, mode='r', *args, **kwargs):
+        """
+        Same as builtin :py:func:`open` except reference files opened
+        for reading are read from memory
+        :return: file object
+        """
+        if not self.is_reference_file(file) or not set(mode) <= set('rbt'):
+            return open(file, mode, *args, **kwargs)
+        data = io.BytesIO(self._get_contents(os.path.abspath(file)))
+        if 'b' in mode:
+            return data
+        return io.TextIOWrapper(data, encoding=kwargs.get('encoding'),
+                                errors=kwargs.get('errors'),
+                                newline=kwargs.get('newline'))
+
+    def read_table(self, pandas, reader, path, *args, **kwargs):
+        """
+        Parses **path** with **reader** function of **pandas**. If
+        **path** is a reference file the table is parsed from memory
+        once per set of arguments and a copy is returned
+        :param pandas: pandas module
+        :param reader: name of pandas function, such as read_csv
+        :param path: path passed to reader
+        :return: result of reader
+        """
+        readfunc = getattr(pandas, reader)
+        if not self.is_reference_file(path):
+            return readfunc(path, *args, **kwargs)
+        path = os.path.abspath(path)
+        key = (path, reader, repr(args), repr(sorted(kwargs.items())))
+        with self._lock:
+            contents = self._get_contents(path)
+            if key not in self._tables:
+                table = readfunc(io.BytesIO(contents), *args, **kwargs)
+                self._parse_count += 1
+                if not hasattr(table, 'copy'):
+                    # such as iterators returned with chunksize set
+                    return table
+                self._tables[key] = table
+            return self._tables[key].copy()
+
+
+class ReferencePandas(object):
+    """
+    Stand in for :py:mod:`pandas` whose readers, such as read_csv(),
+    return tables of reference files from
+    :py:class:`ReferenceData`. All other attributes are those of
+    :py:mod:`pandas`
+    """
+    def __init__(self, pandas, refdata):
+        """
+        Constructor
+        :param pandas: pandas module
+        :param refdata: ReferenceData to read reference files from
+        """
+        self._pandas = pandas
+        self._refdata = refdata
+
+    def get_pandas(self):
+        """
+        Gets pandas module
+        :return:
+        """
+        return self._pandas
+
+    def __getattr__(self, name):
+        if name in PANDAS_READERS:
+            pandas = self._pandas
+            refdata = self._refdata
+
+            def reader(path, *args, **kwargs):
+                return refdata.read_table(pandas, name, path,
+                                          *args, **kwargs)
+            return reader
+        return getattr(self._pandas, name)
+
+
+def route_module_reference_data(module, refdata):
+    """
+    Makes **module** read reference files from **refdata** when it
+    opens them with builtin :py:func:`open` or parses them with
+    pandas through its global reference to pandas, such as
+    pd.read_csv(). Only the globals of **module** are replaced so
+    other users of pandas are unaffected. Meant for libraries, such
+    as DiseaseScope, that only take paths to reference files
+    :param module: module to route reads of
+    :param refdata: ReferenceData to read from
+    :return: None
+    """
+    for name in ('pd', 'pandas'):
+        current = getattr(module, name, None)
+        if isinstance(current, ReferencePandas):
+            current = current.get_pandas()
+        if getattr(current, '__name__', None) != 'pandas':
+            continue
+        setattr(module, name, ReferencePandas(current, refdata))
+    module.open = refdata.open
+    logger.debug('Reading reference files of ' + str(module.__name__) +
+                 ' from shared reference data')
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""Node local scratch directories for temporary files of tasks"""
+import os
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# prefix of directory under scratch directory holding
+# the task directories of one task runner process
+RUNNER_DIR_PREFIX = 'diseasescope_runner.'
+
+
+def is_process_alive(pid):
+    """
+    Checks if process with id **pid** is running on this machine
+    :param pid: process id
+    :return: True if running otherwise False
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ScratchSpace(object):
+    """
+    Creates a scratch directory per task under a directory on fast
+    node local storage, such as SSD or tmpfs, so temporary files of
+    the pipeline are not written to the shared JOB_PATH. Task scratch
+    directories are placed under a directory named after the pid of
+    this process. Directories of processes no longer running, left
+    by a crash, are removed by :py:meth:`remove_stale`
+    """
+    def __init__(self, scratchdir, pid=None):
+        """
+        Constructor
+        :param scratchdir: directory on node local storage
+        :param pid: process id used to name directory of this
+                    process, if None pid of this process is used
+        """
+        self._scratchdir = os.path.abspath(scratchdir)
+        if pid is None:
+            pid = os.getpid()
+        self._pid = pid
+        self._runnerdir = os.path.join(self._scratchdir,
+                                       RUNNER_DIR_PREFIX + str(pid))
+
+    def get_runner_dir(self):
+        """
+        Gets directory holding task scratch directories of
+        this process
+        :return: path as str
+        """
+        return self._runnerdir
+
+    def get_task_scratchdir(self, taskid):
+        """
+        Gets scratch directory of task
+        :param taskid: id of task
+        :return: path as str
+        """
+        return os.path.join(self._runnerdir, str(taskid))
+
+    def create(self, taskid):
+        """
+        Creates empty scratch directory for task, removing any
+        left over from a previous attempt
+        :param taskid: id of task
+        :return: path to scratch directory
+        """
+        path = self.get_task_scratchdir(taskid)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, mode=0o775)
+        return path
+
+    def copy_artifacts(self, taskid, destdir, artifacts):
+        """
+        Copies files named in **artifacts** that exist in scratch
+        directory of task to **destdir**. Other files are not copied
+        :param taskid: id of task
+        :param destdir: directory to copy files to
+        :param artifacts: list of file names
+        :return: list of file names copied
+        """
+        copied = []
+        path = self.get_task_scratchdir(taskid)
+        if not os.path.isdir(destdir):
+            return copied
+        for name in artifacts:
+            src = os.path.join(path, name)
+            if not os.path.isfile(src):
+                continue
+            try:
+                shutil.copyfile(src, os.path.join(destdir, name))
+                copied.append(name)
+            except OSError as e:
+                logger.error('Unable to copy ' + src + ' to ' + destdir +
+                             ' : ' + str(e))
+        return copied
+
+    def remove(self, taskid):
+        """
+        Removes scratch directory of task
+        :param taskid: id of task
+        :return: None
+        """
+        shutil.rmtree(self.get_task_scratchdir(taskid), ignore_errors=True)
+
+    def remove_all(self):
+        """
+        Removes directory of this process and all task scratch
+        directories in it
+        :return: None
+        """
+        shutil.rmtree(self._runnerdir, ignore_errors=True)
+
+    def remove_stale(self):
+        """
+        Removes directories of task runner processes that are
+        no longer running
+        :return: list of directories removed
+        """
+        removed = []
+        if not os.path.isdir(self._scratchdir):
+            return removed
+        for entry in os.listdir(self._scratchdir):
+            if not entry.startswith(RUNNER_DIR_PREFIX):
+                continue
+            try:
+                pid = int(entry[len(RUNNER_DIR_PREFIX):])
+            except ValueError:
+                continue
+            if pid == self._pid or is_process_alive(pid):
+                continue
+            path = os.path.join(self._scratchdir, entry)
+            logger.info('Removing stale scratch directory ' + path)
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+        return removed
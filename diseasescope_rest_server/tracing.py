@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+
+"""Trace ids and spans following a task from POST through the runner"""
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+# W3C trace context header read from incoming requests and
+# added to outbound requests
+TRACEPARENT_HEADER = 'traceparent'
+
+# header with bare trace id, read from incoming requests and set
+# on response to POST so clients can log it
+TRACE_ID_HEADER = 'X-Trace-Id'
+
+DEFAULT_SERVICE_NAME = 'diseasescope_taskrunner'
+
+# span kind of outbound calls in zipkin format
+CLIENT_KIND = 'CLIENT'
+
+TRACE_ID_RE = re.compile('^[0-9a-f]{32}$')
+TRACEPARENT_RE = re.compile('^[0-9a-f]{2}-([0-9a-f]{32})-'
+                            '([0-9a-f]{16})-[0-9a-f]{2}$')
+
+_local = threading.local()
+
+
+def new_trace_id():
+    """
+    Generates trace id
+    :return: 32 character lower case hex str
+    """
+    return uuid.uuid4().hex
+
+
+def new_span_id():
+    """
+    Generates span id
+    :return: 16 character lower case hex str
+    """
+    return uuid.uuid4().hex[0:16]
+
+
+def _is_valid_trace_id(trace_id):
+    """
+    Checks trace id is 32 hex characters and not all zeros
+    """
+    return (TRACE_ID_RE.match(trace_id) is not None and
+            trace_id != '0' * 32)
+
+
+def get_trace_id_from_headers(headers):
+    """
+    Gets trace id from :py:const:`TRACEPARENT_HEADER` or
+    :py:const:`TRACE_ID_HEADER` of request, generating a
+    new one if neither holds a valid trace id
+    :param headers: dict like headers of request
+    :return: trace id as 32 character lower case hex str
+    """
+    traceparent = headers.get(TRACEPARENT_HEADER)
+    if traceparent is not None:
+        match = TRACEPARENT_RE.match(traceparent.strip().lower())
+        if match is not None and _is_valid_trace_id(match.group(1)):
+            return match.group(1)
+    trace_id = headers.get(TRACE_ID_HEADER)
+    if trace_id is not None:
+        trace_id = trace_id.strip().lower().replace('-', '')
+        if _is_valid_trace_id(trace_id):
+            return trace_id
+    return new_trace_id()
+
+
+def get_current_span():
+    """
+    Gets span active in this thread
+    :return: Span or None if no span is active
+    """
+    return getattr(_local, 'span', None)
+
+
+@contextmanager
+def use_span(span):
+    """
+    Makes **span** the active span of this thread while in the
+    with block. Spans of outbound calls made in the block are
+    created as children of it
+    :param span: Span or None to leave no span active
+    """
+    previous = getattr(_local, 'span', None)
+    _local.span = span
+    try:
+        yield span
+    finally:
+        _local.span = previous
+
+
+class Span(object):
+    """
+    Timed operation within a trace, exported in zipkin v2 json
+    format by the :py:class:`Tracer` that created it once
+    :py:meth:`finish` is called
+    """
+    def __init__(self, tracer, name, trace_id, parent_id=None,
+                 start=None, kind=None, tags=None):
+        """
+        Constructor
+        :param tracer: Tracer that exports span
+        :param name: name of operation
+        :param trace_id: id of trace span belongs to
+        :param parent_id: id of parent span or None if root span
+        :param start: start time in seconds since epoch, None
+                      for current time
+        :param kind: zipkin span kind, such as :py:const:`CLIENT_KIND`
+        :param tags: dict of tags
+        """
+        self._tracer = tracer
+        self._name = name
+        self._trace_id = trace_id
+        self._span_id = new_span_id()
+        self._parent_id = parent_id
+        self._start = time.time() if start is None else start
+        self._end = None
+        self._kind = kind
+        self._tags = {}
+        if tags is not None:
+            for key, val in tags.items():
+                self.set_tag(key, val)
+
+    def get_trace_id(self):
+        """
+        Gets id of trace
+        :return:
+        """
+        return self._trace_id
+
+    def get_span_id(self):
+        """
+        Gets id of span
+        :return:
+        """
+        return self._span_id
+
+    def get_tags(self):
+        """
+        Gets tags of span
+        :return: dict of str => str
+        """
+        return self._tags
+
+    def set_tag(self, key, val):
+        """
+        Sets tag, zipkin only allows str values so **val**
+        is converted to str
+        :param key: name of tag
+        :param val: value of tag
+        :return: None
+        """
+        self._tags[key] = str(val)
+
+    def start_child(self, name, start=None, kind=None, tags=None):
+        """
+        Starts span that is a child of this one
+        :param name: name of operation
+        :param start: start time in seconds since epoch, None for
+                      current time
+        :param kind: zipkin span kind
+        :param tags: dict of tags
+        :return: Span
+        """
+        return Span(self._tracer, name, self._trace_id,
+                    parent_id=self._span_id, start=start, kind=kind,
+                    tags=tags)
+
+    def get_traceparent(self):
+        """
+        Gets W3C traceparent header value denoting this span
+        :return: str
+        """
+        return '00-' + self._trace_id + '-' + self._span_id + '-01'
+
+    def finish(self, end=None):
+        """
+        Ends span and exports it. Calls after the first are ignored
+        :param end: end time in seconds since epoch, None for
+                    current time
+        :return: None
+        """
+        if self._end is not None:
+            return
+        self._end = time.time() if end is None else end
+        self._tracer.export(self)
+
+    def to_dict(self):
+        """
+        Gets span in zipkin v2 json format
+        :return: dict
+        """
+        end = self._end if self._end is not None else time.time()
+        span = {'traceId': self._trace_id,
+                'id': self._span_id,
+                'name': self._name,
+                'timestamp': int(self._start * 1000000),
+                'duration': max(int((end - self._start) * 1000000), 0),
+                'localEndpoint': {
+                    'serviceName': self._tracer.get_service_name()},
+                'tags': dict(self._tags)}
+        if self._parent_id is not None:
+            span['parentId'] = self._parent_id
+        if self._kind is not None:
+            span['kind'] = self._kind
+        return span
+
+
+class Tracer(object):
+    """
+    Creates spans and passes finished ones to an exporter
+    """
+    def __init__(self, exporter, service_name=DEFAULT_SERVICE_NAME):
+        """
+        Constructor
+        :param exporter: FileSpanExporter or ZipkinSpanExporter
+        :param service_name: name of service set on spans
+        """
+        self._exporter = exporter
+        self._service_name = service_name
+
+    def get_service_name(self):
+        """
+        Gets name of service set on spans
+        :return:
+        """
+        return self._service_name
+
+    def start_span(self, name, trace_id, start=None, tags=None):
+        """
+        Starts root span of trace
+        :param name: name of operation
+        :param trace_id: id of trace
+        :param start: start time in seconds since epoch, None
+                      for current time
+        :param tags: dict of tags
+        :return: Span
+        """
+        return Span(self, name, trace_id, start=start, tags=tags)
+
+    def export(self, span):
+        """
+        Exports finished span, logging any error
+        :param span: Span
+        :return: None
+        """
+        try:
+            self._exporter.export([span.to_dict()])
+        except Exception:
+            logger.exception('Caught exception exporting span')
+
+    def shutdown(self):
+        """
+        Exports any spans not yet exported
+        :return: None
+        """
+        self._exporter.shutdown()
+
+
+class FileSpanExporter(object):
+    """
+    Appends spans, one zipkin v2 json object per line, to a file
+    that can be shipped to a collector
+    """
+    def __init__(self, path):
+        """
+        Constructor
+        :param path: file to append spans to
+        """
+        self._path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        """
+        Appends spans to file
+        :param spans: list of spans as dicts
+        :return: None
+        """
+        lines = ''.join([json.dumps(s, sort_keys=True) + '\n'
+                         for s in spans])
+        with self._lock:
+            with open(self._path, 'a') as f:
+                f.write(lines)
+
+    def shutdown(self):
+        """
+        Does nothing, spans are written as they are exported
+        :return: None
+        """
+        pass
+
+
+class ZipkinSpanExporter(object):
+    """
+    Posts spans in batches, every **interval** seconds, to the
+    ``/api/v2/spans`` endpoint of a zipkin compatible collector,
+    such as zipkin, jaeger or the OpenTelemetry collector. Spans
+    exceeding **max_queue** while the collector is down are dropped
+    """
+    def __init__(self, url, interval=5.0, max_queue=10000, timeout=10,
+                 session=None):
+        """
+        Constructor
+        :param url: url of collector, ie http://localhost:9411/api/v2/spans
+        :param interval: time in seconds between posts
+        :param max_queue: maximum number of spans waiting to be posted
+        :param timeout: timeout in seconds of post
+        :param session: :py:class:`requests.Session` to post with, if
+                        None a new one is created. A session is used so
+                        posts are not routed through the shared session
+                        of the runner and traced themselves
+        """
+        self._url = url
+        self._interval = interval
+        self._max_queue = max_queue
+        self._timeout = timeout
+        if session is None:
+            session = requests.Session()
+        self._session = session
+        self._queue = []
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get_dropped_count(self):
+        """
+        Gets number of spans dropped because queue was full
+        :return:
+        """
+        return self._dropped
+
+    def export(self, spans):
+        """
+        Queues spans to be posted
+        :param spans: list of spans as dicts
+        :return: None
+        """
+        with self._lock:
+            room = self._max_queue - len(self._queue)
+            if room < len(spans):
+                self._dropped += len(spans) - max(room, 0)
+                spans = spans[0:max(room, 0)]
+            self._queue.extend(spans)
+
+    def flush(self):
+        """
+        Posts queued spans to collector, spans of a failed post are
+        put back in the queue
+        :return: number of spans posted
+        """
+        with self._lock:
+            batch = self._queue
+            self._queue = []
+        if len(batch) == 0:
+            return 0
+        try:
+            resp = self._session.post(self._url, json=batch,
+                                      timeout=self._timeout)
+            if resp.status_code >= 300:
+                raise Exception('Collector returned status ' +
+                                str(resp.status_code))
+        except Exception as e:
+            logger.warning('Unable to post ' + str(len(batch)) +
+                           ' spans to ' + self._url + ' : ' + str(e))
+            self.export(batch)
+            return 0
+        return len(batch)
+
+    def _flush_periodically(self):
+        """
+        Posts spans every **interval** seconds until stopped
+        """
+        while not self._stop.wait(self._interval):
+            self.flush()
+
+    def start(self):
+        """
+        Starts thread posting spans
+        :return: None
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._flush_periodically,
+                                        name='span-exporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """
+        Stops thread and posts remaining spans
+        :return: None
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
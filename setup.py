@@ -25,6 +25,8 @@ requirements = [
     'flask-restplus',
     'Flask-Limiter',
     'python-daemon',
+    'requests',
+    'numpy',
     'diseasescope'
 ]
 
@@ -56,7 +58,10 @@ setup(
     keywords='DiseaseScope.upper()',
     name='diseasescope_rest_server',
     packages=find_packages(include=['diseasescope_rest_server']),
-    scripts=['diseasescope_rest_server/diseasescope_taskrunner.py'],
+    scripts=['diseasescope_rest_server/diseasescope_taskrunner.py',
+             'diseasescope_rest_server/diseasescope_benchmark.py',
+             'diseasescope_rest_server/diseasescope_migratelayout.py',
+             'diseasescope_rest_server/diseasescope_archivetasks.py'],
     setup_requires=setup_requirements,
     test_suite='tests',
     tests_require=test_requirements,
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `archive` module."""
+
+import os
+import json
+import time
+import fcntl
+import unittest
+import shutil
+import tempfile
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import archive
+from diseasescope_rest_server.archive import TaskArchive
+from diseasescope_rest_server.archive import TaskArchiver
+from diseasescope_rest_server.dao import TaskLayout
+
+
+class TestArchive(unittest.TestCase):
+    """Tests for `archive` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+        self._archivedir = archive.get_archive_dir(self._temp_dir)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def _write_task(self, taskdir, taskdict, result=None, age=0):
+        os.makedirs(taskdir)
+        files = [(dao.TASK_JSON, taskdict)]
+        if result is not None:
+            files.append((dao.RESULT, result))
+        mtime = time.time() - age
+        for name, data in files:
+            path = os.path.join(taskdir, name)
+            with open(path, 'w') as f:
+                json.dump(data, f)
+            os.utime(path, (mtime, mtime))
+        return taskdir
+
+    def test_get_day(self):
+        self.assertEqual(archive.get_day(0), '19700101')
+        self.assertEqual(archive.get_day(86400 * 365 + 3600), '19710101')
+
+    def test_append_and_get_task(self):
+        arch = TaskArchive(self._archivedir)
+        self.assertEqual(arch.refresh(), 0)
+        self.assertIsNone(arch.get_task('a'))
+        arch.append('20200101', [])
+        self.assertFalse(os.path.isdir(self._archivedir))
+
+        arch.append('20200101', [('a', {'x': 1}), ('b', {'x': 2})])
+        arch.append('20200102', [('c', {'x': 3})])
+        self.assertEqual(sorted(os.listdir(self._archivedir)),
+                         ['20200101.idx', '20200101.seg',
+                          '20200102.idx', '20200102.seg'])
+        self.assertEqual(arch.get_task('b'), {'x': 2})
+        self.assertEqual(arch.get_location('a')[0:2], ('20200101', 0))
+
+        # another reader sees appends on miss
+        other = TaskArchive(self._archivedir)
+        self.assertEqual(other.get_task('c'), {'x': 3})
+        arch.append('20200101', [('d', {'x': 4})])
+        self.assertEqual(other.get_task('d'), {'x': 4})
+        self.assertEqual(other.get_task('a'), {'x': 1})
+        self.assertEqual(other.refresh(), 0)
+        self.assertFalse(other.has_task('missing'))
+
+    def test_interrupted_append(self):
+        arch = TaskArchive(self._archivedir)
+        arch.append('20200101', [('a', {'x': 1})])
+        index = os.path.join(self._archivedir, '20200101' +
+                             archive.INDEX_SUFFIX)
+        with open(index, 'a') as f:
+            f.write('b 999')
+        self.assertTrue(arch.has_task('a'))
+        self.assertFalse(arch.has_task('b'))
+        arch.append('20200101', [('c', {'x': 3})])
+        with open(index, 'a') as f:
+            f.write('bad line here\nd x 1\n')
+
+        other = TaskArchive(self._archivedir)
+        self.assertEqual(other.refresh(), 2)
+        self.assertEqual(other.get_task('c'), {'x': 3})
+        self.assertFalse(other.has_task('b'))
+        self.assertTrue(arch.has_task('c'))
+
+        # location past end of segment
+        with open(index, 'a') as f:
+            f.write('e 100000 10\n')
+        self.assertIsNone(other.get_task('e'))
+
+    def test_delete(self):
+        arch = TaskArchive(self._archivedir)
+        self.assertFalse(arch.delete('a'))
+        arch.append('20200101', [('a', {'x': 1}), ('b', {'x': 2})])
+        other = TaskArchive(self._archivedir)
+        self.assertTrue(other.has_task('a'))
+
+        self.assertTrue(arch.delete('a'))
+        self.assertIsNone(arch.get_task('a'))
+        self.assertFalse(arch.delete('a'))
+
+        # other readers see the delete, even with task in memory
+        self.assertIsNone(other.get_task('a'))
+        self.assertFalse(other.has_task('a'))
+        self.assertEqual(other.get_task('b'), {'x': 2})
+
+        # line left by an interrupted delete is ignored
+        with open(os.path.join(self._archivedir,
+                               archive.DELETED_FILE), 'a') as f:
+            f.write('\nb')
+        self.assertEqual(other.get_task('b'), {'x': 2})
+        self.assertTrue(arch.delete('b'))
+        self.assertIsNone(other.get_task('b'))
+        self.assertIsNone(TaskArchive(self._archivedir).get_task('a'))
+
+    def test_archive_tasks(self):
+        donedir = os.path.join(self._temp_dir, dao.DONE_STATUS)
+        old = 40 * archive.DAY_SECONDS
+        t1 = self._write_task(os.path.join(donedir, '1.2.3.4', 'aaaa11'),
+                              {'submitTime': 1},
+                              result={'result': {'ndexurl': 'x'}}, age=old)
+        t2 = self._write_task(os.path.join(donedir, 'bb', 'bbbb22'),
+                              {'message': 'failed'}, age=old)
+        t3 = self._write_task(os.path.join(donedir, '1.2.3.4', 'cccc33'),
+                              {'submitTime': 3})
+        t4 = self._write_task(os.path.join(donedir, '1.2.3.4', 'dddd44'),
+                              {'submitTime': 4}, age=old)
+        os.makedirs(os.path.join(self._temp_dir, dao.DELETE_REQUESTS))
+        open(os.path.join(self._temp_dir, dao.DELETE_REQUESTS,
+                          'dddd44'), 'a').close()
+        os.makedirs(os.path.join(donedir, '1.2.3.4', 'nojson'))
+
+        archiver = TaskArchiver(self._temp_dir, layout=TaskLayout(),
+                                batch_size=1)
+        self.assertEqual([t[1] for t in archiver.get_archivable_taskdirs()],
+                         ['aaaa11', 'bbbb22'])
+
+        # delete request arriving after tasks were listed
+        counts = {'archived': 0, 'failed': 0}
+        archiver._archive_batch('20200101', [('dddd44', t4)], counts)
+        self.assertEqual(counts, {'archived': 0, 'failed': 0})
+        self.assertTrue(os.path.isdir(t4))
+        self.assertEqual(archiver.archive_tasks(time_budget=-1),
+                         {'archived': 0, 'failed': 0})
+        self.assertEqual(archiver.archive_tasks(),
+                         {'archived': 2, 'failed': 0})
+        self.assertFalse(os.path.isdir(t1))
+        self.assertFalse(os.path.isdir(t2))
+        self.assertTrue(os.path.isdir(t3))
+        self.assertTrue(os.path.isdir(t4))
+
+        arch = TaskArchive(self._archivedir)
+        self.assertEqual(arch.get_task('aaaa11'),
+                         {'result': {'ndexurl': 'x'},
+                          dao.STATUS_RESULT_KEY: dao.DONE_STATUS})
+        self.assertEqual(arch.get_task('bbbb22'),
+                         {'message': 'failed',
+                          dao.STATUS_RESULT_KEY: dao.ERROR_STATUS})
+        self.assertEqual(arch.get_location('aaaa11')[0],
+                         archive.get_day(time.time() - old))
+        self.assertEqual(archiver.archive_tasks(),
+                         {'archived': 0, 'failed': 0})
+
+    def test_archive_tasks_delete_during_append(self):
+        donedir = os.path.join(self._temp_dir, dao.DONE_STATUS)
+        t1 = self._write_task(os.path.join(donedir, '1.2.3.4', 'aaaa11'),
+                              {'submitTime': 1}, age=100)
+        t2 = self._write_task(os.path.join(donedir, '1.2.3.4', 'bbbb22'),
+                              {'submitTime': 2}, age=100)
+        deletedir = os.path.join(self._temp_dir, dao.DELETE_REQUESTS)
+        os.makedirs(deletedir)
+        arch = TaskArchive(self._archivedir)
+        append = arch.append
+
+        def append_with_delete(day, records):
+            # delete request arrives once delete requests were checked,
+            # too early for the REST service to delete it from archive
+            open(os.path.join(deletedir, 'aaaa11'), 'a').close()
+            self.assertFalse(TaskArchive(self._archivedir).delete('aaaa11'))
+            append(day, records)
+
+        arch.append = append_with_delete
+        archiver = TaskArchiver(self._temp_dir, min_age=10, archive=arch)
+        self.assertEqual(archiver.archive_tasks(),
+                         {'archived': 2, 'failed': 0})
+        self.assertFalse(os.path.isdir(t1))
+        self.assertFalse(os.path.isdir(t2))
+        other = TaskArchive(self._archivedir)
+        self.assertIsNone(other.get_task('aaaa11'))
+        self.assertEqual(other.get_task('bbbb22'),
+                         {'submitTime': 2,
+                          dao.STATUS_RESULT_KEY: dao.ERROR_STATUS})
+
+    def test_archive_tasks_already_archived(self):
+        donedir = os.path.join(self._temp_dir, dao.DONE_STATUS)
+        t1 = self._write_task(os.path.join(donedir, '1.2.3.4', 'aaaa11'),
+                              {'submitTime': 1}, age=100)
+        arch = TaskArchive(self._archivedir)
+        arch.append(archive.get_day(time.time()), [('aaaa11', {'x': 1})])
+        archiver = TaskArchiver(self._temp_dir, min_age=10, archive=arch)
+        self.assertEqual(archiver.archive_tasks(),
+                         {'archived': 1, 'failed': 0})
+        self.assertFalse(os.path.isdir(t1))
+        # task is not archived twice
+        self.assertEqual(arch.get_task('aaaa11'), {'x': 1})
+
+        # unknown file in task directory prevents removal
+        t2 = self._write_task(os.path.join(donedir, '1.2.3.4', 'bbbb22'),
+                              {'submitTime': 2}, age=100)
+        open(os.path.join(t2, 'unknown'), 'a').close()
+        self.assertEqual(archiver.archive_tasks(),
+                         {'archived': 0, 'failed': 1})
+        self.assertTrue(os.path.isdir(t2))
+        self.assertEqual(arch.get_task('bbbb22'),
+                         {'submitTime': 2,
+                          dao.STATUS_RESULT_KEY: dao.ERROR_STATUS})
+
+    def test_archive_tasks_bad_task_json(self):
+        donedir = os.path.join(self._temp_dir, dao.DONE_STATUS)
+        t1 = os.path.join(donedir, '1.2.3.4', 'aaaa11')
+        os.makedirs(t1)
+        with open(os.path.join(t1, dao.TASK_JSON), 'w') as f:
+            f.write('{bad')
+        archiver = TaskArchiver(self._temp_dir, min_age=-10)
+        self.assertEqual(archiver.archive_tasks(),
+                         {'archived': 0, 'failed': 1})
+        self.assertTrue(os.path.isdir(t1))
+
+    def test_archive_tasks_other_archiver_running(self):
+        os.makedirs(self._archivedir)
+        self._write_task(os.path.join(self._temp_dir, dao.DONE_STATUS,
+                                      '1.2.3.4', 'aaaa11'), {}, age=100)
+        archiver = TaskArchiver(self._temp_dir, min_age=10)
+        with open(os.path.join(self._archivedir,
+                               archive.LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertEqual(archiver.archive_tasks(),
+                             {'archived': 0, 'failed': 0})
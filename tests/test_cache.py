@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `cache` module."""
+
+import os
+import time
+import unittest
+import shutil
+import tempfile
+import threading
+from unittest.mock import MagicMock
+
+from diseasescope_rest_server import cache
+from diseasescope_rest_server.cache import StageCache
+
+
+class TestCache(unittest.TestCase):
+    """Tests for `cache` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_reference_version(self):
+        afile = os.path.join(self._temp_dir, 'a.txt')
+        with open(afile, 'w') as f:
+            f.write('hello')
+        v1 = cache.get_reference_version([afile, None, '/doesnotexist'])
+        self.assertEqual(v1, cache.get_reference_version([afile]))
+        with open(afile, 'w') as f:
+            f.write('changed')
+        self.assertNotEqual(v1, cache.get_reference_version([afile]))
+
+    def test_get_key(self):
+        c = StageCache(self._temp_dir, version='1')
+        key = c.get_key('stage', {'b': 1, 'a': 2})
+        self.assertEqual(key, c.get_key('stage', {'a': 2, 'b': 1}))
+        self.assertNotEqual(key, c.get_key('other', {'a': 2, 'b': 1}))
+        self.assertNotEqual(key, StageCache(self._temp_dir,
+                                            version='2').get_key(
+            'stage', {'a': 2, 'b': 1}))
+
+    def test_get_put(self):
+        cdir = os.path.join(self._temp_dir, 'cache')
+        c = StageCache(cdir)
+        self.assertTrue(os.path.isdir(cdir))
+        key = c.get_key('stage', {'doid': 1})
+        self.assertEqual(c.get('stage', key), None)
+        self.assertTrue(c.put('stage', key, {'genes': ['a', 'b']}))
+        self.assertEqual(c.get('stage', key), {'genes': ['a', 'b']})
+        self.assertEqual(c.get_hits(), 1)
+        self.assertEqual(c.get_misses(), 1)
+
+        # unpicklable value
+        self.assertFalse(c.put('stage', key, {'lock': threading.Lock()}))
+
+        # corrupt entry
+        entry = c._get_entry_path(key)
+        with open(entry, 'w') as f:
+            f.write('not gzip')
+        self.assertEqual(c.get('stage', key), None)
+        self.assertFalse(os.path.isfile(entry))
+
+    def test_ttl(self):
+        c = StageCache(self._temp_dir, ttls={'short': 60},
+                       default_ttl=3600)
+        key = c.get_key('short', {})
+        c.put('short', key, 'val')
+        longkey = c.get_key('long', {})
+        c.put('long', longkey, 'val')
+        past = time.time() - 120
+        os.utime(c._get_entry_path(key), (past, past))
+        os.utime(c._get_entry_path(longkey), (past, past))
+        self.assertEqual(c.get('short', key), None)
+        self.assertFalse(os.path.isfile(c._get_entry_path(key)))
+        self.assertEqual(c.get('long', longkey), 'val')
+
+    def test_put_scans_only_when_needed(self):
+        c = StageCache(self._temp_dir, max_size=10 * 1024,
+                       scan_interval=3600)
+        c.evict = MagicMock(wraps=c.evict)
+        self.assertIsNone(c.get_size())
+        c.put('stage', c.get_key('stage', {'i': 0}), 'a')
+        self.assertEqual(c.evict.call_count, 1)
+        size = c.get_size()
+        self.assertTrue(size > 0)
+        for i in range(1, 4):
+            c.put('stage', c.get_key('stage', {'i': i}), 'a')
+        self.assertEqual(c.evict.call_count, 1)
+        self.assertTrue(c.get_size() > size)
+
+        # crossing maximum size scans and evicts
+        c.put('stage', c.get_key('stage', {'i': 'big'}),
+              os.urandom(20 * 1024))
+        self.assertEqual(c.evict.call_count, 2)
+        self.assertTrue(c.get_size() <= 10 * 1024)
+
+        # scan interval passed
+        c._scan_time = 0
+        c.put('stage', c.get_key('stage', {'i': 5}), 'a')
+        self.assertEqual(c.evict.call_count, 3)
+
+    def test_evict_least_recently_used(self):
+        c = StageCache(self._temp_dir, max_size=10 * 1024 * 1024)
+        keys = []
+        for i in range(3):
+            key = c.get_key('stage', {'i': i})
+            c.put('stage', key, os.urandom(1024))
+            keys.append(key)
+        self.assertEqual(c.evict(), 0)
+
+        # make first entry the most recently used
+        now = time.time()
+        for i, key in enumerate(keys):
+            os.utime(c._get_entry_path(key), (now - 100 + i, now))
+        os.utime(c._get_entry_path(keys[0]), (now, now))
+
+        entrysize = os.path.getsize(c._get_entry_path(keys[0]))
+        c._max_size = entrysize * 2
+        self.assertEqual(c.evict(), 1)
+        self.assertTrue(os.path.isfile(c._get_entry_path(keys[0])))
+        self.assertFalse(os.path.isfile(c._get_entry_path(keys[1])))
+        self.assertTrue(os.path.isfile(c._get_entry_path(keys[2])))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `clixo` module."""
+
+import os
+import time
+import stat
+import unittest
+import shutil
+import tempfile
+
+import pandas as pd
+
+from diseasescope_rest_server import clixo
+from diseasescope_rest_server.clixo import ClixoPool
+from diseasescope_rest_server.clixo import ClixoError
+from diseasescope_rest_server.pipeline import TaskCancelledError
+from diseasescope_rest_server.edgetable import EdgeTable
+
+
+class TestClixo(unittest.TestCase):
+    """Tests for `clixo` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def _write_script(self, body):
+        script = os.path.join(self._temp_dir, 'fakeclixo.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\n' + body + '\n')
+        os.chmod(script, stat.S_IRWXU)
+        return script
+
+    def test_write_and_read_files(self):
+        network = pd.DataFrame({'Gene1': ['A', 'B'], 'Gene2': ['B', 'C'],
+                                'mean': [0.5, 0.25], 'other': [1, 2]})
+        edgefile = os.path.join(self._temp_dir, 'edges.tsv')
+        clixo.write_edge_table(network, ['Gene1', 'Gene2'], 'mean', edgefile)
+        with open(edgefile, 'r') as f:
+            self.assertEqual(f.read(), 'A\tB\t0.5\nB\tC\t0.25\n')
+
+        outfile = os.path.join(self._temp_dir, 'out.tsv')
+        with open(outfile, 'w') as f:
+            f.write('# CLIXO output\n\n1\t2\tdefault\t0.1\n'
+                    '2\tA\tgene\n2\tbad\n')
+        self.assertEqual(clixo.read_clixo_output(outfile),
+                         [['1', '2', 'default'], ['2', 'A', 'gene']])
+
+    def test_write_edge_table_if_changed(self):
+        network = EdgeTable.from_dataframe(
+            pd.DataFrame({'Gene1': ['A', 'B'], 'Gene2': ['B', 'C'],
+                          'mean': [0.5, 0.25]}))
+        edgefile = os.path.join(self._temp_dir, 'edges.tsv')
+        cols = ['Gene1', 'Gene2']
+        self.assertTrue(clixo.write_edge_table_if_changed(network, cols,
+                                                          'mean', edgefile))
+        with open(edgefile, 'r') as f:
+            self.assertEqual(f.read(), 'A\tB\t0.5\nB\tC\t0.25\n')
+
+        # same network is not written again
+        self.assertFalse(clixo.write_edge_table_if_changed(network, cols,
+                                                           'mean', edgefile))
+        changed = network.rename_nodes(['X', 'B', 'C'])
+        self.assertTrue(clixo.write_edge_table_if_changed(changed, cols,
+                                                          'mean', edgefile))
+        with open(edgefile, 'r') as f:
+            self.assertEqual(f.read(), 'X\tB\t0.5\nB\tC\t0.25\n')
+
+        # DataFrames are always written
+        df = network.to_dataframe()
+        self.assertTrue(clixo.write_edge_table_if_changed(df, cols, 'mean',
+                                                          edgefile))
+        self.assertFalse(os.path.isfile(edgefile +
+                                        clixo.EDGE_TABLE_CHECKSUM_SUFFIX))
+
+    def test_get_hiview_url(self):
+        self.assertEqual(clixo.get_hiview_url('http://hiview/',
+                                              'http://ndex/#/network/abc',
+                                              'test.ndexbio.org'),
+                         'http://hiview/abc?type=test&server='
+                         'http://test.ndexbio.org')
+
+    def test_get_command(self):
+        pool = ClixoPool(clixo_cmd='/bin/clixo')
+        self.assertEqual(pool.get_command('e.tsv', 0.1, 0.5),
+                         ['/bin/clixo', '-i', 'e.tsv', '-a', '0.1',
+                          '-b', '0.5'])
+
+    def test_run(self):
+        script = self._write_script('echo "$@"\n'
+                                    'echo "threads $OMP_NUM_THREADS"')
+        pool = ClixoPool(clixo_cmd=script, max_instances=2,
+                         cores_per_run=1, cpus=[0])
+        self.assertEqual(pool.get_max_instances(), 2)
+        outfile = os.path.join(self._temp_dir, 'out.tsv')
+        pool.run('edges.tsv', outfile, 0.1, 0.5)
+        with open(outfile, 'r') as f:
+            self.assertEqual(f.read(), '-i edges.tsv -a 0.1 -b 0.5\n'
+                                       'threads 1\n')
+        self.assertEqual(pool._free_cpus, [0])
+
+    def test_run_fails(self):
+        script = self._write_script('echo oops 1>&2\nexit 3')
+        pool = ClixoPool(clixo_cmd=script)
+        try:
+            pool.run('e.tsv', os.path.join(self._temp_dir, 'out.tsv'),
+                     0.1, 0.5)
+            self.fail('Expected ClixoError')
+        except ClixoError as e:
+            self.assertEqual(str(e), 'CLIXO exited with code 3 : oops')
+
+        pool = ClixoPool(clixo_cmd=os.path.join(self._temp_dir, 'nope'))
+        try:
+            pool.run('e.tsv', os.path.join(self._temp_dir, 'out.tsv'),
+                     0.1, 0.5)
+            self.fail('Expected ClixoError')
+        except ClixoError as e:
+            self.assertTrue(str(e).startswith('Unable to run '))
+
+    def test_run_timeout(self):
+        script = self._write_script('exec sleep 10')
+        pool = ClixoPool(clixo_cmd=script, timeout=0.1)
+        try:
+            pool.run('e.tsv', os.path.join(self._temp_dir, 'out.tsv'),
+                     0.1, 0.5)
+            self.fail('Expected ClixoError')
+        except ClixoError as e:
+            self.assertEqual(str(e), 'CLIXO did not finish within '
+                                     '0.1 seconds')
+
+    def test_run_cancelled(self):
+        pidfile = os.path.join(self._temp_dir, 'pid')
+        script = self._write_script('echo $$ > ' + pidfile +
+                                    '\nexec sleep 30')
+        pool = ClixoPool(clixo_cmd=script, max_instances=1, cpus=[0],
+                         poll_interval=0.01)
+
+        def cancel_check():
+            if os.path.isfile(pidfile) and os.path.getsize(pidfile) > 0:
+                raise TaskCancelledError('cancelled')
+
+        start = time.time()
+        try:
+            pool.run('e.tsv', os.path.join(self._temp_dir, 'out.tsv'),
+                     0.1, 0.5, cancel_check=cancel_check)
+            self.fail('Expected TaskCancelledError')
+        except TaskCancelledError as e:
+            self.assertEqual(str(e), 'cancelled')
+        self.assertTrue(time.time() - start < 20)
+        with open(pidfile, 'r') as f:
+            pid = int(f.read())
+        try:
+            os.kill(pid, 0)
+            self.fail('Expected CLIXO process to be killed')
+        except OSError:
+            pass
+        # run and CPUs are freed
+        self.assertEqual(pool._free_cpus, [0])
+        self.assertTrue(pool._slots.acquire(blocking=False))
+
+        # cancelled while waiting for a free run, slot is still held
+        try:
+            pool.run('e.tsv', os.path.join(self._temp_dir, 'out2.tsv'),
+                     0.1, 0.5, cancel_check=cancel_check)
+            self.fail('Expected TaskCancelledError')
+        except TaskCancelledError:
+            pass
+        self.assertFalse(os.path.isfile(os.path.join(self._temp_dir,
+                                                     'out2.tsv')))
+
+    def test_allocate_cpus(self):
+        pool = ClixoPool(cores_per_run=2, cpus=[0, 1, 2])
+        first = pool._allocate_cpus()
+        self.assertEqual(first, [0, 1])
+        self.assertEqual(pool._allocate_cpus(), [2])
+        self.assertEqual(pool._allocate_cpus(), [])
+        pool._release_cpus(first)
+        self.assertEqual(pool._allocate_cpus(), [0, 1])
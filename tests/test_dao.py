@@ -12,6 +12,10 @@ import diseasescope_rest_server
 from diseasescope_rest_server.dao import FileBasedTask
 from diseasescope_rest_server.dao import FileBasedSubmittedTaskFactory
 from diseasescope_rest_server.dao import DeletedFileBasedTaskFactory
+from diseasescope_rest_server.dao import OrphanedTaskSweeper
+from diseasescope_rest_server.dao import CoalescingTaskWriter
+from diseasescope_rest_server.dao import TaskLayout
+from diseasescope_rest_server.dao import TaskLayoutMigrator
 from diseasescope_rest_server import dao
 
 
@@ -42,6 +46,11 @@ class TestDAO(unittest.TestCase):
 
         task.set_taskdir('/foo')
         self.assertEqual(task.get_taskdir(), '/foo')
+        self.assertEqual(task.get_scratchdir(), '/foo')
+        task.set_scratchdir('/scratch')
+        self.assertEqual(task.get_scratchdir(), '/scratch')
+        task.set_scratchdir(None)
+        self.assertEqual(task.get_scratchdir(), '/foo')
 
         task.set_taskdict({ dao.DOID_PARAM: 1234})
         self.assertEqual(task.get_diseaseid(), 1234)
@@ -85,6 +94,167 @@ class TestDAO(unittest.TestCase):
         self.assertEqual(res[FileBasedTask.IPADDR], 'i')
         self.assertEqual(res[FileBasedTask.UUID], 'myjob')
 
+    def test_filebasedtask_get_uuid_ip_state_basedir_from_sharded_path(self):
+        task = FileBasedTask('/b/submitted/ab/cd/abcdef', None)
+        res = task._get_uuid_ip_state_basedir_from_path()
+        self.assertEqual(res[FileBasedTask.BASEDIR], '/b')
+        self.assertEqual(res[FileBasedTask.STATE], 'submitted')
+        self.assertEqual(res[FileBasedTask.IPADDR], None)
+        self.assertEqual(res[FileBasedTask.UUID], 'abcdef')
+
+        # address comes from task json
+        task.set_taskdict({dao.REMOTEIP_PARAM: '1.2.3.4'})
+        self.assertEqual(task.get_ipaddress(), '1.2.3.4')
+
+        # directory not a prefix of uuid is an address
+        task = FileBasedTask('/b/submitted/ab/abcdef', {})
+        self.assertEqual(task.get_ipaddress(), None)
+        task = FileBasedTask('/b/submitted/xy/abcdef', {})
+        self.assertEqual(task.get_ipaddress(), 'xy')
+
+    def test_tasklayout_get_taskdir(self):
+        layout = TaskLayout()
+        self.assertFalse(layout.is_sharded())
+        self.assertEqual(layout.get_taskdir('/b', dao.SUBMITTED_STATUS,
+                                            'abcdef', ipaddr='1.2.3.4'),
+                         '/b/submitted/1.2.3.4/abcdef')
+
+        layout = TaskLayout(shard_depth=2, shard_width=2)
+        self.assertTrue(layout.is_sharded())
+        self.assertEqual(layout.get_shard_dirs('abcdef'), ['ab', 'cd'])
+        self.assertEqual(layout.get_taskdir('/b', dao.DONE_STATUS,
+                                            'abcdef', ipaddr='1.2.3.4'),
+                         '/b/done/ab/cd/abcdef')
+        try:
+            layout.get_taskdir('/b', dao.DONE_STATUS, 'abcd')
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+
+        for depth, width in [(-1, 2), (dao.MAX_SHARD_DEPTH + 1, 2), (1, 0)]:
+            try:
+                TaskLayout(shard_depth=depth, shard_width=width)
+                self.fail('Expected ValueError')
+            except ValueError:
+                pass
+
+    def test_tasklayout_find_and_iter_mixed_tree(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            statedir = os.path.join(temp_dir, dao.SUBMITTED_STATUS)
+            layout = TaskLayout(shard_depth=2)
+            self.assertEqual(layout.find_taskdirs(statedir, ['abcdef']), {})
+            self.assertEqual(list(layout.iter_taskdirs(statedir)), [])
+            iptask = os.path.join(statedir, '1.2.3.4', 'ab1111')
+            shallow = os.path.join(statedir, 'ab', 'ab2222')
+            deep = os.path.join(statedir, 'ab', 'cd', 'abcdef')
+            v6task = os.path.join(statedir, '::1', 'ef0000')
+            for tdir in [iptask, shallow, deep, v6task]:
+                os.makedirs(tdir)
+            open(os.path.join(statedir, 'ab', 'cd', 'abcd99'), 'a').close()
+
+            self.assertEqual(sorted([e.path for e in
+                                     layout.iter_taskdirs(statedir)]),
+                             sorted([iptask, shallow, deep, v6task]))
+            self.assertEqual(layout.find_taskdirs(
+                statedir, ['ab1111', 'ab2222', 'abcdef', 'ef0000',
+                           'abcd99', 'missing', '..', '']),
+                {'ab1111': iptask, 'ab2222': shallow, 'abcdef': deep,
+                 'ef0000': v6task})
+            self.assertEqual(layout.find_taskdir(statedir, 'abcdef'), deep)
+            self.assertEqual(layout.find_taskdir(statedir, 'ab/cd'), None)
+
+            # unsharded layout finds sharded tasks too
+            self.assertEqual(TaskLayout().find_taskdir(statedir, 'abcdef'),
+                             deep)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_move_task_with_layout(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ataskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                    '1.2.3.4', 'abcdef')
+            os.makedirs(ataskdir)
+            layout = TaskLayout(shard_depth=2)
+            task = FileBasedTask(ataskdir,
+                                 {dao.REMOTEIP_PARAM: '1.2.3.4'},
+                                 layout=layout)
+            self.assertEqual(task.move_task(dao.PROCESSING_STATUS), None)
+            self.assertEqual(task.get_taskdir(),
+                             os.path.join(temp_dir, dao.PROCESSING_STATUS,
+                                          'ab', 'cd', 'abcdef'))
+            self.assertEqual(task.get_ipaddress(), '1.2.3.4')
+
+            # without layout task stays in layout it is in
+            task = FileBasedTask(task.get_taskdir(), {})
+            self.assertEqual(task.move_task(dao.DONE_STATUS), None)
+            self.assertEqual(task.get_taskdir(),
+                             os.path.join(temp_dir, dao.DONE_STATUS,
+                                          'ab', 'cd', 'abcdef'))
+
+            # back to address layout
+            task = FileBasedTask(task.get_taskdir(),
+                                 {dao.REMOTEIP_PARAM: '1.2.3.4'},
+                                 layout=TaskLayout())
+            self.assertEqual(task.move_task(dao.SUBMITTED_STATUS), None)
+            self.assertEqual(task.get_taskdir(), ataskdir)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_tasklayoutmigrator(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            submitdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS)
+            t1 = os.path.join(submitdir, '1.2.3.4', 'abcdef')
+            t2 = os.path.join(temp_dir, dao.DONE_STATUS, '5.6.7.8', 'cd0000')
+            t3 = os.path.join(temp_dir, dao.PROCESSING_STATUS,
+                              '1.2.3.4', 'ef0000')
+            short = os.path.join(submitdir, '9.9.9.9', 'ab')
+            for tdir in [t1, t2, t3, short]:
+                os.makedirs(tdir)
+            with open(os.path.join(t1, dao.TASK_JSON), 'w') as f:
+                json.dump({dao.REMOTEIP_PARAM: '1.2.3.4'}, f)
+            layout = TaskLayout(shard_depth=2)
+            migrator = TaskLayoutMigrator(temp_dir, layout)
+
+            # dry run moves nothing
+            self.assertEqual(migrator.migrate(dry_run=True),
+                             {'moved': 2, 'skipped': 0, 'failed': 1})
+            self.assertTrue(os.path.isdir(t1))
+
+            # target already exists
+            dupe = os.path.join(temp_dir, dao.DONE_STATUS, 'cd', '00',
+                                'cd0000')
+            os.makedirs(dupe)
+            self.assertEqual(migrator.migrate(),
+                             {'moved': 1, 'skipped': 0, 'failed': 2})
+            os.rmdir(dupe)
+            self.assertEqual(migrator.migrate(),
+                             {'moved': 1, 'skipped': 0, 'failed': 1})
+            self.assertEqual(sorted(os.listdir(submitdir)),
+                             ['9.9.9.9', 'ab'])
+            self.assertTrue(os.path.isdir(os.path.join(submitdir, 'ab',
+                                                       'cd', 'abcdef')))
+            self.assertFalse(os.path.isdir(os.path.join(temp_dir,
+                                                        dao.DONE_STATUS,
+                                                        '5.6.7.8')))
+            # processing tasks are left to runners
+            self.assertTrue(os.path.isdir(t3))
+
+            # moving back uses address in task json, task without
+            # one is left where it is
+            migrator = TaskLayoutMigrator(temp_dir, TaskLayout())
+            self.assertEqual(migrator.migrate(time_budget=-1),
+                             {'moved': 0, 'skipped': 0, 'failed': 0})
+            self.assertEqual(migrator.migrate(),
+                             {'moved': 1, 'skipped': 0, 'failed': 1})
+            self.assertTrue(os.path.isdir(t1))
+            self.assertTrue(os.path.isdir(dupe))
+            self.assertFalse(os.path.isdir(os.path.join(submitdir, 'ab')))
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_save_task(self):
         temp_dir = tempfile.mkdtemp()
         try:
@@ -122,6 +292,97 @@ class TestDAO(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_write_task_json_fsync(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            task = FileBasedTask(temp_dir, {'a': 1})
+            self.assertEqual(task.write_task_json('{"a": 2}', fsync=True),
+                             None)
+            with open(os.path.join(temp_dir, dao.TASK_JSON), 'r') as f:
+                self.assertEqual(f.read(), '{"a": 2}')
+            self.assertEqual(os.listdir(temp_dir), [dao.TASK_JSON])
+            task.set_taskdir(os.path.join(temp_dir, 'nope'))
+            self.assertTrue('is not a directory' in
+                            task.write_task_json('{}'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_coalescingtaskwriter(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            try:
+                CoalescingTaskWriter(fsync='foo')
+                self.fail('Expected ValueError')
+            except ValueError as e:
+                self.assertEqual(str(e), 'Unknown fsync policy: foo')
+
+            # without background thread every save is written
+            writer = CoalescingTaskWriter(interval=3600)
+            task = FileBasedTask(temp_dir, {'progress': 0})
+            task.set_writer(writer)
+            self.assertEqual(task.save_task(), None)
+            self.assertEqual(writer.get_write_count(), 1)
+
+            # with background thread saves within interval coalesce
+            writer = CoalescingTaskWriter(interval=3600,
+                                          fsync=dao.FSYNC_INTERVAL)
+            writer.start()
+            task.set_writer(writer)
+            task.get_taskdict()['progress'] = 1
+            task.save_task()
+            for i in range(2, 20):
+                task.get_taskdict()['progress'] = i
+                task.save_task()
+            writer.flush(task)
+            writer.stop()
+            self.assertTrue(writer.get_write_count() <= 2)
+            self.assertEqual(writer.get_pending_count(), 0)
+            with open(os.path.join(temp_dir, dao.TASK_JSON), 'r') as f:
+                self.assertEqual(json.load(f), {'progress': 19})
+
+            # pending data is written when writer stops
+            writer = CoalescingTaskWriter(interval=3600,
+                                          fsync=dao.FSYNC_ALWAYS)
+            writer.start()
+            task.set_writer(writer)
+            task.get_taskdict()['progress'] = 20
+            task.save_task()
+            task.get_taskdict()['progress'] = 21
+            task.save_task()
+            writer.stop()
+            with open(os.path.join(temp_dir, dao.TASK_JSON), 'r') as f:
+                self.assertEqual(json.load(f), {'progress': 21})
+            # stale data is never written over newer data
+            writer._write(task, 1, '{"progress": 0}')
+            with open(os.path.join(temp_dir, dao.TASK_JSON), 'r') as f:
+                self.assertEqual(json.load(f), {'progress': 21})
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_move_task_flushes_writer(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            taskdir = os.path.join(temp_dir, dao.PROCESSING_STATUS,
+                                   '1.2.3.4', 'abc')
+            os.makedirs(taskdir)
+            writer = CoalescingTaskWriter(interval=3600)
+            writer.start()
+            task = FileBasedTask(taskdir, {'progress': 1})
+            task.set_writer(writer)
+            task.save_task()
+            task.get_taskdict()['progress'] = 50
+            task.save_task()
+            self.assertEqual(task.move_task(dao.ERROR_STATUS,
+                                            error_message='bad'), None)
+            writer.stop()
+            with open(os.path.join(task.get_taskdir(),
+                                   dao.TASK_JSON), 'r') as f:
+                data = json.load(f)
+            self.assertEqual(data, {'progress': 50, 'message': 'bad'})
+            self.assertFalse(os.path.isdir(taskdir))
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_move_task(self):
         temp_dir = tempfile.mkdtemp()
         try:
@@ -240,6 +501,98 @@ class TestDAO(unittest.TestCase):
             self.assertTrue('trying to remove ' in task.delete_task_files())
             self.assertTrue(os.path.isdir(valid_dir))
 
+            # try with checkpoint directory
+            valid_dir = os.path.join(temp_dir, 'withcheckpoints')
+            cdir = os.path.join(valid_dir, dao.CHECKPOINT_DIR)
+            os.makedirs(cdir, mode=0o755)
+            open(os.path.join(cdir, 'foo.pkl.gz'), 'a').close()
+            open(os.path.join(valid_dir, dao.TASK_JSON),
+                 'a').close()
+            task = FileBasedTask(valid_dir, {})
+            self.assertEqual(task.delete_task_files(), None)
+            self.assertFalse(os.path.isdir(valid_dir))
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_filebasedtask_delete_task_files_with_manifest(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            valid_dir = os.path.join(temp_dir, 'task')
+            subdir = os.path.join(valid_dir, 'clixo', 'nested')
+            os.makedirs(subdir, mode=0o755)
+            open(os.path.join(subdir, 'foo'), 'a').close()
+            os.symlink(temp_dir, os.path.join(subdir, 'link'))
+            for name in [dao.TASK_JSON, dao.RESULT, 'edges.tsv',
+                         'notlisted']:
+                open(os.path.join(valid_dir, name), 'a').close()
+            dao.record_task_files(valid_dir, ['edges.tsv', 'clixo'])
+            dao.record_task_files(valid_dir, ['missing.tsv'])
+            dao.record_task_files(valid_dir, [])
+            self.assertEqual(dao.get_task_files(valid_dir),
+                             set(['edges.tsv', 'clixo', 'missing.tsv']))
+            try:
+                dao.record_task_files(valid_dir, ['../foo'])
+                self.fail('Expected ValueError')
+            except ValueError as e:
+                self.assertTrue('is not directly under' in str(e))
+
+            # file not in manifest keeps directory and manifest
+            task = FileBasedTask(valid_dir, {})
+            self.assertTrue('trying to remove ' in task.delete_task_files())
+            self.assertEqual(sorted(os.listdir(valid_dir)),
+                             [dao.TASK_MANIFEST, 'notlisted'])
+
+            os.unlink(os.path.join(valid_dir, 'notlisted'))
+            self.assertEqual(task.delete_task_files(), None)
+            self.assertFalse(os.path.isdir(valid_dir))
+            # symbolic link was not followed
+            self.assertTrue(os.path.isdir(temp_dir))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_remove_tree(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tree = os.path.join(temp_dir, 'tree')
+            os.makedirs(os.path.join(tree, 'a', 'b'))
+            keep = os.path.join(temp_dir, 'keep')
+            os.makedirs(keep)
+            open(os.path.join(keep, 'x'), 'a').close()
+            open(os.path.join(tree, 'a', 'b', 'c'), 'a').close()
+            open(os.path.join(tree, 'd'), 'a').close()
+            os.symlink(keep, os.path.join(tree, 'a', 'keeplink'))
+            dao.remove_tree(tree)
+            self.assertFalse(os.path.exists(tree))
+            self.assertEqual(os.listdir(keep), ['x'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_orphanedtasksweeper(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            sweeper = OrphanedTaskSweeper(temp_dir, min_age=0)
+            self.assertEqual(sweeper.get_orphaned_taskdirs(), [])
+            self.assertEqual(sweeper.sweep(), 0)
+
+            valid = os.path.join(temp_dir, dao.DONE_STATUS, '1.2.3.4', 'ok')
+            os.makedirs(valid)
+            open(os.path.join(valid, dao.TASK_JSON), 'a').close()
+            orphan = os.path.join(temp_dir, dao.PROCESSING_STATUS,
+                                  '1.2.3.4', 'orphan')
+            os.makedirs(os.path.join(orphan, dao.CHECKPOINT_DIR))
+            open(os.path.join(orphan, dao.RESULT), 'a').close()
+            open(os.path.join(temp_dir, dao.DONE_STATUS, 'somefile'),
+                 'a').close()
+
+            # too new to be removed
+            self.assertEqual(OrphanedTaskSweeper(
+                temp_dir, min_age=3600).get_orphaned_taskdirs(), [])
+            self.assertEqual(sweeper.get_orphaned_taskdirs(), [orphan])
+            self.assertEqual(sweeper.sweep(time_budget=-1), 0)
+            self.assertEqual(sweeper.sweep(), 1)
+            self.assertFalse(os.path.isdir(orphan))
+            self.assertTrue(os.path.isdir(valid))
         finally:
             shutil.rmtree(temp_dir)
 
@@ -308,133 +661,67 @@ class TestDAO(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
-    def test_deletefilebasedtaskfactory_get_task_with_id(self):
-        temp_dir = tempfile.mkdtemp()
-        try:
-            # try where taskdir is not set
-            tfac = DeletedFileBasedTaskFactory(None)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res, None)
-
-            # try with valid taskdir
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res, None)
-
-            # try where we match in submit dir, but match is not
-            # a directory
-            submitfile = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
-                                      '1.2.3.4', 'foo')
-            os.makedirs(os.path.dirname(submitfile), mode=0o755)
-            open(submitfile, 'a').close()
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res, None)
-            os.unlink(submitfile)
-
-            # try where we match in submit dir, but no json file
-            submitdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
-                                     '1.2.3.4', 'foo')
-            os.makedirs(submitdir, mode=0o755)
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res.get_taskdir(), submitdir)
-
-            # try where we match in submit dir and there is a json file
-            taskfile = os.path.join(submitdir,
-                                    dao.TASK_JSON)
-            with open(taskfile, 'w') as f:
-                json.dump({ diseasescope_rest_server.REMOTEIP_PARAM: '1.2.3.4'}, f)
-                f.flush()
-
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res.get_taskdir(), submitdir)
-            self.assertEqual(res.get_ipaddress(), '1.2.3.4')
-
-            # try where loading json file raises exception
-            os.unlink(taskfile)
-            open(taskfile, 'a').close()
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res.get_taskdir(), submitdir)
-            self.assertEqual(res.get_taskdict(), {})
-            shutil.rmtree(submitdir)
-
-            # try where we match in processing dir
-            procdir = os.path.join(temp_dir, dao.PROCESSING_STATUS,
-                                   '4.5.5.5',
-                                   '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            os.makedirs(procdir, mode=0o755)
-            res = tfac._get_task_with_id('02e487ef-79df-4d99-8f22-'
-                                         '1ff1d6d52a2a')
-            self.assertEqual(res.get_taskdir(), procdir)
-            shutil.rmtree(procdir)
-
-            # try where we match in done dir
-            donedir = os.path.join(temp_dir, dao.DONE_STATUS,
-                                   '192.168.5.5',
-                                   '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            os.makedirs(donedir, mode=0o755)
-            res = tfac._get_task_with_id('02e487ef-79df-4d99-8f22-'
-                                         '1ff1d6d52a2a')
-            self.assertEqual(res.get_taskdir(), donedir)
-
-        finally:
-            shutil.rmtree(temp_dir)
-
-    def test_deletefilebasedtaskfactory_get_next_task(self):
+    def test_deletefilebasedtaskfactory_get_next_tasks(self):
         temp_dir = tempfile.mkdtemp()
         try:
             # test where delete request dir is None
             tfac = DeletedFileBasedTaskFactory(None)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
+            self.assertEqual(tfac.get_next_tasks(), [])
 
             # test where delete request dir is not a directory
             tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
+            self.assertEqual(tfac.get_next_tasks(), [])
 
-            # no delete requests found
+            # no delete requests, just a directory
             del_req_dir = os.path.join(temp_dir, dao.DELETE_REQUESTS)
-            os.makedirs(del_req_dir, mode=0o755)
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
-
-            # directory in delete requests dir
-            dir_in_del_dir = os.path.join(del_req_dir, 'uhohadir')
-            os.makedirs(dir_in_del_dir, mode=0o755)
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
-
-            # Found a delete request, but no task found in system
-            a_request = os.path.join(del_req_dir,
-                                     '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            with open(a_request, 'w') as f:
-                f.write('1.2.3.4')
-                f.flush()
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
-            self.assertTrue(not os.path.isfile(a_request))
-
-            # Found a valid request in system
-            a_request = os.path.join(del_req_dir,
-                                     '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            with open(a_request, 'w') as f:
-                f.write('1.2.3.4')
-                f.flush()
-            done_dir = os.path.join(temp_dir, dao.DONE_STATUS,
-                                    '1.2.3.4',
-                                    '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            os.makedirs(done_dir, mode=0o755)
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res.get_taskdir(), done_dir)
-            self.assertEqual(res.get_taskdict(), {})
-            self.assertTrue(not os.path.isfile(a_request))
-
+            os.makedirs(os.path.join(del_req_dir, 'uhohadir'), mode=0o755)
+            self.assertEqual(tfac.get_next_tasks(), [])
+
+            # several requests, only some of which match tasks
+            for taskid in ['t1', 't2', 't3', 'missing']:
+                with open(os.path.join(del_req_dir, taskid), 'w') as f:
+                    f.write('1.2.3.4')
+            t1 = os.path.join(temp_dir, dao.DONE_STATUS, '1.2.3.4', 't1')
+            t2 = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                              '5.6.7.8', 't2')
+            t3 = os.path.join(temp_dir, dao.PROCESSING_STATUS,
+                              '1.2.3.4', 't3')
+            for tdir in [t1, t2, t3]:
+                os.makedirs(tdir, mode=0o755)
+            # task json is not parsed, even if invalid
+            open(os.path.join(t1, dao.TASK_JSON), 'a').close()
+            with open(os.path.join(t2, dao.TASK_JSON), 'w') as f:
+                json.dump({diseasescope_rest_server.REMOTEIP_PARAM:
+                           '5.6.7.8'}, f)
+            # a file matching an id should be ignored
+            open(os.path.join(temp_dir, dao.DONE_STATUS,
+                              '1.2.3.4', 'missing'), 'a').close()
+
+            res = tfac.get_next_tasks()
+            self.assertEqual(sorted([t.get_taskdir() for t in res]),
+                             sorted([t1, t2, t3]))
+            for t in res:
+                self.assertEqual(t.get_taskdict(), {})
+
+            # request for missing task is removed, others remain
+            self.assertFalse(os.path.isfile(os.path.join(del_req_dir,
+                                                         'missing')))
+            self.assertEqual(sorted(tfac.get_delete_request_ids()),
+                             ['t1', 't2', 't3'])
+
+            # test max_tasks
+            self.assertEqual(len(tfac.get_next_tasks(max_tasks=2)), 2)
+
+            self.assertTrue(tfac.has_delete_request('t1'))
+            tfac.remove_delete_request('t1')
+            self.assertFalse(tfac.has_delete_request('t1'))
+            self.assertFalse(tfac.has_delete_request(None))
+            self.assertFalse(DeletedFileBasedTaskFactory(
+                None).has_delete_request('t2'))
+            self.assertEqual(sorted(tfac.get_delete_request_ids()),
+                             ['t2', 't3'])
+
+            # removing an already removed request is fine
+            tfac.remove_delete_request('t1')
         finally:
             shutil.rmtree(temp_dir)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `diseasescope_archivetasks` script."""
+
+import os
+import json
+import time
+import unittest
+import shutil
+import tempfile
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import archive
+from diseasescope_rest_server import diseasescope_archivetasks as da
+
+
+class TestDiseasescopeArchivetasks(unittest.TestCase):
+    """Tests for `diseasescope_archivetasks` script."""
+
+    def test_parse_arguments(self):
+        res = da._parse_arguments('hi', ['/tasks'])
+        self.assertEqual(res.taskdir, '/tasks')
+        self.assertEqual(res.days, 30.0)
+        self.assertEqual(res.batch_size, 100)
+        self.assertEqual(res.shard_width, dao.DEFAULT_SHARD_WIDTH)
+        self.assertEqual(res.time_budget, None)
+
+    def test_main(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            taskdir = os.path.join(temp_dir, dao.DONE_STATUS, '1.2.3.4',
+                                   'abcdef')
+            os.makedirs(taskdir)
+            tjson = os.path.join(taskdir, dao.TASK_JSON)
+            with open(tjson, 'w') as f:
+                json.dump({'result': {}}, f)
+            mtime = time.time() - 2 * archive.DAY_SECONDS
+            os.utime(tjson, (mtime, mtime))
+
+            self.assertEqual(da.main(['archive', temp_dir]), 0)
+            self.assertTrue(os.path.isdir(taskdir))
+            self.assertEqual(da.main(['archive', temp_dir, '--days', '1']), 0)
+            self.assertFalse(os.path.isdir(taskdir))
+            arch = archive.TaskArchive(archive.get_archive_dir(temp_dir))
+            self.assertEqual(arch.get_task('abcdef'),
+                             {'result': {},
+                              dao.STATUS_RESULT_KEY: dao.DONE_STATUS})
+
+            # bad shard width
+            self.assertEqual(da.main(['archive', temp_dir,
+                                      '--shard_width', '0']), 2)
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `diseasescope_benchmark` script."""
+
+import os
+import unittest
+import shutil
+import tempfile
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import diseasescope_benchmark as db
+from diseasescope_rest_server.diseasescope_benchmark import BenchmarkResult
+
+
+class TestDiseasescopeBenchmark(unittest.TestCase):
+    """Tests for `diseasescope_benchmark` script."""
+
+    def test_parse_arguments(self):
+        res = db._parse_arguments('hi', [])
+        self.assertEqual(res.jobs, 20)
+        self.assertEqual(res.workdir, None)
+        self.assertEqual(res.error_rate, 0.0)
+
+    def test_get_percentile(self):
+        self.assertEqual(db.get_percentile([], 50), None)
+        self.assertEqual(db.get_percentile([3], 99), 3)
+        vals = list(range(1, 101))
+        self.assertEqual(db.get_percentile(vals, 50), 50)
+        self.assertEqual(db.get_percentile(vals, 99), 99)
+        self.assertEqual(db.get_percentile(vals, 100), 100)
+
+    def test_benchmarkresult(self):
+        res = BenchmarkResult()
+        res.add_job(2.0, {dao.STATUS_RESULT_KEY: dao.DONE_STATUS,
+                          dao.STAGES_KEY: {'a': {'duration': 300},
+                                           'b': {'duration': 100}}})
+        res.add_job(4.0, {dao.STATUS_RESULT_KEY: dao.ERROR_STATUS})
+        res.set_elapsed(3600.0)
+        report = res.get_report(3)
+        self.assertEqual(report['completed'], 1)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['unfinished'], 1)
+        self.assertEqual(report['jobsPerHour'], 2.0)
+        self.assertEqual(report['timeToResultP50'], 2.0)
+        self.assertEqual(report['timeToResultP99'], 4.0)
+        self.assertEqual(report['stages']['a'], {'duration': 300,
+                                                 'fraction': 0.75})
+        self.assertTrue('jobsPerHour' in db.format_report(report))
+
+    def test_main(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            workdir = os.path.join(temp_dir, 'work')
+            res = db.main(['benchmark', '--workdir', workdir,
+                           '--jobs', '2', '--poll_interval', '0.01',
+                           '--latency', 'clixo=0,biggim=0,biothings=0,'
+                                        'mygene=0,ndex=0',
+                           '--payload_size', '10', '--json'])
+            self.assertEqual(res, 0)
+            self.assertEqual(len(os.listdir(os.path.join(workdir,
+                                                         dao.DONE_STATUS,
+                                                         '127.0.0.1'))), 2)
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `diseasescope_migratelayout` script."""
+
+import os
+import unittest
+import shutil
+import tempfile
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import diseasescope_migratelayout as dm
+
+
+class TestDiseasescopeMigratelayout(unittest.TestCase):
+    """Tests for `diseasescope_migratelayout` script."""
+
+    def test_parse_arguments(self):
+        res = dm._parse_arguments('hi', ['/tasks'])
+        self.assertEqual(res.taskdir, '/tasks')
+        self.assertEqual(res.shard_depth, dao.DEFAULT_SHARD_DEPTH)
+        self.assertEqual(res.shard_width, dao.DEFAULT_SHARD_WIDTH)
+        self.assertEqual(res.states, 'submitted,done')
+        self.assertEqual(res.dry_run, False)
+
+    def test_main(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            taskdir = os.path.join(temp_dir, dao.DONE_STATUS, '1.2.3.4',
+                                   'abcdef')
+            os.makedirs(taskdir)
+            res = dm.main(['migrate', temp_dir, '--dry_run'])
+            self.assertEqual(res, 0)
+            self.assertTrue(os.path.isdir(taskdir))
+
+            res = dm.main(['migrate', temp_dir, '--states', 'done',
+                           '--shard_depth', '1', '--shard_width', '3'])
+            self.assertEqual(res, 0)
+            self.assertTrue(os.path.isdir(os.path.join(temp_dir,
+                                                       dao.DONE_STATUS,
+                                                       'abc', 'abcdef')))
+
+            # bad shard depth
+            self.assertEqual(dm.main(['migrate', temp_dir,
+                                      '--shard_depth', '-1']), 2)
+        finally:
+            shutil.rmtree(temp_dir)
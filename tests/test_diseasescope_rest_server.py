@@ -14,6 +14,8 @@ import re
 from werkzeug.datastructures import FileStorage
 import diseasescope_rest_server
 from diseasescope_rest_server import dao
+from diseasescope_rest_server import estimate
+from diseasescope_rest_server import archive
 from diseasescope_rest_server import ErrorResponse
 
 
@@ -100,6 +102,37 @@ class TestDiseasescope(unittest.TestCase):
                                               basedir=self._temp_dir),
                          theuuid_dir)
 
+    def test_create_and_get_task_sharded(self):
+        config = diseasescope_rest_server.app.config
+        config[diseasescope_rest_server.SHARD_DEPTH_KEY] = 2
+        try:
+            pdict = {}
+            pdict['remoteip'] = '1.2.3.4'
+            pdict[dao.DOID_PARAM] = 1234
+            res = diseasescope_rest_server.create_task(pdict)
+            taskdir = os.path.join(diseasescope_rest_server.get_submit_dir(),
+                                   res[0:2], res[2:4], res)
+            self.assertTrue(os.path.isdir(taskdir))
+            with open(os.path.join(taskdir, dao.TASK_JSON), 'r') as f:
+                self.assertEqual(json.load(f)['remoteip'], '1.2.3.4')
+            self.assertEqual(diseasescope_rest_server.get_task(
+                res, basedir=diseasescope_rest_server.get_submit_dir()),
+                taskdir)
+
+            # tasks stored under address are still found
+            olddir = os.path.join(self._temp_dir, '1.2.3.4', '1234')
+            os.makedirs(olddir, mode=0o755)
+            self.assertEqual(diseasescope_rest_server.get_task(
+                '1234', basedir=self._temp_dir), olddir)
+
+            rv = self._app.get(diseasescope_rest_server.SERVICE_NS + '/' +
+                               res)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(json.loads(rv.data)['status'],
+                             dao.SUBMITTED_STATUS)
+        finally:
+            config[diseasescope_rest_server.SHARD_DEPTH_KEY] = 0
+
     def test_baseurl(self):
         """Test something."""
         rv = self._app.get('/')
@@ -184,6 +217,28 @@ class TestDiseasescope(unittest.TestCase):
         self.assertEqual(jdata['tasktype'], 'diseasescope_ontology')
         self.assertEqual(jdata[dao.DOID_PARAM], 1234)
 
+    def test_post_sets_trace_id(self):
+        tid = '4bf92f3577b34da6a3ce929d0e0e4736'
+        rv = self._app.post(diseasescope_rest_server.SERVICE_NS,
+                            json={dao.DOID_PARAM: 1234},
+                            headers={'traceparent': '00-' + tid +
+                                                    '-00f067aa0ba902b7-01'},
+                            follow_redirects=True)
+        self.assertEqual(rv.status_code, 202)
+        self.assertEqual(rv.headers['X-Trace-Id'], tid)
+        uuidstr = re.sub('^.*/', '', rv.headers['Location'])
+        tpath = diseasescope_rest_server.get_task(
+            uuidstr, basedir=diseasescope_rest_server.get_submit_dir())
+        with open(os.path.join(tpath, dao.TASK_JSON), 'r') as f:
+            self.assertEqual(json.load(f)[dao.TRACE_ID_KEY], tid)
+
+        # new trace id is made if request has none
+        rv = self._app.post(diseasescope_rest_server.SERVICE_NS,
+                            json={dao.DOID_PARAM: 1234},
+                            follow_redirects=True)
+        self.assertEqual(len(rv.headers['X-Trace-Id']), 32)
+        self.assertNotEqual(rv.headers['X-Trace-Id'], tid)
+
     def test_get_status_no_submidir(self):
         rv = self._app.get(diseasescope_rest_server.SERVICE_NS + '/status')
         data = json.loads(rv.data)
@@ -264,8 +319,73 @@ class TestDiseasescope(unittest.TestCase):
                            '/qazxsw')
         data = json.loads(rv.data)
         self.assertEqual('yo', data['task'])
+        self.assertEqual(data[dao.STATUS_RESULT_KEY], dao.ERROR_STATUS)
         self.assertEqual(rv.status_code, 200)
 
+    def test_get_id_sets_status_from_task_state(self):
+        task_dir = os.path.join(self._temp_dir,
+                                dao.PROCESSING_STATUS,
+                                '45.67.54.33', 'qazxsw')
+        os.makedirs(task_dir, mode=0o755)
+        tfile = os.path.join(task_dir, dao.TASK_JSON)
+        with open(tfile, 'w') as f:
+            f.write('{"progress": 50}')
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/qazxsw')
+        data = json.loads(rv.data)
+        self.assertEqual(data[dao.STATUS_RESULT_KEY], dao.PROCESSING_STATUS)
+
+        done_dir = os.path.join(self._temp_dir, dao.DONE_STATUS,
+                                '45.67.54.33')
+        os.makedirs(done_dir, mode=0o755)
+        shutil.move(task_dir, done_dir)
+        with open(os.path.join(done_dir, 'qazxsw', dao.TASK_JSON), 'w') as f:
+            f.write('{"progress": 100, "result": {"hiviewurl": "x"}}')
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/qazxsw')
+        data = json.loads(rv.data)
+        self.assertEqual(data[dao.STATUS_RESULT_KEY], dao.DONE_STATUS)
+
+    def test_get_id_includes_estimate(self):
+        with open(os.path.join(self._temp_dir, estimate.STAGE_MODEL_FILE),
+                  'w') as f:
+            json.dump({'a': {estimate.MODEL_ALL_KEY: {
+                estimate.MODEL_MEAN_KEY: 600000,
+                estimate.MODEL_COUNT_KEY: 1}}}, f)
+        for state, taskid, submit in [(dao.PROCESSING_STATUS, 'p1', 1),
+                                      (dao.SUBMITTED_STATUS, 's1', 2),
+                                      (dao.SUBMITTED_STATUS, 's2', 3)]:
+            task_dir = os.path.join(self._temp_dir, state, '1.2.3.4',
+                                    taskid)
+            os.makedirs(task_dir, mode=0o755)
+            with open(os.path.join(task_dir, dao.TASK_JSON), 'w') as f:
+                json.dump({'submitTime': submit, 'progress': 0}, f)
+
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS + '/s2')
+        data = json.loads(rv.data)
+        self.assertEqual(data[dao.STATUS_RESULT_KEY], dao.SUBMITTED_STATUS)
+        self.assertEqual(data[estimate.QUEUE_POSITION_KEY], 2)
+        self.assertEqual(data[estimate.ESTIMATED_FINISH_TIME_KEY] -
+                         data[estimate.ESTIMATED_START_TIME_KEY], 600000)
+        self.assertEqual(data[estimate.POLL_INTERVAL_KEY], 300000)
+        self.assertEqual(rv.headers['Retry-After'], '300')
+
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS + '/p1')
+        data = json.loads(rv.data)
+        self.assertEqual(data[estimate.QUEUE_POSITION_KEY], 0)
+        self.assertTrue(data[estimate.POLL_INTERVAL_KEY] >= 5000)
+        self.assertTrue('Retry-After' in rv.headers)
+
+        done_dir = os.path.join(self._temp_dir, dao.DONE_STATUS,
+                                '1.2.3.4', 'd1')
+        os.makedirs(done_dir, mode=0o755)
+        with open(os.path.join(done_dir, dao.TASK_JSON), 'w') as f:
+            f.write('{"progress": 100, "result": {"hiviewurl": "x"}}')
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS + '/d1')
+        data = json.loads(rv.data)
+        self.assertFalse(estimate.QUEUE_POSITION_KEY in data)
+        self.assertFalse('Retry-After' in rv.headers)
+
     def test_get_id_found_in_done_status_with_result_file_no_task_file(self):
         task_dir = os.path.join(self._temp_dir,
                                 dao.DONE_STATUS,
@@ -306,5 +426,72 @@ class TestDiseasescope(unittest.TestCase):
         self.assertEqual(data['hello'], 'there')
         self.assertEqual(rv.status_code, 200)
 
+    def test_get_id_found_in_archive(self):
+        task_dir = os.path.join(self._temp_dir,
+                                dao.DONE_STATUS,
+                                '45.67.54.33', 'qazxsw')
+        os.makedirs(task_dir, mode=0o755)
+        resfile = os.path.join(task_dir, dao.RESULT)
+        with open(resfile, 'w') as f:
+            f.write('{ "hello": "there", "result": {}}')
+            f.flush()
+        tfile = os.path.join(task_dir, dao.TASK_JSON)
+        with open(tfile, 'w') as f:
+            f.write('{"task": "yo"}')
+            f.flush()
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/qazxsw')
+        self.assertEqual(rv.status_code, 200)
+
+        archiver = archive.TaskArchiver(self._temp_dir, min_age=-10)
+        self.assertEqual(archiver.archive_tasks(),
+                         {'archived': 1, 'failed': 0})
+        self.assertFalse(os.path.isdir(task_dir))
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/qazxsw')
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data)
+        self.assertEqual(data, {'hello': 'there', 'result': {},
+                                dao.STATUS_RESULT_KEY: dao.DONE_STATUS})
+        self.assertEqual(diseasescope_rest_server.get_task_archive(),
+                         diseasescope_rest_server.get_task_archive())
+
+        # deleted archived task is no longer returned
+        rv = self._app.delete(diseasescope_rest_server.SERVICE_NS +
+                              '/qazxsw')
+        self.assertEqual(rv.status_code, 200)
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/qazxsw')
+        self.assertEqual(rv.status_code, 410)
+
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/missing')
+        self.assertEqual(rv.status_code, 410)
+
+    def test_get_profile(self):
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/qazxsw/profile/' + dao.TASK_JSON)
+        self.assertEqual(rv.status_code, 404)
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/qazxsw/profile/profile.json')
+        self.assertEqual(rv.status_code, 404)
+
+        task_dir = os.path.join(self._temp_dir,
+                                dao.DONE_STATUS,
+                                '45.67.54.33', 'qazxsw')
+        os.makedirs(task_dir, mode=0o755)
+        with open(os.path.join(task_dir, dao.TASK_JSON), 'w') as f:
+            f.write('{"task": "yo"}')
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/qazxsw/profile/profile.json')
+        self.assertEqual(rv.status_code, 404)
+        with open(os.path.join(task_dir, 'profile.json'), 'w') as f:
+            f.write('{"genes": {}}')
+        rv = self._app.get(diseasescope_rest_server.SERVICE_NS +
+                           '/qazxsw/profile/profile.json')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data), {'genes': {}})
+        rv.close()
+
     def test_log_task_json_file_with_none(self):
         self.assertEqual(diseasescope_rest_server.log_task_json_file(None), None)
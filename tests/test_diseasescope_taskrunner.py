@@ -4,19 +4,40 @@
 """Tests for `diseasescope_taskrunner` script."""
 
 import os
+import sys
 import json
+import time
 import unittest
 import shutil
+import logging
 import tempfile
+import threading
 from unittest.mock import MagicMock
-
-import diseasescope_rest_server
+from unittest.mock import patch
+
+import requests
+
+from diseasescope_rest_server import httpsession
+from diseasescope_rest_server import refdata
+from diseasescope_rest_server import scratch
+from diseasescope_rest_server import lease
+from diseasescope_rest_server import metrics
+from diseasescope_rest_server import pipeline
+from diseasescope_rest_server import profiling
+from diseasescope_rest_server import tracing
+from diseasescope_rest_server import estimate
+from diseasescope_rest_server.estimate import StageDurationModel
+from diseasescope_rest_server.profiling import ProfilePolicy
+from diseasescope_rest_server.lease import TaskLeaseManager
+from diseasescope_rest_server.scratch import ScratchSpace
 from diseasescope_rest_server import diseasescope_taskrunner as dt
 from diseasescope_rest_server.dao import FileBasedTask
 from diseasescope_rest_server.dao import FileBasedSubmittedTaskFactory
 from diseasescope_rest_server.dao import DeletedFileBasedTaskFactory
+from diseasescope_rest_server.dao import CoalescingTaskWriter
 from diseasescope_rest_server.diseasescope_taskrunner import Diseasescopetaskrunner
 from diseasescope_rest_server import dao
+from diseasescope.diseasescope import DiseaseScope
 
 class TestDiseasescopetaskrunner(unittest.TestCase):
     """Tests for `diseasescope_taskrunner` package."""
@@ -31,11 +52,18 @@ class TestDiseasescopetaskrunner(unittest.TestCase):
 
     def test_parse_arguments(self):
         """Test something."""
-        res = dt._parse_arguments('hi', ['foo'])
+        res = dt._parse_arguments('hi', ['foo',
+                                         '--doidmappingfile', 'doid',
+                                         '--genesetfile', 'geneset'])
         self.assertEqual(res.taskdir, 'foo')
 
         self.assertEqual(res.wait_time, 30)
         self.assertEqual(res.disabledelete, False)
+        self.assertEqual(res.delete_time_budget, 10.0)
+        self.assertEqual(res.doidmappingfile, 'doid')
+        self.assertEqual(res.genesetfile, 'geneset')
+        self.assertEqual(res.shard_depth, 0)
+        self.assertEqual(res.shard_width, dao.DEFAULT_SHARD_WIDTH)
 
     def test_nbgwastaskrunner_run_tasks_no_work(self):
         mocktaskfac = MagicMock()
@@ -70,232 +98,827 @@ class TestDiseasescopetaskrunner(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
-    def test_nbgwastaskrunner_remove_deleted_task(self):
+    def test_process_task(self):
         temp_dir = tempfile.mkdtemp()
         try:
-            # try where delete task factory is none
+            taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                   '1.2.3.4', 'sometask')
+            os.makedirs(taskdir, mode=0o755)
+            task = FileBasedTask(taskdir, {dao.DOID_PARAM: 1234,
+                                           'submitTime': 1})
             runner = Diseasescopetaskrunner(wait_time=0)
-            self.assertEqual(runner._remove_deleted_task(), False)
+            scope = MagicMock()
+            scope.hiview_url = 'http://hiview'
+            scope.ndex_url = None
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(return_value=scope)
+            runner._process_task(task)
+            self.assertEqual(runner._pipeline.run.call_args[0][0], task)
+            self.assertEqual(task.get_state(), dao.DONE_STATUS)
+            with open(os.path.join(task.get_taskdir(),
+                                   dao.TASK_JSON), 'r') as f:
+                data = json.load(f)
+            self.assertEqual(data['progress'], 100)
+            self.assertEqual(data['result']['hiviewurl'], 'http://hiview')
+            self.assertTrue(data[dao.QUEUE_WAIT_TIME_KEY] > 0)
+            self.assertTrue(data['wallTime'] > 0)
+        finally:
+            shutil.rmtree(temp_dir)
 
-            # try where no task is returned
-            mockfac = MagicMock()
-            mockfac.get_next_task = MagicMock(return_value=None)
+    def test_process_task_cancelled_by_delete_request(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            taskid = '02e487ef-79df-4d99-8f22-1ff1d6d52a2a'
+            taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                   '1.2.3.4', taskid)
+            os.makedirs(taskdir, mode=0o755)
+            task = FileBasedTask(taskdir, {dao.DOID_PARAM: 1234,
+                                           'submitTime': 1})
+            task.save_task()
+            del_req_dir = os.path.join(temp_dir, dao.DELETE_REQUESTS)
+            os.makedirs(del_req_dir, mode=0o755)
+            dfac = DeletedFileBasedTaskFactory(temp_dir)
             runner = Diseasescopetaskrunner(wait_time=0,
-                                      deletetaskfactory=mockfac)
-            res = runner._remove_deleted_task()
-            self.assertEqual(res, False)
-            mockfac.get_next_task.assert_called()
+                                            deletetaskfactory=dfac,
+                                            cancel_poll_interval=0.01,
+                                            watchdog_interval=0.01)
+            monitors = []
+
+            def fake_run(thetask, monitor=None):
+                # delete request arrives while task is running
+                monitors.append(monitor)
+                open(os.path.join(del_req_dir, taskid), 'a').close()
+                monitor.wait_for_cancel(10)
+                monitor.check_cancelled('foo')
+
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(side_effect=fake_run)
+            runner._process_task(task)
+            self.assertFalse(os.path.isdir(task.get_taskdir()))
+            self.assertFalse(dfac.has_delete_request(taskid))
+            self.assertEqual(os.listdir(os.path.join(temp_dir,
+                                                     dao.PROCESSING_STATUS,
+                                                     '1.2.3.4')), [])
+            self.assertEqual(monitors[0].get_cancel_reason(), 'Task deleted')
+        finally:
+            shutil.rmtree(temp_dir)
 
-            # try where task.get_taskdir() is None
-            task = MagicMock()
-            task.get_taskdir = MagicMock(return_value=None)
-            mockfac.get_next_task = MagicMock(return_value=task)
+    def _run_timed_out_task(self, fake_run, **kwargs):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                   '1.2.3.4', 'sometask')
+            os.makedirs(taskdir, mode=0o755)
+            task = FileBasedTask(taskdir, {dao.DOID_PARAM: 1234,
+                                           'submitTime': 1})
             runner = Diseasescopetaskrunner(wait_time=0,
-                                      deletetaskfactory=mockfac)
-            res = runner._remove_deleted_task()
-            self.assertEqual(res, True)
-            mockfac.get_next_task.assert_called()
-            task.get_taskdir.assert_called()
+                                            watchdog_interval=0.01,
+                                            **kwargs)
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(side_effect=fake_run)
+            runner._process_task(task)
+            self.assertEqual(task.get_state(), dao.DONE_STATUS)
+            with open(os.path.join(task.get_taskdir(),
+                                   dao.TASK_JSON), 'r') as f:
+                data = json.load(f)
+            self.assertEqual(runner.get_timed_out_task_count(), 1)
+            return runner, data
+        finally:
+            shutil.rmtree(temp_dir)
 
-            # try where task.delete_task_files() raises Exception
-            task = MagicMock()
-            task.get_taskdir = MagicMock(return_value='/foo')
-            task.delete_task_files = MagicMock(side_effect=Exception('some '
-                                                                     'error'))
-            mockfac.get_next_task = MagicMock(return_value=task)
-            runner = Diseasescopetaskrunner(wait_time=0,
-                                      deletetaskfactory=mockfac)
-            res = runner._remove_deleted_task()
-            self.assertEqual(res, False)
-            mockfac.get_next_task.assert_called()
-            task.get_taskdir.assert_called()
-            task.delete_task_files.assert_called()
-
-            # try with valid task to delete, but delete returns message
-            task = MagicMock()
-            task.get_taskdir = MagicMock(return_value='/foo')
-            task.delete_task_files = MagicMock(return_value='a error')
-            mockfac.get_next_task = MagicMock(return_value=task)
-            runner = Diseasescopetaskrunner(wait_time=0,
-                                      deletetaskfactory=mockfac)
-            res = runner._remove_deleted_task()
-            self.assertEqual(res, True)
-            mockfac.get_next_task.assert_called()
-            task.get_taskdir.assert_called()
-            task.delete_task_files.assert_called()
-
-            # try with valid task to delete
-            task = MagicMock()
-            task.get_taskdir = MagicMock(return_value='/foo')
-            task.delete_task_files = MagicMock(return_value=None)
-            mockfac.get_next_task = MagicMock(return_value=task)
+    def test_process_task_stage_timeout(self):
+        def fake_run(thetask, monitor=None):
+            monitor.stage_started('network')
+            monitor.wait_for_cancel(10)
+            monitor.check_cancelled('network')
+
+        runner, data = self._run_timed_out_task(fake_run,
+                                                stage_timeouts={'network':
+                                                                0.05},
+                                                default_stage_timeout=100)
+        self.assertEqual(data['message'], 'Stage network exceeded '
+                                          'timeout of 0.05 seconds')
+        self.assertTrue(runner.get_stall_time() >= 0.05)
+        registry = metrics.MetricsRegistry(labels={})
+        runner.collect_metrics(registry)
+        self.assertEqual(registry.get_value(metrics.TIMED_OUT_TASKS), 1)
+        self.assertEqual(registry.get_value(metrics.STAGE_STALL_SECONDS),
+                         runner.get_stall_time())
+
+    def test_process_task_task_timeout(self):
+        def fake_run(thetask, monitor=None):
+            monitor.stage_started('genes')
+            monitor.wait_for_cancel(10)
+            monitor.check_cancelled('genes')
+
+        runner, data = self._run_timed_out_task(fake_run, task_timeout=0.05)
+        self.assertEqual(data['message'], 'Task exceeded timeout of 0.05 '
+                                          'seconds in stage genes')
+
+    def test_process_task_pipeline_error(self):
+        runner = Diseasescopetaskrunner(wait_time=0,
+                                        watchdog_interval=0.01)
+        task = MagicMock()
+        task.get_taskdir = MagicMock(return_value='/foo')
+        task.get_taskdict = MagicMock(return_value={})
+        runner._pipeline = MagicMock()
+        runner._pipeline.run = MagicMock(side_effect=ValueError('bad'))
+        try:
+            runner._process_task(task)
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'bad')
+
+    def test_run_tasks_routes_diseasescope_requests(self):
+        orig_get = requests.get
+        session = httpsession.PooledSession()
+        module = sys.modules[DiseaseScope.__module__]
+        module.requests = requests
+        try:
             runner = Diseasescopetaskrunner(wait_time=0,
-                                      deletetaskfactory=mockfac)
-            res = runner._remove_deleted_task()
-            self.assertEqual(res, True)
-            mockfac.get_next_task.assert_called()
-            task.get_taskdir.assert_called()
-            task.delete_task_files.assert_called()
+                                            httpsession=session)
+            runner.run_tasks(keep_looping=lambda: False)
+            self.assertEqual(module.requests.get, session.get)
+            self.assertTrue(requests.get is orig_get)
+        finally:
+            del module.requests
+
+    def test_run_tasks_routes_diseasescope_reference_data(self):
+        temp_dir = tempfile.mkdtemp()
+        module = sys.modules[DiseaseScope.__module__]
+        try:
+            doidfile = os.path.join(temp_dir, 'doid.tsv')
+            with open(doidfile, 'w') as f:
+                f.write('doid\n1\n')
+            ref = refdata.ReferenceData([doidfile])
+            runner = Diseasescopetaskrunner(wait_time=0, doidfile=doidfile,
+                                            referencedata=ref)
+            runner.run_tasks(keep_looping=lambda: False)
+            self.assertEqual(module.open, ref.open)
+            with module.open(doidfile) as f:
+                self.assertEqual(f.read(), 'doid\n1\n')
         finally:
+            if 'open' in module.__dict__:
+                del module.open
             shutil.rmtree(temp_dir)
 
-    def test_deletefilebasedtaskfactory_get_task_with_id(self):
+    def test_run_tasks_processes_tasks_concurrently(self):
         temp_dir = tempfile.mkdtemp()
         try:
-            # try where taskdir is not set
-            tfac = DeletedFileBasedTaskFactory(None)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res, None)
-
-            # try with valid taskdir
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res, None)
-
-            # try where we match in submit dir, but match is not
-            # a directory
-            submitfile = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
-                                      '1.2.3.4', 'foo')
-            os.makedirs(os.path.dirname(submitfile), mode=0o755)
-            open(submitfile, 'a').close()
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res, None)
-            os.unlink(submitfile)
-
-            # try where we match in submit dir, but no json file
-            submitdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
-                                     '1.2.3.4', 'foo')
-            os.makedirs(submitdir, mode=0o755)
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res.get_taskdir(), submitdir)
-
-            # try where we match in submit dir and there is a json file
-            taskfile = os.path.join(submitdir,
-                                    dao.TASK_JSON)
-            with open(taskfile, 'w') as f:
-                json.dump({ diseasescope_rest_server.REMOTEIP_PARAM: '1.2.3.4'}, f)
-                f.flush()
-
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res.get_taskdir(), submitdir)
-            self.assertEqual(res.get_ipaddress(), '1.2.3.4')
-
-            # try where loading json file raises exception
-            os.unlink(taskfile)
-            open(taskfile, 'a').close()
-            res = tfac._get_task_with_id('foo')
-            self.assertEqual(res.get_taskdir(), submitdir)
-            self.assertEqual(res.get_taskdict(), {})
-            shutil.rmtree(submitdir)
-
-            # try where we match in processing dir
-            procdir = os.path.join(temp_dir, dao.PROCESSING_STATUS,
-                                   '4.5.5.5',
-                                   '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            os.makedirs(procdir, mode=0o755)
-            res = tfac._get_task_with_id('02e487ef-79df-4d99-8f22-'
-                                         '1ff1d6d52a2a')
-            self.assertEqual(res.get_taskdir(), procdir)
-            shutil.rmtree(procdir)
-
-            # try where we match in done dir
-            donedir = os.path.join(temp_dir, dao.DONE_STATUS,
-                                   '192.168.5.5',
-                                   '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            os.makedirs(donedir, mode=0o755)
-            res = tfac._get_task_with_id('02e487ef-79df-4d99-8f22-'
-                                         '1ff1d6d52a2a')
-            self.assertEqual(res.get_taskdir(), donedir)
+            for taskid in ['task1', 'task2']:
+                taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                       '1.2.3.4', taskid)
+                os.makedirs(taskdir, mode=0o755)
+                FileBasedTask(taskdir, {dao.DOID_PARAM: 1,
+                                        'submitTime': 1}).save_task()
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01, max_tasks=2,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir))
+            barrier = threading.Barrier(2, timeout=10)
+
+            def fake_run(thetask, monitor=None):
+                # only passes if both tasks are in flight at once
+                barrier.wait()
+                scope = MagicMock()
+                scope.hiview_url = 'http://hiview'
+                scope.ndex_url = None
+                return scope
+
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(side_effect=fake_run)
+            loops = [True, True, False]
+            runner.run_tasks(keep_looping=lambda: loops.pop(0))
+            self.assertEqual(sorted(os.listdir(os.path.join(
+                temp_dir, dao.DONE_STATUS, '1.2.3.4'))), ['task1', 'task2'])
+            self.assertFalse(barrier.broken)
+            self.assertEqual(runner._active_tasks, {})
+        finally:
+            shutil.rmtree(temp_dir)
 
+    def test_run_tasks_with_scratchspace(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                   '1.2.3.4', 'task1')
+            os.makedirs(taskdir, mode=0o755)
+            FileBasedTask(taskdir, {dao.DOID_PARAM: 1,
+                                    'submitTime': 1}).save_task()
+            scratchspace = ScratchSpace(os.path.join(temp_dir, 'scratch'))
+            # left by a runner that crashed
+            stale = os.path.join(temp_dir, 'scratch',
+                                 scratch.RUNNER_DIR_PREFIX + '999999999')
+            os.makedirs(stale)
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                scratchspace=scratchspace,
+                taskwriter=CoalescingTaskWriter(interval=3600))
+            scratchdirs = []
+
+            def fake_run(thetask, monitor=None):
+                scratchdirs.append(thetask.get_scratchdir())
+                for name in ['keep.txt', 'tossed.txt']:
+                    with open(os.path.join(thetask.get_scratchdir(),
+                                           name), 'w') as f:
+                        f.write(name)
+                scope = MagicMock()
+                scope.hiview_url = 'http://hiview'
+                scope.ndex_url = None
+                return scope
+
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(side_effect=fake_run)
+            runner._pipeline.get_artifacts = MagicMock(
+                return_value=['keep.txt', 'missing.txt'])
+            loops = [True, False]
+            runner.run_tasks(keep_looping=lambda: loops.pop(0))
+            self.assertEqual(scratchdirs,
+                             [scratchspace.get_task_scratchdir('task1')])
+            donedir = os.path.join(temp_dir, dao.DONE_STATUS, '1.2.3.4',
+                                   'task1')
+            self.assertEqual(sorted(os.listdir(donedir)),
+                             ['keep.txt', dao.TASK_MANIFEST, dao.TASK_JSON])
+            self.assertEqual(dao.get_task_files(donedir),
+                             set(['keep.txt', 'missing.txt']))
+            self.assertFalse(os.path.isdir(stale))
+            self.assertFalse(os.path.isdir(scratchspace.get_runner_dir()))
+            with open(os.path.join(donedir, dao.TASK_JSON), 'r') as f:
+                self.assertEqual(json.load(f)['progress'], 100)
+            self.assertEqual(runner._taskwriter.get_pending_count(), 0)
         finally:
             shutil.rmtree(temp_dir)
 
-    def test_deletefilebasedtaskfactory_get_next_task(self):
+    def test_run_tasks_with_leases(self):
         temp_dir = tempfile.mkdtemp()
         try:
-            # test where delete request dir is None
-            tfac = DeletedFileBasedTaskFactory(None)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
+            taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                   '1.2.3.4', 'task1')
+            os.makedirs(taskdir, mode=0o755)
+            FileBasedTask(taskdir, {dao.DOID_PARAM: 1,
+                                    'submitTime': 1}).save_task()
+            # left in processing by a runner that died
+            deaddir = os.path.join(temp_dir, dao.PROCESSING_STATUS,
+                                   '1.2.3.4', 'task2')
+            os.makedirs(deaddir, mode=0o755)
+            deadtask = FileBasedTask(deaddir, {dao.DOID_PARAM: 2,
+                                               'submitTime': 1})
+            deadtask.save_task()
+            TaskLeaseManager(temp_dir, lease_time=-1).heartbeat(deadtask)
+
+            manager = TaskLeaseManager(temp_dir, owner='me', lease_time=0.03)
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                leasemanager=manager, recovery_interval=3600, max_tasks=2)
+            leases = []
+
+            def fake_run(thetask, monitor=None):
+                time.sleep(0.1)
+                leases.append(lease.read_lease(thetask.get_taskdir()))
+                scope = MagicMock()
+                scope.hiview_url = 'http://hiview'
+                scope.ndex_url = None
+                return scope
+
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(side_effect=fake_run)
+            loops = [True, True, False]
+            runner.run_tasks(keep_looping=lambda: loops.pop(0))
+
+            # dead task was requeued then processed
+            self.assertEqual(len(leases), 2)
+            for entry in leases:
+                self.assertEqual(entry[lease.LEASE_OWNER_KEY], 'me')
+                self.assertTrue(entry[lease.LEASE_HEARTBEAT_KEY] >
+                                time.time() - 1)
+            donedir = os.path.join(temp_dir, dao.DONE_STATUS, '1.2.3.4')
+            self.assertEqual(sorted(os.listdir(donedir)),
+                             ['task1', 'task2'])
+            for taskid in ['task1', 'task2']:
+                self.assertIsNone(lease.read_lease(os.path.join(donedir,
+                                                                taskid)))
+            with open(os.path.join(donedir, 'task2', dao.TASK_JSON)) as f:
+                self.assertEqual(json.load(f)[lease.RECOVERY_ATTEMPTS_KEY],
+                                 1)
+            # not checked again until interval elapses
+            self.assertEqual(runner._recover_expired_tasks(), (0, 0))
+        finally:
+            shutil.rmtree(temp_dir)
 
-            # test where delete request dir is not a directory
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
+    def _write_submitted_task(self, temp_dir, taskid):
+        taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                               '1.2.3.4', taskid)
+        os.makedirs(taskdir, mode=0o755)
+        FileBasedTask(taskdir, {dao.DOID_PARAM: 1,
+                                'submitTime': 1}).save_task()
+        return taskdir
 
-            # no delete requests found
-            del_req_dir = os.path.join(temp_dir, dao.DELETE_REQUESTS)
-            os.makedirs(del_req_dir, mode=0o755)
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
-
-            # directory in delete requests dir
-            dir_in_del_dir = os.path.join(del_req_dir, 'uhohadir')
-            os.makedirs(dir_in_del_dir, mode=0o755)
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
-
-            # Found a delete request, but no task found in system
-            a_request = os.path.join(del_req_dir,
-                                     '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            with open(a_request, 'w') as f:
-                f.write('1.2.3.4')
-                f.flush()
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res, None)
-            self.assertTrue(not os.path.isfile(a_request))
-
-            # Found a valid request in system
-            a_request = os.path.join(del_req_dir,
-                                     '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            with open(a_request, 'w') as f:
-                f.write('1.2.3.4')
-                f.flush()
-            done_dir = os.path.join(temp_dir, dao.DONE_STATUS,
-                                    '1.2.3.4',
-                                    '02e487ef-79df-4d99-8f22-1ff1d6d52a2a')
-            os.makedirs(done_dir, mode=0o755)
-            tfac = DeletedFileBasedTaskFactory(temp_dir)
-            res = tfac.get_next_task()
-            self.assertEqual(res.get_taskdir(), done_dir)
-            self.assertEqual(res.get_taskdict(), {})
-            self.assertTrue(not os.path.isfile(a_request))
+    def test_request_drain_lets_task_in_flight_finish(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for taskid in ['task1', 'task2']:
+                self._write_submitted_task(temp_dir, taskid)
+            replacement = MagicMock()
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                replacement_factory=replacement)
+            self.assertFalse(runner.is_draining())
+
+            def fake_run(thetask, monitor=None):
+                runner.request_drain(timeout=60, replace=True)
+                time.sleep(0.05)
+                scope = MagicMock()
+                scope.hiview_url = 'http://hiview'
+                scope.ndex_url = None
+                return scope
+
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(side_effect=fake_run)
+            runner.run_tasks()
+            self.assertTrue(runner.is_draining())
+            replacement.assert_called_once_with()
+            # task in flight finished and no other task was claimed
+            self.assertEqual(os.listdir(os.path.join(
+                temp_dir, dao.DONE_STATUS, '1.2.3.4')), ['task1'])
+            self.assertEqual(os.listdir(os.path.join(
+                temp_dir, dao.SUBMITTED_STATUS, '1.2.3.4')), ['task2'])
+        finally:
+            shutil.rmtree(temp_dir)
 
+    def test_run_tasks_replaced_once_stage_pools_exhausted(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for taskid in ['task1', 'task2']:
+                self._write_submitted_task(temp_dir, taskid)
+            replacement = MagicMock()
+            pools = MagicMock()
+            pools.is_exhausted = MagicMock(side_effect=[False, True])
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                stagepools=pools, replacement_factory=replacement)
+
+            def fake_run(thetask, monitor=None):
+                raise pipeline.StagePoolExhaustedError('io pool has 1 '
+                                                       'abandoned stages')
+
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(side_effect=fake_run)
+            runner.run_tasks()
+            self.assertTrue(runner.is_draining())
+            replacement.assert_called_once_with()
+            # task refused by pools is put back, other is not claimed
+            self.assertEqual(sorted(os.listdir(os.path.join(
+                temp_dir, dao.SUBMITTED_STATUS, '1.2.3.4'))),
+                ['task1', 'task2'])
+            self.assertFalse(os.path.isdir(os.path.join(temp_dir,
+                                                        dao.ERROR_STATUS)))
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_request_drain_requeues_task_after_deadline(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._write_submitted_task(temp_dir, 'task1')
+            manager = TaskLeaseManager(temp_dir, owner='me')
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                leasemanager=manager)
+            monitors = []
+
+            def fake_run(thetask, monitor=None):
+                monitors.append(monitor)
+                runner.request_drain(timeout=0)
+                while monitor.is_cancelled() is False:
+                    time.sleep(0.01)
+                raise Exception('cancelled')
+
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(side_effect=fake_run)
+            runner.run_tasks()
+            self.assertTrue(monitors[0].is_cancelled())
+            taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                   '1.2.3.4', 'task1')
+            self.assertTrue(os.path.isdir(taskdir))
+            self.assertIsNone(lease.read_lease(taskdir))
+            self.assertFalse(os.path.isdir(os.path.join(temp_dir,
+                                                        dao.DONE_STATUS)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_tasks_skips_task_claimed_by_another_runner(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            taskdir = self._write_submitted_task(temp_dir, 'task1')
+            task = FileBasedTask(taskdir, {})
+            # another runner claims the task first
+            shutil.move(taskdir, os.path.join(temp_dir, 'elsewhere'))
+            mocktaskfac = MagicMock()
+            mocktaskfac.get_next_task = MagicMock(side_effect=[task, None])
+            runner = Diseasescopetaskrunner(wait_time=0,
+                                            taskfactory=mocktaskfac)
+            loops = [True, True, False]
+            runner.run_tasks(keep_looping=lambda: loops.pop(0))
+            self.assertEqual(runner._active_tasks, {})
+            self.assertFalse(os.path.isdir(os.path.join(temp_dir,
+                                                        dao.DONE_STATUS)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_install_signal_handlers(self):
+        runner = Diseasescopetaskrunner(wait_time=0)
+        previous = dt.install_signal_handlers(runner, 5)
+        try:
+            os.kill(os.getpid(), dt.signal.SIGHUP)
+            time.sleep(0.01)
+            self.assertTrue(runner.is_draining())
+            self.assertTrue(runner._replace)
+            self.assertTrue(runner._drain_deadline <= time.time() + 5)
+        finally:
+            for signum, handler in previous.items():
+                dt.signal.signal(signum, handler)
+
+        runner = Diseasescopetaskrunner(wait_time=0)
+        previous = dt.install_signal_handlers(runner, None)
+        try:
+            os.kill(os.getpid(), dt.signal.SIGTERM)
+            time.sleep(0.01)
+            self.assertTrue(runner.is_draining())
+            self.assertFalse(runner._replace)
+            self.assertIsNone(runner._drain_deadline)
+        finally:
+            for signum, handler in previous.items():
+                dt.signal.signal(signum, handler)
+
+    def test_main_sighup_with_metrics_port_in_use(self):
+        temp_dir = tempfile.mkdtemp()
+        root = logging.getLogger()
+        root_state = (root.level, list(root.handlers))
+        # metrics server of runner being replaced
+        old = metrics.MetricsServer(metrics.MetricsRegistry(), 0)
+        old.start()
+        try:
+            args = ['foo.py', '--wait_time', '0', '--nodaemon',
+                    '--metrics_port', str(old.get_port())]
+            args.extend(self._write_main_files(temp_dir))
+            loops = []
+
+            def keep_looping():
+                loops.append(True)
+                if len(loops) == 1:
+                    os.kill(os.getpid(), dt.signal.SIGHUP)
+                    time.sleep(0.01)
+                return True
+
+            with patch('subprocess.Popen') as mockpopen:
+                self.assertIsNone(dt.main(args + [temp_dir],
+                                          keep_looping=keep_looping))
+                self.assertEqual(mockpopen.call_count, 1)
+                # started where relative paths of arguments resolve
+                self.assertEqual(mockpopen.call_args[1]['cwd'],
+                                 os.getcwd())
+            self.assertTrue(len(loops) >= 1)
+        finally:
+            old.stop()
+            root.setLevel(root_state[0])
+            root.handlers = root_state[1]
+            shutil.rmtree(temp_dir)
+
+    def test_spawn_replacement(self):
+        with patch('subprocess.Popen') as mockpopen:
+            dt.spawn_replacement(['/bin/runner.py', '--nodaemon', 'foo'])
+            mockpopen.assert_called_once_with(
+                [dt.sys.executable, '/bin/runner.py', '--nodaemon', 'foo'],
+                cwd=None, close_fds=True, start_new_session=True)
+        with patch('subprocess.Popen') as mockpopen:
+            dt.spawn_replacement(['/bin/runner.py', 'tasks'], cwd='/home')
+            mockpopen.assert_called_once_with(
+                [dt.sys.executable, '/bin/runner.py', 'tasks'],
+                cwd='/home', close_fds=True, start_new_session=True)
+
+    def test_run_tasks_records_metrics(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._write_submitted_task(temp_dir, 'task1')
+            registry = metrics.MetricsRegistry(labels={})
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01, max_tasks=3,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                stagepools=pipeline.StagePools(io_workers=2, cpu_workers=1),
+                metrics=registry)
+
+            def fake_run(thetask, monitor=None):
+                scope = MagicMock()
+                scope.hiview_url = 'http://hiview'
+                scope.ndex_url = None
+                return scope
+
+            runner._pipeline = MagicMock()
+            runner._pipeline.run = MagicMock(side_effect=fake_run)
+            loops = [True, False]
+            runner.run_tasks(keep_looping=lambda: loops.pop(0))
+            self.assertEqual(registry.get_value(metrics.CLAIM_SECONDS), 1)
+            self.assertEqual(registry.get_value(
+                metrics.QUEUE_WAIT_SECONDS), 1)
+            self.assertEqual(registry.get_value(
+                metrics.TASKS_TOTAL, labels={'outcome': dao.DONE_STATUS}), 1)
+
+            runner.collect_metrics(registry)
+            self.assertEqual(registry.get_value(metrics.TASKS_IN_FLIGHT), 0)
+            self.assertEqual(registry.get_value(metrics.TASK_SLOTS), 3)
+            self.assertEqual(registry.get_value(
+                metrics.STAGE_POOL_WORKERS,
+                labels={'kind': pipeline.IO_STAGE}), 2)
+            self.assertEqual(registry.get_value(
+                metrics.STAGE_POOL_PENDING,
+                labels={'kind': pipeline.CPU_STAGE}), 0)
+            self.assertEqual(registry.get_value(
+                metrics.STAGE_POOL_ABANDONED,
+                labels={'kind': pipeline.IO_STAGE}), 0)
+            self.assertEqual(registry.get_value(metrics.TIMED_OUT_TASKS), 0)
+            self.assertEqual(registry.get_value(
+                metrics.STAGE_STALL_SECONDS), 0)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_tasks_profiles_requested_task(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                   '1.2.3.4', 'task1')
+            os.makedirs(taskdir, mode=0o755)
+            FileBasedTask(taskdir, {dao.DOID_PARAM: 1, 'submitTime': 1,
+                                    dao.PROFILE_PARAM: True}).save_task()
+            self._write_submitted_task(temp_dir, 'task2')
+
+            def run_genes(scope, task):
+                scope.genes = [str(i) for i in range(1000)]
+
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01, max_tasks=2,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                scope_factory=lambda t: MagicMock(hiview_url='http://h',
+                                                  ndex_url=None),
+                stages=[pipeline.PipelineStage('genes', run_genes,
+                                               outputs=['genes'])],
+                profilepolicy=ProfilePolicy())
+            loops = [True, True, False]
+            runner.run_tasks(keep_looping=lambda: loops.pop(0))
+            donedir = os.path.join(temp_dir, dao.DONE_STATUS, '1.2.3.4')
+            self.assertEqual(sorted(os.listdir(os.path.join(donedir,
+                                                            'task1'))),
+                             [dao.TASK_MANIFEST, 'profile.genes.pstats',
+                              profiling.PROFILE_SUMMARY_FILE, dao.TASK_JSON])
+            self.assertEqual(dao.get_task_files(os.path.join(donedir,
+                                                             'task1')),
+                             set([profiling.PROFILE_SUMMARY_FILE,
+                                  'profile.genes.pstats']))
+            with open(os.path.join(donedir, 'task1',
+                                   profiling.PROFILE_SUMMARY_FILE)) as f:
+                self.assertEqual(list(json.load(f).keys()), ['genes'])
+            self.assertEqual(os.listdir(os.path.join(donedir, 'task2')),
+                             [dao.TASK_JSON])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_tasks_records_spans(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            taskdir = os.path.join(temp_dir, dao.SUBMITTED_STATUS,
+                                   '1.2.3.4', 'task1')
+            os.makedirs(taskdir, mode=0o755)
+            tid = tracing.new_trace_id()
+            FileBasedTask(taskdir, {dao.DOID_PARAM: 5, 'submitTime': 1000,
+                                    dao.TRACE_ID_KEY: tid}).save_task()
+            # task created before trace ids were added
+            self._write_submitted_task(temp_dir, 'task2')
+            tracefile = os.path.join(temp_dir, 'spans.json')
+
+            def run_genes(scope, task):
+                self.assertIsNotNone(tracing.get_current_span())
+                scope.genes = ['a']
+
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01, max_tasks=2,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                scope_factory=lambda t: MagicMock(hiview_url='http://h',
+                                                  ndex_url=None),
+                stages=[pipeline.PipelineStage('genes', run_genes,
+                                               outputs=['genes'])],
+                tracer=tracing.Tracer(tracing.FileSpanExporter(tracefile)))
+            loops = [True, True, False]
+            runner.run_tasks(keep_looping=lambda: loops.pop(0))
+            with open(tracefile, 'r') as f:
+                spans = [json.loads(line) for line in f]
+            traces = {}
+            for span in spans:
+                traces.setdefault(span['traceId'], []).append(span)
+            self.assertEqual(len(traces), 2)
+            donedir = os.path.join(temp_dir, dao.DONE_STATUS, '1.2.3.4')
+            with open(os.path.join(donedir, 'task2', dao.TASK_JSON)) as f:
+                self.assertTrue(json.load(f)[dao.TRACE_ID_KEY] in traces)
+
+            byname = {s['name']: s for s in traces[tid]}
+            self.assertEqual(sorted(byname.keys()),
+                             ['claim', 'queue_wait', 'stage genes', 'task'])
+            root = byname['task']
+            self.assertEqual(root['timestamp'], 1000000)
+            self.assertEqual(root['tags']['outcome'], dao.DONE_STATUS)
+            self.assertEqual(root['tags']['taskid'], 'task1')
+            self.assertEqual(root['tags']['doid'], '5')
+            self.assertFalse('parentId' in root)
+            for name in ['claim', 'queue_wait', 'stage genes']:
+                self.assertEqual(byname[name]['parentId'], root['id'])
+            self.assertEqual(byname['queue_wait']['timestamp'], 1000000)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_tasks_records_stage_durations(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._write_submitted_task(temp_dir, 'task1')
+            modelfile = os.path.join(temp_dir, estimate.STAGE_MODEL_FILE)
+
+            def run_genes(scope, task):
+                scope.disease_genes = ['a', 'b']
+
+            def run_network(scope, task):
+                raise Exception('network failed')
+
+            stages = [pipeline.PipelineStage('genes', run_genes,
+                                             outputs=['disease_genes']),
+                      pipeline.PipelineStage('network', lambda s, t: None,
+                                             requires=['genes'])]
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                scope_factory=lambda t: MagicMock(hiview_url='http://h',
+                                                  ndex_url=None),
+                stages=stages,
+                durationmodel=StageDurationModel(modelfile))
+            loops = [True, False]
+            runner.run_tasks(keep_looping=lambda: loops.pop(0))
+            model = StageDurationModel(modelfile)
+            self.assertTrue(model.load())
+            self.assertEqual(model.get_stage_names(), ['genes', 'network'])
+            self.assertIsNotNone(model.get_stage_duration('genes', size=2))
+            self.assertIsNotNone(model.get_remaining_time({}))
+
+            # durations of failed tasks are not recorded
+            self._write_submitted_task(temp_dir, 'task2')
+            stages[1] = pipeline.PipelineStage('network', run_network,
+                                               requires=['genes'])
+            model = MagicMock()
+            runner = Diseasescopetaskrunner(
+                wait_time=0, watchdog_interval=0.01,
+                taskfactory=FileBasedSubmittedTaskFactory(temp_dir),
+                scope_factory=lambda t: MagicMock(hiview_url='http://h',
+                                                  ndex_url=None),
+                stages=stages, durationmodel=model)
+            loops = [True, False]
+            runner.run_tasks(keep_looping=lambda: loops.pop(0))
+            self.assertFalse(model.record_task.called)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_sweep_orphaned_tasks(self):
+        runner = Diseasescopetaskrunner(wait_time=0)
+        self.assertEqual(runner._sweep_orphaned_tasks(), 0)
+        sweeper = MagicMock()
+        sweeper.sweep = MagicMock(side_effect=[2, Exception('boom')])
+        runner = Diseasescopetaskrunner(wait_time=0, sweeper=sweeper,
+                                        sweep_interval=0,
+                                        delete_time_budget=5)
+        self.assertEqual(runner._sweep_orphaned_tasks(), 2)
+        sweeper.sweep.assert_called_with(time_budget=5)
+        self.assertEqual(runner._sweep_orphaned_tasks(), 0)
+
+        # not run again until interval elapses
+        runner = Diseasescopetaskrunner(wait_time=0, sweeper=sweeper,
+                                        sweep_interval=3600)
+        sweeper.sweep = MagicMock(return_value=1)
+        self.assertEqual(runner._sweep_orphaned_tasks(), 1)
+        self.assertEqual(runner._sweep_orphaned_tasks(), 0)
+        self.assertEqual(sweeper.sweep.call_count, 1)
+
+    def test_remove_deleted_tasks_skips_tasks_in_flight(self):
+        task = MagicMock()
+        task.get_task_uuid = MagicMock(return_value='running')
+        dfac = MagicMock()
+        dfac.get_next_tasks = MagicMock(return_value=[task])
+        runner = Diseasescopetaskrunner(wait_time=0, deletetaskfactory=dfac)
+        runner._active_tasks['running'] = MagicMock()
+        self.assertEqual(runner._remove_deleted_tasks(), 0)
+        task.delete_task_files.assert_not_called()
+        dfac.remove_delete_request.assert_not_called()
+
+    def test_create_diseasescope(self):
+        task = FileBasedTask('/foo', {dao.DOID_PARAM: 2841})
+        with patch.object(dt, 'DiseaseScope') as mockscope:
+            runner = Diseasescopetaskrunner(wait_time=0, doidfile='doid',
+                                            genesetfile='geneset')
+            runner._create_diseasescope(task)
+            mockscope.assert_called_once_with(2841, convert_doid=True,
+                                              doid_mapping_file='doid',
+                                              geneset_file='geneset')
+
+    def test_remove_deleted_tasks(self):
+        # try where delete task factory is none
+        runner = Diseasescopetaskrunner(wait_time=0)
+        self.assertEqual(runner._remove_deleted_tasks(), 0)
+
+        # try where factory raises exception
+        mockfac = MagicMock()
+        mockfac.get_next_tasks = MagicMock(side_effect=Exception('error'))
+        runner = Diseasescopetaskrunner(wait_time=0,
+                                        deletetaskfactory=mockfac)
+        self.assertEqual(runner._remove_deleted_tasks(), 0)
+
+        # try where no tasks are returned
+        mockfac.get_next_tasks = MagicMock(return_value=[])
+        self.assertEqual(runner._remove_deleted_tasks(), 0)
+
+        # try with several tasks, one of which fails to delete
+        tasks = []
+        for taskid in ['a', 'b', 'c']:
+            task = MagicMock()
+            task.get_taskdir = MagicMock(return_value='/foo/' + taskid)
+            task.get_task_uuid = MagicMock(return_value=taskid)
+            task.delete_task_files = MagicMock(return_value=None)
+            tasks.append(task)
+        tasks[1].delete_task_files = MagicMock(side_effect=Exception('x'))
+        tasks[2].delete_task_files = MagicMock(return_value='a error')
+        mockfac.get_next_tasks = MagicMock(return_value=tasks)
+        mockfac.remove_delete_request = MagicMock()
+        self.assertEqual(runner._remove_deleted_tasks(), 3)
+        for task in tasks:
+            task.delete_task_files.assert_called_once_with()
+        self.assertEqual(mockfac.remove_delete_request.call_count, 3)
+
+        # try where time budget is exceeded
+        mockfac.remove_delete_request = MagicMock()
+        runner = Diseasescopetaskrunner(wait_time=0,
+                                        deletetaskfactory=mockfac,
+                                        delete_time_budget=-1)
+        self.assertEqual(runner._remove_deleted_tasks(), 0)
+        mockfac.remove_delete_request.assert_not_called()
+
+    def _write_main_files(self, temp_dir):
+        """
+        Writes logging configuration and reference files needed
+        by :py:func:`dt.main`
+        :return: list of arguments setting those files
+        """
+        logconfig = os.path.join(temp_dir, 'logging.conf')
+        with open(logconfig, 'w') as f:
+            f.write('[loggers]\nkeys=root\n\n'
+                    '[handlers]\nkeys=null\n\n'
+                    '[formatters]\nkeys=\n\n'
+                    '[logger_root]\nlevel=CRITICAL\nhandlers=null\n\n'
+                    '[handler_null]\nclass=NullHandler\nargs=()\n')
+        doidfile = os.path.join(temp_dir, 'doid')
+        genesetfile = os.path.join(temp_dir, 'geneset')
+        for path in [doidfile, genesetfile]:
+            open(path, 'a').close()
+        return ['--logconfig', logconfig, '--doidmappingfile', doidfile,
+                '--genesetfile', genesetfile]
+
     def test_main(self):
         temp_dir = tempfile.mkdtemp()
+        root = logging.getLogger()
+        root_state = (root.level, list(root.handlers))
         try:
+            args = ['foo.py', '--wait_time', '0', '--nodaemon']
+            args.extend(self._write_main_files(temp_dir))
+
             # test no work and disable delete true
             loop = MagicMock()
             loop.side_effect = [True, True, False]
-            dt.main(['foo.py', '--wait_time', '0',
-                     '--nodaemon',
-                     temp_dir],
-                    keep_looping=loop)
+            self.assertIsNone(dt.main(args + [temp_dir], keep_looping=loop))
+            self.assertEqual(loop.call_count, 3)
 
             # test no work and disable delete false
             loop = MagicMock()
             loop.side_effect = [True, True, False]
-            dt.main(['foo.py', '--wait_time', '0',
-                     '--nodaemon',
-                     '--disabledelete',
-                     temp_dir],
-                    keep_looping=loop)
+            self.assertIsNone(dt.main(args + ['--disabledelete', temp_dir],
+                                      keep_looping=loop))
+            self.assertEqual(loop.call_count, 3)
 
             # test exception catch works
             loop = MagicMock()
             loop.side_effect = Exception('some error')
-            dt.main(['foo.py', '--wait_time', '0',
-                     '--nodaemon',
-                     temp_dir],
-                    keep_looping=loop)
+            self.assertEqual(dt.main(args + [temp_dir], keep_looping=loop),
+                             2)
+
+            # missing reference file fails at startup
+            loop = MagicMock()
+            self.assertEqual(dt.main(args + ['--doidmappingfile', 'nope',
+                                             temp_dir],
+                                     keep_looping=loop), 2)
+            self.assertEqual(loop.call_count, 0)
         finally:
+            root.setLevel(root_state[0])
+            root.handlers = root_state[1]
             shutil.rmtree(temp_dir)
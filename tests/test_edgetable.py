@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `edgetable` module."""
+
+import os
+import unittest
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from diseasescope_rest_server import edgetable
+from diseasescope_rest_server.edgetable import EdgeTable
+
+
+class TestEdgeTable(unittest.TestCase):
+    """Tests for `edgetable` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def _get_dataframe(self):
+        return pd.DataFrame({'Gene1': ['10', '20', '30', '10'],
+                             'Gene2': ['20', '30', '40', '40'],
+                             'mean': [0.5, 0.25, 0.1, 1.0],
+                             'note': ['a', 'b', 'c', 'd']})
+
+    def test_from_dataframe(self):
+        table = EdgeTable.from_dataframe(self._get_dataframe())
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table.get_number_of_nodes(), 4)
+        self.assertEqual(list(table.get_symbols()), ['10', '20', '30', '40'])
+        self.assertEqual(table.get_sources().dtype, np.int32)
+        self.assertEqual(list(table.get_sources()), [0, 1, 2, 0])
+        self.assertEqual(list(table.get_targets()), [1, 2, 3, 3])
+        self.assertEqual(table.get_attribute_names(), ['mean'])
+        self.assertEqual(table.get_attribute('mean').dtype, np.float32)
+        self.assertEqual(table.get_columns(), ('Gene1', 'Gene2'))
+        self.assertTrue(table.get_nbytes() > 0)
+
+    def test_from_dataframe_pandas_dtypes(self):
+        df = pd.DataFrame({'Gene1': pd.array(['10', '20'], dtype='string'),
+                           'Gene2': pd.array(['20', '30'], dtype='string'),
+                           'count': pd.array([1, None], dtype='Int64'),
+                           'flag': [True, False],
+                           'note': pd.array(['a', 'b'], dtype='string')})
+        table = EdgeTable.from_dataframe(df)
+        self.assertEqual(list(table.get_symbols()), ['10', '20', '30'])
+        self.assertEqual(list(table.get_targets()), [1, 2])
+        self.assertEqual(table.get_attribute_names(), ['count'])
+        self.assertEqual(table.get_attribute('count')[0], 1.0)
+        self.assertTrue(np.isnan(table.get_attribute('count')[1]))
+
+    def test_to_dataframe(self):
+        table = EdgeTable.from_dataframe(self._get_dataframe())
+        df = table.to_dataframe()
+        self.assertEqual(list(df.columns), ['Gene1', 'Gene2', 'mean'])
+        self.assertEqual(list(df['Gene1']), ['10', '20', '30', '10'])
+        self.assertEqual(list(df['Gene2']), ['20', '30', '40', '40'])
+        self.assertTrue(np.allclose(df['mean'], [0.5, 0.25, 0.1, 1.0]))
+
+    def test_rename_nodes(self):
+        table = EdgeTable.from_dataframe(self._get_dataframe())
+        try:
+            table.rename_nodes(['A'])
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Expected 4 symbols, got 1')
+
+        # 30 has no new name and 20 and 40 are merged
+        res = table.rename_nodes(['A', 'B', None, 'B'])
+        self.assertEqual(list(res.get_symbols()), ['A', 'B'])
+        df = res.to_dataframe()
+        self.assertEqual(list(df['Gene1']), ['A', 'A'])
+        self.assertEqual(list(df['Gene2']), ['B', 'B'])
+        self.assertTrue(np.allclose(df['mean'], [0.5, 1.0]))
+
+    def test_node_dataframe(self):
+        table = EdgeTable.from_dataframe(self._get_dataframe())
+        nodes = table.get_node_dataframe()
+        self.assertEqual(list(nodes['Gene1']), ['10', '20', '30', '40'])
+
+        # rename and drop a row as convert_edge_table_names does
+        nodes = nodes[nodes['Gene1'] != '30'].copy()
+        for c in ['Gene1', 'Gene2']:
+            nodes[c] = 'SYM' + nodes[c]
+        self.assertEqual(list(table.get_symbols_from_node_dataframe(nodes)),
+                         ['SYM10', 'SYM20', None, 'SYM40'])
+
+        # columns that disagree or unknown ids are rejected
+        bad = nodes.copy()
+        bad['Gene2'] = 'x'
+        self.assertIsNone(table.get_symbols_from_node_dataframe(bad))
+        bad = nodes.copy()
+        bad.index = [0, 1, 7]
+        self.assertIsNone(table.get_symbols_from_node_dataframe(bad))
+        self.assertIsNone(table.get_symbols_from_node_dataframe(None))
+
+    def test_write_tsv(self):
+        table = EdgeTable.from_dataframe(self._get_dataframe())
+        path = os.path.join(self._temp_dir, 'edges.tsv')
+        table.write_tsv(path, 'mean')
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), '10\t20\t0.5\n20\t30\t0.25\n'
+                                       '30\t40\t0.1\n10\t40\t1.0\n')
+
+    def test_save_and_load(self):
+        table = EdgeTable.from_dataframe(self._get_dataframe())
+        path = os.path.join(self._temp_dir, 'network.edges')
+        table.save(path)
+        # saving again replaces existing table
+        table.save(path)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+        self.assertTrue(edgetable.get_size_of_directory(path) > 0)
+
+        loaded = EdgeTable.load(path)
+        self.assertFalse(loaded.get_sources().flags.writeable)
+        self.assertEqual(loaded.get_checksum(), table.get_checksum())
+        self.assertEqual(loaded.get_columns(), ('Gene1', 'Gene2'))
+        self.assertTrue(loaded.to_dataframe().equals(table.to_dataframe()))
+
+        loaded = EdgeTable.load(path, mmap=False)
+        self.assertTrue(loaded.get_sources().flags.writeable)
+        self.assertEqual(loaded.get_checksum(), table.get_checksum())
+
+    def test_load_truncated(self):
+        table = EdgeTable.from_dataframe(self._get_dataframe())
+        path = os.path.join(self._temp_dir, 'network.edges')
+        table.save(path)
+        np.save(os.path.join(path, edgetable.TARGETS_FILE),
+                np.zeros(2, dtype=np.int32))
+        try:
+            EdgeTable.load(path)
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertTrue('expected 4 edges, found 2' in str(e))
+
+    def test_get_checksum(self):
+        table = EdgeTable.from_dataframe(self._get_dataframe())
+        renamed = table.rename_nodes(['A', 'B', 'C', 'D'])
+        self.assertNotEqual(table.get_checksum(), renamed.get_checksum())
+        self.assertEqual(table.get_checksum(),
+                         EdgeTable.from_dataframe(
+                             self._get_dataframe()).get_checksum())
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `estimate` module."""
+
+import os
+import json
+import unittest
+import shutil
+import tempfile
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import estimate
+from diseasescope_rest_server.estimate import StageDurationModel
+from diseasescope_rest_server.estimate import TaskQueueIndex
+from diseasescope_rest_server.estimate import QueueEstimator
+from diseasescope_rest_server.pipeline import PipelineStage
+
+
+def _get_taskdict(stages, genes=None):
+    entries = {}
+    for name, timing in stages.items():
+        entries[name] = dict(timing)
+        if genes is not None:
+            entries[name]['outputSize'] = {estimate.GENE_SET_ATTR: genes}
+    return {dao.STAGES_KEY: entries}
+
+
+class TestEstimate(unittest.TestCase):
+    """Tests for `estimate` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def _write_task(self, state, taskid, taskdict):
+        taskdir = os.path.join(self._temp_dir, state, '1.2.3.4', taskid)
+        os.makedirs(taskdir)
+        with open(os.path.join(taskdir, dao.TASK_JSON), 'w') as f:
+            json.dump(taskdict, f)
+        return taskdir
+
+    def _get_model(self):
+        model = StageDurationModel()
+        model.set_stages([PipelineStage('a', None),
+                          PipelineStage('b', None),
+                          PipelineStage('c', None, requires=['a', 'b'])])
+        model.record_task(_get_taskdict({'a': {'duration': 1000},
+                                         'b': {'duration': 3000},
+                                         'c': {'duration': 2000}}))
+        return model
+
+    def test_get_gene_set_size(self):
+        self.assertIsNone(estimate.get_gene_set_size(None))
+        self.assertIsNone(estimate.get_gene_set_size({}))
+        self.assertIsNone(estimate.get_gene_set_size(
+            _get_taskdict({'a': {'duration': 1}})))
+        taskdict = _get_taskdict({'a': {}}, genes=10)
+        taskdict[dao.STAGES_KEY]['b'] = {
+            'outputSize': {estimate.GENE_SET_ATTR: 40}}
+        self.assertEqual(estimate.get_gene_set_size(taskdict), 40)
+
+    def test_model_rolling_mean(self):
+        model = StageDurationModel(alpha=0.5, buckets=(100,),
+                                   min_samples=2)
+        self.assertIsNone(model.get_stage_duration('a'))
+        model.record_task(None)
+        model.record_task({dao.STAGES_KEY: {'a': {'duration': 100},
+                                            'b': {'startTime': 5}}})
+        model.record_task({dao.STAGES_KEY: {'a': {'duration': 300}}})
+        # plain average until 1/alpha durations then weighted
+        self.assertEqual(model.get_stage_duration('a'), 200)
+        model.record_task({dao.STAGES_KEY: {'a': {'duration': 400}}})
+        self.assertEqual(model.get_stage_duration('a'), 300)
+        # cached stages are not counted
+        model.record_task({dao.STAGES_KEY: {'a': {'duration': 0,
+                                                  'cached': True}}})
+        self.assertEqual(model.get_stage_duration('a'), 300)
+        self.assertEqual(model.get_stage_names(), ['a'])
+
+        # size group used once it has min_samples durations
+        model.record_task(_get_taskdict({'a': {'duration': 1000}},
+                                        genes=500))
+        self.assertEqual(model.get_stage_duration('a', size=500), 650)
+        model.record_task(_get_taskdict({'a': {'duration': 2000}},
+                                        genes=500))
+        self.assertEqual(model.get_stage_duration('a', size=500), 1500)
+        self.assertEqual(model.get_stage_duration('a', size=5), 1325)
+
+    def test_model_save_and_load(self):
+        path = os.path.join(self._temp_dir, estimate.STAGE_MODEL_FILE)
+        model = StageDurationModel(path)
+        self.assertFalse(model.load())
+        model.set_stages([PipelineStage('a', None),
+                          PipelineStage('b', None, requires=['a'])])
+        model.record_task(_get_taskdict({'a': {'duration': 10}}))
+        self.assertEqual(os.listdir(self._temp_dir),
+                         [estimate.STAGE_MODEL_FILE])
+
+        other = StageDurationModel(path)
+        self.assertTrue(other.load())
+        self.assertFalse(other.load())
+        self.assertEqual(other.get_stage_duration('a'), 10)
+        self.assertEqual(other.get_stage_names(), ['a', 'b'])
+
+        # requires are kept when model is reloaded before update
+        other.record_task(_get_taskdict({'b': {'duration': 20}}))
+        model.record_task(_get_taskdict({'a': {'duration': 30}}))
+        with open(path, 'r') as f:
+            data = json.load(f)
+        self.assertEqual(data['b'][estimate.MODEL_REQUIRES_KEY], ['a'])
+        self.assertEqual(data['b'][estimate.MODEL_ALL_KEY],
+                         {estimate.MODEL_MEAN_KEY: 20,
+                          estimate.MODEL_COUNT_KEY: 1})
+        self.assertEqual(data['a'][estimate.MODEL_ALL_KEY],
+                         {estimate.MODEL_MEAN_KEY: 20,
+                          estimate.MODEL_COUNT_KEY: 2})
+
+        with open(path, 'w') as f:
+            f.write('{bad')
+        self.assertFalse(StageDurationModel(path).load())
+
+    def test_get_remaining_time(self):
+        model = self._get_model()
+        self.assertIsNone(StageDurationModel().get_remaining_time({}))
+        # c waits for longer of a and b
+        self.assertEqual(model.get_remaining_time({}, now=0), 5000)
+        self.assertEqual(model.get_remaining_time(None, now=0), 5000)
+        taskdict = _get_taskdict({'a': {'startTime': 0, 'duration': 1000},
+                                  'b': {'startTime': 500}})
+        self.assertEqual(model.get_remaining_time(taskdict, now=1500),
+                         4000)
+        # running stage past its expected duration
+        self.assertEqual(model.get_remaining_time(taskdict, now=9000),
+                         2000)
+
+        # stage with no durations
+        model.set_stages([PipelineStage('d', None, requires=['c'])])
+        self.assertIsNone(model.get_remaining_time({}, now=0))
+
+    def test_get_remaining_time_without_stages(self):
+        model = StageDurationModel()
+        model.record_task(_get_taskdict({'a': {'duration': 1000},
+                                         'b': {'duration': 3000}}))
+        self.assertEqual(model.get_remaining_time({}, now=0), 4000)
+
+    def test_task_queue_index(self):
+        index = TaskQueueIndex(self._temp_dir, ttl=3600)
+        self.assertTrue(index.refresh())
+        self.assertEqual(index.get_tasks(dao.SUBMITTED_STATUS), [])
+        self._write_task(dao.SUBMITTED_STATUS, 'b', {'submitTime': 2})
+        self._write_task(dao.SUBMITTED_STATUS, 'a', {'submitTime': 3})
+        self._write_task(dao.SUBMITTED_STATUS, 'c', {'submitTime': 1})
+        taskdir = self._write_task(dao.PROCESSING_STATUS, 'd',
+                                   {'submitTime': 0})
+        os.makedirs(os.path.join(self._temp_dir, dao.SUBMITTED_STATUS,
+                                 '1.2.3.4', 'nojson'))
+        with open(os.path.join(self._temp_dir, dao.SUBMITTED_STATUS,
+                               'notadir'), 'w') as f:
+            f.write('x')
+        self.assertFalse(index.refresh())
+        self.assertTrue(index.refresh(force=True))
+        self.assertEqual([t[0] for t in
+                          index.get_tasks(dao.SUBMITTED_STATUS)],
+                         ['c', 'b', 'a'])
+        self.assertEqual(index.get_tasks(dao.PROCESSING_STATUS),
+                         [('d', {'submitTime': 0})])
+
+        shutil.rmtree(taskdir)
+        self.assertTrue(index.refresh(force=True))
+        self.assertEqual(index.get_tasks(dao.PROCESSING_STATUS), [])
+
+    def test_estimate_unknown_durations(self):
+        estimator = QueueEstimator(self._temp_dir, default_poll=30)
+        self._write_task(dao.SUBMITTED_STATUS, 'a', {'submitTime': 1})
+        res = estimator.get_estimate('a', dao.SUBMITTED_STATUS, now=1000)
+        self.assertEqual(res, {estimate.QUEUE_POSITION_KEY: 1,
+                               estimate.ESTIMATED_START_TIME_KEY: 1000,
+                               estimate.ESTIMATED_FINISH_TIME_KEY: None,
+                               estimate.POLL_INTERVAL_KEY: 5000})
+
+        res = estimator.get_estimate('b', dao.PROCESSING_STATUS,
+                                     taskdict={}, now=1000)
+        self.assertEqual(res, {estimate.QUEUE_POSITION_KEY: 0,
+                               estimate.ESTIMATED_START_TIME_KEY: 1000,
+                               estimate.ESTIMATED_FINISH_TIME_KEY: None,
+                               estimate.POLL_INTERVAL_KEY: 30000})
+
+    def test_estimate(self):
+        model = self._get_model()
+        index = TaskQueueIndex(self._temp_dir, ttl=0)
+        estimator = QueueEstimator(self._temp_dir, index=index,
+                                   model=model, slots=2, min_poll=1,
+                                   max_poll=3600)
+        self._write_task(dao.PROCESSING_STATUS, 'p1', _get_taskdict(
+            {'a': {'startTime': 100000, 'duration': 1000},
+             'b': {'startTime': 100000, 'duration': 3000},
+             'c': {'startTime': 103000}}))
+        for taskid, submit in [('s1', 1), ('s2', 2), ('s3', 3)]:
+            self._write_task(dao.SUBMITTED_STATUS, taskid,
+                             {'submitTime': submit})
+        now = 104000
+
+        # p1 finishes at 105000, s1 takes free slot
+        res = estimator.get_estimate('p1', dao.PROCESSING_STATUS, now=now)
+        self.assertEqual(res, {estimate.QUEUE_POSITION_KEY: 0,
+                               estimate.ESTIMATED_START_TIME_KEY: 100000,
+                               estimate.ESTIMATED_FINISH_TIME_KEY: 105000,
+                               estimate.POLL_INTERVAL_KEY: 1000})
+        res = estimator.get_estimate('s1', dao.SUBMITTED_STATUS, now=now)
+        self.assertEqual(res[estimate.QUEUE_POSITION_KEY], 1)
+        self.assertEqual(res[estimate.ESTIMATED_START_TIME_KEY], now)
+        self.assertEqual(res[estimate.ESTIMATED_FINISH_TIME_KEY], 109000)
+        self.assertEqual(res[estimate.POLL_INTERVAL_KEY], 1000)
+        res = estimator.get_estimate('s2', dao.SUBMITTED_STATUS, now=now)
+        self.assertEqual(res[estimate.QUEUE_POSITION_KEY], 2)
+        self.assertEqual(res[estimate.ESTIMATED_START_TIME_KEY], 105000)
+        self.assertEqual(res[estimate.ESTIMATED_FINISH_TIME_KEY], 110000)
+        res = estimator.get_estimate('s3', dao.SUBMITTED_STATUS, now=now)
+        self.assertEqual(res[estimate.QUEUE_POSITION_KEY], 3)
+        self.assertEqual(res[estimate.ESTIMATED_START_TIME_KEY], 109000)
+        self.assertEqual(res[estimate.ESTIMATED_FINISH_TIME_KEY], 114000)
+        self.assertEqual(res[estimate.POLL_INTERVAL_KEY], 1250)
+
+        # task not yet in index goes to end of queue
+        res = estimator.get_estimate('s4', dao.SUBMITTED_STATUS,
+                                     taskdict={}, now=now)
+        self.assertEqual(res[estimate.QUEUE_POSITION_KEY], 4)
+        self.assertEqual(res[estimate.ESTIMATED_START_TIME_KEY], 110000)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `fakeservices` module."""
+
+import unittest
+
+import requests
+
+from diseasescope_rest_server import fakeservices
+from diseasescope_rest_server.fakeservices import FakeServices
+from diseasescope_rest_server.fakeservices import FakeServiceSettings
+from diseasescope_rest_server.fakeservices import FakeDiseaseScope
+from diseasescope_rest_server.httpsession import PooledSession
+
+
+class TestFakeservices(unittest.TestCase):
+    """Tests for `fakeservices` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._services = FakeServices(settings={
+            fakeservices.BIOTHINGS_SERVICE: FakeServiceSettings(
+                payload_size=5),
+            fakeservices.NDEX_SERVICE: FakeServiceSettings(error_rate=1.0)
+        }, seed=1)
+        self._services.start()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self._services.stop()
+
+    def test_requests(self):
+        url = self._services.get_url(fakeservices.BIOTHINGS_SERVICE)
+        self.assertTrue(url.startswith('http://127.0.0.1:'))
+        resp = requests.get(url + '/disease/1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), {'items': [0, 1, 2, 3, 4]})
+
+        resp = requests.post(self._services.get_url(
+            fakeservices.NDEX_SERVICE) + '/network', json={'a': 1})
+        self.assertEqual(resp.status_code, 503)
+
+        # services not configured use default settings
+        resp = requests.get(self._services.get_url(
+            fakeservices.BIGGIM_SERVICE))
+        self.assertEqual(len(resp.json()['items']), 100)
+        self.assertEqual(self._services.get_request_count(
+            fakeservices.BIOTHINGS_SERVICE), 1)
+        self.assertEqual(self._services.get_request_count(
+            fakeservices.CLIXO_SERVICE), 0)
+
+    def test_fakediseasescope(self):
+        self._services.get_settings(fakeservices.NDEX_SERVICE).error_rate = 0
+        scope = FakeDiseaseScope(2841, self._services)
+        scope.get_disease_genes()
+        self.assertEqual(scope.disease_genes, ['0', '1', '2', '3', '4'])
+        scope.get_disease_tissues(n=2)
+        self.assertEqual(scope.tissues, ['tissue0', 'tissue1'])
+        scope.expand_gene_set()
+        self.assertEqual(len(scope.disease_genes), 105)
+        scope.get_network()
+        self.assertEqual(len(scope.network), 100)
+        scope.convert_edge_table_names(['Gene1', 'Gene2'], 'entrezgene',
+                                       'symbol')
+        self.assertTrue(scope.network['Gene1'][0].startswith('SYM'))
+        scope.infer_hierarchical_model()
+        self.assertEqual(scope.hiview_url, self._services.get_url(
+            fakeservices.HIVIEW_SERVICE) + '/100')
+
+    def test_fakediseasescope_with_session(self):
+        session = PooledSession(retries=0)
+        scope = FakeDiseaseScope(2841, self._services, session=session)
+        scope.get_disease_genes()
+        self.assertEqual(scope.disease_genes, ['0', '1', '2', '3', '4'])
+        self.assertEqual(session.get_request_count(), 1)
+
+    def test_fakediseasescope_service_error(self):
+        scope = FakeDiseaseScope(2841, self._services)
+        scope.network = []
+        try:
+            scope.infer_hierarchical_model()
+            self.fail('Expected HTTPError')
+        except requests.exceptions.HTTPError:
+            pass
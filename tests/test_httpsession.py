@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `httpsession` module."""
+
+import time
+import types
+import unittest
+from unittest.mock import MagicMock
+
+import requests
+from requests.adapters import BaseAdapter
+
+from diseasescope_rest_server import httpsession
+from diseasescope_rest_server import metrics
+from diseasescope_rest_server import tracing
+from diseasescope_rest_server.metrics import MetricsRegistry
+from diseasescope_rest_server.httpsession import CircuitBreaker
+from diseasescope_rest_server.httpsession import CircuitOpenError
+from diseasescope_rest_server.httpsession import JitterRetry
+from diseasescope_rest_server.httpsession import PooledSession
+
+
+class FakeAdapter(BaseAdapter):
+    """Adapter returning preset status codes or raising errors"""
+    def __init__(self, results):
+        super(FakeAdapter, self).__init__()
+        self.results = results
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append((request, kwargs))
+        res = self.results.pop(0)
+        if isinstance(res, Exception):
+            raise res
+        resp = requests.Response()
+        resp.status_code = res
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+class TestHttpsession(unittest.TestCase):
+    """Tests for `httpsession` module."""
+
+    def test_jitterretry(self):
+        retry = JitterRetry(total=5, backoff_factor=1)
+        self.assertEqual(retry.get_backoff_time(), 0)
+        for i in range(3):
+            retry = retry.increment(method='GET', url='/')
+        for i in range(20):
+            backoff = retry.get_backoff_time()
+            self.assertTrue(0 <= backoff <= 4)
+
+    def test_circuitbreaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        self.assertEqual(breaker.get_state(), CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.get_state(), CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.get_state(), CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+        # after reset timeout only one trial request is allowed
+        breaker._opened_time = time.time() - 61
+        self.assertEqual(breaker.get_state(), CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.get_state(), CircuitBreaker.OPEN)
+
+        breaker._opened_time = time.time() - 61
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.get_state(), CircuitBreaker.CLOSED)
+
+    def test_pooledsession_adapter(self):
+        session = PooledSession(retries=3, backoff_factor=0.1,
+                                pool_size=4)
+        adapter = session.get_adapter('https://biothings.io')
+        self.assertTrue(isinstance(adapter.max_retries, JitterRetry))
+        self.assertEqual(adapter.max_retries.total, 3)
+        self.assertEqual(adapter.max_retries.backoff_factor, 0.1)
+        self.assertTrue(502 in adapter.max_retries.status_forcelist)
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+    def test_pooledsession_request(self):
+        session = PooledSession(timeout=(1, 2), failure_threshold=2)
+        adapter = FakeAdapter([200, 503, requests.exceptions.ConnectionError(
+            'down'), 200])
+        session.mount('http://', adapter)
+        self.assertEqual(session.get('http://foo/a').status_code, 200)
+        self.assertEqual(adapter.requests[0][1]['timeout'], (1, 2))
+        self.assertEqual(session.get('http://foo/a',
+                                     timeout=5).status_code, 503)
+        self.assertEqual(adapter.requests[1][1]['timeout'], 5)
+        try:
+            session.get('http://foo/b')
+            self.fail('Expected ConnectionError')
+        except requests.exceptions.ConnectionError as e:
+            self.assertFalse(isinstance(e, CircuitOpenError))
+        self.assertEqual(session.get_circuit_states(),
+                         {'foo': CircuitBreaker.OPEN})
+
+        # circuit of host is open, request is not sent
+        try:
+            session.get('http://foo/c')
+            self.fail('Expected CircuitOpenError')
+        except CircuitOpenError as e:
+            self.assertEqual(str(e), 'Circuit open for foo '
+                                     'rejecting request')
+        self.assertEqual(len(adapter.requests), 3)
+
+        # other hosts unaffected
+        self.assertEqual(session.get('http://bar/a').status_code, 200)
+        self.assertEqual(session.get_request_count(), 4)
+        self.assertEqual(session.get_failure_count(), 2)
+
+    def test_pooledsession_request_metrics(self):
+        registry = MetricsRegistry(labels={})
+        session = PooledSession(failure_threshold=2, metrics=registry)
+        adapter = FakeAdapter([200, 503, 200])
+        session.mount('http://', adapter)
+        session.get('http://foo/a')
+        session.get('http://foo/a')
+        session.get('http://bar/a')
+        self.assertEqual(registry.get_value(metrics.HTTP_SECONDS,
+                                            labels={'target': 'foo'}), 2)
+        self.assertEqual(registry.get_value(metrics.HTTP_SECONDS,
+                                            labels={'target': 'bar'}), 1)
+        self.assertEqual(registry.get_value(metrics.HTTP_ERRORS_TOTAL,
+                                            labels={'target': 'foo'}), 1)
+        self.assertIsNone(registry.get_value(metrics.HTTP_ERRORS_TOTAL,
+                                             labels={'target': 'bar'}))
+
+    def test_pooledsession_request_traced(self):
+        spans = []
+        exporter = MagicMock()
+        exporter.export = MagicMock(side_effect=spans.extend)
+        tracer = tracing.Tracer(exporter)
+        session = PooledSession(retries=0)
+        adapter = FakeAdapter([200, 200, requests.exceptions.ConnectionError(
+            'down')])
+        session.mount('http://', adapter)
+
+        # no span active, nothing recorded
+        session.get('http://foo/a')
+        self.assertFalse(tracing.TRACEPARENT_HEADER in
+                         adapter.requests[0][0].headers)
+
+        root = tracer.start_span('task', tracing.new_trace_id())
+        with tracing.use_span(root):
+            session.get('http://foo/b', headers={'X-Other': 'y'})
+            try:
+                session.post('http://foo/c')
+                self.fail('Expected ConnectionError')
+            except requests.exceptions.ConnectionError:
+                pass
+        self.assertEqual(len(spans), 2)
+        self.assertEqual(spans[0]['name'], 'GET foo')
+        self.assertEqual(spans[0]['parentId'], root.get_span_id())
+        self.assertEqual(spans[0]['kind'], tracing.CLIENT_KIND)
+        self.assertEqual(spans[0]['tags'], {'http.method': 'GET',
+                                            'http.url': 'http://foo/b',
+                                            'http.status_code': '200'})
+        self.assertEqual(spans[1]['name'], 'POST foo')
+        self.assertEqual(spans[1]['tags']['error'], 'down')
+        headers = adapter.requests[1][0].headers
+        self.assertEqual(headers[tracing.TRACEPARENT_HEADER],
+                         '00-' + root.get_trace_id() + '-' +
+                         spans[0]['id'] + '-01')
+        self.assertEqual(headers['X-Other'], 'y')
+
+    def test_pooledsession_post_not_retried(self):
+        session = PooledSession(retries=3)
+        retry = session.get_adapter('http://foo').max_retries
+        self.assertTrue(retry._is_method_retryable('GET'))
+        self.assertFalse(retry._is_method_retryable('POST'))
+
+    def test_route_module_requests(self):
+        orig_get = requests.get
+        session = PooledSession()
+        module = types.ModuleType('fakelib')
+        self.assertFalse(httpsession.route_module_requests(module,
+                                                           session))
+        module.requests = requests
+        self.assertTrue(httpsession.route_module_requests(module,
+                                                          session))
+        self.assertTrue(httpsession.route_module_requests(module,
+                                                          session))
+        self.assertEqual(module.requests.get, session.get)
+        self.assertEqual(module.requests.post, session.post)
+        self.assertTrue(module.requests.exceptions is requests.exceptions)
+        self.assertTrue(module.requests.get_session() is session)
+        self.assertTrue(requests.get is orig_get)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `lease` module."""
+
+import os
+import json
+import time
+import unittest
+import shutil
+import tempfile
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import lease
+from diseasescope_rest_server.dao import FileBasedTask
+from diseasescope_rest_server.lease import TaskLeaseManager
+
+
+class TestLease(unittest.TestCase):
+    """Tests for `lease` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def _create_task(self, state, taskid, taskdict=None):
+        taskdir = os.path.join(self._temp_dir, state, '1.2.3.4', taskid)
+        os.makedirs(taskdir)
+        if taskdict is None:
+            taskdict = {dao.DOID_PARAM: 1}
+        task = FileBasedTask(taskdir, taskdict)
+        task.save_task()
+        return task
+
+    def test_get_owner_id(self):
+        owner = lease.get_owner_id()
+        self.assertTrue(':' + str(os.getpid()) + ':' in owner)
+        self.assertNotEqual(owner, lease.get_owner_id())
+
+    def test_heartbeat_and_release(self):
+        task = self._create_task(dao.PROCESSING_STATUS, 'a')
+        manager = TaskLeaseManager(self._temp_dir, owner='me', lease_time=60)
+        self.assertEqual(manager.get_owner(), 'me')
+        self.assertIsNone(lease.read_lease(task.get_taskdir()))
+        manager.heartbeat(task)
+        data = lease.read_lease(task.get_taskdir())
+        self.assertEqual(data[lease.LEASE_OWNER_KEY], 'me')
+        self.assertEqual(data[lease.LEASE_EXPIRES_KEY],
+                         data[lease.LEASE_HEARTBEAT_KEY] + 60)
+        self.assertFalse(manager.is_expired(task.get_taskdir()))
+        self.assertTrue(manager.is_expired(task.get_taskdir(),
+                                           now=time.time() + 61))
+
+        # lease of another owner is not released
+        TaskLeaseManager(self._temp_dir, owner='other').release(task)
+        self.assertIsNotNone(lease.read_lease(task.get_taskdir()))
+        manager.release(task)
+        self.assertIsNone(lease.read_lease(task.get_taskdir()))
+        manager.release(task)
+
+        # heartbeat on missing directory is ignored
+        manager.heartbeat(FileBasedTask(os.path.join(self._temp_dir, 'x'),
+                                        {}))
+
+    def test_is_expired_without_lease(self):
+        task = self._create_task(dao.PROCESSING_STATUS, 'a')
+        manager = TaskLeaseManager(self._temp_dir, lease_time=60)
+        self.assertFalse(manager.is_expired(task.get_taskdir()))
+        self.assertTrue(manager.is_expired(task.get_taskdir(),
+                                           now=time.time() + 61))
+        self.assertFalse(manager.is_expired(os.path.join(self._temp_dir,
+                                                         'nope')))
+
+    def test_recover_expired_tasks(self):
+        manager = TaskLeaseManager(self._temp_dir, owner='me',
+                                   lease_time=60, max_retries=1)
+        self.assertEqual(manager.recover_expired_tasks(), (0, 0))
+        dead = TaskLeaseManager(self._temp_dir, owner='dead',
+                                lease_time=-1)
+        live = self._create_task(dao.PROCESSING_STATUS, 'live')
+        manager.heartbeat(live)
+        expired = self._create_task(dao.PROCESSING_STATUS, 'expired')
+        dead.heartbeat(expired)
+        exhausted = self._create_task(dao.PROCESSING_STATUS, 'exhausted',
+                                      {dao.DOID_PARAM: 1,
+                                       lease.RECOVERY_ATTEMPTS_KEY: 1})
+        dead.heartbeat(exhausted)
+        inflight = self._create_task(dao.PROCESSING_STATUS, 'inflight')
+        dead.heartbeat(inflight)
+        os.makedirs(os.path.join(self._temp_dir, dao.PROCESSING_STATUS,
+                                 '1.2.3.4', 'nojson'))
+
+        self.assertEqual(sorted([t.get_task_uuid() for t in
+                                 manager.get_expired_tasks(
+                                     exclude=set(['inflight']))]),
+                         ['exhausted', 'expired'])
+        self.assertEqual(manager.recover_expired_tasks(
+            exclude=set(['inflight'])), (1, 1))
+
+        requeued = os.path.join(self._temp_dir, dao.SUBMITTED_STATUS,
+                                '1.2.3.4', 'expired')
+        with open(os.path.join(requeued, dao.TASK_JSON), 'r') as f:
+            self.assertEqual(json.load(f)[lease.RECOVERY_ATTEMPTS_KEY], 1)
+        self.assertIsNone(lease.read_lease(requeued))
+
+        failed = os.path.join(self._temp_dir, dao.DONE_STATUS,
+                              '1.2.3.4', 'exhausted')
+        with open(os.path.join(failed, dao.TASK_JSON), 'r') as f:
+            self.assertEqual(json.load(f)['message'],
+                             'Task abandoned after runner processing it '
+                             'stopped 2 times')
+        self.assertTrue(os.path.isdir(live.get_taskdir()))
+        self.assertTrue(os.path.isdir(inflight.get_taskdir()))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metrics` module."""
+
+import os
+import time
+import socket
+import unittest
+import shutil
+import tempfile
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import metrics
+from diseasescope_rest_server.metrics import MetricsRegistry
+from diseasescope_rest_server.metrics import MetricsServer
+from diseasescope_rest_server.metrics import TaskQueueCollector
+from diseasescope_rest_server.metrics import TextfileExporter
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for `metrics` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_default_labels(self):
+        registry = MetricsRegistry()
+        registry.inc('foo_total')
+        self.assertEqual(registry.get_value(
+            'foo_total', labels={metrics.HOST_LABEL: socket.gethostname()}),
+            1)
+
+    def test_counter_and_gauge(self):
+        registry = MetricsRegistry(labels={'host': 'h1'})
+        self.assertIsNone(registry.get_value('foo_total'))
+        registry.inc('foo_total')
+        registry.inc('foo_total', value=2)
+        registry.inc('foo_total', labels={'x': 'a"b'})
+        registry.set(metrics.TASKS_IN_FLIGHT, 3)
+        registry.set(metrics.TASKS_IN_FLIGHT, 1)
+        self.assertEqual(registry.get_value('foo_total'), 3)
+        self.assertEqual(registry.get_value(metrics.TASKS_IN_FLIGHT), 1)
+        try:
+            registry.set('foo_total', 1)
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Metric foo_total is a counter '
+                                     'not a gauge')
+        self.assertEqual(registry.render(),
+                         '# HELP diseasescope_tasks_in_flight Number of '
+                         'tasks being processed\n'
+                         '# TYPE diseasescope_tasks_in_flight gauge\n'
+                         'diseasescope_tasks_in_flight{host="h1"} 1.0\n'
+                         '# TYPE foo_total counter\n'
+                         'foo_total{host="h1"} 3.0\n'
+                         'foo_total{host="h1",x="a\\"b"} 1.0\n')
+
+    def test_histogram(self):
+        registry = MetricsRegistry(labels={}, buckets=(1.0, 10.0))
+        registry.observe('foo_seconds', 0.5, labels={'stage': 'a'})
+        registry.observe('foo_seconds', 5, labels={'stage': 'a'})
+        registry.observe('foo_seconds', 50, labels={'stage': 'a'})
+        self.assertEqual(registry.get_value('foo_seconds',
+                                            labels={'stage': 'a'}), 3)
+        self.assertIsNone(registry.get_value('foo_seconds'))
+        self.assertEqual(registry.render(),
+                         '# TYPE foo_seconds histogram\n'
+                         'foo_seconds_bucket{stage="a",le="1.0"} 1\n'
+                         'foo_seconds_bucket{stage="a",le="10.0"} 2\n'
+                         'foo_seconds_bucket{stage="a",le="+Inf"} 3\n'
+                         'foo_seconds_sum{stage="a"} 55.5\n'
+                         'foo_seconds_count{stage="a"} 3\n')
+
+    def test_collectors(self):
+        registry = MetricsRegistry(labels={})
+        calls = []
+
+        def bad_collector(reg):
+            raise Exception('boom')
+
+        registry.add_collector(bad_collector)
+        registry.add_collector(lambda reg: calls.append(reg))
+        registry.render()
+        self.assertEqual(calls, [registry])
+
+    def test_task_queue_collector(self):
+        for state, taskid in [(dao.SUBMITTED_STATUS, 'a'),
+                              (dao.SUBMITTED_STATUS, 'b'),
+                              (dao.PROCESSING_STATUS, 'c'),
+                              (dao.DONE_STATUS, 'd')]:
+            os.makedirs(os.path.join(self._temp_dir, state, '1.2.3.4',
+                                     taskid))
+        os.makedirs(os.path.join(self._temp_dir, dao.DELETE_REQUESTS))
+        open(os.path.join(self._temp_dir, dao.DELETE_REQUESTS, 'd'),
+             'w').close()
+        registry = MetricsRegistry(labels={})
+        TaskQueueCollector(self._temp_dir)(registry)
+        for state, depth in [(dao.SUBMITTED_STATUS, 2),
+                             (dao.PROCESSING_STATUS, 1),
+                             (dao.DELETE_REQUESTS, 1)]:
+            self.assertEqual(registry.get_value(metrics.QUEUE_DEPTH,
+                                                labels={'state': state}),
+                             depth)
+        self.assertIsNone(registry.get_value(
+            metrics.QUEUE_DEPTH, labels={'state': dao.DONE_STATUS}))
+        self.assertEqual(metrics.count_tasks(self._temp_dir, 'nope'), 0)
+
+    def test_metrics_server(self):
+        registry = MetricsRegistry(labels={})
+        registry.inc('foo_total')
+        server = MetricsServer(registry, 0)
+        self.assertIsNone(server.get_port())
+        server.start()
+        try:
+            url = 'http://127.0.0.1:' + str(server.get_port())
+            resp = urlopen(url + metrics.METRICS_PATH)
+            self.assertEqual(resp.headers['Content-Type'],
+                             metrics.CONTENT_TYPE)
+            self.assertEqual(resp.read().decode('utf-8'),
+                             '# TYPE foo_total counter\nfoo_total 1.0\n')
+            try:
+                urlopen(url + '/other')
+                self.fail('Expected HTTPError')
+            except HTTPError as e:
+                self.assertEqual(e.code, 404)
+        finally:
+            server.stop()
+        server.stop()
+
+    def test_metrics_server_port_in_use(self):
+        registry = MetricsRegistry(labels={})
+        registry.inc('foo_total')
+        first = MetricsServer(registry, 0)
+        first.start()
+        port = first.get_port()
+        second = MetricsServer(registry, port, retry_interval=0.01)
+        waiting = MetricsServer(registry, port, retry_interval=0.01)
+        try:
+            second.start()
+            self.assertIsNone(second.get_port())
+            waiting.start()
+            waiting.stop()
+            first.stop()
+            timeout = time.time() + 10
+            while second.get_port() is None and time.time() < timeout:
+                time.sleep(0.01)
+            self.assertEqual(second.get_port(), port)
+            resp = urlopen('http://127.0.0.1:' + str(port) +
+                           metrics.METRICS_PATH)
+            self.assertEqual(resp.getcode(), 200)
+            self.assertIsNone(waiting.get_port())
+        finally:
+            first.stop()
+            second.stop()
+        self.assertIsNone(second.get_port())
+
+        # other errors are raised
+        server = MetricsServer(registry, 0, address='256.0.0.1')
+        self.assertRaises(OSError, server.start)
+
+    def test_textfile_exporter(self):
+        registry = MetricsRegistry(labels={})
+        registry.inc('foo_total')
+        path = os.path.join(self._temp_dir, 'runner.prom')
+        exporter = TextfileExporter(registry, path, interval=3600)
+        exporter.start()
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(),
+                             '# TYPE foo_total counter\nfoo_total 1.0\n')
+        registry.inc('foo_total')
+        exporter.stop()
+        exporter.stop()
+        with open(path, 'r') as f:
+            self.assertTrue('foo_total 2.0' in f.read())
+        self.assertEqual(os.listdir(self._temp_dir), ['runner.prom'])
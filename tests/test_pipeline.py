@@ -0,0 +1,763 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pipeline` module."""
+
+import os
+import time
+import unittest
+import shutil
+import tempfile
+import threading
+from unittest.mock import MagicMock
+
+import pandas as pd
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import pipeline
+from diseasescope_rest_server import clixo
+from diseasescope_rest_server import metrics
+from diseasescope_rest_server import tracing
+from diseasescope_rest_server.metrics import MetricsRegistry
+from diseasescope_rest_server.pipeline import PipelineStage
+from diseasescope_rest_server.pipeline import StageCheckpointer
+from diseasescope_rest_server.pipeline import DiseaseScopePipeline
+from diseasescope_rest_server.pipeline import PipelineProgress
+from diseasescope_rest_server.pipeline import TaskCancelledError
+from diseasescope_rest_server.pipeline import TaskMonitor
+from diseasescope_rest_server.cache import StageCache
+from diseasescope_rest_server.edgetable import EdgeTable
+
+
+class FakeScope(object):
+    """Fake DiseaseScope object"""
+    def __init__(self):
+        self.calls = []
+        self.genes = None
+        self.network = None
+
+
+class TestPipeline(unittest.TestCase):
+    """Tests for `pipeline` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def _get_task(self):
+        task = MagicMock()
+        task.get_taskdir = MagicMock(return_value=self._temp_dir)
+        task.get_scratchdir = MagicMock(return_value=self._temp_dir)
+        return task
+
+    def _get_stages(self, fail_stage=None):
+        def run_genes(scope, task):
+            scope.calls.append('genes')
+            scope.genes = ['a', 'b']
+
+        def run_network(scope, task):
+            scope.calls.append('network')
+            if fail_stage == 'network':
+                raise Exception('network failed')
+            scope.network = [('a', 'b')]
+
+        def run_infer(scope, task):
+            scope.calls.append('infer')
+            if fail_stage == 'infer':
+                raise Exception('infer failed')
+            scope.url = 'http://foo'
+
+        return [PipelineStage('genes', run_genes),
+                PipelineStage('network', run_network, requires=['genes']),
+                PipelineStage('infer', run_infer, requires=['network'])]
+
+    def test_get_diseasescope_stages(self):
+        names = [s.get_name() for s in pipeline.get_diseasescope_stages()]
+        self.assertEqual(names, [pipeline.GET_DISEASE_GENES_STAGE,
+                                 pipeline.GET_DISEASE_TISSUES_STAGE,
+                                 pipeline.EXPAND_GENE_SET_STAGE,
+                                 pipeline.GET_NETWORK_STAGE,
+                                 pipeline.CONVERT_EDGE_TABLE_NAMES_STAGE,
+                                 pipeline.INFER_HIERARCHICAL_MODEL_STAGE])
+
+    def test_get_diseasescope_stages_clixo_local(self):
+        pool = MagicMock()
+        stages = pipeline.get_diseasescope_stages(
+            infer_method=clixo.CLIXO_LOCAL_METHOD, clixopool=pool)
+        self.assertEqual([s.get_name() for s in stages[-2:]],
+                         [pipeline.INFER_HIERARCHICAL_MODEL_STAGE,
+                          pipeline.UPLOAD_HIERARCHY_STAGE])
+        self.assertEqual(stages[-2].get_kind(), pipeline.CPU_STAGE)
+        self.assertEqual(stages[-2].get_artifacts(),
+                         [clixo.CLIXO_OUTPUT_FILE, clixo.CLIXO_ERROR_FILE])
+        self.assertEqual(DiseaseScopePipeline(MagicMock(),
+                                              stages=stages).get_artifacts(),
+                         [clixo.CLIXO_OUTPUT_FILE, clixo.CLIXO_ERROR_FILE])
+        self.assertEqual(stages[-1].get_kind(), pipeline.IO_STAGE)
+        try:
+            pipeline.get_diseasescope_stages(infer_method='foo')
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Unknown infer method: foo')
+
+        # run local inference stage with fake pool
+        def fake_run(edgefile, outputfile, alpha, beta, cancel_check=None):
+            self.assertTrue(os.path.isfile(edgefile))
+            self.assertEqual((alpha, beta), (0.01, 0.5))
+            self.assertEqual(cancel_check, pipeline._check_stage_cancelled)
+            with open(outputfile, 'w') as f:
+                f.write('1\tA\tgene\n')
+        pool.run = MagicMock(side_effect=fake_run)
+        scope = FakeScope()
+        scope.network = pd.DataFrame({'Gene1': ['A'], 'Gene2': ['B'],
+                                      'mean': [0.5]})
+        output = stages[-2].run(scope, self._get_task())
+        self.assertEqual(output, {'hierarchy': [['1', 'A', 'gene']]})
+        self.assertTrue(set([clixo.EDGE_TABLE_FILE, clixo.CLIXO_OUTPUT_FILE,
+                             clixo.CLIXO_ERROR_FILE]).issubset(
+            dao.get_task_files(self._temp_dir)))
+
+    def test_diseasescope_stages_use_edgetable(self):
+        stages = pipeline.get_diseasescope_stages()
+        scope = FakeScope()
+        network = pd.DataFrame({'Gene1': ['1', '2', '1'],
+                                'Gene2': ['2', '3', '3'],
+                                'mean': [0.5, 0.25, 1.0]})
+
+        def get_network(method='biggim'):
+            scope.network = network
+        scope.get_network = get_network
+        output = stages[3].run(scope, self._get_task())
+        self.assertTrue(isinstance(output['network'], EdgeTable))
+        self.assertEqual(len(output['network']), 3)
+
+        # convert is given one row per node, node 3 is dropped
+        converted = []
+
+        def convert(columns, scope_name, field, keep=False):
+            converted.append(len(scope.network))
+            df = scope.network[scope.network['Gene1'] != '3'].copy()
+            for c in columns:
+                df[c] = 'SYM' + df[c]
+            scope.network = df
+        scope.convert_edge_table_names = convert
+        output = stages[4].run(scope, self._get_task())
+        self.assertEqual(converted, [3])
+        df = output['network'].to_dataframe()
+        self.assertEqual(list(df['Gene1']), ['SYM1'])
+        self.assertEqual(list(df['Gene2']), ['SYM2'])
+
+        # infer is given a DataFrame and network is kept compact
+        def infer(edge_attr='mean', method=None, temp_path=None,
+                  method_kwargs=None):
+            self.assertTrue(isinstance(scope.network, pd.DataFrame))
+            scope.hiview_url = 'http://hiview'
+        scope.infer_hierarchical_model = infer
+        output = stages[5].run(scope, self._get_task())
+        self.assertEqual(output, {'hiview_url': 'http://hiview'})
+        self.assertTrue(isinstance(scope.network, EdgeTable))
+
+    def test_pipelinestage_run(self):
+        scope = FakeScope()
+        scope.genes = ['x']
+
+        def run_stage(s, task):
+            s.genes.append('y')
+            s.network = ['z']
+            s.newattr = 5
+
+        stage = PipelineStage('foo', run_stage, outputs=['genes'])
+        self.assertEqual(stage.get_name(), 'foo')
+        self.assertEqual(stage.get_outputs(), ['genes'])
+        res = stage.run(scope, None)
+        self.assertEqual(res, {'genes': ['x', 'y'],
+                               'network': ['z'],
+                               'newattr': 5})
+
+    def test_stagecheckpointer_save_restore_clear(self):
+        checkpointer = StageCheckpointer(self._temp_dir)
+        self.assertEqual(checkpointer.get_completed_stages(), [])
+        self.assertTrue(checkpointer.save('one', {'genes': ['a']}))
+        self.assertTrue(checkpointer.save('two', {'network': [1, 2]}))
+
+        stages = checkpointer.get_completed_stages()
+        self.assertEqual([s[pipeline.MANIFEST_NAME_KEY] for s in stages],
+                         ['one', 'two'])
+        self.assertTrue(stages[0][pipeline.MANIFEST_SIZE_KEY] > 0)
+
+        scope = FakeScope()
+        self.assertEqual(StageCheckpointer(self._temp_dir).restore(scope),
+                         ['one', 'two'])
+        self.assertEqual(scope.genes, ['a'])
+        self.assertEqual(scope.network, [1, 2])
+
+        checkpointer.clear()
+        self.assertFalse(os.path.isdir(os.path.join(self._temp_dir,
+                                                    dao.CHECKPOINT_DIR)))
+        self.assertEqual(checkpointer.get_completed_stages(), [])
+
+    def test_stagecheckpointer_edgetable(self):
+        checkpointer = StageCheckpointer(self._temp_dir)
+        network = EdgeTable.from_dataframe(
+            pd.DataFrame({'Gene1': ['A', 'B'], 'Gene2': ['B', 'C'],
+                          'mean': [0.5, 0.25]}))
+        self.assertTrue(checkpointer.save('net', {'network': network,
+                                                  'genes': ['a']}))
+        stages = checkpointer.get_completed_stages()
+        self.assertEqual(stages[0][pipeline.MANIFEST_EDGETABLES_KEY],
+                         {'network': 'net.network.edges'})
+        self.assertTrue(os.path.isdir(os.path.join(self._temp_dir,
+                                                   dao.CHECKPOINT_DIR,
+                                                   'net.network.edges')))
+        scope = FakeScope()
+        self.assertEqual(StageCheckpointer(self._temp_dir).restore(scope),
+                         ['net'])
+        self.assertEqual(scope.genes, ['a'])
+        self.assertTrue(isinstance(scope.network, EdgeTable))
+        self.assertEqual(scope.network.get_checksum(),
+                         network.get_checksum())
+
+    def test_stagecheckpointer_unpicklable_output(self):
+        checkpointer = StageCheckpointer(self._temp_dir)
+        self.assertFalse(checkpointer.save('one',
+                                           {'lock': threading.Lock()}))
+        # checkpointing is now disabled
+        self.assertFalse(checkpointer.save('two', {'genes': ['a']}))
+        self.assertEqual(checkpointer.get_completed_stages(), [])
+
+    def test_stagecheckpointer_corrupt_files(self):
+        checkpointer = StageCheckpointer(self._temp_dir)
+        checkpointer.save('one', {'genes': ['a']})
+        checkpointer.save('two', {'network': [1, 2]})
+        cdir = os.path.join(self._temp_dir, dao.CHECKPOINT_DIR)
+        with open(os.path.join(cdir, 'two' + pipeline.CHECKPOINT_SUFFIX),
+                  'w') as f:
+            f.write('not gzip')
+        scope = FakeScope()
+        self.assertEqual(checkpointer.restore(scope), ['one'])
+
+        with open(os.path.join(cdir, pipeline.CHECKPOINT_MANIFEST),
+                  'w') as f:
+            f.write('{')
+        self.assertEqual(checkpointer.get_completed_stages(), [])
+
+    def test_diseasescopepipeline_run_and_resume(self):
+        scopes = []
+
+        def factory(task):
+            scope = FakeScope()
+            scopes.append(scope)
+            return scope
+
+        task = self._get_task()
+        pline = DiseaseScopePipeline(factory,
+                                     stages=self._get_stages(
+                                         fail_stage='infer'))
+        self.assertEqual(len(pline.get_stages()), 3)
+        try:
+            pline.run(task)
+            self.fail('Expected exception')
+        except Exception as e:
+            self.assertEqual(str(e), 'infer failed')
+        self.assertEqual(scopes[0].calls, ['genes', 'network', 'infer'])
+
+        # retry resumes from last completed stage
+        pline = DiseaseScopePipeline(factory,
+                                     stages=self._get_stages())
+        scope = pline.run(task)
+        self.assertEqual(scope.calls, ['infer'])
+        self.assertEqual(scope.genes, ['a', 'b'])
+        self.assertEqual(scope.network, [('a', 'b')])
+        self.assertEqual(scope.url, 'http://foo')
+
+        # checkpoints removed after successful run
+        self.assertFalse(os.path.isdir(os.path.join(self._temp_dir,
+                                                    dao.CHECKPOINT_DIR)))
+
+    def test_diseasescopepipeline_run_with_profiler(self):
+        profiler = MagicMock()
+        profiler.profile = MagicMock(
+            side_effect=lambda name, func, *args: func(*args))
+        pline = DiseaseScopePipeline(lambda t: FakeScope(),
+                                     stages=self._get_stages())
+        scope = pline.run(self._get_task(), profiler=profiler)
+        self.assertEqual(scope.url, 'http://foo')
+        self.assertEqual(sorted([c[0][0] for c in
+                                 profiler.profile.call_args_list]),
+                         sorted([s.get_name() for s in self._get_stages()]))
+
+    def test_diseasescopepipeline_run_traced(self):
+        spans = []
+        exporter = MagicMock()
+        exporter.export = MagicMock(side_effect=spans.extend)
+        root = tracing.Tracer(exporter).start_span('task',
+                                                   tracing.new_trace_id())
+        pline = DiseaseScopePipeline(lambda t: FakeScope(),
+                                     stages=self._get_stages(
+                                         fail_stage='infer'))
+        with tracing.use_span(root):
+            try:
+                pline.run(self._get_task())
+                self.fail('Expected Exception')
+            except Exception as e:
+                self.assertEqual(str(e), 'infer failed')
+        self.assertEqual(sorted([s['name'] for s in spans]),
+                         sorted(['stage ' + s.get_name()
+                                 for s in self._get_stages()]))
+        for span in spans:
+            self.assertEqual(span['parentId'], root.get_span_id())
+            self.assertTrue('queueWait' in span['tags'])
+        failed = [s for s in spans if s['name'] == 'stage infer'][0]
+        self.assertEqual(failed['tags']['error'], 'infer failed')
+
+    def test_diseasescopepipeline_run_with_cache(self):
+        cachedir = os.path.join(self._temp_dir, 'cache')
+        stagecache = StageCache(cachedir)
+        calls = []
+
+        def run_genes(scope, task, method):
+            calls.append('genes')
+            scope.genes = [method, str(task.get_diseaseid())]
+
+        def run_network(scope, task):
+            calls.append('network')
+            scope.network = list(scope.genes)
+
+        def run_infer(scope, task):
+            calls.append('infer')
+            scope.url = 'http://' + '/'.join(scope.network)
+
+        def get_stages():
+            return [PipelineStage('genes', run_genes,
+                                  params={'method': 'x'},
+                                  cacheable=True),
+                    PipelineStage('network', run_network,
+                                  requires=['genes'],
+                                  cacheable=True),
+                    PipelineStage('infer', run_infer,
+                                  requires=['network'])]
+
+        taskdir = os.path.join(self._temp_dir, 'task')
+        os.makedirs(taskdir)
+        task = MagicMock()
+        task.get_taskdir = MagicMock(return_value=taskdir)
+        task.get_diseaseid = MagicMock(return_value=1234)
+
+        registry = MetricsRegistry(labels={})
+        pline = DiseaseScopePipeline(lambda t: FakeScope(),
+                                     stages=get_stages(),
+                                     cache=stagecache,
+                                     metrics=registry)
+        scope = pline.run(task)
+        self.assertEqual(scope.url, 'http://x/1234')
+        self.assertEqual(calls, ['genes', 'network', 'infer'])
+        for name in ['genes', 'network', 'infer']:
+            self.assertEqual(registry.get_value(metrics.STAGE_SECONDS,
+                                                labels={'stage': name}), 1)
+
+        # same disease skips straight to last stage
+        del calls[:]
+        scope = pline.run(task)
+        self.assertEqual(scope.url, 'http://x/1234')
+        self.assertEqual(calls, ['infer'])
+        self.assertEqual(stagecache.get_hits(), 2)
+        self.assertEqual(registry.get_value(
+            metrics.STAGE_CACHE_TOTAL,
+            labels={'stage': 'genes', 'result': 'hit'}), 1)
+        self.assertEqual(registry.get_value(
+            metrics.STAGE_CACHE_TOTAL,
+            labels={'stage': 'genes', 'result': 'miss'}), 1)
+        self.assertEqual(registry.get_value(metrics.STAGE_SECONDS,
+                                            labels={'stage': 'genes'}), 1)
+
+        # different disease runs everything
+        del calls[:]
+        task.get_diseaseid = MagicMock(return_value=5)
+        scope = pline.run(task)
+        self.assertEqual(scope.url, 'http://x/5')
+        self.assertEqual(calls, ['genes', 'network', 'infer'])
+
+    def test_get_sizes(self):
+        scope = FakeScope()
+        scope.genes = ['a', 'b']
+        scope.count = 5
+        self.assertEqual(pipeline.get_sizes(scope, ['genes', 'count',
+                                                    'network', 'nope']),
+                         {'genes': 2})
+
+    def test_pipelineprogress(self):
+        task = self._get_task()
+        taskdict = {}
+        task.get_taskdict = MagicMock(return_value=taskdict)
+        task.save_task = MagicMock(return_value=None)
+        progress = PipelineProgress(task, 4)
+        progress.stage_restored('one')
+        self.assertEqual(taskdict[dao.PROGRESS_KEY], 25)
+
+        progress.stage_started('two', time.time() - 2)
+        self.assertEqual(task.save_task.call_count, 1)
+        entry = taskdict[dao.STAGES_KEY]['two']
+        self.assertTrue(entry[pipeline.STAGE_QUEUE_WAIT_KEY] >= 2000)
+        self.assertTrue(entry[pipeline.STAGE_START_TIME_KEY] > 0)
+
+        progress.stage_finished('two', {'genes': 2}, {'network': 3})
+        self.assertEqual(taskdict[dao.PROGRESS_KEY], 50)
+        self.assertEqual(entry[pipeline.STAGE_INPUT_SIZE_KEY], {'genes': 2})
+        self.assertEqual(entry[pipeline.STAGE_OUTPUT_SIZE_KEY],
+                         {'network': 3})
+        self.assertEqual(entry[pipeline.STAGE_CACHED_KEY], False)
+        self.assertTrue(entry[pipeline.STAGE_DURATION_KEY] >= 0)
+
+        # every update is saved, writer of task coalesces writes
+        self.assertEqual(task.save_task.call_count, 2)
+
+        # progress never reaches 100
+        progress.stage_finished('three', {}, {})
+        progress.stage_finished('four', {}, {}, cached=True)
+        self.assertEqual(taskdict[dao.PROGRESS_KEY], 99)
+        self.assertEqual(taskdict[dao.STAGES_KEY]['four'][
+                             pipeline.STAGE_CACHED_KEY], True)
+
+        # task with no task json
+        task.get_taskdict = MagicMock(return_value=None)
+        progress = PipelineProgress(task, 1)
+        progress.stage_started('one', time.time())
+        progress.stage_finished('one', {}, {})
+
+    def test_diseasescopepipeline_run_records_stages(self):
+        task = self._get_task()
+        taskdict = {}
+        task.get_taskdict = MagicMock(return_value=taskdict)
+        task.save_task = MagicMock(return_value=None)
+        stages = self._get_stages()
+        stages[1] = PipelineStage('network', stages[1]._func,
+                                  outputs=['network'], requires=['genes'])
+        stages[0] = PipelineStage('genes', stages[0]._func,
+                                  outputs=['genes'])
+        pline = DiseaseScopePipeline(lambda t: FakeScope(), stages=stages)
+        pline.run(task)
+        self.assertEqual(sorted(taskdict[dao.STAGES_KEY].keys()),
+                         ['genes', 'infer', 'network'])
+        netentry = taskdict[dao.STAGES_KEY]['network']
+        self.assertEqual(netentry[pipeline.STAGE_INPUT_SIZE_KEY],
+                         {'genes': 2})
+        self.assertEqual(netentry[pipeline.STAGE_OUTPUT_SIZE_KEY],
+                         {'network': 1})
+        self.assertEqual(taskdict[dao.PROGRESS_KEY], 99)
+        # start and end of each stage
+        self.assertEqual(task.save_task.call_count, 6)
+
+    def test_diseasescopepipeline_run_cancelled(self):
+        scopes = []
+
+        def factory(task):
+            scopes.append(FakeScope())
+            return scopes[-1]
+
+        monitor = TaskMonitor()
+        stages = self._get_stages()
+
+        def run_network(scope, task):
+            scope.calls.append('network')
+            monitor.cancel('Task deleted')
+
+        stages[1] = PipelineStage('network', run_network,
+                                  requires=['genes'])
+        pline = DiseaseScopePipeline(factory, stages=stages)
+        try:
+            pline.run(self._get_task(), monitor=monitor)
+            self.fail('Expected TaskCancelledError')
+        except TaskCancelledError as e:
+            self.assertEqual(str(e), 'Task cancelled at stage network : '
+                                     'Task deleted')
+        self.assertEqual(scopes[0].calls, ['genes', 'network'])
+
+    def test_diseasescopepipeline_run_cancelled_while_stage_hangs(self):
+        monitor = TaskMonitor()
+        release = threading.Event()
+        finished = threading.Event()
+        errors = []
+
+        def run_network(scope, task):
+            monitor.cancel('Stage network exceeded timeout')
+            release.wait(10)
+            try:
+                pipeline._record_temp_files(task, ['foo'])
+            except TaskCancelledError as e:
+                errors.append(e)
+            finished.set()
+
+        stages = self._get_stages()
+        stages[1] = PipelineStage('network', run_network,
+                                  requires=['genes'])
+        pools = pipeline.StagePools(io_workers=1, cpu_workers=1,
+                                    queue_size=0)
+        try:
+            pline = DiseaseScopePipeline(lambda t: FakeScope(),
+                                         stages=stages, pools=pools)
+            try:
+                pline.run(self._get_task(), monitor=monitor)
+                self.fail('Expected TaskCancelledError')
+            except TaskCancelledError as e:
+                self.assertEqual(str(e), 'Task cancelled at stage network '
+                                         ': Stage network exceeded timeout')
+
+            # hung stage no longer holds the only io thread
+            self.assertEqual(pools.get_abandoned(pipeline.IO_STAGE), 1)
+            self.assertEqual(pools.get_pending(pipeline.IO_STAGE), 0)
+            self.assertEqual(pools.submit(pipeline.IO_STAGE,
+                                          lambda: 'next').result(10),
+                             'next')
+
+            # abandoned stage writes nothing once it returns
+            release.set()
+            self.assertTrue(finished.wait(10))
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(dao.get_task_files(self._temp_dir), set())
+        finally:
+            release.set()
+            pools.shutdown()
+        self.assertEqual(pools.get_abandoned(pipeline.IO_STAGE), 0)
+
+    def test_taskmonitor(self):
+        monitor = TaskMonitor()
+        self.assertEqual(monitor.get_current_stage(), (None, None))
+        monitor.stage_started('genes')
+        name, start = monitor.get_current_stage()
+        self.assertEqual(name, 'genes')
+        self.assertTrue(start >= monitor.get_start_time())
+        monitor.stage_finished('genes')
+        self.assertEqual(monitor.get_current_stage(), (None, None))
+        monitor.check_cancelled('genes')
+        self.assertFalse(monitor.wait_for_cancel(0))
+
+        monitor.cancel('too slow')
+        self.assertTrue(monitor.is_cancelled())
+        self.assertTrue(monitor.wait_for_cancel(0))
+        self.assertEqual(monitor.get_cancel_reason(), 'too slow')
+        try:
+            monitor.check_cancelled('infer')
+            self.fail('Expected TaskCancelledError')
+        except TaskCancelledError as e:
+            self.assertEqual(str(e), 'Task cancelled at stage infer : '
+                                     'too slow')
+
+    def test_parse_stage_times(self):
+        self.assertEqual(pipeline.parse_stage_times(None), {})
+        self.assertEqual(pipeline.parse_stage_times(''), {})
+        self.assertEqual(pipeline.parse_stage_times('a=10, b=2.5'),
+                         {'a': 10.0, 'b': 2.5})
+        try:
+            pipeline.parse_stage_times('a')
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Invalid entry: a expected '
+                                     '<stage>=<seconds>')
+
+    def test_stagedag(self):
+        def noop(scope, task):
+            return None
+
+        stages = [PipelineStage('infer', noop, requires=['network']),
+                  PipelineStage('genes', noop),
+                  PipelineStage('network', noop,
+                                requires=['genes', 'tissues']),
+                  PipelineStage('tissues', noop)]
+        dag = pipeline.StageDAG(stages)
+        self.assertEqual([s.get_name() for s in dag.get_order()],
+                         ['genes', 'tissues', 'network', 'infer'])
+        self.assertEqual(dag.get_stage('genes'), stages[1])
+        self.assertEqual(dag.get_stage('foo'), None)
+        ready = dag.get_ready_stages(set(), set())
+        self.assertEqual([s.get_name() for s in ready], ['genes', 'tissues'])
+        ready = dag.get_ready_stages({'genes'}, {'genes', 'tissues'})
+        self.assertEqual(ready, [])
+        ready = dag.get_ready_stages({'genes', 'tissues'},
+                                     {'genes', 'tissues'})
+        self.assertEqual([s.get_name() for s in ready], ['network'])
+
+        try:
+            pipeline.StageDAG([PipelineStage('a', noop, requires=['b'])])
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Stage a requires unknown stage b')
+        try:
+            pipeline.StageDAG([PipelineStage('a', noop, requires=['b']),
+                               PipelineStage('b', noop, requires=['a'])])
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Cycle found in stages: a, b')
+
+    def test_diseasescopepipeline_run_overlaps_independent_stages(self):
+        barrier = threading.Barrier(2, timeout=10)
+
+        def run_genes(scope, task):
+            # only passes if tissues runs at the same time
+            barrier.wait()
+            scope.genes = ['a', 'b']
+
+        def run_tissues(scope, task):
+            barrier.wait()
+            scope.tissues = ['liver']
+
+        def run_network(scope, task):
+            scope.network = scope.genes + scope.tissues
+
+        stages = [PipelineStage('genes', run_genes),
+                  PipelineStage('tissues', run_tissues),
+                  PipelineStage('network', run_network,
+                                requires=['genes', 'tissues'])]
+        monitor = TaskMonitor()
+        pline = DiseaseScopePipeline(lambda t: FakeScope(), stages=stages,
+                                     max_workers=2)
+        scope = pline.run(self._get_task(), monitor=monitor)
+        self.assertEqual(scope.network, ['a', 'b', 'liver'])
+        self.assertEqual(monitor.get_running_stages(), {})
+
+    def test_taskmonitor_multiple_running_stages(self):
+        monitor = TaskMonitor()
+        monitor.stage_started('genes')
+        time.sleep(0.01)
+        monitor.stage_started('tissues')
+        self.assertEqual(sorted(monitor.get_running_stages().keys()),
+                         ['genes', 'tissues'])
+        self.assertEqual(monitor.get_current_stage()[0], 'genes')
+        monitor.stage_finished('genes')
+        self.assertEqual(monitor.get_current_stage()[0], 'tissues')
+
+    def test_stagepools(self):
+        pools = pipeline.StagePools(io_workers=1, cpu_workers=2,
+                                    queue_size=1)
+        try:
+            self.assertEqual(pools.get_workers(pipeline.IO_STAGE), 1)
+            self.assertEqual(pools.get_workers(pipeline.CPU_STAGE), 2)
+            release = threading.Event()
+            f1 = pools.submit(pipeline.IO_STAGE, release.wait, 10)
+            f2 = pools.submit(pipeline.IO_STAGE, lambda: 'two')
+            self.assertEqual(pools.get_pending(pipeline.IO_STAGE), 2)
+
+            # io pool and its queue are full so next submit waits
+            submitted = threading.Event()
+
+            def submit_third():
+                pools.submit(pipeline.IO_STAGE, lambda: 'three')
+                submitted.set()
+            t = threading.Thread(target=submit_third)
+            t.start()
+            self.assertFalse(submitted.wait(0.1))
+
+            # cpu pool is independent of io pool
+            f4 = pools.submit(pipeline.CPU_STAGE, lambda: 'four')
+            self.assertEqual(f4.result(timeout=10), 'four')
+
+            release.set()
+            self.assertTrue(f1.result(timeout=10))
+            self.assertEqual(f2.result(timeout=10), 'two')
+            self.assertTrue(submitted.wait(10))
+            t.join()
+        finally:
+            pools.shutdown()
+        self.assertEqual(pools.get_pending(pipeline.IO_STAGE), 0)
+        try:
+            pools.submit(pipeline.IO_STAGE, lambda: 'late')
+            self.fail('Expected RuntimeError')
+        except RuntimeError:
+            pass
+
+    def test_stagepools_abandon(self):
+        pools = pipeline.StagePools(io_workers=1, cpu_workers=1,
+                                    queue_size=1)
+        release = threading.Event()
+        try:
+            f1 = pools.submit(pipeline.IO_STAGE, release.wait, 10)
+            f2 = pools.submit(pipeline.IO_STAGE, lambda: 'two')
+            self.assertFalse(f2.done())
+
+            # waiting stage is cancelled, running one frees its thread
+            pools.abandon(f2)
+            self.assertTrue(f2.cancelled())
+            pools.abandon(f1)
+            pools.abandon(f1)
+            self.assertEqual(pools.get_abandoned(pipeline.IO_STAGE), 1)
+            f3 = pools.submit(pipeline.IO_STAGE, lambda: 'three')
+            self.assertEqual(f3.result(timeout=10), 'three')
+            pools.abandon(f3)
+            self.assertEqual(pools.get_abandoned(pipeline.IO_STAGE), 1)
+
+            release.set()
+            self.assertTrue(f1.result(timeout=10))
+        finally:
+            release.set()
+            pools.shutdown()
+        self.assertEqual(pools.get_abandoned(pipeline.IO_STAGE), 0)
+        self.assertEqual(pools.get_pending(pipeline.IO_STAGE), 0)
+
+    def test_stagepools_max_abandoned(self):
+        pools = pipeline.StagePools(io_workers=1, cpu_workers=1,
+                                    max_abandoned=1)
+        self.assertEqual(pools.get_max_abandoned(), 1)
+        self.assertEqual(pipeline.StagePools().get_max_abandoned(),
+                         pipeline.DEFAULT_MAX_ABANDONED)
+        release = threading.Event()
+        try:
+            f1 = pools.submit(pipeline.IO_STAGE, release.wait, 10)
+            while not f1.running():
+                time.sleep(0.01)
+            self.assertFalse(pools.is_exhausted())
+            pools.abandon(f1)
+            self.assertTrue(pools.is_exhausted())
+            self.assertTrue(pools.is_exhausted(pipeline.IO_STAGE))
+            self.assertFalse(pools.is_exhausted(pipeline.CPU_STAGE))
+            try:
+                pools.submit(pipeline.IO_STAGE, lambda: 'two')
+                self.fail('Expected StagePoolExhaustedError')
+            except pipeline.StagePoolExhaustedError as e:
+                self.assertEqual(str(e), 'io pool has 1 abandoned stages '
+                                         'still running')
+            f3 = pools.submit(pipeline.CPU_STAGE, lambda: 'three')
+            self.assertEqual(f3.result(timeout=10), 'three')
+
+            # abandoned stage returning frees the pool
+            release.set()
+            self.assertTrue(f1.result(timeout=10))
+            timeout = time.time() + 10
+            while pools.is_exhausted() and time.time() < timeout:
+                time.sleep(0.01)
+            f4 = pools.submit(pipeline.IO_STAGE, lambda: 'four')
+            self.assertEqual(f4.result(timeout=10), 'four')
+        finally:
+            release.set()
+            pools.shutdown()
+
+        pools = pipeline.StagePools(max_abandoned=None)
+        self.assertFalse(pools.is_exhausted())
+
+    def test_diseasescopepipeline_run_on_shared_pools(self):
+        kinds = {}
+
+        def run_genes(scope, task):
+            kinds['genes'] = threading.current_thread().name
+            scope.genes = ['a']
+
+        def run_network(scope, task):
+            kinds['network'] = threading.current_thread().name
+            scope.network = list(scope.genes)
+
+        stages = [PipelineStage('genes', run_genes),
+                  PipelineStage('network', run_network, requires=['genes'],
+                                kind=pipeline.CPU_STAGE)]
+        self.assertEqual(stages[0].get_kind(), pipeline.IO_STAGE)
+        pools = pipeline.StagePools(io_workers=1, cpu_workers=1)
+        try:
+            pline = DiseaseScopePipeline(lambda t: FakeScope(),
+                                         stages=stages, pools=pools)
+            scope = pline.run(self._get_task())
+            self.assertEqual(scope.network, ['a'])
+        finally:
+            pools.shutdown()
+        self.assertTrue(kinds['genes'].startswith('io-stage'))
+        self.assertTrue(kinds['network'].startswith('cpu-stage'))
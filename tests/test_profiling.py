@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `profiling` module."""
+
+import os
+import json
+import pstats
+import unittest
+import shutil
+import tempfile
+import tracemalloc
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from diseasescope_rest_server import dao
+from diseasescope_rest_server import profiling
+from diseasescope_rest_server.profiling import ProfilePolicy
+from diseasescope_rest_server.profiling import TaskProfiler
+
+
+def _allocate(size):
+    data = [0] * size
+    return len(data)
+
+
+class TestProfiling(unittest.TestCase):
+    """Tests for `profiling` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def _get_task(self, taskdict):
+        task = MagicMock()
+        task.get_taskdict = MagicMock(return_value=taskdict)
+        return task
+
+    def test_get_profile_file(self):
+        self.assertEqual(profiling.get_profile_file('get_network'),
+                         'profile.get_network.pstats')
+        self.assertTrue(profiling.is_profile_file('profile.json'))
+        self.assertTrue(profiling.is_profile_file('profile.foo.pstats'))
+        self.assertFalse(profiling.is_profile_file(dao.TASK_JSON))
+        self.assertFalse(profiling.is_profile_file('profile.x/../y.pstats'))
+
+    def test_profile_policy(self):
+        policy = ProfilePolicy()
+        self.assertFalse(policy.should_profile(self._get_task({})))
+        self.assertFalse(policy.should_profile(self._get_task(None)))
+        self.assertTrue(policy.should_profile(self._get_task(
+            {dao.PROFILE_PARAM: True})))
+        self.assertFalse(policy.should_profile(self._get_task(
+            {dao.PROFILE_PARAM: 'yes'})))
+
+        policy = ProfilePolicy(enabled=True)
+        self.assertTrue(policy.should_profile(self._get_task({})))
+
+        rand = MagicMock(side_effect=[0.05, 0.5])
+        policy = ProfilePolicy(sample_rate=0.1, random_func=rand)
+        self.assertTrue(policy.should_profile(self._get_task({})))
+        self.assertFalse(policy.should_profile(self._get_task({})))
+
+    def test_profile_and_save(self):
+        profiler = TaskProfiler(self._temp_dir, top=3)
+        self.assertEqual(profiler.get_files(),
+                         [profiling.PROFILE_SUMMARY_FILE])
+        profiler.start()
+        try:
+            self.assertTrue(tracemalloc.is_tracing())
+            self.assertEqual(profiler.profile('alloc', _allocate, 100000),
+                             100000)
+            try:
+                profiler.profile('fail', _allocate, 'x')
+                self.fail('Expected TypeError')
+            except TypeError:
+                pass
+        finally:
+            profiler.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+        profiler.save()
+
+        self.assertEqual(profiler.get_files(),
+                         ['profile.alloc.pstats', 'profile.fail.pstats',
+                          profiling.PROFILE_SUMMARY_FILE])
+        with open(os.path.join(self._temp_dir,
+                               profiling.PROFILE_SUMMARY_FILE), 'r') as f:
+            summary = json.load(f)
+        self.assertEqual(sorted(summary.keys()), ['alloc', 'fail'])
+        entry = summary['alloc']
+        self.assertEqual(entry[profiling.PROFILE_FILE_KEY],
+                         'profile.alloc.pstats')
+        self.assertTrue(entry[profiling.PEAK_MEMORY_KEY] >= 100000 * 8)
+        self.assertTrue(entry[profiling.WALL_TIME_KEY] >= 0)
+        self.assertTrue(entry[profiling.CPU_TIME_KEY] >= 0)
+        self.assertTrue(len(entry[profiling.TOP_FUNCTIONS_KEY]) <= 3)
+        self.assertTrue('_allocate' in
+                        entry[profiling.TOP_FUNCTIONS_KEY][0]['function'])
+        stats = pstats.Stats(os.path.join(self._temp_dir,
+                                          'profile.alloc.pstats'))
+        self.assertTrue(any(key[2] == '_allocate'
+                            for key in stats.stats.keys()))
+
+    def test_profile_without_tracing(self):
+        profiler = TaskProfiler(self._temp_dir)
+        profiler.profile('alloc', _allocate, 10)
+        self.assertIsNone(
+            profiler.get_stages()['alloc'][profiling.PEAK_MEMORY_KEY])
+
+    def test_tracing_shared_by_profilers(self):
+        first = TaskProfiler(self._temp_dir)
+        second = TaskProfiler(self._temp_dir)
+        first.start()
+        first.start()
+        second.start()
+        first.stop()
+        self.assertTrue(tracemalloc.is_tracing())
+        second.stop()
+        second.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_profile_unwritable_dir(self):
+        profiler = TaskProfiler(os.path.join(self._temp_dir, 'nope'))
+        profiler.profile('alloc', _allocate, 10)
+        self.assertIsNone(
+            profiler.get_stages()['alloc'][profiling.PROFILE_FILE_KEY])
+        self.assertEqual(profiler.get_files(),
+                         [profiling.PROFILE_SUMMARY_FILE])
+
+    def test_profile_when_other_profiler_active(self):
+        # python 3.12 and later raise ValueError if another
+        # profiler is active in the process
+        prof = MagicMock()
+        prof.enable = MagicMock(side_effect=ValueError('Another profiling '
+                                                       'tool is already '
+                                                       'active'))
+        profiler = TaskProfiler(self._temp_dir)
+        with patch('diseasescope_rest_server.profiling.cProfile.Profile',
+                   return_value=prof):
+            self.assertEqual(profiler.profile('alloc', _allocate, 10), 10)
+        prof.disable.assert_not_called()
+        entry = profiler.get_stages()['alloc']
+        self.assertIsNone(entry[profiling.PROFILE_FILE_KEY])
+        self.assertEqual(entry[profiling.TOP_FUNCTIONS_KEY], [])
+        self.assertTrue(entry[profiling.WALL_TIME_KEY] >= 0)
+        self.assertEqual(profiler.get_files(),
+                         [profiling.PROFILE_SUMMARY_FILE])
+        profiler.save()
+
+    def test_profile_stage_finished_after_stop(self):
+        profiler = TaskProfiler(self._temp_dir)
+        profiler.start()
+        profiler.stop()
+        self.assertEqual(profiler.profile('alloc', _allocate, 10), 10)
+        self.assertEqual(profiler.get_stages(), {})
+        self.assertFalse(os.path.isfile(os.path.join(
+            self._temp_dir, profiling.get_profile_file('alloc'))))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `refdata` module."""
+
+import os
+import time
+import types
+import unittest
+import shutil
+import tempfile
+
+import pandas as pd
+
+from diseasescope_rest_server import refdata
+from diseasescope_rest_server.refdata import ReferenceData
+from diseasescope_rest_server.refdata import ReferencePandas
+
+
+class TestRefdata(unittest.TestCase):
+    """Tests for `refdata` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+        self._mapfile = os.path.join(self._temp_dir, 'doid.tsv')
+        with open(self._mapfile, 'w') as f:
+            f.write('doid\tname\n1816\tcancer\n2841\tasthma\n')
+        self._otherfile = os.path.join(self._temp_dir, 'other.tsv')
+        with open(self._otherfile, 'w') as f:
+            f.write('a\tb\n1\t2\n')
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_is_reference_file(self):
+        ref = ReferenceData([self._mapfile, None])
+        self.assertEqual(ref.get_files(), [self._mapfile])
+        self.assertTrue(ref.is_reference_file(self._mapfile))
+        self.assertTrue(ref.is_reference_file(self._mapfile.encode()))
+        self.assertFalse(ref.is_reference_file(self._otherfile))
+        self.assertFalse(ref.is_reference_file(None))
+
+    def test_load_missing_file(self):
+        ref = ReferenceData([os.path.join(self._temp_dir, 'nope')])
+        self.assertRaises(OSError, ref.load)
+
+    def test_open(self):
+        ref = ReferenceData([self._mapfile])
+        ref.load()
+        # same size and modification time so contents in memory are used
+        stat = os.stat(self._mapfile)
+        with open(self._mapfile, 'r+') as f:
+            f.write('DOID')
+        os.utime(self._mapfile, (stat.st_atime, stat.st_mtime))
+        with ref.open(self._mapfile) as f:
+            self.assertEqual(f.readline(), 'doid\tname\n')
+        with ref.open(self._mapfile, 'rb') as f:
+            self.assertEqual(f.read(4), b'doid')
+        with ref.open(self._otherfile) as f:
+            self.assertEqual(f.readline(), 'a\tb\n')
+        newfile = os.path.join(self._temp_dir, 'new')
+        with ref.open(newfile, 'w') as f:
+            f.write('hi')
+        self.assertTrue(os.path.isfile(newfile))
+
+    def test_read_table(self):
+        ref = ReferenceData([self._mapfile])
+        df = ref.read_table(pd, 'read_csv', self._mapfile, sep='\t')
+        self.assertEqual(list(df['name']), ['cancer', 'asthma'])
+        df['name'] = 'changed'
+        df = ref.read_table(pd, 'read_csv', self._mapfile, sep='\t')
+        self.assertEqual(list(df['name']), ['cancer', 'asthma'])
+        self.assertEqual(ref.get_parse_count(), 1)
+
+        # other arguments parse again
+        df = ref.read_table(pd, 'read_csv', self._mapfile)
+        self.assertEqual(len(df.columns), 1)
+        self.assertEqual(ref.get_parse_count(), 2)
+
+        # changed file is read again
+        mtime = time.time() + 10
+        with open(self._mapfile, 'w') as f:
+            f.write('doid\tname\n1\tx\n')
+        os.utime(self._mapfile, (mtime, mtime))
+        df = ref.read_table(pd, 'read_csv', self._mapfile, sep='\t')
+        self.assertEqual(list(df['name']), ['x'])
+        self.assertEqual(ref.get_parse_count(), 3)
+
+        # other files are not memoized
+        df = ref.read_table(pd, 'read_table', self._otherfile)
+        self.assertEqual(list(df['b']), [2])
+        self.assertEqual(ref.get_parse_count(), 3)
+
+    def test_route_module_reference_data(self):
+        ref = ReferenceData([self._mapfile])
+        module = types.ModuleType('fakelib')
+        module.pd = pd
+        refdata.route_module_reference_data(module, ref)
+        refdata.route_module_reference_data(module, ref)
+        self.assertTrue(isinstance(module.pd, ReferencePandas))
+        self.assertTrue(module.pd.get_pandas() is pd)
+        self.assertTrue(module.pd.DataFrame is pd.DataFrame)
+        self.assertFalse(hasattr(module, 'pandas'))
+        self.assertEqual(module.open, ref.open)
+
+        for x in range(3):
+            df = module.pd.read_csv(self._mapfile, sep='\t')
+            self.assertEqual(list(df['doid']), [1816, 2841])
+        self.assertEqual(ref.get_parse_count(), 1)
+        self.assertTrue(pd.read_csv is not module.pd.read_csv)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `scratch` module."""
+
+import os
+import unittest
+import shutil
+import tempfile
+
+from diseasescope_rest_server import scratch
+from diseasescope_rest_server.scratch import ScratchSpace
+
+
+class TestScratch(unittest.TestCase):
+    """Tests for `scratch` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_is_process_alive(self):
+        self.assertTrue(scratch.is_process_alive(os.getpid()))
+        self.assertFalse(scratch.is_process_alive(999999999))
+
+    def test_create_copy_and_remove(self):
+        space = ScratchSpace(self._temp_dir, pid=5)
+        self.assertEqual(space.get_runner_dir(),
+                         os.path.join(self._temp_dir,
+                                      scratch.RUNNER_DIR_PREFIX + '5'))
+        path = space.create('task1')
+        self.assertEqual(path, space.get_task_scratchdir('task1'))
+        with open(os.path.join(path, 'out.txt'), 'w') as f:
+            f.write('hi')
+        with open(os.path.join(path, 'tmp.txt'), 'w') as f:
+            f.write('tmp')
+
+        # creating again gives an empty directory
+        space.create('task1')
+        self.assertEqual(os.listdir(path), [])
+        with open(os.path.join(path, 'out.txt'), 'w') as f:
+            f.write('hi')
+
+        destdir = os.path.join(self._temp_dir, 'dest')
+        self.assertEqual(space.copy_artifacts('task1', destdir,
+                                              ['out.txt']), [])
+        os.mkdir(destdir)
+        self.assertEqual(space.copy_artifacts('task1', destdir,
+                                              ['out.txt', 'nope.txt']),
+                         ['out.txt'])
+        self.assertEqual(os.listdir(destdir), ['out.txt'])
+
+        space.remove('task1')
+        self.assertFalse(os.path.isdir(path))
+        self.assertTrue(os.path.isdir(space.get_runner_dir()))
+        space.remove_all()
+        self.assertFalse(os.path.isdir(space.get_runner_dir()))
+
+    def test_remove_stale(self):
+        space = ScratchSpace(os.path.join(self._temp_dir, 'notthere'))
+        self.assertEqual(space.remove_stale(), [])
+
+        space = ScratchSpace(self._temp_dir)
+        space.create('task1')
+        alive = ScratchSpace(self._temp_dir, pid=1)
+        alive.create('task2')
+        dead = ScratchSpace(self._temp_dir, pid=999999999)
+        dead.create('task3')
+        os.mkdir(os.path.join(self._temp_dir,
+                              scratch.RUNNER_DIR_PREFIX + 'foo'))
+        os.mkdir(os.path.join(self._temp_dir, 'other'))
+        self.assertEqual(space.remove_stale(), [dead.get_runner_dir()])
+        self.assertEqual(sorted(os.listdir(self._temp_dir)),
+                         sorted([os.path.basename(space.get_runner_dir()),
+                                 scratch.RUNNER_DIR_PREFIX + '1',
+                                 scratch.RUNNER_DIR_PREFIX + 'foo',
+                                 'other']))
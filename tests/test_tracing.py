@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tracing` module."""
+
+import os
+import json
+import unittest
+import shutil
+import tempfile
+import threading
+from unittest.mock import MagicMock
+
+from diseasescope_rest_server import tracing
+from diseasescope_rest_server.tracing import Tracer
+from diseasescope_rest_server.tracing import FileSpanExporter
+from diseasescope_rest_server.tracing import ZipkinSpanExporter
+
+
+class ListExporter(object):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+    def shutdown(self):
+        pass
+
+
+class TestTracing(unittest.TestCase):
+    """Tests for `tracing` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_new_ids(self):
+        self.assertEqual(len(tracing.new_trace_id()), 32)
+        self.assertEqual(len(tracing.new_span_id()), 16)
+        self.assertNotEqual(tracing.new_trace_id(), tracing.new_trace_id())
+
+    def test_get_trace_id_from_headers(self):
+        tid = '4bf92f3577b34da6a3ce929d0e0e4736'
+        self.assertEqual(tracing.get_trace_id_from_headers(
+            {tracing.TRACEPARENT_HEADER:
+             '00-' + tid + '-00f067aa0ba902b7-01'}), tid)
+        self.assertEqual(tracing.get_trace_id_from_headers(
+            {tracing.TRACE_ID_HEADER: tid.upper()}), tid)
+        self.assertEqual(tracing.get_trace_id_from_headers(
+            {tracing.TRACE_ID_HEADER: '4bf92f35-77b3-4da6-a3ce-929d0e0e4736'}),
+            tid)
+
+        # invalid headers get a new trace id
+        for headers in [{},
+                        {tracing.TRACEPARENT_HEADER: 'garbage'},
+                        {tracing.TRACEPARENT_HEADER:
+                         '00-' + '0' * 32 + '-00f067aa0ba902b7-01'},
+                        {tracing.TRACE_ID_HEADER: 'xyz'}]:
+            res = tracing.get_trace_id_from_headers(headers)
+            self.assertEqual(len(res), 32)
+            self.assertNotEqual(res, tid)
+
+    def test_use_span(self):
+        self.assertIsNone(tracing.get_current_span())
+        span = MagicMock()
+        seen = []
+        with tracing.use_span(span):
+            self.assertEqual(tracing.get_current_span(), span)
+            with tracing.use_span(None):
+                self.assertIsNone(tracing.get_current_span())
+            # other threads do not see span
+            thread = threading.Thread(
+                target=lambda: seen.append(tracing.get_current_span()))
+            thread.start()
+            thread.join()
+            self.assertEqual(tracing.get_current_span(), span)
+        self.assertIsNone(tracing.get_current_span())
+        self.assertEqual(seen, [None])
+
+    def test_spans(self):
+        exporter = ListExporter()
+        tracer = Tracer(exporter, service_name='foo')
+        self.assertEqual(tracer.get_service_name(), 'foo')
+        tid = tracing.new_trace_id()
+        root = tracer.start_span('task', tid, start=10.0,
+                                 tags={'doid': 1})
+        self.assertEqual(root.get_trace_id(), tid)
+        self.assertEqual(root.get_tags(), {'doid': '1'})
+        child = root.start_child('GET foo', start=11.0,
+                                 kind=tracing.CLIENT_KIND)
+        self.assertEqual(child.get_traceparent(),
+                         '00-' + tid + '-' + child.get_span_id() + '-01')
+        child.finish(end=11.5)
+        child.finish(end=20)
+        root.finish(end=12.0)
+        self.assertEqual(exporter.spans, [
+            {'traceId': tid, 'id': child.get_span_id(),
+             'parentId': root.get_span_id(), 'name': 'GET foo',
+             'kind': tracing.CLIENT_KIND, 'timestamp': 11000000,
+             'duration': 500000, 'localEndpoint': {'serviceName': 'foo'},
+             'tags': {}},
+            {'traceId': tid, 'id': root.get_span_id(), 'name': 'task',
+             'timestamp': 10000000, 'duration': 2000000,
+             'localEndpoint': {'serviceName': 'foo'},
+             'tags': {'doid': '1'}}])
+
+    def test_tracer_export_error(self):
+        exporter = MagicMock()
+        exporter.export = MagicMock(side_effect=Exception('full'))
+        tracer = Tracer(exporter)
+        tracer.start_span('task', tracing.new_trace_id()).finish()
+        tracer.shutdown()
+        exporter.shutdown.assert_called_once_with()
+
+    def test_file_span_exporter(self):
+        path = os.path.join(self._temp_dir, 'spans.json')
+        tracer = Tracer(FileSpanExporter(path))
+        tid = tracing.new_trace_id()
+        tracer.start_span('a', tid).finish()
+        tracer.start_span('b', tid).finish()
+        tracer.shutdown()
+        with open(path, 'r') as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual([s['name'] for s in spans], ['a', 'b'])
+        self.assertEqual(spans[0]['localEndpoint']['serviceName'],
+                         tracing.DEFAULT_SERVICE_NAME)
+
+    def test_zipkin_span_exporter(self):
+        session = MagicMock()
+        session.post = MagicMock(side_effect=[Exception('down'),
+                                              MagicMock(status_code=500),
+                                              MagicMock(status_code=202)])
+        exporter = ZipkinSpanExporter('http://zipkin/api/v2/spans',
+                                      max_queue=2, session=session)
+        self.assertEqual(exporter.flush(), 0)
+        exporter.export([{'id': '1'}, {'id': '2'}, {'id': '3'}])
+        self.assertEqual(exporter.get_dropped_count(), 1)
+        self.assertEqual(exporter.flush(), 0)
+        self.assertEqual(exporter.flush(), 0)
+        self.assertEqual(exporter.flush(), 2)
+        session.post.assert_called_with('http://zipkin/api/v2/spans',
+                                        json=[{'id': '1'}, {'id': '2'}],
+                                        timeout=10)
+        self.assertEqual(exporter.flush(), 0)
+
+    def test_zipkin_span_exporter_thread(self):
+        session = MagicMock()
+        session.post = MagicMock(return_value=MagicMock(status_code=202))
+        exporter = ZipkinSpanExporter('http://zipkin/api/v2/spans',
+                                      interval=3600, session=session)
+        exporter.start()
+        exporter.export([{'id': '1'}])
+        exporter.shutdown()
+        session.post.assert_called_once_with('http://zipkin/api/v2/spans',
+                                             json=[{'id': '1'}],
+                                             timeout=10)